@@ -23,11 +23,16 @@ THE SOFTWARE.
 """
 
 from boxtree.tree import Tree, TreeWithLinkedPointSources, box_flags_enum
-from boxtree.tree_build import TreeBuilder
+from boxtree.tree_build import (
+        TreeBuilder, TreeBuildWorkspace, StickyBoundingBox)
+from boxtree.tree_update import TreeUpdater, LooseTreeUpdater
+from boxtree.tree_build_chunked import ChunkedTreeBuilder
 
 __all__ = [
     "Tree", "TreeWithLinkedPointSources",
-    "TreeBuilder", "box_flags_enum"]
+    "TreeBuilder", "TreeBuildWorkspace", "StickyBoundingBox",
+    "TreeUpdater", "LooseTreeUpdater", "ChunkedTreeBuilder",
+    "box_flags_enum"]
 
 __doc__ = """
 :mod:`boxtree` can do three main things:
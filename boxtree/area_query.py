@@ -28,8 +28,8 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.array  # noqa
 from mako.template import Template
-from boxtree.tools import AXIS_NAMES, DeviceDataRecord
-from pytools import memoize_method
+from boxtree.tools import (
+        AXIS_NAMES, DeviceDataRecord, memoize_method_in_context)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -53,6 +53,18 @@ Area queries are implemented using peer lists.
 
 .. autoclass:: PeerListLookup
 
+Point location (Points -> containing leaves)
+--------------------------------------------
+
+.. autoclass:: PointLocator
+
+k nearest neighbors
+-------------------
+
+.. autoclass:: KNNBuilder
+
+.. autoclass:: KNNResult
+
 """
 
 
@@ -72,6 +84,12 @@ class PeerListLookup(DeviceDataRecord):
 
     .. attribute:: peer_lists
 
+    .. attribute:: peer_list_images
+
+        If :attr:`boxtree.Tree.is_periodic`, the image of each entry of
+        :attr:`peer_lists`, an index into :attr:`boxtree.Tree.image_offsets`.
+        Otherwise *None*.
+
     .. automethod:: get
 
     .. versionadded:: 2016.1
@@ -93,6 +111,31 @@ class AreaQueryResult(DeviceDataRecord):
 
     .. attribute:: leaves_near_ball_lists
 
+    .. attribute:: leaves_near_ball_images
+
+        If :attr:`boxtree.Tree.is_periodic`, the image of each entry of
+        :attr:`leaves_near_ball_lists` that overlaps the ball, an index into
+        :attr:`boxtree.Tree.image_offsets`. Otherwise *None*.
+
+    .. attribute:: particles_in_ball_starts
+
+        If particles were requested from :class:`AreaQueryBuilder`, indices
+        into :attr:`particles_in_ball_lists`, analogous to
+        :attr:`leaves_near_ball_starts`. Otherwise *None*.
+
+    .. attribute:: particles_in_ball_lists
+
+        If particles were requested from :class:`AreaQueryBuilder`, the
+        numbers of the sources or targets inside each ball, in the requested
+        order. Otherwise *None*.
+
+    .. attribute:: particles_in_ball_images
+
+        If particles were requested and :attr:`boxtree.Tree.is_periodic`,
+        the image of each entry of :attr:`particles_in_ball_lists` that is
+        inside the ball, an index into :attr:`boxtree.Tree.image_offsets`.
+        Otherwise *None*.
+
     .. automethod:: get
 
     .. versionadded:: 2016.1
@@ -111,11 +154,48 @@ typedef ${dtype_to_ctype(peer_list_idx_dtype)} peer_list_idx_t;
         bool is_overlapping;
 
         ${check_l_infty_ball_overlap(
-            "is_overlapping", box_id, "ball_radius", "ball_center")}
+            "is_overlapping", box_id, "ball_radius", "image_ball_center")}
 
         if (is_overlapping)
         {
-            APPEND_leaves(${box_id});
+            ${append_with_image("leaves", box_id, "image")}
+            %if particle_kind is not None:
+                ${add_particles_in_ball_to_list(box_id)}
+            %endif
+        }
+    }
+</%def>
+
+<%def name="add_particles_in_ball_to_list(box_id)">
+    particle_id_t particle_start = box_particle_starts[${box_id}];
+    particle_id_t particle_end = particle_start
+        + box_particle_counts_nonchild[${box_id}];
+
+    for (particle_id_t particle_nr = particle_start;
+        particle_nr < particle_end; ++particle_nr)
+    {
+        coord_t dist = 0;
+        %for i in range(dimensions):
+            {
+                coord_t axis_dist = particle_${AXIS_NAMES[i]}[particle_nr]
+                    - image_ball_center.s${i};
+                %if ball_norm == "linf":
+                    dist = fmax(dist, fabs(axis_dist));
+                %elif ball_norm == "l2":
+                    dist += axis_dist * axis_dist;
+                %endif
+            }
+        %endfor
+
+        %if ball_norm == "linf":
+            bool in_ball = dist <= ball_radius;
+        %elif ball_norm == "l2":
+            bool in_ball = dist <= ball_radius * ball_radius;
+        %endif
+
+        if (in_ball)
+        {
+            ${append_with_image("particles", "particle_nr", "image")}
         }
     }
 </%def>
@@ -206,6 +286,15 @@ void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t ball_nr)
     {
         box_id_t peer_box = peer_lists[pb_i];
 
+        // Leaves in the peer's image of the tree overlap the ball if their
+        // untranslated versions overlap the ball moved the opposite way.
+        %if periodic:
+            int image = peer_list_images[pb_i];
+        %else:
+            const int image = IDENTITY_IMAGE;
+        %endif
+        ${image_frame_center("image_ball_center", "ball_center", "image")}
+
         if (!(box_flags[peer_box] & BOX_HAS_CHILDREN))
         {
             ${add_box_to_list_if_overlaps_ball("peer_box")}
@@ -241,91 +330,6 @@ void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t ball_nr)
 }
 """
 
-PEER_LIST_FINDER_TEMPLATE = r"""//CL//
-
-void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
-{
-    ${load_center("center", "box_id")}
-
-    if (box_id == 0)
-    {
-        // Peer of root = self
-        APPEND_peers(box_id);
-        return;
-    }
-
-    int level = box_levels[box_id];
-
-    // To find this box's peers, start at the top of the tree, descend
-    // into adjacent (or overlapping) parents.
-    ${walk_init(0)}
-
-    while (continue_walk)
-    {
-        box_id_t child_box_id = box_child_ids[
-                walk_morton_nr * aligned_nboxes + walk_box_id];
-
-        if (child_box_id)
-        {
-            ${load_center("child_center", "child_box_id")}
-
-            // child_box_id lives on walk_level+1.
-            bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                center, level, child_center, walk_level+1, false);
-
-            if (a_or_o)
-            {
-                // child_box_id lives on walk_level+1.
-                if (walk_level+1 == level)
-                {
-                    APPEND_peers(child_box_id);
-                }
-                else if (!(box_flags[child_box_id] & BOX_HAS_CHILDREN))
-                {
-                    APPEND_peers(child_box_id);
-                }
-                else
-                {
-                    // Check if any children are adjacent or overlapping.
-                    // If not, this box must be a peer.
-                    bool must_be_peer = true;
-
-                    for (int morton_nr = 0;
-                         must_be_peer && morton_nr < ${2**dimensions};
-                         ++morton_nr)
-                    {
-                        box_id_t next_child_id = box_child_ids[
-                            morton_nr * aligned_nboxes + child_box_id];
-                        if (next_child_id)
-                        {
-                            ${load_center("next_child_center", "next_child_id")}
-                            must_be_peer &= !is_adjacent_or_overlapping(root_extent,
-                                center, level, next_child_center, walk_level+2,
-                                false);
-                        }
-                    }
-
-                    if (must_be_peer)
-                    {
-                        APPEND_peers(child_box_id);
-                    }
-                    else
-                    {
-                        // We want to descend into this box. Put the current state
-                        // on the stack.
-                        ${walk_push("child_box_id")}
-                        continue;
-                    }
-                }
-            }
-        }
-
-        ${walk_advance()}
-    }
-}
-
-"""
-
 # }}}
 
 
@@ -345,9 +349,11 @@ class AreaQueryBuilder(object):
 
     # {{{ Kernel generation
 
-    @memoize_method
+    @memoize_method_in_context
     def get_area_query_kernel(self, dimensions, coord_dtype, box_id_dtype,
-                              ball_id_dtype, peer_list_idx_dtype, max_levels):
+                              ball_id_dtype, peer_list_idx_dtype, max_levels,
+                              periodic=False, particle_kind=None,
+                              particle_id_dtype=None, ball_norm="linf"):
         from pyopencl.tools import dtype_to_ctype
         from boxtree import box_flags_enum
 
@@ -364,7 +370,7 @@ class AreaQueryBuilder(object):
             dimensions=dimensions,
             dtype_to_ctype=dtype_to_ctype,
             box_id_dtype=box_id_dtype,
-            particle_id_dtype=None,
+            particle_id_dtype=particle_id_dtype,
             coord_dtype=coord_dtype,
             vec_types=cl.array.vec.types,
             max_levels=max_levels,
@@ -373,6 +379,9 @@ class AreaQueryBuilder(object):
             peer_list_idx_dtype=peer_list_idx_dtype,
             ball_id_dtype=ball_id_dtype,
             debug=False,
+            periodic=periodic,
+            particle_kind=particle_kind,
+            ball_norm=ball_norm,
             # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
             stick_out_factor=0)
 
@@ -386,19 +395,42 @@ class AreaQueryBuilder(object):
             VectorArg(box_flags_enum.dtype, "box_flags"),
             VectorArg(peer_list_idx_dtype, "peer_list_starts"),
             VectorArg(box_id_dtype, "peer_lists"),
+            ] + ([VectorArg(np.int8, "peer_list_images")] if periodic else []) + [
             VectorArg(coord_dtype, "ball_radii"),
             ] + [
             VectorArg(coord_dtype, "ball_"+ax)
             for ax in AXIS_NAMES[:dimensions]]
 
-        from pyopencl.algorithm import ListOfListsBuilder
+        list_names = ["leaves"]
+        lists = [("leaves", box_id_dtype)]
+
+        if particle_kind is not None:
+            arg_decls += [
+                VectorArg(particle_id_dtype, "box_particle_starts"),
+                VectorArg(particle_id_dtype, "box_particle_counts_nonchild"),
+                ] + [
+                VectorArg(coord_dtype, "particle_"+ax)
+                for ax in AXIS_NAMES[:dimensions]]
+
+            list_names.append("particles")
+            lists.append(("particles", particle_id_dtype))
+
+        count_sharing = {}
+        if periodic:
+            # /!\ This makes a promise that APPEND_*_images will
+            # always occur *after* the corresponding APPEND_*.
+            for list_name in list_names:
+                lists.append((list_name+"_images", np.int8))
+                count_sharing[list_name+"_images"] = list_name
+
+        from boxtree.tools import ListOfListsBuilder
         area_query_kernel = ListOfListsBuilder(
             self.context,
-            [("leaves", box_id_dtype)],
+            lists,
             str(template.render(**render_vars)),
             arg_decls=arg_decls,
             name_prefix="area_query",
-            count_sharing={},
+            count_sharing=count_sharing,
             complex_kernel=True)
 
         logger.info("done building area query kernel")
@@ -407,7 +439,8 @@ class AreaQueryBuilder(object):
     # }}}
 
     def __call__(self, queue, tree, ball_centers, ball_radii, peer_lists=None,
-                 wait_for=None):
+                 wait_for=None, profiler=None, particles=None, ball_norm="linf",
+                 particle_order="tree"):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -420,11 +453,29 @@ class AreaQueryBuilder(object):
             of positive numbers.
             Its *dtype* must match *tree*'s
             :attr:`boxtree.Tree.coord_dtype`.
+            If *tree* is periodic (see :attr:`boxtree.Tree.is_periodic`),
+            the ball centers must lie in the root box, and the radii must
+            not exceed :attr:`boxtree.Tree.root_extent`. Balls then also
+            overlap leaves in the images of the root box.
         :arg peer_lists: may either be *None* or an instance of
             :class:`PeerListLookup` associated with `tree`.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the query (and the peer list build, if needed) is
+            recorded.
+        :arg particles: may either be *None*, ``"sources"`` or ``"targets"``.
+            If not *None*, also find the sources or targets inside each ball,
+            in the same pass as the leaves, see
+            :attr:`AreaQueryResult.particles_in_ball_lists`. This requires
+            that the particles of *tree* have no extent.
+        :arg ball_norm: ``"linf"`` or ``"l2"``, the norm in which particles
+            must be within the ball radius of its center.
+            (Leaves are always found in the ``"linf"`` norm.)
+        :arg particle_order: ``"tree"`` or ``"user"``, whether to return
+            particle numbers in tree or user order (see
+            :ref:`particle-orderings`).
         :returns: a tuple *(aq, event)*, where *lbl* is an instance of
             :class:`AreaQueryResult`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -443,34 +494,99 @@ class AreaQueryBuilder(object):
         max_levels = div_ceil(tree.nlevels, 10) * 10
 
         if peer_lists is None:
-            peer_lists, evt = self.peer_list_finder(queue, tree, wait_for=wait_for)
+            peer_lists, evt = self.peer_list_finder(queue, tree,
+                    wait_for=wait_for, profiler=profiler)
             wait_for = [evt]
 
         if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
             raise ValueError("size of peer lists must match with number of boxes")
 
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
+        if particles is None:
+            particle_args = ()
+        elif particles in ["sources", "targets"]:
+            if getattr(tree, particles+"_have_extent"):
+                raise ValueError("finding %s in balls is not supported "
+                        "for trees with %s that have extent"
+                        % (particles, particles))
+
+            particle_args = (
+                    getattr(tree, "box_%s_starts" % particles[:-1]).data,
+                    getattr(tree, "box_%s_counts_nonchild" % particles[:-1])
+                    .data,
+                    ) + tuple(
+                            coord.data for coord in getattr(tree, particles))
+        else:
+            raise ValueError("unknown value of 'particles': %s" % particles)
+
+        if ball_norm not in ["linf", "l2"]:
+            raise ValueError("unknown value of 'ball_norm': %s" % ball_norm)
+        if particle_order not in ["tree", "user"]:
+            raise ValueError(
+                    "unknown value of 'particle_order': %s" % particle_order)
+
         area_query_kernel = self.get_area_query_kernel(tree.dimensions,
             tree.coord_dtype, tree.box_id_dtype, ball_id_dtype,
-            peer_lists.peer_list_starts.dtype, max_levels)
+            peer_lists.peer_list_starts.dtype, max_levels, periodic,
+            particles, tree.particle_id_dtype, ball_norm)
 
         logger.info("area query: run area query")
 
-        result, evt = area_query_kernel(
-                queue, len(ball_radii),
-                tree.box_centers.data, tree.root_extent,
-                tree.box_levels.data, tree.aligned_nboxes,
-                tree.box_child_ids.data, tree.box_flags.data,
-                peer_lists.peer_list_starts.data,
-                peer_lists.peer_lists.data, ball_radii.data,
-                *tuple(bc.data for bc in ball_centers),
-                wait_for=wait_for)
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "area query")
+
+        with prof.span("area query"):
+            result, evt = area_query_kernel(
+                    queue, len(ball_radii),
+                    tree.box_centers.data, tree.root_extent,
+                    tree.box_levels.data, tree.aligned_nboxes,
+                    tree.box_child_ids.data, tree.box_flags.data,
+                    peer_lists.peer_list_starts.data,
+                    peer_lists.peer_lists.data,
+                    *(((peer_lists.peer_list_images.data,) if periodic else ())
+                        + (ball_radii.data,)
+                        + tuple(bc.data for bc in ball_centers)
+                        + particle_args),
+                    index_dtype=tree.box_id_dtype, wait_for=wait_for)
+        prof.built_lists("area query", result, evt)
+
+        particles_in_ball_starts = None
+        particles_in_ball_lists = None
+        particles_in_ball_images = None
+
+        if particles is not None:
+            particles_in_ball_starts = result["particles"].starts
+            particles_in_ball_lists = result["particles"].lists
+            if periodic:
+                particles_in_ball_images = result["particles_images"].lists
+
+            if particle_order == "user":
+                if particles == "sources":
+                    user_particle_ids = tree.user_source_ids
+                else:
+                    from boxtree.tools import reverse_index_array
+                    user_particle_ids = reverse_index_array(
+                            tree.sorted_target_ids, queue=queue)
+
+                particles_in_ball_lists = cl.array.take(
+                        user_particle_ids, particles_in_ball_lists,
+                        queue=queue)
+                evt = particles_in_ball_lists.events[-1]
 
         logger.info("area query: done")
 
         return AreaQueryResult(
                 tree=tree,
                 leaves_near_ball_starts=result["leaves"].starts,
-                leaves_near_ball_lists=result["leaves"].lists).with_queue(None), evt
+                leaves_near_ball_lists=result["leaves"].lists,
+                leaves_near_ball_images=(
+                    result["leaves_images"].lists if periodic else None),
+                particles_in_ball_starts=particles_in_ball_starts,
+                particles_in_ball_lists=particles_in_ball_lists,
+                particles_in_ball_images=particles_in_ball_images,
+                ).with_queue(None), evt
 
 # }}}
 
@@ -502,100 +618,672 @@ class PeerListFinder(object):
     def __init__(self, context):
         self.context = context
 
-    # {{{ Kernel generation
+        from boxtree.traversal import _LevelByLevelListsBuilder
+        self.level_lists_builder = _LevelByLevelListsBuilder(context)
 
-    @memoize_method
-    def get_peer_list_finder_kernel(self, dimensions, coord_dtype,
-                                    box_id_dtype, max_levels):
+    def __call__(self, queue, tree, wait_for=None, profiler=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the peer list build is recorded.
+        :returns: a tuple *(pl, event)*, where *pl* is an instance of
+            :class:`PeerListLookup`, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+        """
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
+        logger.info("peer list finder: find peer lists")
+
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "peer list finder")
+
+        with prof.span("peer lists"):
+            result, evt = self.level_lists_builder(
+                    queue, tree, "peers", wait_for=wait_for)
+        prof.built_lists("peer lists", result, evt)
+
+        logger.info("peer list finder: done")
+
+        return PeerListLookup(
+                tree=tree,
+                peer_list_starts=result["peers"].starts,
+                peer_lists=result["peers"].lists,
+                peer_list_images=(
+                    result["peers_images"].lists if periodic else None),
+                ).with_queue(None), evt
+
+# }}}
+
+
+# {{{ point location
+
+POINT_LOCATOR_TEMPLATE = r"""//CL//
+    bool in_root = true;
+
+    %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+        coord_t ${ax} = point_${ax}[i];
+        in_root = in_root
+            && bbox_min_${ax} <= ${ax} && ${ax} < bbox_min_${ax} + root_extent;
+    %endfor
+
+    box_id_t box_id = in_root ? 0 : -1;
+
+    while (in_root)
+    {
+        int morton_nr = 0
+        %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+            | ((${ax} >= box_centers[aligned_nboxes * ${iax} + box_id])
+                << ${dimensions-1-iax})
+        %endfor
+            ;
+
+        box_id_t child_box_id = box_child_ids[
+            aligned_nboxes * morton_nr + box_id];
+        if (!child_box_id)
+            break;
+
+        box_id = child_box_id;
+    }
+
+    box_ids[i] = box_id;
+"""
+
+
+class PointLocator(object):
+    """Given a set of points, this class finds the leaf box containing each
+    of them by descending the tree from the root.
+
+    See also :meth:`boxtree.Tree.find_box_nrs_for_points` for a host
+    version of this.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method_in_context
+    def get_point_locator_kernel(self, dimensions, coord_dtype, box_id_dtype):
         from pyopencl.tools import dtype_to_ctype
-        from boxtree import box_flags_enum
+        preamble = """//CL//
+            typedef %s box_id_t;
+            typedef %s coord_t;
+            """ % (dtype_to_ctype(box_id_dtype), dtype_to_ctype(coord_dtype))
 
-        logger.info("start building peer list finder kernel")
+        from pyopencl.tools import VectorArg, ScalarArg
+        # The points come first, as they determine the kernel's range.
+        arg_decls = [
+            VectorArg(coord_dtype, "point_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(box_id_dtype, "box_ids"),
+            VectorArg(coord_dtype, "box_centers"),
+            ScalarArg(coord_dtype, "root_extent"),
+            ScalarArg(box_id_dtype, "aligned_nboxes"),
+            VectorArg(box_id_dtype, "box_child_ids"),
+            ] + [
+            ScalarArg(coord_dtype, "bbox_min_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ]
 
-        from boxtree.traversal import (
-            TRAVERSAL_PREAMBLE_TEMPLATE, HELPER_FUNCTION_TEMPLATE)
+        from pyopencl.elementwise import ElementwiseKernel
+        return ElementwiseKernel(self.context, arg_decls,
+                str(Template(POINT_LOCATOR_TEMPLATE, strict_undefined=True)
+                    .render(dimensions=dimensions, AXIS_NAMES=AXIS_NAMES)),
+                name="locate_points", preamble=preamble)
 
-        template = Template(
-            TRAVERSAL_PREAMBLE_TEMPLATE
-            + HELPER_FUNCTION_TEMPLATE
-            + PEER_LIST_FINDER_TEMPLATE,
-            strict_undefined=True)
+    def __call__(self, queue, tree, points, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(box_ids, event)*, where *box_ids* is a
+            :class:`pyopencl.array.Array` of the ids of the smallest boxes
+            containing each point, or -1 for points outside the root box,
+            and *event* is a :class:`pyopencl.Event` for dependency
+            management. These boxes are leaves, unless the tree was pruned
+            and the point lies where an empty box was removed.
+        """
+
+        from pytools import single_valued
+        if single_valued(pt.dtype for pt in points) != tree.coord_dtype:
+            raise TypeError("points dtype must match tree.coord_dtype")
+
+        knl = self.get_point_locator_kernel(
+                tree.dimensions, tree.coord_dtype, tree.box_id_dtype)
+
+        logger.info("point location: run")
+
+        bbox_min, _ = tree.bounding_box
+
+        box_ids = cl.array.empty(queue, len(points[0]), tree.box_id_dtype)
+        evt = knl(
+                *(tuple(points) + (
+                    box_ids, tree.box_centers, tree.root_extent,
+                    tree.aligned_nboxes, tree.box_child_ids)
+                    + tuple(bbox_min)),
+                queue=queue, wait_for=wait_for)
+
+        logger.info("point location: done")
+
+        return box_ids, evt
+
+# }}}
+
+
+# {{{ k nearest neighbors
+
+KNN_TEMPLATE = r"""//CL//
+#define K ${k}
+
+// Bounded max-heap of the (squared) distances and numbers of the K nearest
+// particles found so far, with the farthest at the top.
+
+inline void heap_insert(coord_t dist_sq, particle_id_t particle_nr,
+    coord_t *heap_dists_sq, particle_id_t *heap_ids, int *heap_size)
+{
+    int pos;
+
+    if (*heap_size < K)
+    {
+        // sift up
+        pos = (*heap_size)++;
+        while (pos > 0 && heap_dists_sq[(pos - 1) / 2] < dist_sq)
+        {
+            heap_dists_sq[pos] = heap_dists_sq[(pos - 1) / 2];
+            heap_ids[pos] = heap_ids[(pos - 1) / 2];
+            pos = (pos - 1) / 2;
+        }
+    }
+    else if (dist_sq < heap_dists_sq[0])
+    {
+        // replace the top, sift down
+        pos = 0;
+        while (true)
+        {
+            int child = 2 * pos + 1;
+            if (child >= K)
+                break;
+            if (child + 1 < K && heap_dists_sq[child + 1] > heap_dists_sq[child])
+                ++child;
+            if (heap_dists_sq[child] <= dist_sq)
+                break;
+
+            heap_dists_sq[pos] = heap_dists_sq[child];
+            heap_ids[pos] = heap_ids[child];
+            pos = child;
+        }
+    }
+    else
+        return;
+
+    heap_dists_sq[pos] = dist_sq;
+    heap_ids[pos] = particle_nr;
+}
+
+<%def name="add_particles_to_heap(start, end, skip_seed=True)">
+    for (particle_id_t particle_nr = ${start}; particle_nr < ${end};
+        ++particle_nr)
+    {
+        %if skip_seed:
+            if (seed_start <= particle_nr && particle_nr < seed_end)
+                continue;
+        %endif
+
+        coord_t dist_sq = 0;
+        %for i in range(dimensions):
+            {
+                coord_t axis_dist = particle_${AXIS_NAMES[i]}[particle_nr]
+                    - query.s${i};
+                dist_sq += axis_dist * axis_dist;
+            }
+        %endfor
+
+        heap_insert(dist_sq, particle_nr, heap_dists_sq, heap_ids, &heap_size);
+    }
+</%def>
+
+<%def name="box_is_near(box_id)">
+    (get_box_dist_sq(query, ${box_id}, box_centers, root_extent, box_levels,
+        aligned_nboxes) <= SEARCH_RADIUS_SQ)
+</%def>
+
+inline coord_t get_box_dist_sq(coord_vec_t query, box_id_t box_id,
+    __global const coord_t *box_centers, coord_t root_extent,
+    __global const unsigned char *box_levels, box_id_t aligned_nboxes)
+{
+    ${load_center("box_center", "box_id")}
+    coord_t box_rad = LEVEL_TO_RAD(box_levels[box_id]);
+
+    coord_t dist_sq = 0;
+    %for i in range(dimensions):
+        {
+            coord_t axis_dist = fmax((coord_t) 0,
+                fabs(query.s${i} - box_center.s${i}) - box_rad);
+            dist_sq += axis_dist * axis_dist;
+        }
+    %endfor
+
+    return dist_sq;
+}
+
+#define SEARCH_RADIUS_SQ \
+    (heap_size < K ? INFINITY : heap_dists_sq[0])
+
+void find_knn(
+    particle_id_t query_nr,
+    %for ax in AXIS_NAMES[:dimensions]:
+        __global const coord_t *query_${ax},
+    %endfor
+    __global particle_id_t *knn_ids,
+    __global coord_t *knn_dists,
+    __global const coord_t *box_centers,
+    coord_t root_extent,
+    __global const unsigned char *box_levels,
+    box_id_t aligned_nboxes,
+    __global const box_id_t *box_child_ids,
+    __global const box_id_t *box_parent_ids,
+    __global const box_flags_t *box_flags,
+    __global const peer_list_idx_t *peer_list_starts,
+    __global const box_id_t *peer_lists,
+    __global const particle_id_t *box_particle_starts,
+    __global const particle_id_t *box_particle_counts_cumul
+    %for ax in AXIS_NAMES[:dimensions]:
+        , __global const coord_t *particle_${ax}
+    %endfor
+    )
+{
+    coord_vec_t query;
+    %for i in range(dimensions):
+        query.${AXIS_NAMES[i]} = query_${AXIS_NAMES[i]}[query_nr];
+    %endfor
+
+    coord_t heap_dists_sq[K];
+    particle_id_t heap_ids[K];
+    int heap_size = 0;
+
+    ///////////////////////////////////////////////////////////
+    // Step 1: Find the smallest box containing the query.   //
+    ///////////////////////////////////////////////////////////
+
+    box_id_t box_id = 0;
+
+    if (get_box_dist_sq(query, 0, box_centers, root_extent, box_levels,
+            aligned_nboxes) == 0)
+    {
+        while (box_flags[box_id] & BOX_HAS_CHILDREN)
+        {
+            ${load_center("center", "box_id")}
+            int morton_nr = 0
+            %for i in range(dimensions):
+                | ((query.s${i} >= center.s${i}) << ${dimensions-1-i})
+            %endfor
+                ;
+
+            box_id_t child_box_id = box_child_ids[
+                aligned_nboxes * morton_nr + box_id];
+            if (!child_box_id)
+                break;
+
+            box_id = child_box_id;
+        }
+    }
+
+    ///////////////////////////////////////////////////////////////////
+    // Step 2: Seed the heap with the particles of the smallest      //
+    // ancestor that has enough of them.                             //
+    ///////////////////////////////////////////////////////////////////
+
+    box_id_t seed_box = box_id;
+    while (seed_box && box_particle_counts_cumul[seed_box] < K)
+        seed_box = box_parent_ids[seed_box];
+
+    particle_id_t seed_start = box_particle_starts[seed_box];
+    particle_id_t seed_end = seed_start + box_particle_counts_cumul[seed_box];
+
+    ${add_particles_to_heap("seed_start", "seed_end", skip_seed=False)}
+
+    ///////////////////////////////////////////////////////////////////
+    // Step 3: All particles within the search radius are in the     //
+    // peers of the smallest ancestor at least as big as the radius. //
+    // Walk them, skipping boxes beyond the (shrinking) radius.      //
+    ///////////////////////////////////////////////////////////////////
+
+    box_id_t search_box = box_id;
+    while (search_box)
+    {
+        coord_t box_size = 2 * LEVEL_TO_RAD(box_levels[search_box]);
+        if (box_size * box_size >= SEARCH_RADIUS_SQ)
+            break;
+        search_box = box_parent_ids[search_box];
+    }
+
+    ${walk_init(0)}
+
+    for (peer_list_idx_t pb_i = peer_list_starts[search_box],
+         pb_e = peer_list_starts[search_box+1]; pb_i < pb_e; ++pb_i)
+    {
+        box_id_t peer_box = peer_lists[pb_i];
+
+        if (!${box_is_near("peer_box")})
+            continue;
+
+        if (!(box_flags[peer_box] & BOX_HAS_CHILDREN))
+        {
+            particle_id_t start = box_particle_starts[peer_box];
+            ${add_particles_to_heap(
+                "start", "start + box_particle_counts_cumul[peer_box]")}
+            continue;
+        }
+
+        ${walk_reset("peer_box")}
+
+        while (continue_walk)
+        {
+            box_id_t child_box_id = box_child_ids[
+                walk_morton_nr * aligned_nboxes + walk_box_id];
+
+            if (child_box_id && ${box_is_near("child_box_id")})
+            {
+                if (!(box_flags[child_box_id] & BOX_HAS_CHILDREN))
+                {
+                    particle_id_t start = box_particle_starts[child_box_id];
+                    ${add_particles_to_heap("start",
+                        "start + box_particle_counts_cumul[child_box_id]")}
+                }
+                else
+                {
+                    // We want to descend into this box. Put the current state
+                    // on the stack.
+                    ${walk_push("child_box_id")}
+                    continue;
+                }
+            }
+
+            ${walk_advance()}
+        }
+    }
+
+    ////////////////////////////////////////////////////
+    // Step 4: Sort the heap into the output, nearest //
+    // first.                                         //
+    ////////////////////////////////////////////////////
+
+    for (int j = heap_size; j < K; ++j)
+    {
+        knn_ids[K * query_nr + j] = -1;
+        knn_dists[K * query_nr + j] = INFINITY;
+    }
+
+    while (heap_size)
+    {
+        coord_t dist_sq = heap_dists_sq[0];
+        particle_id_t particle_nr = heap_ids[0];
+
+        knn_ids[K * query_nr + heap_size - 1] = particle_nr;
+        knn_dists[K * query_nr + heap_size - 1] = sqrt(dist_sq);
+
+        // Remove the top by reinserting the last entry into the
+        // (temporarily smaller) heap.
+        --heap_size;
+        coord_t last_dist_sq = heap_dists_sq[heap_size];
+        particle_id_t last_id = heap_ids[heap_size];
+
+        int pos = 0;
+        while (true)
+        {
+            int child = 2 * pos + 1;
+            if (child >= heap_size)
+                break;
+            if (child + 1 < heap_size
+                    && heap_dists_sq[child + 1] > heap_dists_sq[child])
+                ++child;
+            if (heap_dists_sq[child] <= last_dist_sq)
+                break;
+
+            heap_dists_sq[pos] = heap_dists_sq[child];
+            heap_ids[pos] = heap_ids[child];
+            pos = child;
+        }
+
+        heap_dists_sq[pos] = last_dist_sq;
+        heap_ids[pos] = last_id;
+    }
+}
+"""
+
+
+class KNNResult(DeviceDataRecord):
+    """
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to find the neighbors.
+
+    .. attribute:: nearest_particle_ids
+
+        ``particle_id_t [nqueries, k]``
+
+        The numbers of the *k* particles nearest each query point, nearest
+        first, or -1 if there are fewer than *k* particles.
+
+    .. attribute:: nearest_particle_distances
+
+        ``coord_t [nqueries, k]``
+
+        The Euclidean distances of :attr:`nearest_particle_ids` from each
+        query point, or infinity where there is no particle.
+
+    .. automethod:: get
+    """
+
+
+class KNNBuilder(object):
+    """Given a set of query points, this class helps find the *k* sources
+    or targets nearest each of them.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.peer_list_finder = PeerListFinder(self.context)
+
+    @memoize_method_in_context
+    def get_knn_kernel(self, dimensions, coord_dtype, box_id_dtype,
+            particle_id_dtype, peer_list_idx_dtype, max_levels, k):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree import box_flags_enum
+
+        logger.info("start building k nearest neighbors kernel")
+
+        from boxtree.traversal import TRAVERSAL_PREAMBLE_TEMPLATE
 
         render_vars = dict(
             dimensions=dimensions,
             dtype_to_ctype=dtype_to_ctype,
             box_id_dtype=box_id_dtype,
-            particle_id_dtype=None,
+            particle_id_dtype=particle_id_dtype,
             coord_dtype=coord_dtype,
             vec_types=cl.array.vec.types,
             max_levels=max_levels,
             AXIS_NAMES=AXIS_NAMES,
             box_flags_enum=box_flags_enum,
             debug=False,
+            periodic=False,
+            k=k,
             # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
-            stick_out_factor=0,
-            # For calls to the helper is_adjacent_or_overlapping()
-            targets_have_extent=False,
-            sources_have_extent=False)
+            stick_out_factor=0)
+
+        preamble = Template(
+            TRAVERSAL_PREAMBLE_TEMPLATE
+            + "typedef %s peer_list_idx_t;\n"
+            % dtype_to_ctype(peer_list_idx_dtype)
+            + KNN_TEMPLATE,
+            strict_undefined=True).render(**render_vars)
 
         from pyopencl.tools import VectorArg, ScalarArg
-        arg_decls = [
+        # The query points come first, as they determine the kernel's range.
+        args = [
+            VectorArg(coord_dtype, "query_"+ax)
+            for ax in AXIS_NAMES[:dimensions]
+            ] + [
+            VectorArg(particle_id_dtype, "knn_ids"),
+            VectorArg(coord_dtype, "knn_dists"),
             VectorArg(coord_dtype, "box_centers"),
             ScalarArg(coord_dtype, "root_extent"),
             VectorArg(np.uint8, "box_levels"),
             ScalarArg(box_id_dtype, "aligned_nboxes"),
             VectorArg(box_id_dtype, "box_child_ids"),
+            VectorArg(box_id_dtype, "box_parent_ids"),
             VectorArg(box_flags_enum.dtype, "box_flags"),
-        ]
-
-        from pyopencl.algorithm import ListOfListsBuilder
-        peer_list_finder_kernel = ListOfListsBuilder(
-            self.context,
-            [("peers", box_id_dtype)],
-            str(template.render(**render_vars)),
-            arg_decls=arg_decls,
-            name_prefix="find_peer_lists",
-            count_sharing={},
-            complex_kernel=True)
-
-        logger.info("done building peer list finder kernel")
-        return peer_list_finder_kernel
-
-    # }}}
+            VectorArg(peer_list_idx_dtype, "peer_list_starts"),
+            VectorArg(box_id_dtype, "peer_lists"),
+            VectorArg(particle_id_dtype, "box_particle_starts"),
+            VectorArg(particle_id_dtype, "box_particle_counts_cumul"),
+            ] + [
+            VectorArg(coord_dtype, "particle_"+ax)
+            for ax in AXIS_NAMES[:dimensions]]
 
-    def __call__(self, queue, tree, wait_for=None):
+        from pyopencl.elementwise import ElementwiseKernel
+        knn_kernel = ElementwiseKernel(self.context, args,
+                "find_knn(i, %s)" % ", ".join(arg.name for arg in args),
+                name="find_knn_for_queries", preamble=str(preamble))
+
+        logger.info("done building k nearest neighbors kernel")
+        return knn_kernel
+
+    @memoize_method_in_context
+    def get_user_order_kernel(self, particle_id_dtype):
+        from pyopencl.elementwise import ElementwiseKernel
+        from pyopencl.tools import VectorArg
+        return ElementwiseKernel(self.context,
+                [
+                    VectorArg(particle_id_dtype, "particle_ids"),
+                    VectorArg(particle_id_dtype, "user_particle_ids"),
+                    ],
+                # -1 (no particle) stays -1.
+                "if (particle_ids[i] >= 0) "
+                "particle_ids[i] = user_particle_ids[particle_ids[i]]",
+                name="knn_ids_to_user_order")
+
+    def __call__(self, queue, tree, query_points, k, particles="sources",
+            particle_order="tree", peer_lists=None, wait_for=None,
+            profiler=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
+        :arg query_points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances.
+            Their *dtype* must match *tree*'s
+            :attr:`boxtree.Tree.coord_dtype`.
+        :arg k: the number of neighbors to find for each query point.
+        :arg particles: ``"sources"`` or ``"targets"``, which particles of
+            *tree* to search. They must not have extent.
+        :arg particle_order: ``"tree"`` or ``"user"``, whether to return
+            particle numbers in tree or user order (see
+            :ref:`particle-orderings`).
+        :arg peer_lists: may either be *None* or an instance of
+            :class:`PeerListLookup` associated with `tree`.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
-        :returns: a tuple *(pl, event)*, where *pl* is an instance of
-            :class:`PeerListLookup`, and *event* is a :class:`pyopencl.Event`
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the search (and the peer list build, if needed) is
+            recorded.
+        :returns: a tuple *(knn, event)*, where *knn* is an instance of
+            :class:`KNNResult`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
         """
+
+        from pytools import single_valued
+        if single_valued(qp.dtype for qp in query_points) != tree.coord_dtype:
+            raise TypeError("query_points dtype must match tree.coord_dtype")
+
+        if particles not in ["sources", "targets"]:
+            raise ValueError("unknown value of 'particles': %s" % particles)
+        if particle_order not in ["tree", "user"]:
+            raise ValueError(
+                    "unknown value of 'particle_order': %s" % particle_order)
+        if k < 1:
+            raise ValueError("k must be positive")
+
+        if getattr(tree, particles+"_have_extent"):
+            raise NotImplementedError("k nearest neighbors of %s that have "
+                    "extent" % particles)
+        # (Trees stored before is_periodic existed don't have it.)
+        if getattr(tree, "is_periodic", False):
+            raise NotImplementedError(
+                    "k nearest neighbors in periodic trees")
+
         from pytools import div_ceil
         # Avoid generating too many kernels.
         max_levels = div_ceil(tree.nlevels, 10) * 10
 
-        peer_list_finder_kernel = self.get_peer_list_finder_kernel(
-            tree.dimensions, tree.coord_dtype, tree.box_id_dtype, max_levels)
-
-        logger.info("peer list finder: find peer lists")
-
-        result, evt = peer_list_finder_kernel(
-                queue, tree.nboxes,
-                tree.box_centers.data, tree.root_extent,
-                tree.box_levels.data, tree.aligned_nboxes,
-                tree.box_child_ids.data, tree.box_flags.data,
-                wait_for=wait_for)
+        if peer_lists is None:
+            peer_lists, evt = self.peer_list_finder(queue, tree,
+                    wait_for=wait_for, profiler=profiler)
+            wait_for = [evt]
 
-        logger.info("peer list finder: done")
+        if len(peer_lists.peer_list_starts) != tree.nboxes + 1:
+            raise ValueError("size of peer lists must match with number of boxes")
 
-        return PeerListLookup(
+        knn_kernel = self.get_knn_kernel(tree.dimensions,
+            tree.coord_dtype, tree.box_id_dtype, tree.particle_id_dtype,
+            peer_lists.peer_list_starts.dtype, max_levels, k)
+
+        nqueries = len(query_points[0])
+        knn_ids = cl.array.empty(queue, (nqueries, k), tree.particle_id_dtype)
+        knn_dists = cl.array.empty(queue, (nqueries, k), tree.coord_dtype)
+
+        logger.info("k nearest neighbors: run")
+
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "k nearest neighbors")
+
+        evt = knn_kernel(
+                *(tuple(query_points) + (
+                    knn_ids, knn_dists,
+                    tree.box_centers, tree.root_extent,
+                    tree.box_levels, tree.aligned_nboxes,
+                    tree.box_child_ids, tree.box_parent_ids,
+                    tree.box_flags,
+                    peer_lists.peer_list_starts, peer_lists.peer_lists,
+                    getattr(tree, "box_%s_starts" % particles[:-1]),
+                    getattr(tree, "box_%s_counts_cumul" % particles[:-1]),
+                    ) + tuple(getattr(tree, particles))),
+                range=slice(nqueries), queue=queue, wait_for=wait_for)
+        prof.event("k nearest neighbors", evt)
+
+        if particle_order == "user":
+            if particles == "sources":
+                user_particle_ids = tree.user_source_ids
+            else:
+                from boxtree.tools import reverse_index_array
+                user_particle_ids = reverse_index_array(
+                        tree.sorted_target_ids, queue=queue)
+
+            evt = self.get_user_order_kernel(tree.particle_id_dtype)(
+                    knn_ids, user_particle_ids, queue=queue, wait_for=[evt])
+            prof.event("k nearest neighbors: user order", evt)
+
+        logger.info("k nearest neighbors: done")
+
+        return KNNResult(
                 tree=tree,
-                peer_list_starts=result["peers"].starts,
-                peer_lists=result["peers"].lists).with_queue(None), evt
+                nearest_particle_ids=knn_ids,
+                nearest_particle_distances=knn_dists,
+                ).with_queue(None), evt
 
 # }}}
 
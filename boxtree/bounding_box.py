@@ -24,8 +24,8 @@ THE SOFTWARE.
 
 
 import pyopencl as cl  # noqa
-from boxtree.tools import get_type_moniker
-from pytools import memoize, memoize_method
+from boxtree.tools import get_type_moniker, memoize_method_in_context
+from pytools import memoize
 from pyopencl.reduction import ReductionTemplate
 import numpy as np
 
@@ -130,7 +130,7 @@ class BoundingBoxFinder:
                 raise RuntimeError("bounding box finder does not work "
                         "properly with this CL runtime.")
 
-    @memoize_method
+    @memoize_method_in_context
     def get_kernel(self, dimensions, coord_dtype, have_radii):
         bbox_dtype, bbox_cdecl = make_bounding_box_dtype(
                 self.context.devices[0], dimensions, coord_dtype)
@@ -23,12 +23,13 @@ THE SOFTWARE.
 """
 
 
-from pytools import memoize_method, Record
+from pytools import Record
 import numpy as np
 import pyopencl as cl
 import pyopencl.array  # noqa
 from mako.template import Template
-from boxtree.tools import AXIS_NAMES, DeviceDataRecord
+from boxtree.tools import (
+        AXIS_NAMES, DeviceDataRecord, memoize_method_in_context)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -40,6 +41,13 @@ Leaves -> overlapping balls
 .. autoclass:: LeavesToBallsLookupBuilder
 
 .. autoclass:: LeavesToBallsLookup
+
+Morton keys -> boxes
+--------------------
+
+.. autoclass:: BoxHashTableBuilder
+
+.. autoclass:: BoxHashTable
 """
 
 
@@ -63,6 +71,12 @@ class LeavesToBallsLookup(DeviceDataRecord):
 
     .. attribute:: balls_near_box_lists
 
+    .. attribute:: balls_near_box_images
+
+        If :attr:`boxtree.Tree.is_periodic`, the image of the leaf box that
+        each entry of :attr:`balls_near_box_lists` overlaps, an index into
+        :attr:`boxtree.Tree.image_offsets`. Otherwise *None*.
+
     .. automethod:: get
     """
 
@@ -83,42 +97,62 @@ void generate(LIST_ARG_DECL USER_ARG_DECL ball_id_t ball_nr)
     coord_t ball_radius = ball_radii[ball_nr];
 
     // To find overlapping leaves, start at the top of the tree, descend
-    // into overlapping boxes.
-    ${walk_init(0)}
-
-    while (continue_walk)
+    // into overlapping boxes. In a periodic tree, do so in each image of
+    // the tree, by moving the ball the opposite way.
+    for (int image = 0; image < NIMAGES; ++image)
     {
-        box_id_t child_box_id = box_child_ids[
-            walk_morton_nr * aligned_nboxes + walk_box_id];
-        dbg_printf(("  walk box id: %d morton: %d child id: %d level: %d\n",
-            walk_box_id, walk_morton_nr, child_box_id, walk_level));
+        ${image_frame_center("image_ball_center", "ball_center", "image")}
 
-        if (child_box_id)
+        %if periodic:
         {
             bool is_overlapping;
 
             ${check_l_infty_ball_overlap(
-                "is_overlapping", "child_box_id", "ball_radius", "ball_center")}
+                "is_overlapping", "0", "ball_radius", "image_ball_center")}
+
+            if (!is_overlapping)
+                continue;
+        }
+        %endif
+
+        ${walk_init(0)}
+
+        while (continue_walk)
+        {
+            box_id_t child_box_id = box_child_ids[
+                walk_morton_nr * aligned_nboxes + walk_box_id];
+            dbg_printf(("  walk box id: %d morton: %d child id: %d level: %d\n",
+                walk_box_id, walk_morton_nr, child_box_id, walk_level));
 
-            if (is_overlapping)
+            if (child_box_id)
             {
-                if (!(box_flags[child_box_id] & BOX_HAS_CHILDREN))
-                {
-                    APPEND_ball_numbers(ball_nr);
-                    APPEND_overlapping_leaves(child_box_id);
-                }
-                else
-                {
-                    // We want to descend into this box. Put the current state
-                    // on the stack.
+                bool is_overlapping;
 
-                    ${walk_push("child_box_id")}
-                    continue;
+                ${check_l_infty_ball_overlap(
+                    "is_overlapping", "child_box_id", "ball_radius",
+                    "image_ball_center")}
+
+                if (is_overlapping)
+                {
+                    if (!(box_flags[child_box_id] & BOX_HAS_CHILDREN))
+                    {
+                        APPEND_ball_numbers(ball_nr);
+                        ${append_with_image(
+                            "overlapping_leaves", "child_box_id", "image")}
+                    }
+                    else
+                    {
+                        // We want to descend into this box. Put the current
+                        // state on the stack.
+
+                        ${walk_push("child_box_id")}
+                        continue;
+                    }
                 }
             }
-        }
 
-        ${walk_advance()}
+            ${walk_advance()}
+        }
     }
 }
 """
@@ -137,13 +171,16 @@ class LeavesToBallsLookupBuilder(object):
     """
     def __init__(self, context):
         self.context = context
+        self.key_value_sorter = self.get_key_value_sorter()
 
+    @memoize_method_in_context
+    def get_key_value_sorter(self):
         from pyopencl.algorithm import KeyValueSorter
-        self.key_value_sorter = KeyValueSorter(context)
+        return KeyValueSorter(self.context)
 
-    @memoize_method
+    @memoize_method_in_context
     def get_balls_to_leaves_kernel(self, dimensions, coord_dtype, box_id_dtype,
-            ball_id_dtype, max_levels, stick_out_factor):
+            ball_id_dtype, max_levels, stick_out_factor, periodic=False):
         from pyopencl.tools import dtype_to_ctype
         from boxtree import box_flags_enum
         render_vars = dict(
@@ -159,6 +196,7 @@ class LeavesToBallsLookupBuilder(object):
                 box_flags_enum=box_flags_enum,
                 debug=False,
                 stick_out_factor=stick_out_factor,
+                periodic=periodic,
                 )
 
         logger.info("start building leaves-to-balls lookup kernel")
@@ -170,13 +208,26 @@ class LeavesToBallsLookupBuilder(object):
                 + BALLS_TO_LEAVES_TEMPLATE,
                 strict_undefined=True).render(**render_vars)
 
+        count_sharing = {
+                # /!\ This makes a promise that APPEND_ball_numbers will
+                # always occur *before* APPEND_overlapping_leaves.
+                "overlapping_leaves": "ball_numbers"
+                }
+
+        if periodic:
+            # ... and APPEND_overlapping_leaves_images after it.
+            image_lists = [("overlapping_leaves_images", np.int8)]
+            count_sharing["overlapping_leaves_images"] = "ball_numbers"
+        else:
+            image_lists = []
+
         from pyopencl.tools import VectorArg, ScalarArg
-        from pyopencl.algorithm import ListOfListsBuilder
+        from boxtree.tools import ListOfListsBuilder
         result = ListOfListsBuilder(self.context,
                 [
                     ("ball_numbers", ball_id_dtype),
                     ("overlapping_leaves", box_id_dtype),
-                    ],
+                    ] + image_lists,
                 str(src),
                 arg_decls=[
                     VectorArg(box_flags_enum.dtype, "box_flags"),
@@ -190,18 +241,15 @@ class LeavesToBallsLookupBuilder(object):
                         VectorArg(coord_dtype, "ball_"+ax)
                         for ax in AXIS_NAMES[:dimensions]],
                 name_prefix="circles_to_balls",
-                count_sharing={
-                    # /!\ This makes a promise that APPEND_ball_numbers will
-                    # always occur *before* APPEND_overlapping_leaves.
-                    "overlapping_leaves": "ball_numbers"
-                    },
+                count_sharing=count_sharing,
                 complex_kernel=True)
 
         logger.info("done building leaves-to-balls lookup kernel")
 
         return result
 
-    def __call__(self, queue, tree, ball_centers, ball_radii, wait_for=None):
+    def __call__(self, queue, tree, ball_centers, ball_radii, wait_for=None,
+            profiler=None):
         """
         :arg queue: a :class:`pyopencl.CommandQueue`
         :arg tree: a :class:`boxtree.Tree`.
@@ -214,9 +262,15 @@ class LeavesToBallsLookupBuilder(object):
             of positive numbers.
             Its *dtype* must match *tree*'s
             :attr:`boxtree.Tree.coord_dtype`.
+            If *tree* is periodic (see :attr:`boxtree.Tree.is_periodic`),
+            the ball centers must lie in the root box, and the radii must
+            not exceed :attr:`boxtree.Tree.root_extent`. Balls then also
+            overlap leaves in the images of the root box.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the lookup build is recorded.
         :returns: a tuple *(lbl, event)*, where *lbl* is an instance of
             :class:`LeavesToBallsLookup`, and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -234,41 +288,518 @@ class LeavesToBallsLookupBuilder(object):
         # Avoid generating too many kernels.
         max_levels = div_ceil(tree.nlevels, 10) * 10
 
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
         b2l_knl = self.get_balls_to_leaves_kernel(
                 tree.dimensions, tree.coord_dtype,
                 tree.box_id_dtype, ball_id_dtype,
-                max_levels, tree.stick_out_factor)
+                max_levels, tree.stick_out_factor, periodic)
 
         logger.info("leaves-to-balls lookup: prepare ball list")
 
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "leaves-to-balls lookup")
+
         nballs = len(ball_radii)
-        result, evt = b2l_knl(
-                queue, nballs,
-                tree.box_flags.data, tree.box_centers.data,
-                tree.box_child_ids.data, tree.box_levels.data,
-                tree.root_extent, tree.aligned_nboxes,
-                ball_radii.data, *tuple(bc.data for bc in ball_centers),
-                wait_for=wait_for)
+        with prof.span("balls to leaves"):
+            result, evt = b2l_knl(
+                    queue, nballs,
+                    tree.box_flags.data, tree.box_centers.data,
+                    tree.box_child_ids.data, tree.box_levels.data,
+                    tree.root_extent, tree.aligned_nboxes,
+                    ball_radii.data, *tuple(bc.data for bc in ball_centers),
+                    index_dtype=ball_id_dtype, wait_for=wait_for)
+        prof.built_lists("balls to leaves", result, evt)
         wait_for = [evt]
 
         logger.info("leaves-to-balls lookup: key-value sort")
 
-        balls_near_box_starts, balls_near_box_lists, evt \
-                = self.key_value_sorter(
-                        queue,
-                        # keys
-                        result["overlapping_leaves"].lists,
-                        # values
-                        result["ball_numbers"].lists,
-                        tree.nboxes, starts_dtype=tree.box_id_dtype,
-                        wait_for=wait_for)
+        ball_numbers = result["ball_numbers"].lists
+        if periodic:
+            # Sort the positions of the entries instead of the ball
+            # numbers, to reorder the images the same way.
+            values = cl.array.arange(queue, len(ball_numbers),
+                    dtype=ball_id_dtype)
+        else:
+            values = ball_numbers
+
+        with prof.span("key-value sort"):
+            balls_near_box_starts, balls_near_box_lists, evt \
+                    = self.key_value_sorter(
+                            queue,
+                            # keys
+                            result["overlapping_leaves"].lists,
+                            # values
+                            values,
+                            tree.nboxes, starts_dtype=tree.box_id_dtype,
+                            wait_for=wait_for)
+        prof.event("key-value sort", evt)
+
+        if periodic:
+            entry_nrs = balls_near_box_lists
+            balls_near_box_lists = cl.array.take(
+                    ball_numbers, entry_nrs, queue=queue)
+            balls_near_box_images = cl.array.take(
+                    result["overlapping_leaves_images"].lists, entry_nrs,
+                    queue=queue)
+            evt = balls_near_box_images.events[-1]
+            del entry_nrs
+        else:
+            balls_near_box_images = None
+
+        prof.allocation("balls near box starts", balls_near_box_starts)
+        prof.allocation("balls near box lists", balls_near_box_lists)
 
         logger.info("leaves-to-balls lookup: built")
 
         return LeavesToBallsLookup(
                 tree=tree,
                 balls_near_box_starts=balls_near_box_starts,
-                balls_near_box_lists=balls_near_box_lists).with_queue(None), evt
+                balls_near_box_lists=balls_near_box_lists,
+                balls_near_box_images=balls_near_box_images,
+                ).with_queue(None), evt
+
+# }}}
+
+
+# {{{ box hash table
+
+class BoxHashTable(DeviceDataRecord):
+    """A hash table from the Morton keys of the boxes of a tree to their box
+    ids, built by :class:`BoxHashTableBuilder`.
+
+    The Morton key of the box at level *l* whose lower corner is
+    :math:`(i_0, \\dots, i_{d-1}) \\cdot 2^{-l}` times
+    :attr:`boxtree.Tree.root_extent` away from the lower corner of
+    :attr:`boxtree.Tree.bounding_box` is a one bit, followed by the *l* bits
+    of each of the integer coordinates :math:`i_k`, interleaved from the most
+    significant bit on (with those of the first axis first). Keys fit into
+    64 bits as long as ``dimensions * (nlevels - 1) < 64``.
+
+    .. attribute:: tree
+
+        The :class:`boxtree.Tree` instance used to build this table.
+
+    .. attribute:: table_bits
+
+        The table has ``2**table_bits`` slots.
+
+    .. attribute:: table_keys
+
+        ``uint64 [2**table_bits]``
+
+        The Morton key of the box in each slot, or zero for empty slots.
+        (Zero is not a valid key.)
+
+    .. attribute:: table_box_ids
+
+        ``box_id_t [2**table_bits]``
+
+        The box id of the box in each slot.
+
+    .. automethod:: get
+    """
+
+
+BOX_HASH_TABLE_PREAMBLE_TEMPLATE = r"""//CL//
+typedef ${dtype_to_ctype(box_id_dtype)} box_id_t;
+typedef ${dtype_to_ctype(coord_dtype)} coord_t;
+
+// Fibonacci hashing, into the upper table_bits bits of the product
+#define HASH_SLOT(key) (((key) * 0x9E3779B97F4A7C15UL) >> (64 - table_bits))
+
+inline ulong get_morton_key(int level
+    %for ax in AXIS_NAMES[:dimensions]:
+        , ulong i${ax}
+    %endfor
+    )
+{
+    ulong key = 1;
+    for (int bit = level-1; bit >= 0; --bit)
+    {
+        %for ax in AXIS_NAMES[:dimensions]:
+            key = (key << 1) | ((i${ax} >> bit) & 1);
+        %endfor
+    }
+    return key;
+}
+
+// integer coordinate along one axis of the box at *level* with *center*
+inline long get_box_coordinate(coord_t center, coord_t bbox_min,
+    coord_t root_extent, int level)
+{
+    return (long) floor(
+        (center - bbox_min) / root_extent * (coord_t) (1UL << level));
+}
+
+inline box_id_t lookup_box(ulong key, __global const ulong *table_keys,
+    __global const box_id_t *table_box_ids, int table_bits)
+{
+    ulong mask = (1UL << table_bits) - 1;
+
+    for (ulong slot = HASH_SLOT(key); ; slot = (slot + 1) & mask)
+    {
+        ulong slot_key = table_keys[slot];
+        if (slot_key == key)
+            return table_box_ids[slot];
+        if (slot_key == 0)
+            return -1;
+    }
+}
+"""
+
+BOX_HASH_TABLE_INSERTER_TEMPLATE = r"""//CL//
+    int level = box_levels[i];
+
+    %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+        ulong i${ax} = get_box_coordinate(
+            box_centers[aligned_nboxes * ${iax} + i], bbox_min_${ax},
+            root_extent, level);
+    %endfor
+
+    ulong key = get_morton_key(level ${coord_args});
+    ulong mask = (1UL << table_bits) - 1;
+
+    // Slots are claimed atomically. Keys and box ids are only read once
+    // all boxes are inserted.
+    for (ulong slot = HASH_SLOT(key); ; slot = (slot + 1) & mask)
+    {
+        if (atomic_cmpxchg(&slot_taken[slot], 0, 1) == 0)
+        {
+            table_keys[slot] = key;
+            table_box_ids[slot] = i;
+            break;
+        }
+    }
+"""
+
+BOX_FINDER_TEMPLATE = r"""//CL//
+    int level = levels[i];
+    bool in_tree = 0 <= level && level < nlevels;
+
+    %for ax in AXIS_NAMES[:dimensions]:
+        int i${ax} = coords_${ax}[i];
+        in_tree = in_tree && 0 <= i${ax} && i${ax} < (1L << level);
+    %endfor
+
+    if (in_tree)
+        result[i] = lookup_box(get_morton_key(level ${coord_args}),
+            table_keys, table_box_ids, table_bits);
+    else
+        result[i] = -1;
+"""
+
+POINT_LOCATOR_TEMPLATE = r"""//CL//
+    int max_level = nlevels - 1;
+    coord_t scale = (coord_t) (1UL << max_level) / root_extent;
+    bool in_tree = true;
+
+    %for ax in AXIS_NAMES[:dimensions]:
+        coord_t rel_${ax} = (point_${ax}[i] - bbox_min_${ax}) * scale;
+        in_tree = in_tree && 0 <= rel_${ax}
+            && rel_${ax} < (coord_t) (1UL << max_level);
+        ulong i${ax} = in_tree ? (ulong) rel_${ax} : 0;
+    %endfor
+
+    if (in_tree)
+    {
+        // The boxes containing the point that are in the tree are the
+        // root and those above some level, so search for that level.
+        int low_level = 0;
+        int high_level = max_level;
+        box_id_t box_id = 0;
+
+        while (low_level < high_level)
+        {
+            int level = (low_level + high_level + 1) / 2;
+            int shift = max_level - level;
+
+            box_id_t level_box_id = lookup_box(
+                get_morton_key(level
+                    %for ax in AXIS_NAMES[:dimensions]:
+                        , i${ax} >> shift
+                    %endfor
+                    ),
+                table_keys, table_box_ids, table_bits);
+
+            if (level_box_id >= 0)
+            {
+                low_level = level;
+                box_id = level_box_id;
+            }
+            else
+                high_level = level - 1;
+        }
+
+        result[i] = box_id;
+    }
+    else
+        result[i] = -1;
+"""
+
+NEIGHBOR_FINDER_TEMPLATE = r"""//CL//
+    box_id_t box_id = box_ids[i];
+    int level = box_levels[box_id];
+    long level_size = 1L << level;
+    bool in_tree = true;
+
+    %for iax, ax in enumerate(AXIS_NAMES[:dimensions]):
+        long i${ax} = get_box_coordinate(
+            box_centers[aligned_nboxes * ${iax} + box_id], bbox_min_${ax},
+            root_extent, level) + offset_${ax};
+        %if periodic:
+            i${ax} = (i${ax} % level_size + level_size) % level_size;
+        %else:
+            in_tree = in_tree && 0 <= i${ax} && i${ax} < level_size;
+        %endif
+    %endfor
+
+    if (in_tree)
+        result[i] = lookup_box(get_morton_key(level ${coord_args}),
+            table_keys, table_box_ids, table_bits);
+    else
+        result[i] = -1;
+"""
+
+
+class BoxHashTableBuilder(object):
+    """Builds a :class:`BoxHashTable`, and finds boxes in it in constant
+    time (per box), by level and integer coordinates, by a point they
+    contain, or as neighbors of other boxes.
+
+    .. automethod:: __call__
+    .. automethod:: find_boxes
+    .. automethod:: find_boxes_containing_points
+    .. automethod:: find_neighbors
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method_in_context
+    def get_kernel_info(self, dimensions, coord_dtype, box_id_dtype, periodic):
+        from pyopencl.tools import dtype_to_ctype
+        render_vars = dict(
+                dimensions=dimensions,
+                dtype_to_ctype=dtype_to_ctype,
+                box_id_dtype=box_id_dtype,
+                coord_dtype=coord_dtype,
+                AXIS_NAMES=AXIS_NAMES,
+                periodic=periodic,
+                coord_args="".join(
+                    ", i"+ax for ax in AXIS_NAMES[:dimensions]),
+                )
+
+        def render(template):
+            return str(Template(template, strict_undefined=True)
+                    .render(**render_vars))
+
+        preamble = render(BOX_HASH_TABLE_PREAMBLE_TEMPLATE)
+
+        from pyopencl.tools import VectorArg, ScalarArg
+        axis_names = AXIS_NAMES[:dimensions]
+
+        table_args = [
+                VectorArg(np.uint64, "table_keys"),
+                VectorArg(box_id_dtype, "table_box_ids"),
+                ScalarArg(np.int32, "table_bits"),
+                ]
+        bbox_min_args = [
+                ScalarArg(coord_dtype, "bbox_min_"+ax) for ax in axis_names]
+        box_args = [
+                VectorArg(coord_dtype, "box_centers"),
+                VectorArg(np.uint8, "box_levels"),
+                ScalarArg(box_id_dtype, "aligned_nboxes"),
+                ScalarArg(coord_dtype, "root_extent"),
+                ] + bbox_min_args
+
+        from pyopencl.elementwise import ElementwiseKernel
+
+        inserter = ElementwiseKernel(self.context,
+                box_args + table_args + [VectorArg(np.int32, "slot_taken")],
+                render(BOX_HASH_TABLE_INSERTER_TEMPLATE),
+                name="insert_boxes_into_hash_table", preamble=preamble)
+
+        box_finder = ElementwiseKernel(self.context,
+                [
+                    VectorArg(np.int32, "levels"),
+                    ] + [
+                    VectorArg(np.int32, "coords_"+ax) for ax in axis_names
+                    ] + [
+                    ScalarArg(np.int32, "nlevels"),
+                    VectorArg(box_id_dtype, "result"),
+                    ] + table_args,
+                render(BOX_FINDER_TEMPLATE),
+                name="find_boxes_in_hash_table", preamble=preamble)
+
+        point_locator = ElementwiseKernel(self.context,
+                [
+                    VectorArg(coord_dtype, "point_"+ax) for ax in axis_names
+                    ] + [
+                    ScalarArg(coord_dtype, "root_extent"),
+                    ] + bbox_min_args + [
+                    ScalarArg(np.int32, "nlevels"),
+                    VectorArg(box_id_dtype, "result"),
+                    ] + table_args,
+                render(POINT_LOCATOR_TEMPLATE),
+                name="find_boxes_containing_points_in_hash_table",
+                preamble=preamble)
+
+        neighbor_finder = ElementwiseKernel(self.context,
+                [
+                    VectorArg(box_id_dtype, "box_ids"),
+                    ] + box_args + [
+                    ScalarArg(np.int64, "offset_"+ax) for ax in axis_names
+                    ] + [
+                    VectorArg(box_id_dtype, "result"),
+                    ] + table_args,
+                render(NEIGHBOR_FINDER_TEMPLATE),
+                name="find_neighbors_in_hash_table", preamble=preamble)
+
+        return _KernelInfo(
+                inserter=inserter,
+                box_finder=box_finder,
+                point_locator=point_locator,
+                neighbor_finder=neighbor_finder)
+
+    def _get_kernel_info(self, tree):
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
+        return self.get_kernel_info(tree.dimensions, tree.coord_dtype,
+                tree.box_id_dtype, periodic)
+
+    def __call__(self, queue, tree, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue`
+        :arg tree: a :class:`boxtree.Tree`.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+        :returns: a tuple *(table, event)*, where *table* is an instance of
+            :class:`BoxHashTable`, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+        """
+
+        if tree.dimensions * (tree.nlevels - 1) >= 64:
+            raise ValueError("tree has too many levels for 64-bit Morton keys")
+
+        knl_info = self._get_kernel_info(tree)
+
+        # At most half of the slots are taken, to keep probe sequences short.
+        table_bits = max(1, int(np.ceil(np.log2(2 * tree.nboxes))))
+        table_size = 2**table_bits
+
+        table_keys = cl.array.zeros(queue, table_size, np.uint64)
+        table_box_ids = cl.array.empty(queue, table_size, tree.box_id_dtype)
+        slot_taken = cl.array.zeros(queue, table_size, np.int32)
+
+        bbox_min, _ = tree.bounding_box
+
+        logger.info("box hash table: insert boxes")
+
+        evt = knl_info.inserter(
+                tree.box_centers, tree.box_levels, tree.aligned_nboxes,
+                tree.root_extent, *(tuple(bbox_min) + (
+                    table_keys, table_box_ids, table_bits, slot_taken)),
+                range=slice(tree.nboxes), queue=queue,
+                wait_for=wait_for)
+
+        logger.info("box hash table: built")
+
+        return BoxHashTable(
+                tree=tree,
+                table_bits=table_bits,
+                table_keys=table_keys,
+                table_box_ids=table_box_ids,
+                ).with_queue(None), evt
+
+    def find_boxes(self, queue, table, levels, coords, wait_for=None):
+        """
+        :arg table: a :class:`BoxHashTable`.
+        :arg levels: a :class:`pyopencl.array.Array` of :class:`numpy.int32`
+            levels.
+        :arg coords: an object array of :class:`pyopencl.array.Array`
+            instances of :class:`numpy.int32` integer coordinates (see
+            :class:`BoxHashTable`), one per axis.
+        :returns: a tuple *(box_ids, event)*, where *box_ids* is a
+            :class:`pyopencl.array.Array` of the ids of the boxes at
+            *levels* and *coords*, or -1 where there is no such box.
+        """
+        tree = table.tree
+        knl_info = self._get_kernel_info(tree)
+
+        result = cl.array.empty(queue, len(levels), tree.box_id_dtype)
+        evt = knl_info.box_finder(
+                levels, *(tuple(coords) + (
+                    tree.nlevels, result,
+                    table.table_keys, table.table_box_ids, table.table_bits)),
+                queue=queue, wait_for=wait_for)
+
+        return result, evt
+
+    def find_boxes_containing_points(self, queue, table, points,
+            wait_for=None):
+        """
+        :arg table: a :class:`BoxHashTable`.
+        :arg points: an object array of coordinate
+            :class:`pyopencl.array.Array` instances. Their *dtype* must match
+            :attr:`boxtree.Tree.coord_dtype`.
+        :returns: a tuple *(box_ids, event)*, where *box_ids* is a
+            :class:`pyopencl.array.Array` of the ids of the smallest boxes
+            containing each point, or -1 for points outside the root box.
+            These are leaf boxes, unless the tree was pruned and the point
+            lies in an empty box that was removed.
+        """
+        tree = table.tree
+        knl_info = self._get_kernel_info(tree)
+
+        from pytools import single_valued
+        if single_valued(pt.dtype for pt in points) != tree.coord_dtype:
+            raise TypeError("points dtype must match tree.coord_dtype")
+
+        bbox_min, _ = tree.bounding_box
+
+        result = cl.array.empty(queue, len(points[0]), tree.box_id_dtype)
+        evt = knl_info.point_locator(
+                *(tuple(points) + (tree.root_extent,) + tuple(bbox_min) + (
+                    tree.nlevels, result,
+                    table.table_keys, table.table_box_ids, table.table_bits)),
+                queue=queue, wait_for=wait_for)
+
+        return result, evt
+
+    def find_neighbors(self, queue, table, box_ids, offset, wait_for=None):
+        """
+        :arg table: a :class:`BoxHashTable`.
+        :arg box_ids: a :class:`pyopencl.array.Array` of box ids.
+        :arg offset: a sequence of integers, one per axis, in units of the
+            size of each box.
+        :returns: a tuple *(box_ids, event)*, where *box_ids* is a
+            :class:`pyopencl.array.Array` of the ids of the boxes on the
+            same levels as *box_ids*, displaced from them by *offset*, or
+            -1 where there is no such box. If the tree is periodic (see
+            :attr:`boxtree.Tree.is_periodic`), boxes displaced out of the
+            root box are found in its images.
+        """
+        tree = table.tree
+        knl_info = self._get_kernel_info(tree)
+
+        if len(offset) != tree.dimensions:
+            raise ValueError("offset must have one entry per axis")
+
+        bbox_min, _ = tree.bounding_box
+
+        result = cl.array.empty(queue, len(box_ids), tree.box_id_dtype)
+        evt = knl_info.neighbor_finder(
+                box_ids, tree.box_centers, tree.box_levels, tree.aligned_nboxes,
+                tree.root_extent, *(tuple(bbox_min) + tuple(offset) + (
+                    result,
+                    table.table_keys, table.table_box_ids, table.table_bits)),
+                queue=queue, wait_for=wait_for)
+
+        return result, evt
 
 # }}}
 
@@ -0,0 +1,322 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2017 Andreas Kloeckner and contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from time import time
+from contextlib import contextmanager
+
+import pyopencl as cl
+from pytools import Record
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Profiling
+---------
+
+:class:`boxtree.TreeBuilder`, :class:`boxtree.traversal.FMMTraversalBuilder`,
+:class:`boxtree.area_query.AreaQueryBuilder`,
+:class:`boxtree.area_query.PeerListFinder`, and
+:class:`boxtree.geo_lookup.LeavesToBallsLookupBuilder` accept a *profiler*
+argument. If it is given, they record the kernels they enqueue, the points
+at which the host waits for the device, and the sizes of the arrays they
+allocate in it::
+
+    queue = cl.CommandQueue(ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    from boxtree.profiling import Profiler
+    profiler = Profiler(queue)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30, profiler=profiler)
+    trav, _ = tg(queue, tree, profiler=profiler)
+
+    profiler.dump_chrome_trace("boxtree-trace.json")
+
+The resulting file may be viewed in ``chrome://tracing`` or in
+`Perfetto <https://ui.perfetto.dev>`_.
+
+.. autoclass:: Profiler
+
+.. autoclass:: ProfileRecord()
+"""
+
+
+# {{{ profile record
+
+class ProfileRecord(Record):
+    """
+    .. attribute:: kind
+
+        One of
+
+        * ``"kernel"``: a command executed on the device,
+        * ``"sync"``: a span of time in which the host waited for the device,
+          e.g. to read back the number of boxes,
+        * ``"host"``: a span of time spent on the host (possibly including
+          synchronization), for operations whose individual device commands
+          are not available, such as list-of-lists builds,
+        * ``"allocation"``: the allocation of an array.
+
+    .. attribute:: category
+
+        The name of the recording builder, e.g. ``"tree build"``.
+
+    .. attribute:: name
+
+    .. attribute:: start
+
+        Start time in seconds, in the host clock (see :func:`time.time`).
+        Device timestamps are converted to the host clock.
+
+    .. attribute:: end
+
+        End time, like :attr:`start`. Equal to :attr:`start` for
+        allocations.
+
+    .. attribute:: nbytes
+
+        The size of the allocation, for allocations. *None* otherwise.
+    """
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+# }}}
+
+
+# {{{ profiler
+
+class Profiler(object):
+    """Collects timing information from the builders in :mod:`boxtree`.
+
+    .. automethod:: __init__
+    .. automethod:: add_event
+    .. automethod:: add_host_span
+    .. automethod:: add_allocation
+    .. automethod:: get_records
+    .. automethod:: get_summary
+    .. automethod:: to_chrome_trace
+    .. automethod:: dump_chrome_trace
+    """
+
+    def __init__(self, queue):
+        """
+        :arg queue: A :class:`pyopencl.CommandQueue` with profiling enabled.
+            This queue is used to relate device timestamps to host time.
+            All queues whose commands are recorded must have profiling
+            enabled and belong to the same device.
+        """
+
+        if not queue.properties & cl.command_queue_properties.PROFILING_ENABLE:
+            raise ValueError("profiling requires a command queue with "
+                    "PROFILING_ENABLE")
+
+        # Relate device timestamps (in ns) to host time.
+        evt = cl.enqueue_marker(queue)
+        evt.wait()
+        self.device_time_offset = time() - evt.profile.end * 1e-9
+
+        self._records = []
+        self._pending_events = []
+
+    def add_event(self, category, name, event):
+        """Record the device command that completes *event*. The event's
+        timing information is only read once :meth:`get_records` is called.
+        """
+
+        if event is not None:
+            self._pending_events.append((category, name, event))
+
+    def add_host_span(self, category, name, start, end, kind="host"):
+        """Record a span of host time (in seconds, as returned by
+        :func:`time.time`). *kind* is ``"host"`` or ``"sync"``.
+        """
+
+        self._records.append(ProfileRecord(
+            kind=kind, category=category, name=name,
+            start=start, end=end, nbytes=None))
+
+    def add_allocation(self, category, name, nbytes):
+        t = time()
+        self._records.append(ProfileRecord(
+            kind="allocation", category=category, name=name,
+            start=t, end=t, nbytes=int(nbytes)))
+
+    def _resolve_events(self):
+        for category, name, event in self._pending_events:
+            event.wait()
+            try:
+                start = event.profile.start * 1e-9 + self.device_time_offset
+                end = event.profile.end * 1e-9 + self.device_time_offset
+            except cl.RuntimeError:
+                raise ValueError("no profiling information available for "
+                        "'%s' (%s), was it enqueued on a queue with "
+                        "PROFILING_ENABLE?" % (name, category))
+
+            self._records.append(ProfileRecord(
+                kind="kernel", category=category, name=name,
+                start=start, end=end, nbytes=None))
+
+        self._pending_events = []
+
+    def get_records(self):
+        """Wait for all recorded device commands to complete and return a
+        list of :class:`ProfileRecord` instances, sorted by start time.
+        """
+
+        self._resolve_events()
+        return sorted(self._records, key=lambda rec: rec.start)
+
+    def get_summary(self):
+        """Return a :class:`dict` mapping ``(kind, category, name)`` to a
+        tuple ``(count, total)``, where *total* is the total duration in
+        seconds for commands and spans, and the total number of bytes for
+        allocations.
+        """
+
+        result = {}
+        for rec in self.get_records():
+            key = (rec.kind, rec.category, rec.name)
+            count, total = result.get(key, (0, 0))
+            if rec.kind == "allocation":
+                total += rec.nbytes
+            else:
+                total += rec.duration
+            result[key] = (count + 1, total)
+
+        return result
+
+    def to_chrome_trace(self):
+        """Return the recorded information as a JSON-compatible
+        :class:`dict` in the Trace Event Format understood by
+        ``chrome://tracing``. Device commands and host spans are
+        shown in separate threads. Allocations are shown as instant events
+        and as a counter of the total number of allocated bytes.
+        """
+
+        records = self.get_records()
+        if records:
+            t0 = records[0].start
+        else:
+            t0 = 0
+
+        def to_us(t):
+            return (t - t0) * 1e6
+
+        pid = 0
+        tids = {"kernel": 0, "sync": 1, "host": 1, "allocation": 2}
+        thread_names = ["device", "host", "allocations"]
+
+        events = [
+                {"name": "process_name", "ph": "M", "pid": pid,
+                    "args": {"name": "boxtree"}}]
+        for tid, thread_name in enumerate(thread_names):
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": thread_name}})
+
+        total_nbytes = 0
+        for rec in records:
+            event = {
+                    "name": rec.name, "cat": "%s,%s" % (rec.category, rec.kind),
+                    "pid": pid, "tid": tids[rec.kind],
+                    "ts": to_us(rec.start)}
+
+            if rec.kind == "allocation":
+                total_nbytes += rec.nbytes
+                event.update(ph="i", s="t", args={"nbytes": rec.nbytes})
+                events.append(event)
+                events.append({
+                    "name": "allocated bytes", "ph": "C", "pid": pid,
+                    "ts": event["ts"],
+                    "args": {"nbytes": total_nbytes}})
+            else:
+                event.update(ph="X", dur=to_us(rec.end) - to_us(rec.start))
+                events.append(event)
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump_chrome_trace(self, filename):
+        """Write the result of :meth:`to_chrome_trace` to *filename* as
+        JSON.
+        """
+
+        import json
+        with open(filename, "w") as outf:
+            json.dump(self.to_chrome_trace(), outf)
+
+# }}}
+
+
+# {{{ recording helper for builders
+
+class ProfileRecorder(object):
+    """Records into a :class:`Profiler` on behalf of one builder, or does
+    nothing if the profiler is *None*. (Used internally by the builders.)
+    """
+
+    def __init__(self, profiler, category):
+        self.profiler = profiler
+        self.category = category
+
+    def event(self, name, event):
+        if self.profiler is not None:
+            self.profiler.add_event(self.category, name, event)
+
+    def allocation(self, name, ary):
+        if self.profiler is not None:
+            self.profiler.add_allocation(self.category, name, ary.nbytes)
+
+    def built_lists(self, name, result, event):
+        """Record the final *event* and the allocated lists of the *result*
+        of a :class:`pyopencl.algorithm.ListOfListsBuilder`.
+        """
+        self.event(name, event)
+        for list_name, built_list in sorted(result.items()):
+            self.allocation("%s: %s" % (name, list_name), built_list.starts)
+            self.allocation("%s: %s" % (name, list_name), built_list.lists)
+
+    @contextmanager
+    def span(self, name, kind="host"):
+        if self.profiler is None:
+            yield
+        else:
+            start = time()
+            yield
+            self.profiler.add_host_span(
+                    self.category, name, start, time(), kind=kind)
+
+    def sync(self, name):
+        """A context manager to be wrapped around operations in which the host
+        waits for the device.
+        """
+        return self.span(name, kind="sync")
+
+# }}}
+
+# vim: foldmethod=marker
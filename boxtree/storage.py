@@ -0,0 +1,300 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2017 Andreas Kloeckner and contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import os
+import json
+from importlib import import_module
+
+import six
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from boxtree.tools import DeviceDataRecord
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Saving and loading trees and traversals
+---------------------------------------
+
+:class:`boxtree.Tree`, :class:`boxtree.tree.TreeWithLinkedPointSources`
+and :class:`boxtree.traversal.FMMTraversalInfo` (as well as any other
+:class:`boxtree.tools.DeviceDataRecord`) may be stored on disk with
+:func:`save` and read back with :func:`load`. This allows, for example,
+building the tree and traversal for a geometry once and reusing them across
+many separate jobs.
+
+The on-disk format is a directory containing one ``.npy`` file per array and
+an index file, ``index.json``, that records the class of the stored record,
+the format version, and all scalar metadata (dtypes, flags, extents). Nested
+records, such as :attr:`boxtree.traversal.FMMTraversalInfo.tree`, are stored
+in subdirectories. Since the arrays are plain ``.npy`` files, :func:`load` can
+memory-map them instead of reading them into memory.
+
+.. autodata:: FORMAT_VERSION
+
+.. autofunction:: save
+.. autofunction:: load
+"""
+
+
+#: The version of the on-disk format written by :func:`save`. :func:`load`
+#: refuses to read data written with a newer version.
+FORMAT_VERSION = 1
+
+_INDEX_FILENAME = "index.json"
+_FORMAT_NAME = "boxtree-record"
+
+
+# {{{ save
+
+def _save_array(ary, dirname, filename):
+    np.save(os.path.join(dirname, filename), ary, allow_pickle=False)
+    return filename + ".npy"
+
+
+def _save_value(value, dirname, name, queue):
+    """Write *value* (if needed) and return a JSON-compatible description
+    of it.
+    """
+
+    if value is None:
+        return {"kind": "none"}
+
+    elif isinstance(value, DeviceDataRecord):
+        subdirname = os.path.join(dirname, name)
+        _save_record(value, subdirname, queue)
+        return {"kind": "record", "dir": name}
+
+    elif isinstance(value, cl.array.Array):
+        return {
+                "kind": "array",
+                "device": True,
+                "file": _save_array(value.get(queue=queue), dirname, name)}
+
+    elif isinstance(value, np.ndarray) and value.dtype.char == "O":
+        return {
+                "kind": "obj_array",
+                "entries": [
+                    _save_value(entry, dirname, "%s.%d" % (name, i), queue)
+                    for i, entry in enumerate(value)]}
+
+    elif isinstance(value, np.ndarray):
+        return {
+                "kind": "array",
+                "device": False,
+                "file": _save_array(value, dirname, name)}
+
+    elif isinstance(value, (tuple, list)):
+        return {
+                "kind": type(value).__name__,
+                "entries": [
+                    _save_value(entry, dirname, "%s.%d" % (name, i), queue)
+                    for i, entry in enumerate(value)]}
+
+    elif isinstance(value, np.dtype):
+        return {"kind": "dtype", "descr": np.lib.format.dtype_to_descr(value)}
+
+    elif isinstance(value, np.generic):
+        # Stored as a zero-dimensional array to round-trip the exact value and
+        # type.
+        return {
+                "kind": "numpy_scalar",
+                "file": _save_array(np.array(value), dirname, name)}
+
+    elif isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        # JSON represents these exactly.
+        return {"kind": "python_scalar", "value": value}
+
+    else:
+        raise TypeError("cannot save attribute '%s' of type '%s'"
+                % (name, type(value).__name__))
+
+
+def _save_record(record, dirname, queue):
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    cls = type(record)
+    fields = {}
+    for field_name in sorted(cls.fields):
+        try:
+            value = getattr(record, field_name)
+        except AttributeError:
+            continue
+
+        fields[field_name] = _save_value(value, dirname, field_name, queue)
+
+    index = {
+            "format": _FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "class": "%s.%s" % (cls.__module__, cls.__name__),
+            "fields": fields,
+            }
+
+    with open(os.path.join(dirname, _INDEX_FILENAME), "w") as outf:
+        json.dump(index, outf, indent=1, sort_keys=True)
+
+
+def save(record, dirname, queue=None):
+    """Store *record* in the directory *dirname*, which is created if it does
+    not exist. Existing files of the same name in *dirname* are overwritten.
+
+    :arg record: A :class:`boxtree.tools.DeviceDataRecord`, such as a
+        :class:`boxtree.Tree` or a
+        :class:`boxtree.traversal.FMMTraversalInfo`. Its data may live either
+        on the host or on the device.
+    :arg queue: A :class:`pyopencl.CommandQueue` used to transfer device
+        arrays to the host. May be *None* if all device arrays in *record*
+        have a queue associated with them.
+    """
+
+    logger.info("saving %s to '%s'" % (type(record).__name__, dirname))
+    _save_record(record, dirname, queue)
+
+# }}}
+
+
+# {{{ load
+
+def _load_array(dirname, filename, mmap):
+    path = os.path.join(dirname, filename)
+
+    if mmap:
+        try:
+            return np.load(path, mmap_mode="r", allow_pickle=False)
+        except ValueError:
+            # Some numpy versions cannot memory-map empty arrays.
+            pass
+
+    return np.load(path, allow_pickle=False)
+
+
+def _load_value(descr, dirname, queue, allocator, mmap):
+    kind = descr["kind"]
+
+    if kind == "none":
+        return None
+
+    elif kind == "record":
+        return _load_record(
+                os.path.join(dirname, descr["dir"]), queue, allocator, mmap)
+
+    elif kind == "array":
+        ary = _load_array(dirname, descr["file"], mmap)
+        if descr["device"] and queue is not None:
+            return cl.array.to_device(queue, ary, allocator=allocator)
+        return ary
+
+    elif kind == "obj_array":
+        from pytools.obj_array import make_obj_array
+        return make_obj_array([
+            _load_value(entry, dirname, queue, allocator, mmap)
+            for entry in descr["entries"]])
+
+    elif kind in ["tuple", "list"]:
+        entries = [
+                _load_value(entry, dirname, queue, allocator, mmap)
+                for entry in descr["entries"]]
+        return tuple(entries) if kind == "tuple" else entries
+
+    elif kind == "dtype":
+        return np.lib.format.descr_to_dtype(_to_descr(descr["descr"]))
+
+    elif kind == "numpy_scalar":
+        return _load_array(dirname, descr["file"], mmap=False)[()]
+
+    elif kind == "python_scalar":
+        return descr["value"]
+
+    else:
+        raise ValueError("unknown attribute kind '%s' in '%s'"
+                % (kind, dirname))
+
+
+def _to_descr(descr):
+    # JSON turns the tuples of structured dtype descriptions into lists.
+    if isinstance(descr, list):
+        return [tuple(_to_descr(item) for item in field) for field in descr]
+    return descr
+
+
+def _load_record(dirname, queue, allocator, mmap):
+    with open(os.path.join(dirname, _INDEX_FILENAME), "r") as inf:
+        index = json.load(inf)
+
+    if index.get("format") != _FORMAT_NAME:
+        raise ValueError("'%s' does not contain a saved boxtree record"
+                % dirname)
+    if index["version"] > FORMAT_VERSION:
+        raise ValueError("'%s' was saved in format version %d, "
+                "but this version of boxtree only supports up to version %d"
+                % (dirname, index["version"], FORMAT_VERSION))
+
+    module_name, _, class_name = index["class"].rpartition(".")
+    if not module_name.startswith("boxtree."):
+        raise ValueError("refusing to load record of class '%s'"
+                % index["class"])
+
+    cls = getattr(import_module(module_name), class_name)
+    if not issubclass(cls, DeviceDataRecord):
+        raise ValueError("'%s' is not a record type" % index["class"])
+
+    fields = dict(
+            (field_name, _load_value(descr, dirname, queue, allocator, mmap))
+            for field_name, descr in six.iteritems(index["fields"]))
+
+    result = cls(**fields)
+    if queue is not None:
+        result = result.with_queue(None)
+
+    return result
+
+
+def load(dirname, queue=None, allocator=None, mmap=True):
+    """Read back a record stored by :func:`save`.
+
+    :arg queue: If given, a :class:`pyopencl.CommandQueue`. All arrays that
+        lived on the device when the record was saved are uploaded to
+        :class:`pyopencl.array.Array` instances using this queue. (The
+        returned record is not associated with *queue*, just like the
+        results of :class:`boxtree.TreeBuilder`.) If *None*, all arrays
+        are returned as :class:`numpy.ndarray` instances, as if
+        :meth:`boxtree.tools.DeviceDataRecord.get` had been called.
+    :arg allocator: The allocator used for the uploaded device arrays.
+    :arg mmap: If *True*, the arrays are memory-mapped from their files
+        (read-only) rather than read into memory.
+
+    :returns: an instance of the class of the stored record.
+    """
+
+    logger.info("loading record from '%s'" % dirname)
+    return _load_record(dirname, queue, allocator, mmap)
+
+# }}}
+
+# vim: foldmethod=marker
@@ -24,10 +24,11 @@ THE SOFTWARE.
 
 
 import numpy as np
-from pytools import Record, memoize_method
+from pytools import Record
 import pyopencl as cl
 import pyopencl.array  # noqa
 from pyopencl.tools import first_arg_dependent_memoize_nested
+from pyopencl.algorithm import ListOfListsBuilder as _ListOfListsBuilderBase
 from mako.template import Template
 from pytools.obj_array import make_obj_array
 
@@ -57,6 +58,37 @@ def realloc_array(ary, new_shape, zero_fill, queue, wait_for):
     return new_ary, evt
 
 
+# {{{ context-wide memoization
+
+def memoize_method_in_context(method):
+    """Like :func:`pytools.memoize_method`, but shares the memoized results
+    among all instances of the class with the same ``self.context``. This
+    keeps separately created builders (e.g. one per time step or per job
+    phase) from generating and compiling the same kernels over again.
+
+    The result of *method* must only depend on the class, ``self.context``,
+    and the arguments.
+    """
+
+    cache = {}
+
+    def wrapper(self, *args, **kwargs):
+        key = (self.context, type(self), args, frozenset(kwargs.items()))
+        try:
+            return cache[key]
+        except KeyError:
+            result = method(self, *args, **kwargs)
+            cache[key] = result
+            return result
+
+    from functools import update_wrapper
+    update_wrapper(wrapper, method)
+    wrapper.clear_cache = cache.clear
+    return wrapper
+
+# }}}
+
+
 def reverse_index_array(indices, target_size=None, result_fill_value=None,
         queue=None):
     """For an array of *indices*, return a new array *result* that satisfies
@@ -345,7 +377,7 @@ class GappyCopyAndMapKernel:
     def __init__(self, context):
         self.context = context
 
-    @memoize_method
+    @memoize_method_in_context
     def _get_kernel(self, dtype, src_index_dtype, map_values=False):
         from pyopencl.tools import VectorArg
 
@@ -393,4 +425,57 @@ class GappyCopyAndMapKernel:
 
 # }}}
 
+
+# {{{ list-of-lists builder with selectable index type
+
+class _WideIndexObjectCount(int):
+    """An object count for which
+    :class:`pyopencl.algorithm.ListOfListsBuilder` picks a 64-bit index type.
+
+    (It otherwise only does so if the object count itself needs one, and it
+    offers no way to request the index type.)
+    """
+
+    def __ge__(self, other):
+        if other == np.iinfo(np.int32).max:
+            return True
+        return int.__ge__(self, other)
+
+
+class ListOfListsBuilder(_ListOfListsBuilderBase):
+    """A :class:`pyopencl.algorithm.ListOfListsBuilder` whose
+    :meth:`__call__` accepts an additional keyword argument *index_dtype*
+    (:class:`numpy.int32` or :class:`numpy.int64`), the type of the list
+    starts and of the object index. If not given, the index type is chosen
+    by :mod:`pyopencl`, based only on the number of objects.
+
+    .. automethod:: __call__
+    """
+
+    def __call__(self, queue, n_objects, *args, **kwargs):
+        index_dtype = kwargs.pop("index_dtype", None)
+
+        if index_dtype is not None:
+            index_dtype = np.dtype(index_dtype)
+
+            if index_dtype == np.int64:
+                n_objects = _WideIndexObjectCount(n_objects)
+            elif index_dtype == np.int32:
+                if n_objects >= np.iinfo(np.int32).max:
+                    raise ValueError("too many objects for 32-bit indices")
+            else:
+                raise TypeError("index_dtype must be int32 or int64")
+
+        result, evt = super(ListOfListsBuilder, self).__call__(
+                queue, n_objects, *args, **kwargs)
+
+        if index_dtype is not None:
+            assert all(
+                    built_list.starts.dtype == index_dtype
+                    for built_list in result.values())
+
+        return result, evt
+
+# }}}
+
 # vim: foldmethod=marker:filetype=pyopencl
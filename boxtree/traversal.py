@@ -23,12 +23,13 @@ THE SOFTWARE.
 """
 
 import numpy as np
-from pytools import Record, memoize_method, memoize_in
+from pytools import Record, memoize_in
 import pyopencl as cl
 import pyopencl.array  # noqa
 from pyopencl.elementwise import ElementwiseTemplate
 from mako.template import Template
-from boxtree.tools import AXIS_NAMES, DeviceDataRecord
+from boxtree.tools import (
+        AXIS_NAMES, DeviceDataRecord, memoize_method_in_context)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -50,6 +51,14 @@ typedef ${dtype_to_ctype(vec_types[coord_dtype, dimensions])} coord_vec_t;
 #define NLEVELS ${max_levels}
 #define STICK_OUT_FACTOR ((coord_t) ${stick_out_factor})
 
+// Periodic images of the root box, see boxtree.Tree.image_offsets.
+%if periodic:
+    #define NIMAGES ${3**dimensions}
+%else:
+    #define NIMAGES 1
+%endif
+#define IDENTITY_IMAGE (NIMAGES / 2)
+
 <%def name="load_center(name, box_id)">
     coord_vec_t ${name};
     %for i in range(dimensions):
@@ -127,6 +136,26 @@ typedef ${dtype_to_ctype(vec_types[coord_dtype, dimensions])} coord_vec_t;
     walk_morton_nr = 0;
 </%def>
 
+<%def name="image_frame_center(name, center, image)">
+    ## *center*, moved by the inverse of the displacement of *image*. Boxes
+    ## in that image of the tree are adjacent to (or overlap) *center* if
+    ## their untranslated versions are adjacent to this point.
+    coord_vec_t ${name} = ${center};
+    %if periodic:
+        %for i in range(dimensions):
+            ${name}.s${i} -= root_extent
+                * (coord_t) ((${image}) / ${3**i} % 3 - 1);
+        %endfor
+    %endif
+</%def>
+
+<%def name="append_with_image(list_name, box_id, image)">
+    APPEND_${list_name}(${box_id});
+    %if periodic:
+        APPEND_${list_name}_images(${image});
+    %endif
+</%def>
+
 <%def name="check_l_infty_ball_overlap(
         is_overlapping, box_id, ball_radius, ball_center)">
     {
@@ -194,6 +223,27 @@ inline bool is_adjacent_or_overlapping(
     return max_dist <= slack;
 }
 
+<%def name="skip_nonadjacent_image(image_center, level)">
+    %if periodic:
+    {
+        // Boxes in this image of the tree can only be adjacent to the box
+        // if this image of the root box is.
+        ${load_center("root_center", "0")}
+        if (!is_adjacent_or_overlapping(root_extent,
+                ${image_center}, ${level}, root_center, 0, false))
+            continue;
+    }
+    %endif
+</%def>
+
+<%def name="load_colleague_image(name, colleague_idx)">
+    %if periodic:
+        int ${name} = colleagues_images[${colleague_idx}];
+    %else:
+        const int ${name} = IDENTITY_IMAGE;
+    %endif
+</%def>
+
 """
 
 # }}}
@@ -260,75 +310,311 @@ LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE = ElementwiseTemplate(
 
 # }}}
 
-# {{{ colleagues
+# {{{ colleagues and peers, level by level
 
-COLLEAGUES_TEMPLATE = r"""//CL//
+# The colleagues and peers (see :class:`boxtree.area_query.PeerListFinder`)
+# of a box are derived from those of its parent, one level at a time, rather
+# than by a walk from the root for each box. Both come out in the order in
+# which such a walk finds them: by image, then depth-first.
+#
+# Neither kind of list ever has more than 3**dimensions entries (counting
+# each periodic image separately): Its boxes do not overlap, are at least
+# as big as the box, and are within half the box's size of it. So the lists
+# are first built in rows of that length, then compacted.
 
-void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
+LEVEL_LISTS_PREAMBLE_TEMPLATE = r"""//CL//
+
+#define MAX_LEVEL_LIST_LENGTH ${3**dimensions}
+
+<%def name="level_list_args(list_name)">
+    __global box_id_t *${list_name}_counts,
+    __global box_id_t *${list_name}_rows
+    %if periodic:
+        , __global char *${list_name}_images_rows
+    %endif
+</%def>
+
+<%def name="level_list_load(list_name, box_id, idx, image)">
+    %if periodic:
+        int ${image} = ${list_name}_images_rows[
+            MAX_LEVEL_LIST_LENGTH * ${box_id} + ${idx}];
+    %else:
+        const int ${image} = IDENTITY_IMAGE;
+    %endif
+</%def>
+
+## Appends to the row of box_id.
+<%def name="level_list_append(list_name, found_box_id, image)">
+    ${list_name}_rows[MAX_LEVEL_LIST_LENGTH * box_id + n] = ${found_box_id};
+    %if periodic:
+        ${list_name}_images_rows[MAX_LEVEL_LIST_LENGTH * box_id + n] =
+            ${image};
+    %endif
+    ++n;
+</%def>
+
+"""
+
+# {{{ neighborhoods
+
+# The "neighborhood" of a box is made up of the box itself and its
+# colleagues. The neighborhood of a box's parent contains the parents of all
+# boxes in the box's neighborhood. (Colleague lists are the neighborhoods
+# without the box itself.)
+
+LEVEL_NEIGHBORHOODS_TEMPLATE = r"""//CL//
+
+void find_neighborhood(
+    box_id_t box_id,
+    __global const coord_t *box_centers,
+    coord_t root_extent,
+    __global const unsigned char *box_levels,
+    box_id_t aligned_nboxes,
+    __global const box_id_t *box_child_ids,
+    __global const box_id_t *box_parent_ids,
+    ${level_list_args("neighborhood")}
+    )
 {
-    ${load_center("center", "box_id")}
+    int level = box_levels[box_id];
+    int n = 0;
 
-    if (box_id == 0)
+    if (level == 0)
     {
-        // The root has no colleagues.
+        // The root, and in a periodic tree, its images
+        for (int image = 0; image < NIMAGES; ++image)
+        { ${level_list_append("neighborhood", "box_id", "image")} }
+
+        neighborhood_counts[box_id] = n;
         return;
     }
 
-    int level = box_levels[box_id];
-
-    dbg_printf(("box id: %d level: %d\n", box_id, level));
+    ${load_center("center", "box_id")}
 
-    // To find this box's colleagues, start at the top of the tree, descend
-    // into adjacent (or overlapping) parents.
-    ${walk_init(0)}
+    box_id_t parent = box_parent_ids[box_id];
 
-    while (continue_walk)
+    for (box_id_t i = 0; i < neighborhood_counts[parent]; ++i)
     {
-        box_id_t child_box_id = box_child_ids[
-                walk_morton_nr * aligned_nboxes + walk_box_id];
-        dbg_printf(("  level: %d walk box id: %d morton: %d child id: %d\n",
-            walk_level, walk_box_id, walk_morton_nr, child_box_id));
+        box_id_t parent_neighbor = neighborhood_rows[
+            MAX_LEVEL_LIST_LENGTH * parent + i];
+        ${level_list_load("neighborhood", "parent", "i", "image")}
+        ${image_frame_center("image_center", "center", "image")}
 
-        if (child_box_id)
+        for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
         {
-            ${load_center("child_center", "child_box_id")}
-
-            bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                center, level, child_center, box_levels[child_box_id], false);
+            box_id_t child_box_id = box_child_ids[
+                    morton_nr * aligned_nboxes + parent_neighbor];
 
-            if (a_or_o)
+            if (child_box_id)
             {
-                // child_box_id lives on walk_level+1.
-                if (walk_level+1 == level  && child_box_id != box_id)
+                ${load_center("child_center", "child_box_id")}
+
+                if (is_adjacent_or_overlapping(root_extent,
+                        image_center, level, child_center, level, false))
                 {
-                    dbg_printf(("    colleague\n"));
-                    APPEND_colleagues(child_box_id);
+                    ${level_list_append(
+                        "neighborhood", "child_box_id", "image")}
                 }
-                else
-                {
-                    // We want to descend into this box. Put the current state
-                    // on the stack.
+            }
+        }
+    }
 
-                    dbg_printf(("    descend\n"));
-                    ${walk_push("child_box_id")}
+    neighborhood_counts[box_id] = n;
+}
 
-                    continue;
+"""
+
+# }}}
+
+# {{{ peers
+
+# The peers of a box are found among the peers of its parent: Those on the
+# parent's level are replaced by their children that are adjacent to the
+# box, or kept if there are none. Coarser ones are kept if they are adjacent
+# to the box. A coarser box that is adjacent to the box, but none of whose
+# children are, may also be an ancestor of peers of the parent. It is found
+# by ascending from the first of those.
+
+LEVEL_PEERS_TEMPLATE = r"""//CL//
+
+void find_peers(
+    box_id_t box_id,
+    __global const coord_t *box_centers,
+    coord_t root_extent,
+    __global const unsigned char *box_levels,
+    box_id_t aligned_nboxes,
+    __global const box_id_t *box_child_ids,
+    __global const box_id_t *box_parent_ids,
+    __global const box_flags_t *box_flags,
+    ${level_list_args("peers")}
+    )
+{
+    int level = box_levels[box_id];
+    int n = 0;
+
+    if (level == 0)
+    {
+        // Peer of root = self (and, in a periodic tree, its images)
+        for (int image = 0; image < NIMAGES; ++image)
+        { ${level_list_append("peers", "box_id", "image")} }
+
+        peers_counts[box_id] = n;
+        return;
+    }
+
+    ${load_center("center", "box_id")}
+
+    box_id_t parent = box_parent_ids[box_id];
+
+    // The root is not a peer of any other box, so it stands for 'none'.
+    box_id_t last_ascent_peer = 0;
+    int last_ascent_peer_image = 0;
+
+    for (box_id_t i = 0; i < peers_counts[parent]; ++i)
+    {
+        box_id_t parent_peer = peers_rows[MAX_LEVEL_LIST_LENGTH * parent + i];
+        ${level_list_load("peers", "parent", "i", "image")}
+        ${image_frame_center("image_center", "center", "image")}
+
+        int parent_peer_level = box_levels[parent_peer];
+        ${load_center("parent_peer_center", "parent_peer")}
+
+        if (is_adjacent_or_overlapping(root_extent,
+                image_center, level, parent_peer_center, parent_peer_level,
+                false))
+        {
+            if (parent_peer_level < level-1
+                    || !(box_flags[parent_peer] & BOX_HAS_CHILDREN))
+            {
+                // Coarser peers of the parent are leaves, or their
+                // children are not adjacent to the parent, and thus not
+                // to this box either.
+                if (parent_peer_level > 0)
+                {
+                    ${level_list_append("peers", "parent_peer", "image")}
                 }
             }
             else
             {
-                dbg_printf(("    not adjacent\n"));
+                bool found_child = false;
+
+                for (int morton_nr = 0; morton_nr < ${2**dimensions};
+                        ++morton_nr)
+                {
+                    box_id_t child_box_id = box_child_ids[
+                        morton_nr * aligned_nboxes + parent_peer];
+
+                    if (child_box_id)
+                    {
+                        ${load_center("child_center", "child_box_id")}
+
+                        if (is_adjacent_or_overlapping(root_extent,
+                                image_center, level, child_center, level,
+                                false))
+                        {
+                            ${level_list_append(
+                                "peers", "child_box_id", "image")}
+                            found_child = true;
+                        }
+                    }
+                }
+
+                if (!found_child && parent_peer_level > 0)
+                {
+                    ${level_list_append("peers", "parent_peer", "image")}
+                }
             }
         }
+        else
+        {
+            // Ascend to the first ancestor that is adjacent to this box.
+            // It is a peer if none of its children are adjacent.
+            box_id_t ancestor = parent_peer;
+            int ancestor_level = parent_peer_level;
+
+            while (ancestor_level > 1)
+            {
+                ancestor = box_parent_ids[ancestor];
+                --ancestor_level;
+
+                ${load_center("ancestor_center", "ancestor")}
+
+                if (is_adjacent_or_overlapping(root_extent,
+                        image_center, level, ancestor_center, ancestor_level,
+                        false))
+                {
+                    bool must_be_peer = true;
+
+                    for (int morton_nr = 0;
+                         must_be_peer && morton_nr < ${2**dimensions};
+                         ++morton_nr)
+                    {
+                        box_id_t child_box_id = box_child_ids[
+                            morton_nr * aligned_nboxes + ancestor];
+
+                        if (child_box_id)
+                        {
+                            ${load_center("child_center", "child_box_id")}
+                            must_be_peer &= !is_adjacent_or_overlapping(
+                                root_extent, image_center, level,
+                                child_center, ancestor_level+1, false);
+                        }
+                    }
+
+                    // The following peers of the parent may descend from
+                    // the same ancestor.
+                    if (must_be_peer
+                            && !(ancestor == last_ascent_peer
+                                && image == last_ascent_peer_image))
+                    {
+                        ${level_list_append("peers", "ancestor", "image")}
+                        last_ascent_peer = ancestor;
+                        last_ascent_peer_image = image;
+                    }
 
-        ${walk_advance()}
+                    break;
+                }
+            }
+        }
     }
+
+    peers_counts[box_id] = n;
 }
 
 """
 
 # }}}
 
+# {{{ compaction
+
+LEVEL_LIST_COMPACTION_TEMPLATE = r"""//CL//
+    box_id_t list_idx = starts[i];
+
+    for (box_id_t row_idx = 0; row_idx < counts[i]; ++row_idx)
+    {
+        box_id_t row_box_id = rows[MAX_LEVEL_LIST_LENGTH * i + row_idx];
+        %if periodic:
+            char image = images_rows[MAX_LEVEL_LIST_LENGTH * i + row_idx];
+        %endif
+
+        if (exclude_self && row_box_id == i
+                %if periodic:
+                    && image == IDENTITY_IMAGE
+                %endif
+                )
+            continue;
+
+        lists[list_idx] = row_box_id;
+        %if periodic:
+            images_lists[list_idx] = image;
+        %endif
+        ++list_idx;
+    }
+"""
+
+# }}}
+
+# }}}
+
 # {{{ neighbor source boxes ("list 1")
 
 NEIGBHOR_SOURCE_BOXES_TEMPLATE = r"""//CL//
@@ -346,68 +632,248 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
     dbg_printf(("box id: %d level: %d\n", box_id, level));
 
-    // root box is not part of walk, check it up front.
-    // Also no need to check for overlap-iness. The root box
-    // overlaps *everybody*.
-
+    // Boxes adjacent to this one are its peers, their ancestors, and the
+    // adjacent descendants of the peers on its own level. Taken in the
+    // order of the peers, they are found in the order of a depth-first walk
+    // from the root. In a periodic tree, do so in each image of the tree.
+    for (int image = 0; image < NIMAGES; ++image)
     {
-        box_flags_t root_flags = box_flags[0];
-        if (root_flags & BOX_HAS_OWN_SOURCES)
-        {
-            APPEND_neighbor_source_boxes(0);
-        }
-    }
+        ${image_frame_center("image_center", "center", "image")}
+        ${skip_nonadjacent_image("image_center", "level")}
 
-    // To find this box's colleagues, start at the top of the tree, descend
-    // into adjacent (or overlapping) parents.
-    ${walk_init(0)}
+        // The root box is not a peer of other boxes, check it up front.
+        // Also no need to check for overlap-iness. The root box
+        // overlaps *everybody*. (Its images were checked above.)
 
-    while (continue_walk)
-    {
-        box_id_t child_box_id = box_child_ids[
-                walk_morton_nr * aligned_nboxes + walk_box_id];
+        {
+            box_flags_t root_flags = box_flags[0];
+            if (root_flags & BOX_HAS_OWN_SOURCES)
+            {
+                ${append_with_image("neighbor_source_boxes", "0", "image")}
+            }
+        }
 
-        dbg_printf(("  walk box id: %d morton: %d child id: %d level: %d\n",
-            walk_box_id, walk_morton_nr, child_box_id, walk_level));
+        %if sources_have_extent or targets_have_extent:
+            // Boxes with children may have own sources, so ancestors of
+            // peers need to be checked. Those of the previous peer (in this
+            // image) have been. (The root stands for 'none'.)
+            box_id_t prev_peer = 0;
+        %endif
 
-        if (child_box_id)
+        for (box_id_t i = peer_list_starts[box_id];
+                i < peer_list_starts[box_id+1]; ++i)
         {
-            ${load_center("child_center", "child_box_id")}
+            %if periodic:
+                if (peer_list_images[i] != image)
+                    continue;
+            %endif
 
-            bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                center, level, child_center, box_levels[child_box_id], false);
+            box_id_t peer = peer_lists[i];
+            int peer_level = box_levels[peer];
 
-            if (a_or_o)
+            %if sources_have_extent or targets_have_extent:
             {
-                box_flags_t flags = box_flags[child_box_id];
-                /* child_box_id == box_id is ok */
-                if (flags & BOX_HAS_OWN_SOURCES)
+                box_id_t ancestors[NLEVELS];
+                int nancestors = 0;
+
+                box_id_t ancestor = peer;
+                int ancestor_level = peer_level;
+                box_id_t prev_ancestor = prev_peer;
+                int prev_ancestor_level = box_levels[prev_peer];
+
+                while (ancestor_level > 1)
                 {
-                    dbg_printf(("    neighbor source box\n"));
+                    ancestor = box_parent_ids[ancestor];
+                    --ancestor_level;
+
+                    while (prev_ancestor_level > ancestor_level)
+                    {
+                        prev_ancestor = box_parent_ids[prev_ancestor];
+                        --prev_ancestor_level;
+                    }
 
-                    APPEND_neighbor_source_boxes(child_box_id);
+                    if (ancestor == prev_ancestor)
+                        break;
+
+                    ancestors[nancestors++] = ancestor;
                 }
 
-                if (flags & BOX_HAS_CHILD_SOURCES)
+                while (nancestors)
                 {
-                    // We want to descend into this box. Put the current state
-                    // on the stack.
+                    box_id_t ancestor = ancestors[--nancestors];
+                    if (box_flags[ancestor] & BOX_HAS_OWN_SOURCES)
+                    {
+                        dbg_printf(("    ancestor neighbor source box\n"));
+                        ${append_with_image(
+                            "neighbor_source_boxes", "ancestor", "image")}
+                    }
+                }
 
-                    dbg_printf(("    descend\n"));
+                prev_peer = peer;
+            }
+            %endif
 
-                    ${walk_push("child_box_id")}
+            box_flags_t peer_flags = box_flags[peer];
 
-                    continue;
+            /* peer == box_id is ok */
+            if (peer_level > 0 && (peer_flags & BOX_HAS_OWN_SOURCES))
+            {
+                dbg_printf(("    neighbor source box\n"));
+                ${append_with_image("neighbor_source_boxes", "peer", "image")}
+            }
+
+            // Coarser peers are leaves, or have no adjacent children.
+            if (peer_level < level || !(peer_flags & BOX_HAS_CHILD_SOURCES))
+                continue;
+
+            ${walk_init("peer")}
+
+            while (continue_walk)
+            {
+                box_id_t child_box_id = box_child_ids[
+                        walk_morton_nr * aligned_nboxes + walk_box_id];
+
+                dbg_printf(("  walk box id: %d morton: %d child id: %d\n",
+                    walk_box_id, walk_morton_nr, child_box_id));
+
+                if (child_box_id)
+                {
+                    ${load_center("child_center", "child_box_id")}
+
+                    bool a_or_o = is_adjacent_or_overlapping(root_extent,
+                        image_center, level, child_center,
+                        box_levels[child_box_id], false);
+
+                    if (a_or_o)
+                    {
+                        box_flags_t flags = box_flags[child_box_id];
+                        if (flags & BOX_HAS_OWN_SOURCES)
+                        {
+                            dbg_printf(("    neighbor source box\n"));
+
+                            ${append_with_image(
+                                "neighbor_source_boxes", "child_box_id",
+                                "image")}
+                        }
+
+                        if (flags & BOX_HAS_CHILD_SOURCES)
+                        {
+                            // We want to descend into this box. Put the
+                            // current state on the stack.
+
+                            dbg_printf(("    descend\n"));
+
+                            ${walk_push("child_box_id")}
+
+                            continue;
+                        }
+                    }
+                    else
+                    {
+                        dbg_printf(("    not adjacent\n"));
+                    }
                 }
+
+                ${walk_advance()}
             }
-            else
+        }
+    }
+}
+
+"""
+
+# In a balanced tree (see :attr:`boxtree.Tree.is_balanced`), leaf boxes
+# adjacent to a (leaf) target box are at most one level above or below it,
+# so no walk from the root is needed: They are among the colleagues of the
+# box, the children of those colleagues, and the colleagues of its parent.
+# (This requires sources and targets without extent, so that boxes with own
+# sources are leaves.)
+
+BALANCED_NEIGBHOR_SOURCE_BOXES_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // /!\ target_box_number is *not* a box_id, despite the type.
+    // It's the number of the source box we're currently processing.
+
+    box_id_t box_id = target_boxes[target_box_number];
+
+    ${load_center("center", "box_id")}
+
+    int level = box_levels[box_id];
+
+    if (box_flags[box_id] & BOX_HAS_OWN_SOURCES)
+    {
+        APPEND_neighbor_source_boxes(box_id);
+    }
+
+    if (level == 0)
+        return;
+
+    // {{{ one level up: colleagues of the parent
+
+    box_id_t parent = box_parent_ids[box_id];
+
+    for (box_id_t i = colleagues_starts[parent];
+            i < colleagues_starts[parent+1]; ++i)
+    {
+        box_id_t parent_colleague = colleagues_list[i];
+
+        if (box_flags[parent_colleague] & BOX_HAS_OWN_SOURCES)
+        {
+            ${load_center("parent_colleague_center", "parent_colleague")}
+
+            bool a_or_o = is_adjacent_or_overlapping(root_extent,
+                center, level, parent_colleague_center, level-1, false);
+
+            if (a_or_o)
             {
-                dbg_printf(("    not adjacent\n"));
+                APPEND_neighbor_source_boxes(parent_colleague);
             }
         }
+    }
+
+    // }}}
+
+    // {{{ same level and one level down: colleagues and their children
+
+    // /!\ i is not a box_id, it's an index into colleagues_list.
+    for (box_id_t i = colleagues_starts[box_id];
+            i < colleagues_starts[box_id+1]; ++i)
+    {
+        box_id_t colleague = colleagues_list[i];
+        box_flags_t colleague_flags = box_flags[colleague];
 
-        ${walk_advance()}
+        if (colleague_flags & BOX_HAS_OWN_SOURCES)
+        {
+            APPEND_neighbor_source_boxes(colleague);
+        }
+
+        if (colleague_flags & BOX_HAS_CHILD_SOURCES)
+        {
+            for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
+            {
+                box_id_t child_box_id = box_child_ids[
+                        morton_nr * aligned_nboxes + colleague];
+
+                if (child_box_id
+                        && (box_flags[child_box_id] & BOX_HAS_OWN_SOURCES))
+                {
+                    ${load_center("child_center", "child_box_id")}
+
+                    bool a_or_o = is_adjacent_or_overlapping(root_extent,
+                        center, level, child_center, level+1, false);
+
+                    if (a_or_o)
+                    {
+                        APPEND_neighbor_source_boxes(child_box_id);
+                    }
+                }
+            }
+        }
     }
+
+    // }}}
 }
 
 """
@@ -438,19 +904,26 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     {
         box_id_t parent_colleague = colleagues_list[i];
 
+        // The siblings are in the same image of the tree as their parent.
+        ${load_colleague_image("image", "i")}
+        ${image_frame_center("image_center", "center", "image")}
+
         for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
         {
             box_id_t sib_box_id = box_child_ids[
                     morton_nr * aligned_nboxes + parent_colleague];
 
+            if (!sib_box_id)
+                continue;
+
             ${load_center("sib_center", "sib_box_id")}
 
             bool sep = !is_adjacent_or_overlapping(root_extent,
-                center, level, sib_center, box_levels[sib_box_id], false);
+                image_center, level, sib_center, box_levels[sib_box_id], false);
 
             if (sep)
             {
-                APPEND_sep_siblings(sib_box_id);
+                ${append_with_image("sep_siblings", "sib_box_id", "image")}
             }
         }
     }
@@ -482,6 +955,10 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
     {
         box_id_t colleague = colleagues_list[i];
 
+        // The walk stays in the image of the tree that the colleague is in.
+        ${load_colleague_image("image", "i")}
+        ${image_frame_center("image_center", "center", "image")}
+
         ${walk_init("colleague")}
 
         while (continue_walk)
@@ -520,7 +997,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                 ${load_center("child_center", "child_box_id")}
 
                 bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                    center, level, child_center, box_levels[child_box_id], false);
+                    image_center, level, child_center, box_levels[child_box_id],
+                    false);
 
                 if (a_or_o)
                 {
@@ -538,7 +1016,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     %if sources_have_extent or targets_have_extent:
                         const bool a_or_o_with_stick_out =
                             is_adjacent_or_overlapping(root_extent,
-                                center, level, child_center,
+                                image_center, level, child_center,
                                 box_levels[child_box_id], true);
                     %else:
                         const bool a_or_o_with_stick_out = false;
@@ -550,7 +1028,8 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
                     if (!a_or_o_with_stick_out)
                     {
-                        APPEND_sep_smaller(child_box_id);
+                        ${append_with_image(
+                            "sep_smaller", "child_box_id", "image")}
                     }
                     else
                     {
@@ -576,6 +1055,54 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 }
 """
 
+# In a balanced tree, children of colleagues that are adjacent to a (leaf)
+# target box are leaves, so there is nothing to descend into.
+
+BALANCED_SEP_SMALLER_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
+{
+    // /!\ target_box_number is *not* a box_id, despite the type.
+    // It's the number of the target box we're currently processing.
+
+    box_id_t box_id = target_boxes[target_box_number];
+
+    ${load_center("center", "box_id")}
+
+    int level = box_levels[box_id];
+
+    // /!\ i is not a box_id, it's an index into colleagues_list.
+    for (box_id_t i = colleagues_starts[box_id];
+            i < colleagues_starts[box_id+1]; ++i)
+    {
+        box_id_t colleague = colleagues_list[i];
+
+        if (!(box_flags[colleague] & BOX_HAS_CHILD_SOURCES))
+            continue;
+
+        for (int morton_nr = 0; morton_nr < ${2**dimensions}; ++morton_nr)
+        {
+            box_id_t child_box_id = box_child_ids[
+                    morton_nr * aligned_nboxes + colleague];
+
+            if (child_box_id && (box_flags[child_box_id] &
+                        (BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES)))
+            {
+                ${load_center("child_center", "child_box_id")}
+
+                bool a_or_o = is_adjacent_or_overlapping(root_extent,
+                    center, level, child_center, level+1, false);
+
+                if (!a_or_o)
+                {
+                    APPEND_sep_smaller(child_box_id);
+                }
+            }
+        }
+    }
+}
+"""
+
 # }}}
 
 # {{{ separated bigger ("list 4")
@@ -674,8 +1201,9 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
     // Look for colleagues of parents that are non-adjacent to tgt_ibox.
     // Walk up the tree from tgt_ibox.
 
-    // Box 0 (== level 0) doesn't have any colleagues, so we can stop the
-    // search for such colleagues there.
+    // Box 0 (== level 0) doesn't have any colleagues (other than its
+    // periodic images, which only have sources of their own if box 0 is
+    // the only box), so we can stop the search for such colleagues there.
     for (int walk_level = box_level - 1; walk_level != 0;
             // {{{ advance
             --walk_level,
@@ -693,9 +1221,15 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 
             if (box_flags[colleague_box_id] & BOX_HAS_OWN_SOURCES)
             {
+                ${load_colleague_image("image", "i")}
+                ${image_frame_center("image_center", "center", "image")}
+                ${image_frame_center(
+                    "image_parent_center", "parent_center", "image")}
+
                 ${load_center("colleague_center", "colleague_box_id")}
                 bool a_or_o = is_adjacent_or_overlapping(root_extent,
-                    center, box_level, colleague_center, walk_level, false);
+                    image_center, box_level, colleague_center, walk_level,
+                    false);
 
                 if (!a_or_o)
                 {
@@ -704,7 +1238,7 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
                     %if sources_have_extent or targets_have_extent:
                         const bool a_or_o_with_stick_out =
                             is_adjacent_or_overlapping(root_extent,
-                                center, box_level, colleague_center,
+                                image_center, box_level, colleague_center,
                                 walk_level, true);
 
                     if (a_or_o_with_stick_out)
@@ -723,15 +1257,16 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
                     {
                         bool parent_a_or_o_with_stick_out =
                             is_adjacent_or_overlapping(root_extent,
-                                parent_center, box_level-1, colleague_center,
-                                walk_level, true);
+                                image_parent_center, box_level-1,
+                                colleague_center, walk_level, true);
 
                         if (parent_a_or_o_with_stick_out)
                         {
                             // "Case 2" above: We're the first box down the chain
                             // to be far enough away to let the interaction into
                             // our local downward subtree.
-                            APPEND_sep_bigger(colleague_box_id);
+                            ${append_with_image(
+                                "sep_bigger", "colleague_box_id", "image")}
                         }
                         else
                         {
@@ -748,6 +1283,46 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 }
 """
 
+# In a balanced tree, a colleague A of an ancestor of "B" above B's parent
+# cannot be a leaf adjacent to the ancestor's child on the path to B, as
+# that child is not a leaf. So A can only be in B's list 4 if it is a
+# colleague of B's parent.
+
+BALANCED_SEP_BIGGER_TEMPLATE = r"""//CL//
+
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
+{
+    box_id_t tgt_ibox = target_or_target_parent_boxes[itarget_or_target_parent_box];
+    ${load_center("center", "tgt_ibox")}
+
+    int box_level = box_levels[tgt_ibox];
+    // The root box has no parents, so no list 4.
+    if (box_level == 0)
+        return;
+
+    box_id_t parent_box_id = box_parent_ids[tgt_ibox];
+
+    // /!\ i is not a box id, it's an index into colleagues_list.
+    for (box_id_t i = colleagues_starts[parent_box_id];
+            i < colleagues_starts[parent_box_id+1]; ++i)
+    {
+        box_id_t colleague_box_id = colleagues_list[i];
+
+        if (box_flags[colleague_box_id] & BOX_HAS_OWN_SOURCES)
+        {
+            ${load_center("colleague_center", "colleague_box_id")}
+            bool a_or_o = is_adjacent_or_overlapping(root_extent,
+                center, box_level, colleague_center, box_level-1, false);
+
+            if (!a_or_o)
+            {
+                APPEND_sep_bigger(colleague_box_id);
+            }
+        }
+    }
+}
+"""
+
 # }}}
 
 
@@ -890,7 +1465,9 @@ class FMMTraversalInfo(DeviceDataRecord):
     :attr:`sep_close_smaller_starts` will be non-*None*. It records
     interactions between boxes that would ordinarily be handled
     through "List 3", but must be evaluated specially/directly
-    because of :ref:`extent`.
+    because of :ref:`extent`. The same is true for trees with nonzero
+    :attr:`boxtree.Tree.looseness`, whose particles may lie outside
+    their boxes.
 
     Indexed like :attr:`target_or_target_parent_boxes`.  See :ref:`csr`.
 
@@ -921,7 +1498,8 @@ class FMMTraversalInfo(DeviceDataRecord):
     :attr:`sep_close_bigger_starts` will be non-*None*. It records
     interactions between boxes that would ordinarily be handled
     through "List 4", but must be evaluated specially/directly
-    because of :ref:`extent`.
+    because of :ref:`extent`. The same is true for trees with nonzero
+    :attr:`boxtree.Tree.looseness`.
 
     Indexed like :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
 
@@ -940,17 +1518,58 @@ class FMMTraversalInfo(DeviceDataRecord):
     .. attribute:: sep_close_bigger_lists
 
         ``box_id_t [*]`` (or *None*)
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Periodic Images
+    .. ------------------------------------------------------------------------
+
+    If :attr:`boxtree.Tree.is_periodic`, boxes in the lists above may be
+    periodic images of the boxes they name. The following arrays then give
+    the image number of each list entry, an index into
+    :attr:`boxtree.Tree.image_offsets`. Sources in a box entered with
+    image *i* interact with the target box as if displaced by
+    ``tree.image_offsets[i] * tree.root_extent``. Together, the lists of
+    a target box and of its ancestors then cover the sources in the root
+    box and in each of its adjacent images exactly once. For trees that
+    are not periodic, these arrays are *None*.
+
+    .. attribute:: colleagues_images
+
+        ``int8 [*]`` (or *None*), indexed like :attr:`colleagues_lists`.
+
+    .. attribute:: neighbor_source_boxes_images
+
+        ``int8 [*]`` (or *None*), indexed like
+        :attr:`neighbor_source_boxes_lists`.
+
+    .. attribute:: sep_siblings_images
+
+        ``int8 [*]`` (or *None*), indexed like :attr:`sep_siblings_lists`.
+
+    .. attribute:: sep_smaller_images
+
+        ``int8 [*]`` (or *None*), indexed like :attr:`sep_smaller_lists`.
+
+    .. attribute:: sep_bigger_images
+
+        ``int8 [*]`` (or *None*), indexed like :attr:`sep_bigger_lists`.
     """
 
     # {{{ "close" list merging -> "unified list 1"
 
-    def merge_close_lists(self, queue, debug=False):
+    def merge_close_lists(self, queue, debug=False, profiler=None):
         """Return a new :class:`FMMTraversalInfo` instance with the contents of
         :attr:`sep_close_smaller_starts` and :attr:`sep_close_bigger_starts`
         merged into :attr:`neighbor_source_boxes_starts` and these two
         attributes set to *None*.
+
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the enqueued kernels are recorded.
         """
 
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "merge close lists")
+
         from boxtree.tools import reverse_index_array
         target_or_target_parent_boxes_from_all_boxes = reverse_index_array(
                 self.target_or_target_parent_boxes, target_size=self.tree.nboxes,
@@ -1046,7 +1665,7 @@ class FMMTraversalInfo(DeviceDataRecord):
         ntarget_boxes = len(self.target_boxes)
         new_neighbor_source_boxes_counts = cl.array.empty(
                 queue, ntarget_boxes+1, self.tree.box_id_dtype)
-        get_new_nb_sources_knl(True)(
+        evt = get_new_nb_sources_knl(True)(
             # input:
             target_or_target_parent_boxes_from_tgt_boxes,
             self.neighbor_source_boxes_starts,
@@ -1057,19 +1676,25 @@ class FMMTraversalInfo(DeviceDataRecord):
             new_neighbor_source_boxes_counts,
             range=slice(ntarget_boxes),
             queue=queue)
+        prof.event("count merged lists", evt)
 
         new_neighbor_source_boxes_starts = cl.array.cumsum(
                 new_neighbor_source_boxes_counts)
+        prof.event("scan merged list counts",
+                new_neighbor_source_boxes_starts.events[-1])
         del new_neighbor_source_boxes_counts
 
+        with prof.sync("read back merged list length"):
+            nnew_neighbor_source_boxes = int(
+                    new_neighbor_source_boxes_starts[ntarget_boxes].get())
+
         new_neighbor_source_boxes_lists = cl.array.empty(
-                queue,
-                int(new_neighbor_source_boxes_starts[ntarget_boxes].get()),
-                self.tree.box_id_dtype)
+                queue, nnew_neighbor_source_boxes, self.tree.box_id_dtype)
+        prof.allocation("merged lists", new_neighbor_source_boxes_lists)
 
         new_neighbor_source_boxes_lists.fill(999999999)
 
-        get_new_nb_sources_knl(False)(
+        evt = get_new_nb_sources_knl(False)(
             # input:
             target_or_target_parent_boxes_from_tgt_boxes,
 
@@ -1086,6 +1711,7 @@ class FMMTraversalInfo(DeviceDataRecord):
             new_neighbor_source_boxes_lists,
             range=slice(ntarget_boxes),
             queue=queue)
+        prof.event("write merged lists", evt)
 
         return self.copy(
             neighbor_source_boxes_starts=new_neighbor_source_boxes_starts,
@@ -1114,6 +1740,241 @@ class FMMTraversalInfo(DeviceDataRecord):
 # }}}
 
 
+# {{{ concurrent list builds
+
+def _call_on_separate_queues(queue, funcs):
+    """Call each of *funcs* with a command queue as its only argument, the
+    first one with *queue*, the others with new queues on the same device,
+    each from its own host thread. (List builders block the host while
+    reading back list lengths, so a single queue, even an out-of-order one,
+    would not let them overlap.)
+
+    :returns: a list of the return values of *funcs*.
+    """
+
+    import threading
+
+    results = [None] * len(funcs)
+    exc_infos = []
+
+    def run(i, func, func_queue):
+        try:
+            results[i] = func(func_queue)
+        except Exception:
+            import sys
+            exc_infos.append(sys.exc_info())
+
+    threads = []
+    for i, func in enumerate(funcs[1:], 1):
+        func_queue = cl.CommandQueue(queue.context, queue.device,
+                properties=queue.properties)
+        thread = threading.Thread(target=run, args=(i, func, func_queue))
+        thread.start()
+        threads.append(thread)
+
+    run(0, funcs[0], queue)
+
+    for thread in threads:
+        thread.join()
+
+    if exc_infos:
+        import six
+        six.reraise(*exc_infos[0])
+
+    return results
+
+# }}}
+
+
+# {{{ level-by-level colleague and peer lists
+
+class _LevelByLevelListsBuilder(object):
+    """Builds colleague or peer lists one tree level at a time. (Used by
+    :class:`FMMTraversalBuilder` and :class:`boxtree.area_query.PeerListFinder`.)
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @memoize_method_in_context
+    def get_kernel_info(self, list_kind, dimensions, coord_dtype, box_id_dtype,
+            periodic):
+        from pyopencl.tools import dtype_to_ctype
+        from boxtree.tree import box_flags_enum
+        render_vars = dict(
+                dimensions=dimensions,
+                dtype_to_ctype=dtype_to_ctype,
+                particle_id_dtype=None,
+                box_id_dtype=box_id_dtype,
+                box_flags_enum=box_flags_enum,
+                coord_dtype=coord_dtype,
+                vec_types=cl.array.vec.types,
+                # Not used (but required by TRAVERSAL_PREAMBLE_TEMPLATE)
+                max_levels=0,
+                stick_out_factor=0,
+                AXIS_NAMES=AXIS_NAMES,
+                debug=False,
+                periodic=periodic,
+                # For calls to the helper is_adjacent_or_overlapping()
+                sources_have_extent=False,
+                targets_have_extent=False,
+                )
+
+        from pyopencl.tools import VectorArg, ScalarArg
+
+        if list_kind == "colleagues":
+            template = LEVEL_NEIGHBORHOODS_TEMPLATE
+            func_name = "find_neighborhood"
+            rows_name = "neighborhood"
+            extra_args = []
+        elif list_kind == "peers":
+            template = LEVEL_PEERS_TEMPLATE
+            func_name = "find_peers"
+            rows_name = "peers"
+            extra_args = [VectorArg(box_flags_enum.dtype, "box_flags")]
+        else:
+            raise ValueError("unknown list kind '%s'" % list_kind)
+
+        preamble = Template(
+                TRAVERSAL_PREAMBLE_TEMPLATE
+                + HELPER_FUNCTION_TEMPLATE
+                + LEVEL_LISTS_PREAMBLE_TEMPLATE
+                + template,
+                strict_undefined=True).render(**render_vars)
+
+        args = [
+                VectorArg(coord_dtype, "box_centers"),
+                ScalarArg(coord_dtype, "root_extent"),
+                VectorArg(np.uint8, "box_levels"),
+                ScalarArg(box_id_dtype, "aligned_nboxes"),
+                VectorArg(box_id_dtype, "box_child_ids"),
+                VectorArg(box_id_dtype, "box_parent_ids"),
+                ] + extra_args + [
+                VectorArg(box_id_dtype, rows_name+"_counts"),
+                VectorArg(box_id_dtype, rows_name+"_rows"),
+                ] + ([VectorArg(np.int8, rows_name+"_images_rows")]
+                    if periodic else [])
+
+        from pyopencl.elementwise import ElementwiseKernel
+        level_lists_finder = ElementwiseKernel(self.context, args,
+                "%s(i, %s)" % (func_name, ", ".join(arg.name for arg in args)),
+                name=func_name+"_on_level", preamble=str(preamble))
+
+        from pyopencl.scan import GenericScanKernel
+        starts_scan = GenericScanKernel(
+                self.context, box_id_dtype,
+                arguments=[
+                    # input
+                    VectorArg(box_id_dtype, "counts"),
+                    ScalarArg(np.int32, "exclude_self"),
+                    # output
+                    VectorArg(box_id_dtype, "starts"),
+                    ],
+                input_expr="counts[i] - exclude_self",
+                scan_expr="a+b", neutral="0",
+                output_statement="""
+                    starts[i] = prev_item;
+                    if (i+1 == N) starts[N] = item;
+                    """,
+                name_prefix="level_list_starts")
+
+        compactor = ElementwiseKernel(self.context,
+                [
+                    VectorArg(box_id_dtype, "counts"),
+                    VectorArg(box_id_dtype, "rows"),
+                    ] + ([VectorArg(np.int8, "images_rows")]
+                        if periodic else []) + [
+                    ScalarArg(np.int32, "exclude_self"),
+                    VectorArg(box_id_dtype, "starts"),
+                    VectorArg(box_id_dtype, "lists"),
+                    ] + ([VectorArg(np.int8, "images_lists")]
+                        if periodic else []),
+                str(Template(LEVEL_LIST_COMPACTION_TEMPLATE,
+                    strict_undefined=True).render(periodic=periodic)),
+                name="compact_level_lists",
+                preamble=str(Template(
+                    TRAVERSAL_PREAMBLE_TEMPLATE + LEVEL_LISTS_PREAMBLE_TEMPLATE,
+                    strict_undefined=True).render(**render_vars)))
+
+        return _KernelInfo(
+                level_lists_finder=level_lists_finder,
+                starts_scan=starts_scan,
+                compactor=compactor)
+
+    def __call__(self, queue, tree, list_kind, wait_for=None):
+        """
+        :arg list_kind: ``"colleagues"`` or ``"peers"``.
+        :returns: a tuple *(result, event)*, where *result* is a dictionary
+            like those returned by :class:`boxtree.tools.ListOfListsBuilder`,
+            containing the list *list_kind* and, for periodic trees, the
+            list of images named with a suffix ``_images``.
+        """
+
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
+        knl_info = self.get_kernel_info(list_kind, tree.dimensions,
+                tree.coord_dtype, tree.box_id_dtype, periodic)
+
+        nboxes = tree.nboxes
+        max_list_length = 3**tree.dimensions
+
+        counts = cl.array.empty(queue, nboxes, tree.box_id_dtype)
+        rows = cl.array.empty(queue, nboxes * max_list_length, tree.box_id_dtype)
+        if periodic:
+            images_rows = cl.array.empty(queue, nboxes * max_list_length, np.int8)
+            images_rows_args = (images_rows,)
+        else:
+            images_rows_args = ()
+
+        extra_args = (tree.box_flags,) if list_kind == "peers" else ()
+
+        for level in range(tree.nlevels):
+            start, stop = tree.level_start_box_nrs[level:level+2]
+            if start == stop:
+                continue
+
+            evt = knl_info.level_lists_finder(
+                    tree.box_centers, tree.root_extent, tree.box_levels,
+                    tree.aligned_nboxes, tree.box_child_ids,
+                    tree.box_parent_ids,
+                    *(extra_args + (counts, rows) + images_rows_args),
+                    range=slice(start, stop), queue=queue, wait_for=wait_for)
+            wait_for = [evt]
+
+        # Colleague lists are the neighborhoods without the box itself.
+        exclude_self = 1 if list_kind == "colleagues" else 0
+
+        starts = cl.array.empty(queue, nboxes+1, tree.box_id_dtype)
+        evt = knl_info.starts_scan(counts, exclude_self, starts,
+                size=nboxes, queue=queue, wait_for=wait_for)
+        evt.wait()
+
+        nentries = int(starts[nboxes:].get(queue=queue)[0])
+
+        lists = cl.array.empty(queue, nentries, tree.box_id_dtype)
+        if periodic:
+            images_lists = cl.array.empty(queue, nentries, np.int8)
+            images_lists_args = (images_lists,)
+        else:
+            images_lists_args = ()
+
+        evt = knl_info.compactor(
+                *((counts, rows) + images_rows_args
+                    + (exclude_self, starts, lists) + images_lists_args),
+                range=slice(0, nboxes), queue=queue)
+
+        from pyopencl.algorithm import BuiltList
+        result = {list_kind: BuiltList(count=nentries, starts=starts, lists=lists)}
+        if periodic:
+            result[list_kind+"_images"] = BuiltList(
+                    count=nentries, starts=starts, lists=images_lists)
+
+        return result, evt
+
+# }}}
+
+
 class _KernelInfo(Record):
     pass
 
@@ -1121,14 +1982,15 @@ class _KernelInfo(Record):
 class FMMTraversalBuilder:
     def __init__(self, context):
         self.context = context
+        self.level_lists_builder = _LevelByLevelListsBuilder(context)
 
     # {{{ kernel builder
 
-    @memoize_method
+    @memoize_method_in_context
     def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
             coord_dtype, box_level_dtype, max_levels,
             sources_are_targets, sources_have_extent, targets_have_extent,
-            stick_out_factor):
+            stick_out_factor, balanced=False, periodic=False):
 
         logging.info("building traversal build kernels")
 
@@ -1151,8 +2013,9 @@ class FMMTraversalBuilder:
                 sources_have_extent=sources_have_extent,
                 targets_have_extent=targets_have_extent,
                 stick_out_factor=stick_out_factor,
+                periodic=periodic,
                 )
-        from pyopencl.algorithm import ListOfListsBuilder
+        from boxtree.tools import ListOfListsBuilder
         from pyopencl.tools import VectorArg, ScalarArg
 
         result = {}
@@ -1202,35 +2065,63 @@ class FMMTraversalBuilder:
                 VectorArg(box_flags_enum.dtype, "box_flags"),
                 ]
 
+        if periodic:
+            colleague_image_args = [VectorArg(np.int8, "colleagues_images")]
+        else:
+            colleague_image_args = []
+
+        if balanced:
+            assert not (sources_have_extent or targets_have_extent)
+            assert not periodic
+
+            neighbor_source_boxes_template = \
+                    BALANCED_NEIGBHOR_SOURCE_BOXES_TEMPLATE
+            neighbor_source_boxes_extra_args = [
+                    VectorArg(box_id_dtype, "target_boxes"),
+                    VectorArg(box_id_dtype, "box_parent_ids"),
+                    VectorArg(box_id_dtype, "colleagues_starts"),
+                    VectorArg(box_id_dtype, "colleagues_list"),
+                    ]
+            sep_smaller_template = BALANCED_SEP_SMALLER_TEMPLATE
+            sep_bigger_template = BALANCED_SEP_BIGGER_TEMPLATE
+        else:
+            neighbor_source_boxes_template = NEIGBHOR_SOURCE_BOXES_TEMPLATE
+            neighbor_source_boxes_extra_args = [
+                    VectorArg(box_id_dtype, "target_boxes"),
+                    VectorArg(box_id_dtype, "box_parent_ids"),
+                    VectorArg(box_id_dtype, "peer_list_starts"),
+                    VectorArg(box_id_dtype, "peer_lists"),
+                    ] + ([VectorArg(np.int8, "peer_list_images")]
+                        if periodic else [])
+            sep_smaller_template = SEP_SMALLER_TEMPLATE
+            sep_bigger_template = SEP_BIGGER_TEMPLATE
+
         for list_name, template, extra_args, extra_lists in [
-                ("colleagues", COLLEAGUES_TEMPLATE, [], []),
-                ("neighbor_source_boxes", NEIGBHOR_SOURCE_BOXES_TEMPLATE,
-                        [
-                            VectorArg(box_id_dtype, "target_boxes"),
-                            ], []),
+                ("neighbor_source_boxes", neighbor_source_boxes_template,
+                        neighbor_source_boxes_extra_args, []),
                 ("sep_siblings", SEP_SIBLINGS_TEMPLATE,
                         [
                             VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
                             VectorArg(box_id_dtype, "box_parent_ids"),
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
-                            ], []),
-                ("sep_smaller", SEP_SMALLER_TEMPLATE,
+                            ] + colleague_image_args, []),
+                ("sep_smaller", sep_smaller_template,
                         [
                             VectorArg(box_id_dtype, "target_boxes"),
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
-                            ],
+                            ] + colleague_image_args,
                             ["sep_close_smaller"]
                             if sources_have_extent or targets_have_extent
                             else []),
-                ("sep_bigger", SEP_BIGGER_TEMPLATE,
+                ("sep_bigger", sep_bigger_template,
                         [
                             VectorArg(box_id_dtype, "target_or_target_parent_boxes"),
                             VectorArg(box_id_dtype, "box_parent_ids"),
                             VectorArg(box_id_dtype, "colleagues_starts"),
                             VectorArg(box_id_dtype, "colleagues_list"),
-                            ],
+                            ] + colleague_image_args,
                             ["sep_close_bigger"]
                             if sources_have_extent or targets_have_extent
                             else []),
@@ -1241,13 +2132,23 @@ class FMMTraversalBuilder:
                     + template,
                     strict_undefined=True).render(**render_vars)
 
+            if periodic:
+                # The image of each box is appended right after the box.
+                image_lists = [(list_name+"_images", np.int8)]
+                count_sharing = {list_name+"_images": list_name}
+            else:
+                image_lists = []
+                count_sharing = {}
+
             result[list_name+"_builder"] = ListOfListsBuilder(self.context,
                     [(list_name, box_id_dtype)]
+                    + image_lists
                     + [(extra_list_name, box_id_dtype)
                         for extra_list_name in extra_lists],
                     str(src),
                     arg_decls=base_args + extra_args,
                     debug=debug, name_prefix=list_name,
+                    count_sharing=count_sharing,
                     complex_kernel=True)
 
         # }}}
@@ -1260,13 +2161,21 @@ class FMMTraversalBuilder:
 
     # {{{ driver
 
-    def __call__(self, queue, tree, wait_for=None, debug=False):
+    def __call__(self, queue, tree, wait_for=None, debug=False, profiler=None,
+            concurrent=False):
         """
         :arg queue: A :class:`pyopencl.CommandQueue` instance.
         :arg tree: A :class:`boxtree.Tree` instance.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             exeuction.
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the list builds and kernels are recorded.
+        :arg concurrent: If *True*, build the mutually independent lists
+            1 through 4 from separate host threads, each on its own command
+            queue on the device of *queue*, so that they may overlap (e.g.
+            on multi-core CPU devices). The returned event waits for all of
+            them.
         :return: A tuple *(trav, event)*, where *trav* is a new instance of
             :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -1280,12 +2189,39 @@ class FMMTraversalBuilder:
         from pytools import div_ceil
         max_levels = div_ceil(tree.nlevels, 5) * 5
 
+        # (Trees stored before is_periodic existed don't have it.)
+        periodic = getattr(tree, "is_periodic", False)
+
+        # Particles of loose trees lie outside their boxes by at most as much
+        # as particles with extent may stick out of theirs, so the adjacency
+        # tests for particles with extent apply to them.
+        # (Trees stored before looseness existed don't have it.)
+        looseness = getattr(tree, "looseness", 0)
+        sources_have_extent = tree.sources_have_extent or bool(looseness)
+        targets_have_extent = tree.targets_have_extent or bool(looseness)
+        stick_out_factor = looseness if looseness else tree.stick_out_factor
+
+        # Balanced trees allow simpler list 1, 3, and 4 builds, as long as
+        # boxes with own sources are leaves. (These builds do not consider
+        # periodic images.)
+        # (Trees stored before is_balanced existed don't have it.)
+        balanced = (
+                getattr(tree, "is_balanced", False)
+                and not (sources_have_extent or targets_have_extent)
+                and not periodic)
+
         knl_info = self.get_kernel_info(
                 tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
                 tree.coord_dtype, tree.box_level_dtype, max_levels,
                 tree.sources_are_targets,
-                tree.sources_have_extent, tree.targets_have_extent,
-                tree.stick_out_factor)
+                sources_have_extent, targets_have_extent,
+                stick_out_factor, balanced=balanced, periodic=periodic)
+
+        def get_images(result, list_name):
+            if periodic:
+                return result[list_name+"_images"].lists
+            else:
+                return None
 
         def fin_debug(s):
             if debug:
@@ -1293,14 +2229,20 @@ class FMMTraversalBuilder:
 
             logger.debug(s)
 
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "traversal build")
+
         logger.info("start building traversal")
 
         # {{{ source boxes, their parents, and target boxes
 
         fin_debug("building list of source boxes, their parents, and target boxes")
 
-        result, evt = knl_info.sources_parents_and_targets_builder(
-                queue, tree.nboxes, tree.box_flags.data, wait_for=wait_for)
+        with prof.span("source and target boxes"):
+            result, evt = knl_info.sources_parents_and_targets_builder(
+                    queue, tree.nboxes, tree.box_flags.data,
+                    index_dtype=tree.box_id_dtype, wait_for=wait_for)
+        prof.built_lists("source and target boxes", result, evt)
         wait_for = [evt]
 
         source_parent_boxes = result["source_parent_boxes"].lists
@@ -1316,142 +2258,234 @@ class FMMTraversalBuilder:
 
         # {{{ figure out level starts in *_parent_boxes
 
-        def extract_level_start_box_nrs(box_list, wait_for):
-            result = cl.array.empty(queue,
-                    tree.nlevels+1, tree.box_id_dtype) \
-                            .fill(len(box_list))
+        # The level starts of all four box lists are extracted into one
+        # array, so that they can be read back in a single transfer, once
+        # the colleagues are being found.
+
+        level_start_box_lists = [
+                source_boxes, source_parent_boxes,
+                target_boxes, target_or_target_parent_boxes]
+        nlevel_starts = tree.nlevels + 1
+
+        level_starts_dev = cl.array.empty(queue,
+                len(level_start_box_lists) * nlevel_starts, tree.box_id_dtype)
+
+        fin_debug("finding level starts in box lists")
+
+        for ilist, box_list in enumerate(level_start_box_lists):
+            list_level_starts_dev = level_starts_dev[
+                    ilist*nlevel_starts:(ilist+1)*nlevel_starts]
+            list_level_starts_dev.fill(len(box_list), wait_for=wait_for)
+
             evt = knl_info.level_start_box_nrs_extractor(
                     tree.level_start_box_nrs_dev,
                     tree.box_levels,
                     box_list,
-                    result,
+                    list_level_starts_dev,
                     range=slice(0, len(box_list)),
-                    queue=queue, wait_for=wait_for)
+                    queue=queue, wait_for=list_level_starts_dev.events)
+            prof.event("extract level starts", evt)
+            level_starts_dev.add_event(evt)
+
+        # }}}
 
-            result = result.get()
+        # {{{ colleagues
+
+        fin_debug("finding colleagues")
+
+        with prof.span("colleagues"):
+            result, evt = self.level_lists_builder(
+                    queue, tree, "colleagues", wait_for=wait_for)
+        prof.built_lists("colleagues", result, evt)
+        wait_for = [evt]
+        colleagues = result["colleagues"]
+        colleagues_images = get_images(result, "colleagues")
+
+        if periodic:
+            colleague_image_args = (colleagues_images.data,)
+        else:
+            colleague_image_args = ()
+
+        # }}}
+
+        # {{{ read back level starts
+
+        with prof.sync("read back level starts"):
+            level_starts = level_starts_dev.get()
+
+        def get_level_start_box_nrs(ilist):
+            result = level_starts[ilist*nlevel_starts:(ilist+1)*nlevel_starts]
 
             # Postprocess result for unoccupied levels
-            prev_start = len(box_list)
+            prev_start = len(level_start_box_lists[ilist])
             for ilev in range(tree.nlevels-1, -1, -1):
                 result[ilev] = prev_start = \
                         min(result[ilev], prev_start)
 
-            return result, evt
+            return result
 
-        fin_debug("finding level starts in source boxes array")
-        level_start_source_box_nrs, evt_s = \
-                extract_level_start_box_nrs(
-                        source_boxes, wait_for=wait_for)
+        level_start_source_box_nrs = get_level_start_box_nrs(0)
+        level_start_source_parent_box_nrs = get_level_start_box_nrs(1)
+        level_start_target_box_nrs = get_level_start_box_nrs(2)
+        level_start_target_or_target_parent_box_nrs = get_level_start_box_nrs(3)
 
-        fin_debug("finding level starts in source parent boxes array")
-        level_start_source_parent_box_nrs, evt_sp = \
-                extract_level_start_box_nrs(
-                        source_parent_boxes, wait_for=wait_for)
+        # }}}
 
-        fin_debug("finding level starts in target boxes array")
-        level_start_target_box_nrs, evt_t = \
-                extract_level_start_box_nrs(
-                        target_boxes, wait_for=wait_for)
+        # Lists 1-4 only depend on the colleagues, so they are built
+        # independently of each other, on separate queues if *concurrent*.
 
-        fin_debug("finding level starts in target or target parent boxes array")
-        level_start_target_or_target_parent_box_nrs, evt_tp = \
-                extract_level_start_box_nrs(
-                        target_or_target_parent_boxes, wait_for=wait_for)
+        # {{{ neighbor source boxes ("list 1")
 
-        wait_for = [evt_s, evt_sp, evt_t, evt_tp]
+        def build_neighbor_source_boxes(list_queue):
+            list_wait_for = wait_for
+
+            if balanced:
+                neighbor_args = (colleagues.starts.data, colleagues.lists.data)
+            else:
+                # Outside of balanced trees, list 1 is found starting from
+                # the peers of each target box.
+                fin_debug("finding peers")
+
+                with prof.span("peers"):
+                    result, evt = self.level_lists_builder(
+                            list_queue, tree, "peers", wait_for=wait_for)
+                prof.built_lists("peers", result, evt)
+                list_wait_for = [evt]
+
+                neighbor_args = (
+                        result["peers"].starts.data, result["peers"].lists.data)
+                if periodic:
+                    neighbor_args += (result["peers_images"].lists.data,)
+
+            fin_debug("finding neighbor source boxes ('list 1')")
+
+            with prof.span("neighbor source boxes (list 1)"):
+                result, evt = knl_info.neighbor_source_boxes_builder(
+                        list_queue, len(target_boxes),
+                        tree.box_centers.data, tree.root_extent,
+                        tree.box_levels.data,
+                        tree.aligned_nboxes, tree.box_child_ids.data,
+                        tree.box_flags.data,
+                        target_boxes.data, tree.box_parent_ids.data,
+                        *neighbor_args,
+                        index_dtype=tree.box_id_dtype, wait_for=list_wait_for)
+            prof.built_lists("neighbor source boxes (list 1)", result, evt)
+
+            return result, evt
 
         # }}}
 
-        # {{{ colleagues
+        # {{{ well-separated siblings ("list 2")
 
-        fin_debug("finding colleagues")
+        def build_sep_siblings(list_queue):
+            fin_debug("finding well-separated siblings ('list 2')")
+
+            with prof.span("separated siblings (list 2)"):
+                result, evt = knl_info.sep_siblings_builder(
+                        list_queue, len(target_or_target_parent_boxes),
+                        tree.box_centers.data, tree.root_extent,
+                        tree.box_levels.data,
+                        tree.aligned_nboxes, tree.box_child_ids.data,
+                        tree.box_flags.data,
+                        target_or_target_parent_boxes.data,
+                        tree.box_parent_ids.data,
+                        colleagues.starts.data, colleagues.lists.data,
+                        *colleague_image_args,
+                        index_dtype=tree.box_id_dtype, wait_for=wait_for)
+            prof.built_lists("separated siblings (list 2)", result, evt)
 
-        result, evt = knl_info.colleagues_builder(
-                queue, tree.nboxes,
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                wait_for=wait_for)
-        wait_for = [evt]
-        colleagues = result["colleagues"]
+            return result, evt
 
         # }}}
 
-        # {{{ neighbor source boxes ("list 1")
-
-        fin_debug("finding neighbor source boxes ('list 1')")
+        # {{{ separated smaller ("list 3")
 
-        result, evt = knl_info.neighbor_source_boxes_builder(
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_boxes.data, wait_for=wait_for)
+        def build_sep_smaller(list_queue):
+            fin_debug("finding separated smaller ('list 3')")
+
+            with prof.span("separated smaller (list 3)"):
+                result, evt = knl_info.sep_smaller_builder(
+                        list_queue, len(target_boxes),
+                        tree.box_centers.data, tree.root_extent,
+                        tree.box_levels.data,
+                        tree.aligned_nboxes, tree.box_child_ids.data,
+                        tree.box_flags.data,
+                        target_boxes.data,
+                        colleagues.starts.data, colleagues.lists.data,
+                        *colleague_image_args,
+                        index_dtype=tree.box_id_dtype, wait_for=wait_for)
+            prof.built_lists("separated smaller (list 3)", result, evt)
 
-        wait_for = [evt]
-        neighbor_source_boxes = result["neighbor_source_boxes"]
+            return result, evt
 
         # }}}
 
-        # {{{ well-separated siblings ("list 2")
+        # {{{ separated bigger ("list 4")
 
-        fin_debug("finding well-separated siblings ('list 2')")
+        def build_sep_bigger(list_queue):
+            fin_debug("finding separated bigger ('list 4')")
+
+            with prof.span("separated bigger (list 4)"):
+                result, evt = knl_info.sep_bigger_builder(
+                        list_queue, len(target_or_target_parent_boxes),
+                        tree.box_centers.data, tree.root_extent,
+                        tree.box_levels.data,
+                        tree.aligned_nboxes, tree.box_child_ids.data,
+                        tree.box_flags.data,
+                        target_or_target_parent_boxes.data,
+                        tree.box_parent_ids.data,
+                        colleagues.starts.data, colleagues.lists.data,
+                        *colleague_image_args,
+                        index_dtype=tree.box_id_dtype, wait_for=wait_for)
+            prof.built_lists("separated bigger (list 4)", result, evt)
 
-        result, evt = knl_info.sep_siblings_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_or_target_parent_boxes.data, tree.box_parent_ids.data,
-                colleagues.starts.data, colleagues.lists.data, wait_for=wait_for)
-        wait_for = [evt]
-        sep_siblings = result["sep_siblings"]
+            return result, evt
 
         # }}}
 
-        # {{{ separated smaller ("list 3")
+        list_builders = [
+                build_neighbor_source_boxes, build_sep_siblings,
+                build_sep_smaller, build_sep_bigger]
 
-        fin_debug("finding separated smaller ('list 3')")
+        if concurrent:
+            list_results = _call_on_separate_queues(queue, list_builders)
+        else:
+            list_results = [build(queue) for build in list_builders]
 
-        result, evt = knl_info.sep_smaller_builder(
-                queue, len(target_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_boxes.data,
-                colleagues.starts.data, colleagues.lists.data,
-                wait_for=wait_for)
-        wait_for = [evt]
-        sep_smaller = result["sep_smaller"]
+        # {{{ unpack lists 1-4
 
-        if tree.sources_have_extent or tree.targets_have_extent:
-            sep_close_smaller_starts = result["sep_close_smaller"].starts
-            sep_close_smaller_lists = result["sep_close_smaller"].lists
-        else:
-            sep_close_smaller_starts = None
-            sep_close_smaller_lists = None
+        ((list1_result, _), (list2_result, _), (list3_result, _),
+                (list4_result, _)) = list_results
 
-        # }}}
+        neighbor_source_boxes = list1_result["neighbor_source_boxes"]
+        neighbor_source_boxes_images = get_images(
+                list1_result, "neighbor_source_boxes")
 
-        # {{{ separated bigger ("list 4")
+        sep_siblings = list2_result["sep_siblings"]
+        sep_siblings_images = get_images(list2_result, "sep_siblings")
 
-        fin_debug("finding separated bigger ('list 4')")
+        sep_smaller = list3_result["sep_smaller"]
+        sep_smaller_images = get_images(list3_result, "sep_smaller")
 
-        result, evt = knl_info.sep_bigger_builder(
-                queue, len(target_or_target_parent_boxes),
-                tree.box_centers.data, tree.root_extent, tree.box_levels.data,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags.data,
-                target_or_target_parent_boxes.data, tree.box_parent_ids.data,
-                colleagues.starts.data, colleagues.lists.data, wait_for=wait_for)
-        wait_for = [evt]
-        sep_bigger = result["sep_bigger"]
+        sep_bigger = list4_result["sep_bigger"]
+        sep_bigger_images = get_images(list4_result, "sep_bigger")
 
-        if tree.sources_have_extent or tree.targets_have_extent:
-            sep_close_bigger_starts = result["sep_close_bigger"].starts
-            sep_close_bigger_lists = result["sep_close_bigger"].lists
+        if sources_have_extent or targets_have_extent:
+            sep_close_smaller_starts = list3_result["sep_close_smaller"].starts
+            sep_close_smaller_lists = list3_result["sep_close_smaller"].lists
+            sep_close_bigger_starts = list4_result["sep_close_bigger"].starts
+            sep_close_bigger_lists = list4_result["sep_close_bigger"].lists
         else:
+            sep_close_smaller_starts = None
+            sep_close_smaller_lists = None
             sep_close_bigger_starts = None
             sep_close_bigger_lists = None
 
         # }}}
 
-        evt, = wait_for
+        # Join the list builds, which may have been on other queues.
+        evt = cl.enqueue_marker(queue,
+                wait_for=[list_evt for _, list_evt in list_results])
 
         logger.info("traversal built")
 
@@ -1491,6 +2525,12 @@ class FMMTraversalBuilder:
 
                 sep_close_bigger_starts=sep_close_bigger_starts,
                 sep_close_bigger_lists=sep_close_bigger_lists,
+
+                colleagues_images=colleagues_images,
+                neighbor_source_boxes_images=neighbor_source_boxes_images,
+                sep_siblings_images=sep_siblings_images,
+                sep_smaller_images=sep_smaller_images,
+                sep_bigger_images=sep_bigger_images,
                 ).with_queue(None), evt
 
     # }}}
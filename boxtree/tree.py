@@ -86,6 +86,35 @@ class Tree(DeviceDataRecord):
 
         Whether this tree has targets in non-leaf boxes
 
+    .. attribute:: is_balanced
+
+        ``bool``
+
+        Whether no leaf box of this tree is adjacent to a non-leaf box on
+        a finer level, so that adjacent leaf boxes differ by at most one
+        level. (See the *balanced* argument of
+        :meth:`TreeBuilder.__call__`.)
+        :class:`boxtree.traversal.FMMTraversalBuilder` builds the
+        interaction lists of such trees more cheaply.
+
+    .. attribute:: is_periodic
+
+        ``bool``
+
+        Whether the particles of this tree are periodically repeated along
+        all axes, with the root box as the unit cell. (See the *periodic*
+        argument of :meth:`TreeBuilder.__call__`.) Box lists built for
+        such trees, such as interaction lists, peer lists and area query
+        results, include boxes in the images of the root box adjacent to
+        it, and record the image of each box alongside it. See
+        :attr:`image_offsets`.
+
+    .. attribute:: ordering
+
+        The order of the children of each box, and therefore of the boxes
+        on each level and of the particles: ``"morton"`` or ``"hilbert"``.
+        (See the *ordering* argument of :meth:`TreeBuilder.__call__`.)
+
     .. ------------------------------------------------------------------------
     .. rubric:: Data types
     .. ------------------------------------------------------------------------
@@ -109,12 +138,36 @@ class Tree(DeviceDataRecord):
         given by :attr:`source_radii` may stick out the box in which they are
         contained. A scalar.
 
+    .. attribute:: looseness
+
+        Particles may lie outside the box in which they are contained, as
+        long as they are inside that box scaled by ``1 + looseness`` about
+        its center. A scalar, zero unless the tree was built with a nonzero
+        *looseness* (see :meth:`TreeBuilder.__call__`), so that its
+        particles can be moved by :class:`boxtree.LooseTreeUpdater`
+        without changing the boxes they are in.
+
     .. attribute:: nsources
 
     .. attribute:: ntargets
 
     .. attribute:: nlevels
 
+    .. attribute:: nimages
+
+        The number of periodic images of the root box, including the root
+        box itself, that box lists refer to. ``3**dimensions`` if
+        :attr:`is_periodic`, 1 otherwise.
+
+    .. attribute:: image_offsets
+
+        ``int8 [nimages, dimensions]``
+
+        A :class:`numpy.ndarray`. Image *i* of the root box (and of the
+        boxes and particles in it) is displaced by
+        ``image_offsets[i] * root_extent`` from the root box. Image
+        ``nimages // 2`` is the root box itself.
+
     .. attribute:: bounding_box
 
         a tuple *(bbox_min, bbox_max)* of
@@ -282,6 +335,9 @@ class Tree(DeviceDataRecord):
         A bitwise combination of :class:`box_flags_enum` constants.
     """
 
+    # Trees stored before this existed are Morton-ordered.
+    ordering = "morton"
+
     @property
     def dimensions(self):
         return len(self.sources)
@@ -308,6 +364,24 @@ class Tree(DeviceDataRecord):
     def aligned_nboxes(self):
         return self.box_child_ids.shape[-1]
 
+    @property
+    def nimages(self):
+        # (Trees stored before is_periodic existed don't have it.)
+        if getattr(self, "is_periodic", False):
+            return 3**self.dimensions
+        else:
+            return 1
+
+    @property
+    def image_offsets(self):
+        if self.nimages == 1:
+            return np.zeros((1, self.dimensions), np.int8)
+
+        image_nrs = np.arange(self.nimages)
+        return np.array([
+            image_nrs // 3**iaxis % 3 - 1
+            for iaxis in range(self.dimensions)], np.int8).T
+
     def plot(self, **kwargs):
         from boxtree.visualization import TreePlotter
         plotter = TreePlotter(self)
@@ -344,33 +418,335 @@ class Tree(DeviceDataRecord):
 
         return self.sorted_target_ids[user_indices]
 
+    def _find_box_nrs_for_particles(self, iparticles, box_starts,
+            box_counts_nonchild):
+        # Each particle is owned by exactly one box with nonchild particles,
+        # and the particle ranges of those boxes don't overlap.
+        owner_boxes, = np.where(box_counts_nonchild > 0)
+        owner_boxes = owner_boxes[np.argsort(box_starts[owner_boxes])]
+
+        iparticles = np.asarray(iparticles)
+        idx = np.searchsorted(
+                box_starts[owner_boxes], iparticles, side="right") - 1
+        box_nrs = owner_boxes[idx]
+
+        box_ends = (box_starts + box_counts_nonchild)[box_nrs]
+        if ((idx < 0) | (iparticles >= box_ends)).any():
+            raise ValueError("particle numbers out of range")
+
+        if iparticles.ndim == 0:
+            return int(box_nrs)
+        return box_nrs
+
     def find_box_nr_for_target(self, itarget):
         """
-        :arg itarget: target number in tree order
+        :arg itarget: target number in tree order, or an array of them
+        :returns: the number of the box owning the target, or an array of
+            them
         """
-        crit = (
-                (self.box_target_starts <= itarget)
-                &
-                (itarget < self.box_target_starts + self.box_target_counts_nonchild))
-
-        return int(np.where(crit)[0])
+        return self._find_box_nrs_for_particles(itarget,
+                self.box_target_starts, self.box_target_counts_nonchild)
 
     def find_box_nr_for_source(self, isource):
         """
-        :arg isource: source number in tree order
+        :arg isource: source number in tree order, or an array of them
+        :returns: the number of the box owning the source, or an array of
+            them
+        """
+        return self._find_box_nrs_for_particles(isource,
+                self.box_source_starts, self.box_source_counts_nonchild)
+
+    def find_box_nrs_for_points(self, points):
+        """Host version of :class:`boxtree.area_query.PointLocator`.
+
+        :arg points: an array of shape ``(dimensions, npoints)``
+        :returns: an array of the numbers of the smallest boxes containing
+            each point, with -1 for points outside the root box
         """
-        crit = (
-                (self.box_source_starts <= isource)
-                &
-                (isource < self.box_source_starts + self.box_source_counts_nonchild))
+        points = np.asarray(points)
 
-        return int(np.where(crit)[0])
+        bbox_min = self.bounding_box[0][:, np.newaxis]
+        in_root = (
+                (bbox_min <= points)
+                & (points < bbox_min + self.root_extent)).all(axis=0)
+
+        box_nrs = np.where(in_root, 0, -1).astype(self.box_id_dtype)
+        descending, = np.where(in_root)
+
+        while len(descending):
+            centers = self.box_centers[:, box_nrs[descending]]
+            morton_nrs = np.zeros(len(descending), np.intp)
+            for iaxis in range(self.dimensions):
+                morton_nrs = (morton_nrs << 1) | (
+                        points[iaxis, descending] >= centers[iaxis])
+
+            child_nrs = self.box_child_ids[morton_nrs, box_nrs[descending]]
+            has_child = child_nrs != 0
+            descending = descending[has_child]
+            box_nrs[descending] = child_nrs[has_child]
+
+        return box_nrs
 
     # }}}
 
 # }}}
 
 
+# {{{ forest
+
+class Forest(DeviceDataRecord):
+    """Many independent trees, built at once by
+    :meth:`boxtree.TreeBuilder.build_forest` as subtrees of one :attr:`tree`.
+
+    Each tree has one box on level :attr:`root_level` of :attr:`tree`,
+    and its boxes are this box and its descendants. Trees are numbered
+    in the order in which their particles were given. The particles, and
+    the boxes on each level, of each tree are contiguous in :attr:`tree`,
+    and ordered by tree number.
+
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+
+    .. attribute:: tree
+
+        A :class:`Tree` in which each tree's particles are mapped into
+        the box of side length one with corner at integer coordinates, on
+        level :attr:`root_level`, given by the tree number as a Morton
+        number. Its geometry is therefore not that of the trees.
+
+    .. attribute:: root_level
+
+        The level of :attr:`tree` holding the root boxes of the trees.
+
+    .. attribute:: ntrees
+
+    .. attribute:: sources
+
+        ``coord_t [dimensions][nparticles]``
+
+        The particles, in their original coordinates, in
+        :ref:`tree source order <particle-orderings>` of :attr:`tree`.
+
+    .. attribute:: tree_particle_starts
+
+        ``particle_id_t [ntrees+1]``
+
+        A :class:`numpy.ndarray`, as passed to
+        :meth:`boxtree.TreeBuilder.build_forest`.
+
+    .. attribute:: tree_bbox_min
+
+        ``coord_t [dimensions, ntrees]``
+
+        A :class:`numpy.ndarray` of the lower corners of the trees'
+        bounding boxes (see :attr:`Tree.bounding_box`).
+
+    .. attribute:: tree_bbox_max
+
+        ``coord_t [dimensions, ntrees]``
+
+        Like :attr:`tree_bbox_min`, for the upper corners.
+
+    .. attribute:: tree_root_extents
+
+        ``coord_t [ntrees]``
+
+        A :class:`numpy.ndarray` of the trees' root box sizes (see
+        :attr:`Tree.root_extent`).
+
+    .. attribute:: tree_root_box_ids
+
+        ``box_id_t [ntrees]``
+
+        A :class:`numpy.ndarray` of the root box of each tree in
+        :attr:`tree`.
+
+    .. attribute:: tree_level_box_starts
+
+        ``box_id_t [tree.nlevels - root_level, ntrees+1]``
+
+        A :class:`numpy.ndarray`. The boxes of tree number *itree* on
+        level *root_level + ilevel* of :attr:`tree` are those numbered
+        ``tree_level_box_starts[ilevel, itree]`` up to (but not including)
+        ``tree_level_box_starts[ilevel, itree+1]``.
+
+    .. attribute:: box_tree_ids
+
+        ``particle_id_t [tree.nboxes]``
+
+        The tree to which each box of :attr:`tree` belongs, or -1 for
+        boxes above :attr:`root_level`.
+
+    .. automethod:: get_trees
+    """
+
+    @property
+    def dimensions(self):
+        return self.tree.dimensions
+
+    @property
+    def ntrees(self):
+        return len(self.tree_particle_starts) - 1
+
+    def get_trees(self, queue):
+        """Return a list of the trees as instances of :class:`Tree` whose
+        data resides on the host (as if returned by :meth:`Tree.get`).
+        These are the trees :meth:`boxtree.TreeBuilder.__call__` would build
+        from the particles of each tree (see
+        :meth:`boxtree.TreeBuilder.build_forest`).
+        """
+        from boxtree.tree_update import (
+                get_box_icoords, box_morton_nrs_from_child_ids,
+                compute_box_centers)
+
+        forest = self.get(queue=queue)
+        ftree = forest.tree
+        dimensions = ftree.dimensions
+        nchildren = 2**dimensions
+        box_id_dtype = ftree.box_id_dtype
+        particle_id_dtype = ftree.particle_id_dtype
+
+        forest_box_icoords = get_box_icoords(
+                ftree.box_parent_ids,
+                box_morton_nrs_from_child_ids(ftree.box_child_ids, ftree.nboxes),
+                ftree.level_start_box_nrs, dimensions).T
+
+        from pytools import div_ceil
+        from pytools.obj_array import make_obj_array
+
+        trees = []
+        for itree in range(forest.ntrees):
+            # {{{ number boxes
+
+            level_starts = forest.tree_level_box_starts[:, itree]
+            level_counts = (
+                    forest.tree_level_box_starts[:, itree+1] - level_starts)
+            nlevels = int(np.sum(level_counts > 0))
+            level_starts = level_starts[:nlevels].astype(np.int64)
+            level_counts = level_counts[:nlevels].astype(np.int64)
+
+            level_start_box_nrs = np.concatenate(
+                    [[0], np.cumsum(level_counts)]).astype(box_id_dtype)
+            nboxes = int(level_start_box_nrs[-1])
+
+            # forest box numbers of the boxes of this tree
+            box_levels = np.repeat(np.arange(nlevels), level_counts)
+            forest_box_ids = (
+                    level_starts[box_levels]
+                    + np.arange(nboxes) - level_start_box_nrs[box_levels])
+
+            def to_tree_box_ids(forest_ids, levels):
+                return (forest_ids - level_starts[levels]
+                        + level_start_box_nrs[levels])
+
+            box_parent_ids = np.zeros(nboxes, np.int64)
+            box_parent_ids[1:] = to_tree_box_ids(
+                    ftree.box_parent_ids[forest_box_ids[1:]],
+                    box_levels[1:] - 1)
+
+            aligned_nboxes = div_ceil(nboxes, 32)*32
+            box_child_ids = np.zeros((nchildren, aligned_nboxes), box_id_dtype)
+            has_children = box_levels + 1 < nlevels
+            forest_child_ids = ftree.box_child_ids[
+                    :, forest_box_ids[has_children]].astype(np.int64)
+            box_child_ids[:, :nboxes][:, has_children] = np.where(
+                    forest_child_ids != 0,
+                    to_tree_box_ids(
+                        forest_child_ids, box_levels[has_children] + 1),
+                    0)
+
+            # }}}
+
+            # {{{ box geometry
+
+            bbox_min = forest.tree_bbox_min[:, itree]
+            bbox_max = forest.tree_bbox_max[:, itree]
+
+            box_icoords = (forest_box_icoords[:, forest_box_ids]
+                    & ((1 << box_levels) - 1))
+
+            box_centers = np.zeros((dimensions, aligned_nboxes),
+                    ftree.coord_dtype)
+            box_centers[:, :nboxes] = compute_box_centers(
+                    box_levels, box_icoords, bbox_min, bbox_max)
+
+            # }}}
+
+            # {{{ particles
+
+            tree_start = ftree.box_source_starts[forest_box_ids[0]]
+            tree_end = tree_start + ftree.box_source_counts_cumul[
+                    forest_box_ids[0]]
+
+            user_source_ids = (
+                    ftree.user_source_ids[tree_start:tree_end]
+                    - forest.tree_particle_starts[itree]
+                    ).astype(particle_id_dtype)
+            sorted_target_ids = np.empty_like(user_source_ids)
+            sorted_target_ids[user_source_ids] = np.arange(
+                    len(user_source_ids), dtype=particle_id_dtype)
+
+            sources = make_obj_array([
+                ax[tree_start:tree_end].copy() for ax in forest.sources])
+
+            box_source_starts = (
+                    ftree.box_source_starts[forest_box_ids] - tree_start
+                    ).astype(particle_id_dtype)
+            box_source_counts_nonchild = \
+                    ftree.box_source_counts_nonchild[forest_box_ids]
+            box_source_counts_cumul = \
+                    ftree.box_source_counts_cumul[forest_box_ids]
+
+            # }}}
+
+            trees.append(Tree(
+                    sources_are_targets=True,
+                    sources_have_extent=False,
+                    targets_have_extent=False,
+
+                    particle_id_dtype=particle_id_dtype,
+                    box_id_dtype=box_id_dtype,
+                    coord_dtype=ftree.coord_dtype,
+                    box_level_dtype=ftree.box_level_dtype,
+
+                    root_extent=forest.tree_root_extents[itree],
+                    stick_out_factor=ftree.stick_out_factor,
+
+                    bounding_box=(bbox_min, bbox_max),
+                    level_start_box_nrs=level_start_box_nrs,
+                    level_start_box_nrs_dev=level_start_box_nrs,
+
+                    sources=sources,
+                    targets=sources,
+
+                    box_source_starts=box_source_starts,
+                    box_source_counts_nonchild=box_source_counts_nonchild,
+                    box_source_counts_cumul=box_source_counts_cumul,
+                    box_target_starts=box_source_starts,
+                    box_target_counts_nonchild=box_source_counts_nonchild,
+                    box_target_counts_cumul=box_source_counts_cumul,
+
+                    box_parent_ids=box_parent_ids.astype(box_id_dtype),
+                    box_child_ids=box_child_ids,
+                    box_centers=box_centers,
+                    box_levels=box_levels.astype(ftree.box_level_dtype),
+                    box_flags=ftree.box_flags[forest_box_ids],
+
+                    user_source_ids=user_source_ids,
+                    sorted_target_ids=sorted_target_ids,
+
+                    _is_pruned=True,
+                    is_balanced=False,
+                    is_periodic=False,
+                    looseness=0,
+                    ordering="morton",
+                    ))
+
+        return trees
+
+# }}}
+
+
 # {{{ tree with linked point sources
 
 class TreeWithLinkedPointSources(Tree):
@@ -669,7 +1045,7 @@ def filter_target_lists_in_user_order(queue, tree, flags):
             queue, tree.ntargets, user_target_ids.dtype)
 
     from pyopencl.tools import VectorArg, dtype_to_ctype
-    from pyopencl.algorithm import ListOfListsBuilder
+    from boxtree.tools import ListOfListsBuilder
     from mako.template import Template
     builder = ListOfListsBuilder(queue.context,
         [("filt_tgt_list", tree.particle_id_dtype)], Template("""//CL//
@@ -702,7 +1078,8 @@ def filter_target_lists_in_user_order(queue, tree, flags):
     result, evt = builder(queue, tree.nboxes,
             user_order_flags.data,
             user_target_ids.data,
-            tree.box_target_starts.data, tree.box_target_counts_nonchild.data)
+            tree.box_target_starts.data, tree.box_target_counts_nonchild.data,
+            index_dtype=tree.particle_id_dtype)
 
     return FilteredTargetListsInUserOrder(
             nfiltered_targets=result["filt_tgt_list"].count,
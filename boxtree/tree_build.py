@@ -23,19 +23,172 @@ THE SOFTWARE.
 """
 
 
+import six
 from six.moves import range, zip
 
 import numpy as np
-from pytools import memoize_method
 import pyopencl as cl
 import pyopencl.array  # noqa
-from functools import partial
 from boxtree.tree import Tree
+from boxtree.tools import memoize_method_in_context
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# {{{ scratch workspace
+
+class TreeBuildWorkspace(object):
+    """Scratch storage that may be passed (as *workspace*) to repeated calls
+    of :meth:`TreeBuilder.__call__`, to avoid reallocating the temporary
+    arrays of the build on every call.
+
+    Each temporary array is kept in a buffer that is grown to the largest
+    size requested so far. In addition, the workspace keeps track of the
+    largest amount of box storage needed so far and uses it as the initial
+    guess for the number of boxes. Once the workspace has seen a build of
+    similar size, builds therefore neither allocate temporary storage nor
+    need to restart a level because box storage ran out.
+
+    Arrays that become part of the resulting :class:`Tree` are not taken
+    from the workspace. They are allocated using the *allocator* passed to
+    the builder, which may be a :class:`pyopencl.tools.MemoryPool` to avoid
+    allocating them afresh as well. (The sorts used by the ``"morton"``
+    engine also allocate their results using *allocator*.)
+
+    The builder does not wait for the work it enqueues to finish before
+    returning, so a workspace must only be used by one build at a time, and
+    builds using it must be ordered with respect to each other, e.g. by
+    running them on the same (in-order) :class:`pyopencl.CommandQueue`.
+
+    .. attribute:: nboxes_guess
+
+        The number of boxes for which box storage is kept, or *None* if no
+        build has used this workspace yet.
+
+    .. attribute:: nbytes
+
+        The total size of the buffers held by the workspace, in bytes.
+
+    .. automethod:: clear
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.aranges = {}
+        self.nboxes_guess = None
+
+    @property
+    def nbytes(self):
+        return (
+                sum(buf.size for buf in six.itervalues(self.buffers))
+                + sum(ary.nbytes for ary in six.itervalues(self.aranges)))
+
+    def clear(self):
+        """Release all buffers held by the workspace."""
+        self.buffers.clear()
+        self.aranges.clear()
+        self.nboxes_guess = None
+
+    def get(self, queue, name, shape, dtype):
+        """Return a tuple *(ary, allocated)*, where *ary* is an uninitialized
+        array of *shape* and *dtype* stored in the buffer named *name*, and
+        *allocated* indicates whether that buffer had to be (re)allocated.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+
+        buf = self.buffers.get(name)
+        allocated = buf is None or buf.size < nbytes
+        if allocated:
+            buf = cl.Buffer(queue.context, cl.mem_flags.READ_WRITE, nbytes)
+            self.buffers[name] = buf
+
+        return cl.array.Array(queue, shape, dtype, data=buf), allocated
+
+    def get_arange(self, queue, n, dtype):
+        """Return a tuple *(ary, allocated)*, where *ary* is an array
+        containing ``0, ..., n-1``. *ary* must not be modified.
+        """
+        dtype = np.dtype(dtype)
+
+        ary = self.aranges.get(dtype)
+        allocated = ary is None or len(ary) < n
+        if allocated:
+            ary = cl.array.arange(queue, n, dtype=dtype)
+            self.aranges[dtype] = ary
+
+        return ary[:n].with_queue(queue), allocated
+
+    def adopt(self, name, ary):
+        """Keep the storage of *ary* as the buffer named *name*."""
+        self.buffers[name] = ary.base_data
+
+    def holds(self, ary):
+        """Return whether *ary* is stored in a buffer of this workspace."""
+        return any(
+                ary.base_data is buf
+                for buf in (
+                    list(six.itervalues(self.buffers))
+                    + [arange.base_data
+                        for arange in six.itervalues(self.aranges)]))
+
+# }}}
+
+
+# {{{ sticky bounding box
+
+class _ParticlesOutsideBoundingBox(ValueError):
+    pass
+
+
+class StickyBoundingBox(object):
+    """A root box that may be passed (as *bbox*) to repeated calls of
+    :meth:`TreeBuilder.__call__`, e.g. once per time step, to keep the
+    geometry of the trees built fixed while the particles move.
+
+    The first build using it finds a bounding box as usual, enlarges it by
+    *margin* and stores it in :attr:`bounding_box`. Subsequent builds use
+    this box without finding a new one. Only if a particle is found outside
+    of it is the build repeated with a newly found (and stored) bounding box.
+
+    .. attribute:: bounding_box
+
+        A tuple ``(bbox_min, bbox_max)`` of :mod:`numpy` vectors, like
+        :attr:`Tree.bounding_box`, or *None* if no build has used this
+        object yet.
+
+    .. attribute:: nupdates
+
+        The number of times :attr:`bounding_box` was found anew.
+
+    .. automethod:: __init__
+    .. automethod:: reset
+    """
+
+    def __init__(self, margin=0):
+        """
+        :arg margin: The amount by which newly found bounding boxes are
+            enlarged on each side, as a fraction of their extent. A larger
+            margin means that particles leave the box less often, at the
+            cost of leaving part of the tree empty.
+        """
+        if margin < 0:
+            raise ValueError("margin must be nonnegative")
+
+        self.margin = margin
+        self.bounding_box = None
+        self.nupdates = 0
+
+    def reset(self):
+        """Cause the next build to find a new bounding box."""
+        self.bounding_box = None
+
+# }}}
+
+
+# {{{ tree builder
+
 class TreeBuilder(object):
     def __init__(self, context):
         """
@@ -56,18 +209,135 @@ class TreeBuilder(object):
     morton_nr_dtype = np.dtype(np.int8)
     box_level_dtype = np.dtype(np.uint8)
 
-    @memoize_method
+    @memoize_method_in_context
     def get_kernel_info(self, dimensions, coord_dtype,
             particle_id_dtype, box_id_dtype,
             sources_are_targets, srcntgts_have_extent,
-            stick_out_factor, adaptive):
+            stick_out_factor, adaptive, srcntgts_have_min_leaf_levels=False,
+            unit_refine_weights=False, hilbert=False,
+            separate_target_limit=False):
 
         from boxtree.tree_build_kernels import get_tree_build_kernel_info
         return get_tree_build_kernel_info(self.context, dimensions, coord_dtype,
             particle_id_dtype, box_id_dtype,
             sources_are_targets, srcntgts_have_extent,
             stick_out_factor, self.morton_nr_dtype, self.box_level_dtype,
-            adaptive=adaptive)
+            adaptive=adaptive,
+            srcntgts_have_min_leaf_levels=srcntgts_have_min_leaf_levels,
+            unit_refine_weights=unit_refine_weights, hilbert=hilbert,
+            separate_target_limit=separate_target_limit)
+
+    @memoize_method_in_context
+    def get_morton_kernel_info(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype, adaptive,
+            unit_refine_weights=False):
+
+        from boxtree.tree_build_kernels import get_morton_tree_build_kernel_info
+        return get_morton_tree_build_kernel_info(self.context, dimensions,
+            coord_dtype, particle_id_dtype, box_id_dtype,
+            self.morton_nr_dtype, self.box_level_dtype,
+            adaptive=adaptive, unit_refine_weights=unit_refine_weights)
+
+    @memoize_method_in_context
+    def get_refine_weight_stats_kernel(self):
+        from boxtree.tree_build_kernels import (refine_weight_dtype,
+                make_refine_weight_stats_dtype, REFINE_WEIGHT_STATS_TPL)
+
+        stats_dtype, _ = make_refine_weight_stats_dtype(self.context.devices[0])
+
+        return REFINE_WEIGHT_STATS_TPL.build(self.context,
+                type_aliases=(
+                    ("reduction_t", stats_dtype),
+                    ("stats_t", stats_dtype),
+                    ("refine_weight_t", refine_weight_dtype),
+                    ))
+
+    @memoize_method_in_context
+    def get_balance_kernel_info(self, particle_id_dtype, box_id_dtype,
+            peer_list_idx_dtype, sources_are_targets):
+        from boxtree.tree import box_flags_enum
+        from boxtree.tree_build_kernels import (_KernelInfo,
+                UNBALANCED_LEAF_FINDER_TPL, MIN_LEAF_LEVEL_MARKER_TPL)
+
+        type_aliases = (
+                ("particle_id_t", particle_id_dtype),
+                ("box_id_t", box_id_dtype),
+                ("peer_list_idx_t", peer_list_idx_dtype),
+                ("box_flags_t", box_flags_enum.dtype),
+                ("box_level_t", self.box_level_dtype),
+                )
+
+        return _KernelInfo(
+                unbalanced_leaf_finder=UNBALANCED_LEAF_FINDER_TPL.build(
+                    self.context, type_aliases,
+                    more_preamble=box_flags_enum.get_c_defines()),
+                min_leaf_level_marker=MIN_LEAF_LEVEL_MARKER_TPL.build(
+                    self.context, type_aliases,
+                    var_values=(
+                        ("sources_are_targets", sources_are_targets),
+                        )),
+                )
+
+    @memoize_method_in_context
+    def get_particles_outside_bbox_finder(self, dimensions, coord_dtype):
+        from boxtree.bounding_box import make_bounding_box_dtype
+        from boxtree.tools import AXIS_NAMES
+        from boxtree.tree_build_kernels import PARTICLES_OUTSIDE_BBOX_FINDER_TPL
+
+        bbox_dtype, _ = make_bounding_box_dtype(
+                self.context.devices[0], dimensions, coord_dtype)
+
+        return PARTICLES_OUTSIDE_BBOX_FINDER_TPL.build(self.context,
+                type_aliases=(
+                    ("bbox_t", bbox_dtype),
+                    ("coord_t", coord_dtype),
+                    ),
+                var_values=(
+                    ("axis_names", AXIS_NAMES[:dimensions]),
+                    ))
+
+    @memoize_method_in_context
+    def get_forest_kernel_info(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype):
+        from boxtree.bounding_box import make_bounding_box_dtype
+        from boxtree.tools import AXIS_NAMES
+        from boxtree.tree_build_kernels import (_KernelInfo,
+                FOREST_PARTICLE_TREE_ID_FINDER_TPL, FOREST_BBOX_SCAN_TPL,
+                FOREST_COORD_MAPPER_TPL, FOREST_BOX_TREE_ID_FINDER_TPL)
+
+        bbox_dtype, _ = make_bounding_box_dtype(
+                self.context.devices[0], dimensions, coord_dtype)
+
+        type_aliases = (
+                ("particle_id_t", particle_id_dtype),
+                ("box_id_t", box_id_dtype),
+                ("box_level_t", self.box_level_dtype),
+                ("bbox_t", bbox_dtype),
+                ("coord_t", coord_dtype),
+                )
+        var_values = (
+                ("axis_names", AXIS_NAMES[:dimensions]),
+                ("dimensions", dimensions),
+                ("coord_dtype", coord_dtype),
+                ("np", np),
+                )
+
+        return _KernelInfo(
+                bbox_dtype=bbox_dtype,
+                particle_tree_id_finder=FOREST_PARTICLE_TREE_ID_FINDER_TPL.build(
+                    self.context, type_aliases),
+                bbox_scan=FOREST_BBOX_SCAN_TPL.build(
+                    self.context,
+                    type_aliases=type_aliases + (
+                        ("scan_t", bbox_dtype),
+                        ("index_t", particle_id_dtype),
+                        ),
+                    var_values=var_values),
+                coord_mapper=FOREST_COORD_MAPPER_TPL.build(
+                    self.context, type_aliases, var_values=var_values),
+                box_tree_id_finder=FOREST_BOX_TREE_ID_FINDER_TPL.build(
+                    self.context, type_aliases),
+                )
 
     # {{{ run control
 
@@ -75,8 +345,12 @@ class TreeBuilder(object):
             allocator=None, debug=False, targets=None,
             source_radii=None, target_radii=None, stick_out_factor=0.25,
             refine_weights=None, max_leaf_refine_weight=None,
-            wait_for=None, non_adaptive=False,
-            **kwargs):
+            max_sources_in_box=None, max_targets_in_box=None,
+            wait_for=None, non_adaptive=False, levels_per_sync=None,
+            particle_id_dtype=None, box_id_dtype=None, engine="level",
+            profiler=None, workspace=None, balanced=False,
+            max_levels=None, min_box_extent=None, bbox=None,
+            ordering="morton", periodic=False, looseness=0, **kwargs):
         """
         :arg queue: a :class:`pyopencl.CommandQueue` instance
         :arg particles: an object array of (XYZ) point coordinate arrays.
@@ -101,12 +375,115 @@ class TreeBuilder(object):
         :arg max_particles_in_box: If not *None*, specifies the maximum number
             of particles in a leaf box. If this is given, both
             *refine_weights* and *max_leaf_refine_weight* must be *None*.
+            This is equivalent to, but cheaper than, passing refine weights
+            that are all one, as no array of weights is needed.
+        :arg max_sources_in_box: If not *None*, specifies the maximum number
+            of sources in a leaf box. Must be given together with
+            *max_targets_in_box*, and only if *targets* is given. A box is
+            then split if it has more sources than *max_sources_in_box* or
+            more targets than *max_targets_in_box*, so that dense targets
+            over sparse sources (or vice versa) do not refine the tree
+            beyond what the sparser kind needs. *max_particles_in_box*,
+            *refine_weights* and *max_leaf_refine_weight* must be *None*.
+            Not supported with the ``"morton"`` engine.
+        :arg max_targets_in_box: See *max_sources_in_box*.
         :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
             instances for whose completion this command waits before starting
             execution.
         :arg non_adaptive: If *True*, return a tree in which all leaf boxes are
             on the same (last) level. The tree is pruned, in the sense that empty
             boxes have been eliminated.
+        :arg levels_per_sync: If *None* (the default), the host waits for the
+            device after each level of refinement to check for termination
+            and for storage overflow. Otherwise, an integer number of
+            levels (or ``"auto"`` to estimate this from the particle count)
+            that are enqueued at a time without synchronizing with the host.
+            Box storage is over-allocated to accommodate any boxes these
+            levels could create. Levels enqueued after refinement has
+            finished do no useful work, so this trades some device work for
+            fewer host round trips. The resulting tree is the same either way.
+        :arg particle_id_dtype: The integer type used for particle numbers
+            (see :attr:`Tree.particle_id_dtype`). If *None*, :class:`numpy.int32`
+            is used if it can hold all particle numbers, and
+            :class:`numpy.int64` otherwise.
+        :arg box_id_dtype: The integer type used for box numbers (see
+            :attr:`Tree.box_id_dtype`). If *None*, this is chosen like
+            *particle_id_dtype*, based on an estimate of the number of boxes.
+            If the number of boxes turns out to exceed the range of this type,
+            :exc:`RuntimeError` is raised.
+        :arg engine: How boxes are formed. ``"level"`` (the default) refines
+            the tree level by level, with two scans over all particles per
+            level. ``"morton"`` computes a Morton key for each particle once,
+            radix-sorts particles by it and derives all boxes from the sorted
+            keys, in a number of passes that does not depend on the number of
+            levels. Both produce the same tree. ``"morton"`` does not support
+            particles with extent and always prunes the tree. It also cannot
+            resolve more than 31 levels in 2D (21 in 3D) and raises
+            :exc:`RuntimeError` if more would be needed.
+            *levels_per_sync* has no effect with ``"morton"``.
+        :arg profiler: If not *None*, a :class:`boxtree.profiling.Profiler`
+            in which the kernels enqueued by the build, the points at which
+            the host waits for the device, and allocations are recorded.
+        :arg workspace: If not *None*, a :class:`TreeBuildWorkspace` from
+            which temporary storage is taken, to be reused in subsequent
+            builds.
+        :arg balanced: If *True*, refine the tree beyond what
+            *max_particles_in_box* (or *max_leaf_refine_weight*) requires,
+            until no leaf box is adjacent to a non-leaf box on a finer
+            level. Adjacent leaf boxes then differ by at most one level,
+            and :attr:`Tree.is_balanced` is set. Leaves that violate this
+            are found on the device using peer lists (see
+            :class:`boxtree.area_query.PeerListFinder`), and the tree is
+            rebuilt with these leaves split, until none are left.
+            Not supported for particles with extent or with the
+            ``"morton"`` engine.
+        :arg max_levels: If not *None*, the maximum number of levels of
+            the tree. Boxes on the last level are not split, regardless of
+            their refine weight, so that leaf boxes there may hold more
+            than *max_particles_in_box* particles (or more than
+            *max_leaf_refine_weight*). This bounds the time and memory
+            needed for particles that are (nearly) coincident, which would
+            otherwise be refined until the maximum number of levels
+            supported by :attr:`Tree.box_level_dtype` is exceeded.
+        :arg min_box_extent: If not *None*, boxes are not split if their
+            children would be smaller than this size. Like *max_levels*,
+            but relative to the size of the root box.
+        :arg bbox: If not *None*, the root box of the tree, to be used
+            instead of finding a bounding box of the particles, which
+            requires waiting for the device. Either a tuple
+            ``(bbox_min, bbox_max)`` of :mod:`numpy` vectors (such as
+            :attr:`Tree.bounding_box` of an earlier tree), or a
+            :class:`StickyBoundingBox`. A tuple that does not describe a
+            cube is extended to one by moving *bbox_max*. All particle
+            centers must be contained in the box, with coordinates
+            greater than or equal to *bbox_min* and less than *bbox_max*.
+            This is checked on the device and reported the next time the
+            build waits for the device anyway, by raising
+            :exc:`ValueError`. Radii of particles with extent may reach
+            beyond the box.
+        :arg ordering: The order of the children of each box, and therefore
+            of boxes on each level and of particles. ``"morton"`` (the
+            default) or ``"hilbert"``, in which consecutive boxes on a level
+            are adjacent to each other, improving the locality of
+            computations that walk boxes in order. Either way,
+            :attr:`Tree.box_child_ids` is indexed by Morton number.
+            ``"hilbert"`` is not supported with the ``"morton"`` engine.
+        :arg periodic: If *True*, the particles are taken to be repeated
+            periodically along all axes, with the root box as the unit
+            cell, and :attr:`Tree.is_periodic` is set. The root box must
+            be given as a tuple *bbox* that describes a cube, and particles
+            must not have extent.
+        :arg looseness: If nonzero, the particles of the tree are allowed
+            to lie outside the box they are sorted into, as long as they are
+            inside that box scaled by ``1 + looseness`` about its center,
+            and :attr:`Tree.looseness` is set. The boxes are formed as
+            usual, but traversals of the tree account for the looseness, so
+            that they remain valid while :class:`LooseTreeUpdater` moves
+            the particles within these limits. Like *stick_out_factor*, this
+            should be small (at most 0.5) for the separation of
+            :attr:`boxtree.traversal.FMMTraversalInfo.sep_siblings_lists`
+            to be useful. Particles must not have extent, and the tree
+            must not be periodic.
         :arg kwargs: Used internally for debugging.
 
         :returns: a tuple ``(tree, event)``, where *tree* is an instance of
@@ -136,9 +513,47 @@ class TreeBuilder(object):
             raise ValueError("must specify targets when specifying "
                     "any kind of radii")
 
+        skip_prune = kwargs.get("skip_prune", False)
+
+        if engine not in ["level", "morton"]:
+            raise ValueError("unknown tree build engine '%s'" % engine)
+
+        if ordering not in ["morton", "hilbert"]:
+            raise ValueError("unknown box ordering '%s'" % ordering)
+
+        if engine == "morton":
+            if ordering != "morton":
+                raise NotImplementedError("the 'morton' engine only supports "
+                        "Morton ordering")
+            if srcntgts_have_extent:
+                raise NotImplementedError("the 'morton' engine does not "
+                        "support sources or targets with extent")
+            if skip_prune:
+                raise NotImplementedError("the 'morton' engine always "
+                        "prunes the tree")
+            if max_sources_in_box is not None or max_targets_in_box is not None:
+                raise NotImplementedError("the 'morton' engine does not "
+                        "support separate source and target limits")
+
+        if periodic:
+            if bbox is None or isinstance(bbox, StickyBoundingBox):
+                raise ValueError("periodic trees require the unit cell to "
+                        "be given as a tuple bbox")
+            if srcntgts_have_extent:
+                raise NotImplementedError("periodic trees of sources or "
+                        "targets with extent are not supported")
+
+        if looseness:
+            if looseness < 0:
+                raise ValueError("looseness must be nonnegative")
+            if srcntgts_have_extent:
+                raise NotImplementedError("loose trees of sources or "
+                        "targets with extent are not supported")
+            if periodic:
+                raise NotImplementedError("loose periodic trees are not "
+                        "supported")
+
         from pytools import single_valued
-        particle_id_dtype = np.int32
-        box_id_dtype = np.int32
         coord_dtype = single_valued(coord.dtype for coord in particles)
 
         if targets is None:
@@ -148,6 +563,30 @@ class TreeBuilder(object):
             ntargets = single_valued(len(coord) for coord in targets)
             nsrcntgts = nsources + ntargets
 
+        def get_id_dtype(max_id):
+            if max_id <= np.iinfo(np.int32).max:
+                return np.dtype(np.int32)
+            else:
+                return np.dtype(np.int64)
+
+        if particle_id_dtype is None:
+            particle_id_dtype = get_id_dtype(nsrcntgts)
+        else:
+            particle_id_dtype = np.dtype(particle_id_dtype)
+
+        if box_id_dtype is None:
+            box_id_dtype = get_id_dtype(2**dimensions * nsrcntgts)
+        else:
+            box_id_dtype = np.dtype(box_id_dtype)
+
+        for id_dtype in [particle_id_dtype, box_id_dtype]:
+            if id_dtype not in [np.int32, np.int64]:
+                raise TypeError("id dtypes must be int32 or int64")
+
+        if nsrcntgts > np.iinfo(particle_id_dtype).max:
+            raise ValueError("particle_id_dtype cannot hold the number of "
+                    "particles")
+
         if source_radii is not None:
             if source_radii.shape != (nsources,):
                 raise ValueError("source_radii has an invalid shape")
@@ -164,22 +603,91 @@ class TreeBuilder(object):
                 raise TypeError("dtypes of coordinate arrays and "
                         "target_radii must agree")
 
+        if isinstance(bbox, StickyBoundingBox):
+            return self._build_with_sticky_bbox(queue, particles, bbox, dict(
+                    max_particles_in_box=max_particles_in_box,
+                    allocator=allocator, debug=debug, targets=targets,
+                    source_radii=source_radii, target_radii=target_radii,
+                    stick_out_factor=stick_out_factor,
+                    refine_weights=refine_weights,
+                    max_leaf_refine_weight=max_leaf_refine_weight,
+                    max_sources_in_box=max_sources_in_box,
+                    max_targets_in_box=max_targets_in_box,
+                    wait_for=wait_for, non_adaptive=non_adaptive,
+                    levels_per_sync=levels_per_sync,
+                    particle_id_dtype=particle_id_dtype,
+                    box_id_dtype=box_id_dtype, engine=engine,
+                    profiler=profiler, workspace=workspace, balanced=balanced,
+                    max_levels=max_levels, min_box_extent=min_box_extent,
+                    ordering=ordering, looseness=looseness, **kwargs))
+
+        if balanced and not non_adaptive:
+            # (Non-adaptive trees are balanced anyway.)
+            if srcntgts_have_extent:
+                raise NotImplementedError("balanced trees of sources or "
+                        "targets with extent are not supported")
+            if engine != "level":
+                raise NotImplementedError("the '%s' engine does not support "
+                        "balanced trees" % engine)
+
+            return self._build_balanced(queue, particles, dict(
+                    max_particles_in_box=max_particles_in_box,
+                    max_levels=max_levels, min_box_extent=min_box_extent,
+                    bbox=bbox, periodic=periodic,
+                    allocator=allocator, debug=debug, targets=targets,
+                    refine_weights=refine_weights,
+                    max_leaf_refine_weight=max_leaf_refine_weight,
+                    max_sources_in_box=max_sources_in_box,
+                    max_targets_in_box=max_targets_in_box,
+                    wait_for=wait_for, levels_per_sync=levels_per_sync,
+                    particle_id_dtype=particle_id_dtype,
+                    box_id_dtype=box_id_dtype,
+                    profiler=profiler, workspace=workspace,
+                    ordering=ordering, looseness=looseness, **kwargs))
+
+        # per-srcntgt (in user order) level below which the leaf containing
+        # it must not be, see _build_balanced
+        srcntgt_min_leaf_levels = kwargs.get("srcntgt_min_leaf_levels")
+        if srcntgt_min_leaf_levels is not None:
+            # The batched level loop only stops refining once no box is
+            # overfull, so use the synchronizing one.
+            levels_per_sync = None
+
         # }}}
 
-        empty = partial(cl.array.empty, queue, allocator=allocator)
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "tree build")
+
+        def empty(shape, dtype):
+            result = cl.array.empty(queue, shape, dtype, allocator=allocator)
+            prof.allocation("empty", result)
+            return result
 
         def zeros(shape, dtype):
             result = (cl.array.empty(queue, shape, dtype, allocator=allocator)
                     .fill(0, wait_for=wait_for))
+            prof.allocation("zeros", result)
             event, = result.events
             return result, event
 
-        knl_info = self.get_kernel_info(dimensions, coord_dtype,
-                particle_id_dtype, box_id_dtype,
-                sources_are_targets, srcntgts_have_extent,
-                stick_out_factor, adaptive=not non_adaptive)
+        def scratch(name, shape, dtype):
+            """Return an uninitialized temporary array, taken from *workspace*
+            if one is given.
+            """
+            if workspace is None:
+                return empty(shape, dtype)
+
+            result, allocated = workspace.get(queue, name, shape, dtype)
+            if allocated:
+                prof.allocation("workspace", result)
+            return result
+
+        def scratch_zeros(name, shape, dtype):
+            result = scratch(name, shape, dtype).fill(0, wait_for=wait_for)
+            event, = result.events
+            return result, event
 
-        # {{{ combine sources and targets into one array, if necessary
+        # {{{ process sources and targets
 
         prep_events = []
 
@@ -187,19 +695,20 @@ class TreeBuilder(object):
             # Targets weren't specified. Sources are also targets. Let's
             # call them "srcntgts".
 
-            srcntgts = particles
-
             assert source_radii is None
             assert target_radii is None
 
-            srcntgt_radii = None
+            # (start, coordinates, radii) of the parts of the srcntgts
+            srcntgt_parts = [(0, particles, None)]
+            srcntgt_coord_args = tuple(particles)
 
         else:
-            # Here, we mash sources and targets into one array to give us one
-            # big array of "srcntgts". In this case, a "srcntgt" is either a
-            # source or a target, but not really both, as above. How will we be
-            # able to tell which it was? Easy: We'll compare its 'user' id with
-            # nsources. If it's >=, it's a target, otherwise it's a source.
+            # In this case, a "srcntgt" is either a source or a target, but
+            # not really both, as above. How will we be able to tell which it
+            # was? Easy: We'll compare its 'user' id with nsources. If it's >=,
+            # it's a target, otherwise it's a source. Sources and targets are
+            # not copied into one array. Instead, kernels reading the
+            # coordinates of srcntgts receive both arrays.
 
             target_coord_dtype = single_valued(tgt_i.dtype for tgt_i in targets)
 
@@ -207,46 +716,48 @@ class TreeBuilder(object):
                 raise TypeError("sources and targets must have same coordinate "
                         "dtype")
 
-            def combine_srcntgt_arrays(ary1, ary2=None):
-                if ary2 is None:
-                    dtype = ary1.dtype
-                else:
-                    dtype = ary2.dtype
-
-                result = empty(nsrcntgts, dtype)
-                if (ary1 is None) or (ary2 is None):
-                    result.fill(0)
-
-                if ary1 is not None and ary1.nbytes:
-                    result[:len(ary1)] = ary1
-
-                if ary2 is not None and ary2.nbytes:
-                    result[nsources:] = ary2
-
-                return result
-
-            from pytools.obj_array import make_obj_array
-            srcntgts = make_obj_array([
-                combine_srcntgt_arrays(src_i, tgt_i)
-                for src_i, tgt_i in zip(particles, targets)
-                ])
-
             if srcntgts_have_extent:
-                srcntgt_radii = combine_srcntgt_arrays(source_radii, target_radii)
-            else:
-                srcntgt_radii = None
-
-        del source_radii
-        del target_radii
-
-        del particles
-
-        user_srcntgt_ids = cl.array.arange(queue, nsrcntgts, dtype=particle_id_dtype,
-                allocator=allocator)
+                # Kernels read the radii of both sources and targets.
+                if source_radii is None:
+                    source_radii, evt = scratch_zeros(
+                            "source_radii", nsources, coord_dtype)
+                    prep_events.append(evt)
+                if target_radii is None:
+                    target_radii, evt = scratch_zeros(
+                            "target_radii", ntargets, coord_dtype)
+                    prep_events.append(evt)
+
+            srcntgt_parts = [
+                    (0, particles, source_radii),
+                    (nsources, targets, target_radii)]
+            srcntgt_coord_args = (
+                    tuple(particles) + (nsources,) + tuple(targets)
+                    + ((source_radii, target_radii)
+                        if srcntgts_have_extent else ()))
+
+        # Kernels taking one coordinate array per axis are run separately
+        # on each nonempty part.
+        srcntgt_parts = [
+                (part_start, part_coords, part_radii)
+                for part_start, part_coords, part_radii in srcntgt_parts
+                if len(part_coords[0])]
+
+
+        if workspace is None:
+            user_srcntgt_ids = cl.array.arange(queue, nsrcntgts,
+                    dtype=particle_id_dtype, allocator=allocator)
+
+            evt, = user_srcntgt_ids.events
+            wait_for.append(evt)
+            del evt
 
-        evt, = user_srcntgt_ids.events
-        wait_for.append(evt)
-        del evt
+        else:
+            # The level loop does not write to the initial user_srcntgt_ids,
+            # so the workspace can keep it around.
+            user_srcntgt_ids, allocated = workspace.get_arange(
+                    queue, nsrcntgts, particle_id_dtype)
+            if allocated:
+                prof.allocation("workspace", user_srcntgt_ids)
 
         # }}}
 
@@ -257,51 +768,171 @@ class TreeBuilder(object):
         specified_max_particles_in_box = max_particles_in_box is not None
         specified_refine_weights = refine_weights is not None and \
             max_leaf_refine_weight is not None
-
-        if specified_max_particles_in_box and specified_refine_weights:
-            raise ValueError("may only specify one of max_particles_in_box and "
-                    "refine_weights/max_leaf_refine_weight")
-        elif not specified_max_particles_in_box and not specified_refine_weights:
-            raise ValueError("must specify either max_particles_in_box or "
-                    "refine_weights/max_leaf_refine_weight")
+        specified_kind_limits = (max_sources_in_box is not None
+                or max_targets_in_box is not None)
+
+        if (specified_max_particles_in_box + specified_refine_weights
+                + specified_kind_limits > 1):
+            raise ValueError("may only specify one of max_particles_in_box, "
+                    "refine_weights/max_leaf_refine_weight and "
+                    "max_sources_in_box/max_targets_in_box")
+        elif not (specified_max_particles_in_box or specified_refine_weights
+                or specified_kind_limits):
+            raise ValueError("must specify either max_particles_in_box, "
+                    "refine_weights/max_leaf_refine_weight or "
+                    "max_sources_in_box/max_targets_in_box")
+        elif specified_kind_limits:
+            if max_sources_in_box is None or max_targets_in_box is None:
+                raise ValueError("must specify both max_sources_in_box and "
+                        "max_targets_in_box")
+            if sources_are_targets:
+                raise ValueError("max_sources_in_box and max_targets_in_box "
+                        "require separate targets")
+            if max_targets_in_box <= 0:
+                raise ValueError("max_targets_in_box must be positive")
+
+            # Only sources carry a (unit) refine weight, so that the weight
+            # of a box is its number of sources. Its number of targets is
+            # found from its particle count.
+            unit_refine_weights = True
+            refine_weights = None
+            max_leaf_refine_weight = max_sources_in_box
+            total_refine_weight = nsources
         elif specified_max_particles_in_box:
-            refine_weights = (
-                cl.array.empty(
-                    queue, nsrcntgts, refine_weight_dtype, allocator=allocator)
-                .fill(1))
-            event, = refine_weights.events
-            prep_events.append(event)
+            # All refine weights are one. The kernels are told so and count
+            # particles instead, so that no array of weights is needed.
+            unit_refine_weights = True
+            refine_weights = None
             max_leaf_refine_weight = max_particles_in_box
+            total_refine_weight = nsrcntgts
         elif specified_refine_weights:
             if refine_weights.dtype != refine_weight_dtype:
                 raise TypeError("refine_weights must have dtype '%s'"
                         % refine_weight_dtype)
 
-        if max_leaf_refine_weight < cl.array.max(refine_weights).get():
-            raise ValueError(
-                    "entries of refine_weights cannot exceed max_leaf_refine_weight")
-        if 0 > cl.array.min(refine_weights).get():
-            raise ValueError("all entries of refine_weights must be nonnegative")
+            unit_refine_weights = False
+
+            # Only a single reduction and a single transfer are needed to
+            # validate the weights and find their total.
+            with prof.sync("validate refine weights"):
+                stats = self.get_refine_weight_stats_kernel()(
+                        refine_weights, queue=queue, wait_for=wait_for).get()
+
+            if len(refine_weights) and (
+                    max_leaf_refine_weight < stats["max_weight"]):
+                raise ValueError("entries of refine_weights cannot exceed "
+                        "max_leaf_refine_weight")
+            if len(refine_weights) and 0 > stats["min_weight"]:
+                raise ValueError(
+                        "all entries of refine_weights must be nonnegative")
+
+            total_refine_weight = int(stats["total_weight"])
+
+        refine_weights_args = () if unit_refine_weights else (refine_weights,)
+
         if max_leaf_refine_weight <= 0:
             raise ValueError("max_leaf_refine_weight must be positive")
 
-        total_refine_weight = cl.array.sum(
-                refine_weights, dtype=np.dtype(np.int64)).get()
+        if specified_kind_limits:
+            max_targets_in_box_args = (max_targets_in_box,)
+
+            # Every box on a level that is split holds more than
+            # max_sources_in_box sources or more than max_targets_in_box
+            # targets, which bounds the number of such boxes.
+            nleaves_guess = (
+                    (max_sources_in_box + nsources - 1) // max_sources_in_box
+                    + (max_targets_in_box + ntargets - 1) // max_targets_in_box)
+            max_split_box_count = (
+                    nsources // (max_sources_in_box + 1)
+                    + ntargets // (max_targets_in_box + 1))
+            root_is_overfull = (nsources > max_sources_in_box
+                    or ntargets > max_targets_in_box)
+        else:
+            max_targets_in_box_args = ()
+
+            nleaves_guess = (
+                    (max_leaf_refine_weight + total_refine_weight - 1)
+                    // max_leaf_refine_weight)
+            max_split_box_count = (
+                    total_refine_weight // (max_leaf_refine_weight + 1))
+            root_is_overfull = total_refine_weight > max_leaf_refine_weight
 
         del max_particles_in_box
         del specified_max_particles_in_box
         del specified_refine_weights
+        del max_sources_in_box
+        del max_targets_in_box
 
         # }}}
 
+        knl_info = self.get_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype,
+                sources_are_targets, srcntgts_have_extent,
+                stick_out_factor, adaptive=not non_adaptive,
+                srcntgts_have_min_leaf_levels=(
+                    srcntgt_min_leaf_levels is not None),
+                unit_refine_weights=unit_refine_weights,
+                hilbert=ordering == "hilbert",
+                separate_target_limit=specified_kind_limits)
+
         # {{{ find and process bounding box
 
-        bbox, _ = self.bbox_finder(srcntgts, srcntgt_radii, wait_for=wait_for)
-        bbox = bbox.get()
+        given_bbox = bbox
+        del bbox
+
+        if given_bbox is None:
+            with prof.sync("find bounding box"):
+                part_bboxes = [
+                        self.bbox_finder(part_coords, part_radii,
+                            wait_for=wait_for + prep_events)[0]
+                        for _, part_coords, part_radii in srcntgt_parts]
+
+                bbox = part_bboxes[0].get()
+                for part_bbox in part_bboxes[1:]:
+                    part_bbox = part_bbox.get()
+                    for ax in axis_names:
+                        bbox["min_"+ax] = min(
+                                bbox["min_"+ax], part_bbox["min_"+ax])
+                        bbox["max_"+ax] = max(
+                                bbox["max_"+ax], part_bbox["max_"+ax])
+                del part_bboxes
+
+            root_extent = max(
+                    bbox["max_"+ax] - bbox["min_"+ax]
+                    for ax in axis_names) * (1+1e-4)
+
+            # (used by StickyBoundingBox)
+            bbox_margin = kwargs.get("bbox_margin", 0)
+            if bbox_margin:
+                for ax in axis_names:
+                    bbox["min_"+ax] -= bbox_margin * root_extent
+                root_extent *= 1 + 2*bbox_margin
 
-        root_extent = max(
-                bbox["max_"+ax] - bbox["min_"+ax]
-                for ax in axis_names) * (1+1e-4)
+        else:
+            given_bbox_min, given_bbox_max = (
+                    np.asarray(given_bbox_min_max, dtype=coord_dtype)
+                    for given_bbox_min_max in given_bbox)
+            if (given_bbox_min.shape != (dimensions,)
+                    or given_bbox_max.shape != (dimensions,)):
+                raise ValueError("bbox must consist of two vectors with one "
+                        "entry per dimension")
+            if not (given_bbox_min < given_bbox_max).all():
+                raise ValueError("bbox must have positive extent along all "
+                        "axes")
+
+            from boxtree.bounding_box import make_bounding_box_dtype
+            bbox_dtype, _ = make_bounding_box_dtype(
+                    self.context.devices[0], dimensions, coord_dtype)
+
+            bbox = np.empty((), bbox_dtype)
+            for i, ax in enumerate(axis_names):
+                bbox["min_"+ax] = given_bbox_min[i]
+
+            root_extent = np.max(given_bbox_max - given_bbox_min)
+
+            if periodic and (given_bbox_max - given_bbox_min != root_extent).any():
+                raise ValueError("the bbox (i.e. the unit cell) of a periodic "
+                        "tree must be a cube")
 
         # make bbox square and slightly larger at the top, to ensure scaled
         # coordinates are always < 1
@@ -315,414 +946,1100 @@ class TreeBuilder(object):
 
         # }}}
 
-        from pytools import div_ceil
+        # {{{ check that particles are inside a given bounding box
 
-        # {{{ allocate data
-
-        logger.debug("allocating memory")
-
-        # box-local morton bin counts for each particle at the current level
-        # only valid from scan -> split'n'sort
-        morton_bin_counts = empty(nsrcntgts, dtype=knl_info.morton_bin_count_dtype)
-
-        # (local) morton nrs for each particle at the current level
-        # only valid from scan -> split'n'sort
-        morton_nrs = empty(nsrcntgts, dtype=self.morton_nr_dtype)
-
-        # 0/1 segment flags
-        # invariant to sorting once set
-        # (particles are only reordered within a box)
-        # valid throughout computation
-        box_start_flags, evt = zeros(nsrcntgts, dtype=np.int8)
-        prep_events.append(evt)
-        srcntgt_box_ids, evt = zeros(nsrcntgts, dtype=box_id_dtype)
-        prep_events.append(evt)
-        split_box_ids, evt = zeros(nsrcntgts, dtype=box_id_dtype)
-        prep_events.append(evt)
-
-        # number of boxes total, and a guess
-        nboxes_dev = empty((), dtype=box_id_dtype)
-        nboxes_dev.fill(1)
-
-        # /!\ If you're allocating an array here that depends on nboxes_guess,
-        # you *must* also write reallocation code down below for the case when
-        # nboxes_guess was too low.
-
-        # Outside nboxes_guess feeding is solely for debugging purposes,
-        # to test the reallocation code.
-        nboxes_guess = kwargs.get("nboxes_guess")
-        if nboxes_guess is None:
-            nboxes_guess = 2**dimensions * (
-                    (max_leaf_refine_weight + total_refine_weight - 1)
-                    // max_leaf_refine_weight)
+        # Checking is enqueued here, but only waited for (in
+        # check_particles_inside_bbox) once the build waits for the device
+        # anyway.
+
+        if given_bbox is not None:
+            have_particles_outside_bbox = scratch(
+                    "have_particles_outside_bbox", 1, np.int32)
+            have_particles_outside_bbox.fill(0, wait_for=wait_for)
+            evt = have_particles_outside_bbox.events[-1]
 
-        assert nboxes_guess > 0
+            for _, part_coords, _ in srcntgt_parts:
+                evt = self.get_particles_outside_bbox_finder(
+                        dimensions, coord_dtype)(
+                        bbox, have_particles_outside_bbox, *part_coords,
+                        queue=queue, range=slice(len(part_coords[0])),
+                        wait_for=[evt])
+                prof.event("find particles outside bounding box", evt)
+            have_particles_outside_bbox.add_event(evt)
 
-        # per-box morton bin counts
-        box_morton_bin_counts = empty(nboxes_guess,
-                dtype=knl_info.morton_bin_count_dtype)
+        # a list, to be modifiable from check_particles_inside_bbox
+        bbox_check_pending = [given_bbox is not None]
 
-        # particle# at which each box starts
-        box_srcntgt_starts, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
-        prep_events.append(evt)
+        def check_particles_inside_bbox():
+            if not bbox_check_pending[0]:
+                return
+            bbox_check_pending[0] = False
 
-        # pointer to parent box
-        box_parent_ids, evt = zeros(nboxes_guess, dtype=box_id_dtype)
-        prep_events.append(evt)
+            with prof.sync("check for particles outside bounding box"):
+                have_particles_outside_bbox_host = int(
+                        have_particles_outside_bbox.get()[0])
 
-        # morton nr identifier {quadr,oct}ant of parent in which this box was created
-        box_morton_nrs, evt = zeros(nboxes_guess, dtype=self.morton_nr_dtype)
-        prep_events.append(evt)
+            if have_particles_outside_bbox_host:
+                raise _ParticlesOutsideBoundingBox("particles found outside "
+                        "of the given bounding box")
 
-        # box -> level map
-        box_levels, evt = zeros(nboxes_guess, self.box_level_dtype)
-        prep_events.append(evt)
+        # }}}
+
+        # {{{ find the deepest level on which boxes may be created
+
+        # *None* if unlimited
+        max_box_level = None
 
-        # number of particles in each box
-        # needs to be globally initialized because empty boxes never get touched
-        box_srcntgt_counts_cumul, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
-        prep_events.append(evt)
+        if max_levels is not None:
+            if max_levels < 1:
+                raise ValueError("max_levels must be positive")
 
-        # Initalize box 0 to contain all particles
-        box_srcntgt_counts_cumul[0].fill(
-                nsrcntgts, queue=queue, wait_for=[evt])
+            max_box_level = max_levels - 1
 
-        # box -> whether the box has a child
-        box_has_children, evt = zeros(nboxes_guess, dtype=np.dtype(np.int32))
-        prep_events.append(evt)
+        if min_box_extent is not None:
+            if min_box_extent <= 0:
+                raise ValueError("min_box_extent must be positive")
 
-        # set parent of root box to itself
-        evt = cl.enqueue_copy(
-                queue, box_parent_ids.data, np.zeros((), dtype=box_parent_ids.dtype))
-        prep_events.append(evt)
+            min_box_extent_level = 0
+            while (min_box_extent_level < np.iinfo(self.box_level_dtype).max
+                    and (root_extent / 2**(min_box_extent_level + 1)
+                        >= min_box_extent)):
+                min_box_extent_level += 1
+
+            if max_box_level is None:
+                max_box_level = min_box_extent_level
+            else:
+                max_box_level = min(max_box_level, min_box_extent_level)
 
         # }}}
 
+        from pytools import div_ceil
+
         def fin_debug(s):
             if debug:
                 queue.finish()
 
             logger.debug(s)
 
+        def check_nboxes_bound(nboxes_bound):
+            # Box numbers are computed in box_id_t on the device, so overflow
+            # has to be ruled out before building a level.
+            if nboxes_bound > np.iinfo(box_id_dtype).max:
+                raise RuntimeError("number of boxes may exceed the range "
+                        "of box_id_dtype '%s', specify a wider one"
+                        % box_id_dtype)
+
         from pytools.obj_array import make_obj_array
-        have_oversize_split_box, evt = zeros((), np.int32)
-        prep_events.append(evt)
 
-        wait_for = prep_events
+        if engine == "morton":
+            # {{{ sort into boxes by Morton key
+
+            # See the comment on the Morton key sort kernels in
+            # boxtree.tree_build_kernels for how this works. The result is
+            # the same as that of the level loop, followed by pruning.
+
+            from boxtree.tree_build_kernels import morton_key_dtype
+            morton_knl_info = self.get_morton_kernel_info(dimensions,
+                    coord_dtype, particle_id_dtype, box_id_dtype,
+                    adaptive=not non_adaptive,
+                    unit_refine_weights=unit_refine_weights)
+            key_levels = morton_knl_info.key_levels
+
+            wait_for = wait_for + prep_events
+
+            from time import time
+            start_time = time()
+
+            fin_debug("compute morton keys")
+
+            morton_keys = scratch("morton_keys", nsrcntgts, morton_key_dtype)
+            key_events = []
+            for part_start, part_coords, _ in srcntgt_parts:
+                npart = len(part_coords[0])
+                evt = morton_knl_info.morton_key_kernel(
+                        bbox, morton_keys[part_start:part_start+npart],
+                        *part_coords,
+                        queue=queue, range=slice(npart), wait_for=wait_for)
+                prof.event("compute morton keys", evt)
+                key_events.append(evt)
+            evt = cl.enqueue_marker(queue, wait_for=key_events)
+            del key_events
+
+            fin_debug("sort by morton key")
+
+            (sorted_keys, sorted_user_ids), evt = morton_knl_info.morton_key_sort(
+                    morton_keys, user_srcntgt_ids, 0,
+                    key_bits=dimensions*key_levels,
+                    queue=queue, allocator=allocator, wait_for=[evt])
+            prof.event("sort by morton key", evt)
+            del morton_keys
+
+            fin_debug("find leaf levels")
+
+            if unit_refine_weights:
+                # Box weights are particle counts, found from the keys alone.
+                refine_weight_sums_args = ()
+            else:
+                refine_weight_sums = scratch(
+                        "refine_weight_sums", nsrcntgts + 1, np.int64)
+                evt = morton_knl_info.refine_weight_sum_scan(
+                        sorted_user_ids, refine_weights, refine_weight_sums,
+                        queue=queue, size=nsrcntgts, wait_for=[evt])
+                prof.event("refine weight sum scan", evt)
+                refine_weight_sums_args = (refine_weight_sums,)
+                del refine_weight_sums
+
+            leaf_levels = scratch(
+                    "leaf_levels", nsrcntgts, self.box_level_dtype)
+            evt = morton_knl_info.leaf_level_finder(
+                    *((sorted_keys, nsrcntgts)
+                        + refine_weight_sums_args
+                        + (max_leaf_refine_weight,
+                            key_levels + 1 if max_box_level is None
+                            else max_box_level,
+                            leaf_levels)),
+                    queue=queue, range=slice(nsrcntgts), wait_for=[evt])
+            prof.event("find leaf levels", evt)
+            del refine_weight_sums_args
+
+            leaf_levels.add_event(evt)
+            with prof.sync("read back max leaf level"):
+                max_leaf_level = int(
+                        cl.array.max(leaf_levels, queue=queue).get())
+
+            check_particles_inside_bbox()
+
+            if max_leaf_level > key_levels:
+                raise RuntimeError("the 'morton' engine can only resolve "
+                        "%d levels, which is not enough for these particles. "
+                        "Use engine='level' instead." % key_levels)
+
+            fin_debug("sort by leaf box")
+
+            user_leaf_keys = scratch(
+                    "user_leaf_keys", nsrcntgts, morton_key_dtype)
+            user_leaf_levels = scratch(
+                    "user_leaf_levels", nsrcntgts, self.box_level_dtype)
+            evt = morton_knl_info.leaf_key_scatter(
+                    sorted_keys, sorted_user_ids, leaf_levels, max_leaf_level,
+                    user_leaf_keys, user_leaf_levels,
+                    queue=queue, range=slice(nsrcntgts), wait_for=[evt])
+            prof.event("scatter leaf keys", evt)
+            del sorted_keys
+            del sorted_user_ids
+            del leaf_levels
+
+            # The sort is stable, and user_srcntgt_ids is still in user order.
+            # Particles therefore stay in user order within each leaf.
+            # (If the root is the only box, there are no key bits to sort by,
+            # but the sort must still produce a copy.)
+            (leaf_keys, user_srcntgt_ids), evt = morton_knl_info.morton_key_sort(
+                    user_leaf_keys, user_srcntgt_ids,
+                    dimensions*(key_levels - max_leaf_level),
+                    key_bits=max(1, dimensions*max_leaf_level),
+                    queue=queue, allocator=allocator, wait_for=[evt])
+            prof.event("sort by leaf box", evt)
+            del user_leaf_keys
+
+            fin_debug("emit boxes")
+
+            box_emit_offsets = scratch("box_emit_offsets", nsrcntgts, np.int64)
+            nboxes_dev = scratch("nboxes", (), np.int64)
+            evt = morton_knl_info.box_count_scan(
+                    leaf_keys, user_srcntgt_ids, user_leaf_levels,
+                    box_emit_offsets, nboxes_dev,
+                    queue=queue, size=nsrcntgts, wait_for=[evt])
+            prof.event("box count scan", evt)
+
+            with prof.sync("read back number of boxes"):
+                nboxes = int(nboxes_dev.get())
+            check_nboxes_bound(nboxes)
+
+            unsorted_box_levels = scratch(
+                    "unsorted_box_levels", nboxes, self.box_level_dtype)
+            unsorted_box_srcntgt_starts = scratch(
+                    "unsorted_box_srcntgt_starts", nboxes, particle_id_dtype)
+            evt = morton_knl_info.box_emitter(
+                    leaf_keys, user_srcntgt_ids, user_leaf_levels,
+                    box_emit_offsets,
+                    unsorted_box_levels, unsorted_box_srcntgt_starts,
+                    queue=queue, range=slice(nsrcntgts), wait_for=[evt])
+            prof.event("emit boxes", evt)
+            del box_emit_offsets
+
+            fin_debug("sort boxes by level")
+
+            (box_levels, box_srcntgt_starts), evt = \
+                    morton_knl_info.box_level_sort(
+                        unsorted_box_levels, unsorted_box_srcntgt_starts,
+                        key_bits=max(1, max_leaf_level.bit_length()),
+                        queue=queue, allocator=allocator, wait_for=[evt])
+            prof.event("sort boxes by level", evt)
+            del unsorted_box_levels
+            del unsorted_box_srcntgt_starts
+
+            # Every level up to the deepest leaf has at least one box.
+            level_start_box_nrs_dev = scratch(
+                    "level_start_box_nrs", max_leaf_level + 2, box_id_dtype)
+            level_start_box_nrs_dev.fill(nboxes)
+            evt = morton_knl_info.level_start_finder(
+                    box_levels, level_start_box_nrs_dev,
+                    queue=queue, range=slice(nboxes),
+                    wait_for=[evt] + level_start_box_nrs_dev.events)
+            prof.event("find level starts", evt)
+            level_start_box_nrs_dev.add_event(evt)
+            with prof.sync("read back level starts"):
+                level_start_box_nrs = level_start_box_nrs_dev.get()
+
+            fin_debug("compute box connectivity")
+
+            box_srcntgt_counts_cumul = empty(nboxes, particle_id_dtype)
+            box_parent_ids = empty(nboxes, box_id_dtype)
+            box_morton_nrs = empty(nboxes, self.morton_nr_dtype)
+            box_has_children = empty(nboxes, np.int32)
+            evt = morton_knl_info.box_info_kernel(
+                    leaf_keys, user_srcntgt_ids, user_leaf_levels, nsrcntgts,
+                    box_levels, box_srcntgt_starts, level_start_box_nrs_dev,
+                    box_srcntgt_counts_cumul, box_parent_ids, box_morton_nrs,
+                    box_has_children,
+                    queue=queue, range=slice(nboxes), wait_for=[evt])
+            prof.event("compute box connectivity", evt)
+
+            srcntgt_box_ids = scratch(
+                    "srcntgt_box_ids", nsrcntgts, box_id_dtype)
+            evt2 = morton_knl_info.srcntgt_box_finder(
+                    user_srcntgt_ids, user_leaf_levels, box_srcntgt_starts,
+                    level_start_box_nrs_dev,
+                    srcntgt_box_ids,
+                    queue=queue, range=slice(nsrcntgts), wait_for=[evt])
+            prof.event("find particle boxes", evt2)
+            wait_for = [evt, evt2]
+            del evt2
 
-        # {{{ level loop
+            del leaf_keys
+            del user_leaf_levels
+            del level_start_box_nrs_dev
 
-        # Level 0 starts at 0 and always contains box 0 and nothing else.
-        # Level 1 therefore starts at 1.
-        level_start_box_nrs = [0, 1]
+            if debug:
+                assert (box_srcntgt_counts_cumul.get() > 0).all()
+                assert (box_srcntgt_starts.get() < nsrcntgts).all()
+
+            level = max_leaf_level
+            nboxes_post_prune = nboxes
+            is_pruned = True
+
+            logger.info("morton sort: %d levels, %d boxes, elapsed time: %g s"
+                    % (level + 1, nboxes, time()-start_time))
+
+            # }}}
 
-        from time import time
-        start_time = time()
-        if total_refine_weight > max_leaf_refine_weight:
-            level = 1
         else:
-            level = 0
+            # {{{ allocate data
+
+            logger.debug("allocating memory")
+
+            # box-local morton bin counts for each particle at the current level
+            # only valid from scan -> split'n'sort
+            morton_bin_counts = scratch("morton_bin_counts", nsrcntgts,
+                    dtype=knl_info.morton_bin_count_dtype)
+
+            # (local) morton nrs for each particle at the current level
+            # only valid from scan -> split'n'sort
+            morton_nrs = scratch("morton_nrs", nsrcntgts,
+                    dtype=self.morton_nr_dtype)
+
+            # 0/1 segment flags
+            # invariant to sorting once set
+            # (particles are only reordered within a box)
+            # valid throughout computation
+            box_start_flags, evt = scratch_zeros(
+                    "box_start_flags", nsrcntgts, dtype=np.int8)
+            prep_events.append(evt)
+            # (The level loop alternates between two buffers for
+            # srcntgt_box_ids and user_srcntgt_ids, see below.)
+            srcntgt_box_ids, evt = scratch_zeros(
+                    "srcntgt_box_ids_0", nsrcntgts, dtype=box_id_dtype)
+            prep_events.append(evt)
+
+            # Hilbert state of the box containing each srcntgt, see
+            # boxtree.tree_build_kernels.get_hilbert_tables
+            # (alternates between two buffers, like srcntgt_box_ids)
+            if ordering == "hilbert":
+                srcntgt_hilbert_states, evt = scratch_zeros(
+                        "srcntgt_hilbert_states_0", nsrcntgts, dtype=np.int8)
+                prep_events.append(evt)
+            else:
+                srcntgt_hilbert_states = None
+            split_box_ids, evt = scratch_zeros(
+                    "split_box_ids", nsrcntgts, dtype=box_id_dtype)
+            prep_events.append(evt)
 
-        # INVARIANTS -- Upon entry to this loop:
-        #
-        # - level is the level being built.
-        # - the last entry of level_start_box_nrs is the beginning of the level
-        #   to be built
+            # number of boxes total, and a guess
+            nboxes_dev = scratch("nboxes", (), dtype=box_id_dtype)
+            nboxes_dev.fill(1)
 
-        # This while condition prevents entering the loop in case there's just a
-        # single box, by how 'level' is set above. Read this as 'while True' with
-        # an edge case.
+            # /!\ If you're allocating an array here that depends on nboxes_guess,
+            # you *must* also write reallocation code down below for the case when
+            # nboxes_guess was too low.
 
-        logger.debug("entering level loop with %s srcntgts" % nsrcntgts)
+            # Outside nboxes_guess feeding is solely for debugging purposes,
+            # to test the reallocation code.
+            nboxes_guess = kwargs.get("nboxes_guess")
+            if nboxes_guess is None:
+                nboxes_guess = 2**dimensions * nleaves_guess
 
-        while level:
-            if debug:
-                # More invariants:
-                assert level == len(level_start_box_nrs) - 1
+                if workspace is not None and workspace.nboxes_guess is not None:
+                    nboxes_guess = max(nboxes_guess, workspace.nboxes_guess)
 
-            if level > np.iinfo(self.box_level_dtype).max:
-                raise RuntimeError("level count exceeded maximum")
+            assert nboxes_guess > 0
 
-            common_args = ((morton_bin_counts, morton_nrs,
-                    box_start_flags, srcntgt_box_ids, split_box_ids,
-                    box_morton_bin_counts,
-                    refine_weights,
-                    max_leaf_refine_weight,
-                    box_srcntgt_starts, box_srcntgt_counts_cumul,
-                    box_parent_ids, box_morton_nrs,
-                    nboxes_dev,
-                    level, bbox,
-                    user_srcntgt_ids)
-                    + tuple(srcntgts)
-                    + ((srcntgt_radii,) if srcntgts_have_extent else ())
-                    )
+            # Unless the tree is pruned, the box arrays become part of the
+            # tree, so they can only be kept in the workspace if it is.
+            if skip_prune:
+                box_workspace = None
 
-            fin_debug("morton count scan")
+                def box_scratch(name, shape, dtype):
+                    return empty(shape, dtype)
 
-            # writes: box_morton_bin_counts, morton_nrs
-            evt = knl_info.morton_count_scan(
-                    *common_args, queue=queue, size=nsrcntgts,
-                    wait_for=wait_for)
-            wait_for = [evt]
+                def box_scratch_zeros(name, shape, dtype):
+                    return zeros(shape, dtype)
+            else:
+                box_workspace = workspace
+                box_scratch = scratch
+                box_scratch_zeros = scratch_zeros
+
+            # per-box morton bin counts
+            box_morton_bin_counts = box_scratch("box_morton_bin_counts",
+                    nboxes_guess, dtype=knl_info.morton_bin_count_dtype)
+
+            # particle# at which each box starts
+            box_srcntgt_starts, evt = box_scratch_zeros("box_srcntgt_starts",
+                    nboxes_guess, dtype=particle_id_dtype)
+            prep_events.append(evt)
+
+            # pointer to parent box
+            box_parent_ids, evt = box_scratch_zeros("box_parent_ids",
+                    nboxes_guess, dtype=box_id_dtype)
+            prep_events.append(evt)
+
+            # morton nr identifier {quadr,oct}ant of parent in which this box
+            # was created
+            box_morton_nrs, evt = box_scratch_zeros("box_morton_nrs",
+                    nboxes_guess, dtype=self.morton_nr_dtype)
+            prep_events.append(evt)
+
+            # box -> level map
+            box_levels, evt = box_scratch_zeros("box_levels",
+                    nboxes_guess, self.box_level_dtype)
+            prep_events.append(evt)
+
+            # number of particles in each box
+            # needs to be globally initialized because empty boxes never get
+            # touched
+            box_srcntgt_counts_cumul, evt = box_scratch_zeros(
+                    "box_srcntgt_counts_cumul",
+                    nboxes_guess, dtype=particle_id_dtype)
+            prep_events.append(evt)
+
+            # Initalize box 0 to contain all particles
+            box_srcntgt_counts_cumul[0].fill(
+                    nsrcntgts, queue=queue, wait_for=[evt])
+
+            # box -> whether the box has a child
+            box_has_children, evt = box_scratch_zeros("box_has_children",
+                    nboxes_guess, dtype=np.dtype(np.int32))
+            prep_events.append(evt)
+
+            # set parent of root box to itself
+            evt = cl.enqueue_copy(
+                    queue, box_parent_ids.data,
+                    np.zeros((), dtype=box_parent_ids.dtype))
+            prep_events.append(evt)
 
-            fin_debug("split box id scan")
+            # }}}
 
-            # writes: nboxes_dev, split_box_ids
-            evt = knl_info.split_box_id_scan(
-                    srcntgt_box_ids,
-                    box_srcntgt_starts,
-                    box_srcntgt_counts_cumul,
-                    box_morton_bin_counts,
-                    refine_weights,
-                    max_leaf_refine_weight,
-                    box_levels,
-                    level,
+            box_array_names = ("box_morton_bin_counts", "box_srcntgt_starts",
+                    "box_parent_ids", "box_morton_nrs", "box_levels",
+                    "box_srcntgt_counts_cumul", "box_has_children")
 
-                    # input/output:
-                    nboxes_dev,
+            def realloc_box_arrays(box_arrays, new_nboxes_guess, wait_for):
+                """Enlarge *box_arrays* to *new_nboxes_guess* entries, returning
+                the new arrays in the same order. The arrays are expected
+                to be in the order of *box_array_names*.
+                """
+                from boxtree.tools import realloc_array
 
-                    # output:
-                    box_has_children,
-                    split_box_ids,
-                    queue=queue, size=nsrcntgts, wait_for=wait_for)
-            wait_for = [evt]
+                new_box_arrays = []
+                resize_events = []
+                for i, (name, ary) in enumerate(zip(box_array_names, box_arrays)):
+                    # All but box_morton_bin_counts need zero-filling.
+                    new_ary, evt = realloc_array(ary, new_shape=new_nboxes_guess,
+                            zero_fill=i > 0, queue=queue, wait_for=wait_for)
+                    new_box_arrays.append(new_ary)
+                    resize_events.append(evt)
+
+                    if box_workspace is not None:
+                        box_workspace.adopt(name, new_ary)
+                        prof.allocation("workspace", new_ary)
+
+                return tuple(new_box_arrays), resize_events
+
+            have_oversize_split_box, evt = scratch_zeros(
+                    "have_oversize_split_box", (), np.int32)
+            prep_events.append(evt)
+
+            keep_refining = scratch("keep_refining", (), np.int32)
+            keep_refining.fill(1, wait_for=wait_for)
+            evt, = keep_refining.events
+            prep_events.append(evt)
+
+            wait_for = prep_events
+
+            def get_new_srcntgt_arrays(level):
+                """Return arrays to receive *user_srcntgt_ids* and
+                *srcntgt_box_ids* after splitting *level*.
+                """
+                # Alternate between two buffers, so that the ones holding
+                # the current values are not overwritten.
+                return (
+                        scratch("user_srcntgt_ids_%d" % (level % 2),
+                            nsrcntgts, particle_id_dtype),
+                        scratch("srcntgt_box_ids_%d" % (level % 2),
+                            nsrcntgts, box_id_dtype))
+
+            def get_new_hilbert_states(level):
+                """Return an array to receive *srcntgt_hilbert_states* after
+                splitting *level*, or *None* if boxes are in Morton order.
+                """
+                if ordering != "hilbert":
+                    return None
+
+                return scratch("srcntgt_hilbert_states_%d" % (level % 2),
+                        nsrcntgts, np.int8)
+
+            def get_hilbert_state_args(hilbert_states, new_hilbert_states):
+                """Return the extra arguments of the split-and-sort kernel."""
+                if hilbert_states is None:
+                    return ()
+                else:
+                    return (hilbert_states, new_hilbert_states)
+
+            def get_split_box_id_extra_args(user_srcntgt_ids):
+                """Return the extra arguments of the split box id scan."""
+                if srcntgt_min_leaf_levels is None:
+                    return max_targets_in_box_args
+                else:
+                    return max_targets_in_box_args + (
+                            user_srcntgt_ids, srcntgt_min_leaf_levels)
 
-            nboxes_new = int(nboxes_dev.get())
+            if srcntgt_min_leaf_levels is None:
+                max_min_leaf_level = 0
+            else:
+                with prof.sync("read back maximum of minimum leaf levels"):
+                    max_min_leaf_level = int(cl.array.max(
+                        srcntgt_min_leaf_levels, queue=queue).get())
 
-            # Assumption: Everything between here and the top of the loop must
-            # be repeatable, so that in an out-of-memory situation, we can just
-            # rerun this bit of the code after reallocating and a minimal reset
-            # procedure.
+            # {{{ level loop
 
-            # {{{ reallocate and retry if nboxes_guess was too small
+            # Level 0 starts at 0 and always contains box 0 and nothing else.
+            # Level 1 therefore starts at 1.
+            level_start_box_nrs = [0, 1]
 
-            if nboxes_new > nboxes_guess:
-                fin_debug("starting nboxes_guess increase")
+            from time import time
+            start_time = time()
+            if ((root_is_overfull or max_min_leaf_level > 0)
+                    and (max_box_level is None or max_box_level > 0)):
+                level = 1
+            else:
+                level = 0
 
-                while nboxes_guess < nboxes_new:
-                    nboxes_guess *= 2
+            # INVARIANTS -- Upon entry to this loop:
+            #
+            # - level is the level being built.
+            # - the last entry of level_start_box_nrs is the beginning of the level
+            #   to be built
 
-                from boxtree.tools import realloc_array
-                my_realloc = partial(realloc_array, new_shape=nboxes_guess,
-                        zero_fill=False, queue=queue, wait_for=wait_for)
-                my_realloc_zeros = partial(realloc_array, new_shape=nboxes_guess,
-                        zero_fill=True, queue=queue, wait_for=wait_for)
+            # This while condition prevents entering the loop in case there's just a
+            # single box, by how 'level' is set above. Read this as 'while True' with
+            # an edge case.
 
-                resize_events = []
-                box_morton_bin_counts, evt = my_realloc(box_morton_bin_counts)
-                resize_events.append(evt)
-
-                box_srcntgt_starts, evt = my_realloc_zeros(box_srcntgt_starts)
-                resize_events.append(evt)
-                box_parent_ids, evt = my_realloc_zeros(box_parent_ids)
-                resize_events.append(evt)
-                box_morton_nrs, evt = my_realloc_zeros(box_morton_nrs)
-                resize_events.append(evt)
-                box_levels, evt = my_realloc_zeros(box_levels)
-                resize_events.append(evt)
-                box_srcntgt_counts_cumul, evt = \
-                        my_realloc_zeros(box_srcntgt_counts_cumul)
-                resize_events.append(evt)
-                box_has_children, evt = my_realloc_zeros(box_has_children)
-                resize_events.append(evt)
-
-                del my_realloc
-                del my_realloc_zeros
-
-                # reset nboxes_dev to previous value
-                nboxes_dev.fill(level_start_box_nrs[-1])
-                resize_events.append(evt)
-
-                wait_for = resize_events
-
-                # retry
-                logger.info("nboxes_guess exceeded: "
-                        "enlarged allocations, restarting level")
-
-                continue
+            logger.debug("entering level loop with %s srcntgts" % nsrcntgts)
+
+            # {{{ batched level loop
+
+            # In this mode, the host does not wait for the device after each
+            # level. Instead, box storage is grown ahead of each batch of levels
+            # so that it cannot overflow, the number of boxes after each level is
+            # recorded on the device, and termination is checked once per batch.
+            # Levels enqueued after refinement has finished do not create boxes
+            # or move particles.
+
+            if levels_per_sync is not None and level:
+                if levels_per_sync == "auto":
+                    levels_per_sync = 2 + int(np.ceil(
+                        np.log2(max(1, total_refine_weight / max_leaf_refine_weight))
+                        / dimensions))
+
+                if levels_per_sync < 1:
+                    raise ValueError("levels_per_sync must be positive")
+
+                max_level = np.iinfo(self.box_level_dtype).max
+
+                # entry *i* records the number of boxes after level *i* was built
+                nboxes_after_level_dev = scratch(
+                        "nboxes_after_level", max_level + 2, box_id_dtype)
+
+                # upper bound on the number of boxes split in any one level
+                if non_adaptive:
+                    max_split_boxes_per_level = nsrcntgts
+                else:
+                    max_split_boxes_per_level = max_split_box_count
+
+                while True:
+                    batch_start_level = level
+                    batch_end_level = min(level + levels_per_sync, max_level + 1)
+                    if max_box_level is not None:
+                        batch_end_level = min(batch_end_level, max_box_level + 1)
+
+                    if batch_start_level >= batch_end_level:
+                        raise RuntimeError("level count exceeded maximum")
+
+                    # {{{ make room for all boxes this batch could create
+
+                    nboxes_bound = level_start_box_nrs[-1]
+                    nlevel_boxes_bound = (
+                            level_start_box_nrs[-1] - level_start_box_nrs[-2])
+                    for level in range(batch_start_level, batch_end_level):
+                        nlevel_boxes_bound = 2**dimensions * min(
+                                nlevel_boxes_bound, max_split_boxes_per_level)
+                        nboxes_bound += nlevel_boxes_bound
+
+                    check_nboxes_bound(nboxes_bound)
+
+                    if nboxes_bound > nboxes_guess:
+                        while nboxes_guess < nboxes_bound:
+                            nboxes_guess *= 2
+
+                        ((box_morton_bin_counts, box_srcntgt_starts, box_parent_ids,
+                                box_morton_nrs, box_levels, box_srcntgt_counts_cumul,
+                                box_has_children),
+                            wait_for) = realloc_box_arrays(
+                                    (box_morton_bin_counts, box_srcntgt_starts,
+                                        box_parent_ids, box_morton_nrs, box_levels,
+                                        box_srcntgt_counts_cumul, box_has_children),
+                                    nboxes_guess, wait_for)
+
+                        logger.info("batched level loop: enlarged box allocations "
+                                "to %d" % nboxes_guess)
+
+                    # }}}
+
+                    for level in range(batch_start_level, batch_end_level):
+                        if level > 1:
+                            # Stop refining once the previous level has no
+                            # overfull boxes. (This matters for non-adaptive
+                            # trees, in which all non-empty boxes are split.)
+                            evt = cl.enqueue_copy(queue,
+                                    keep_refining.data, have_oversize_split_box.data,
+                                    byte_count=keep_refining.nbytes,
+                                    wait_for=wait_for)
+                            wait_for = [evt]
+
+                        have_oversize_split_box.fill(0, wait_for=wait_for)
+                        wait_for = list(have_oversize_split_box.events)
+
+                        common_args = ((morton_bin_counts, morton_nrs,
+                                box_start_flags, srcntgt_box_ids, split_box_ids,
+                                box_morton_bin_counts)
+                                + refine_weights_args
+                                + (max_leaf_refine_weight,)
+                                + max_targets_in_box_args
+                                + (box_srcntgt_starts, box_srcntgt_counts_cumul,
+                                box_parent_ids, box_morton_nrs,
+                                nboxes_dev,
+                                level, bbox,
+                                user_srcntgt_ids)
+                                + srcntgt_coord_args
+                                )
+
+                        fin_debug("morton count scan")
+
+                        evt = knl_info.morton_count_scan(
+                                *common_args, queue=queue, size=nsrcntgts,
+                                wait_for=wait_for)
+                        prof.event("morton count scan", evt)
+                        wait_for = [evt]
+
+                        fin_debug("split box id scan")
+
+                        evt = knl_info.split_box_id_scan(
+                                srcntgt_box_ids,
+                                box_srcntgt_starts,
+                                box_srcntgt_counts_cumul,
+                                box_morton_bin_counts,
+                                max_leaf_refine_weight,
+                                box_levels,
+                                level,
+                                keep_refining,
+
+                                # input/output:
+                                nboxes_dev,
+
+                                # output:
+                                box_has_children,
+                                split_box_ids,
+
+                                *get_split_box_id_extra_args(user_srcntgt_ids),
+                                queue=queue, size=nsrcntgts, wait_for=wait_for)
+                        prof.event("split box id scan", evt)
+                        wait_for = [evt]
+
+                        evt = cl.enqueue_copy(queue,
+                                nboxes_after_level_dev.data, nboxes_dev.data,
+                                byte_count=nboxes_dev.nbytes,
+                                dest_offset=level*nboxes_dev.nbytes,
+                                wait_for=wait_for)
+                        wait_for = [evt]
+
+                        new_user_srcntgt_ids, new_srcntgt_box_ids = \
+                                get_new_srcntgt_arrays(level)
+                        new_srcntgt_hilbert_states = get_new_hilbert_states(level)
+                        split_and_sort_args = (
+                                common_args
+                                + (new_user_srcntgt_ids, have_oversize_split_box,
+                                    new_srcntgt_box_ids, box_levels,
+                                    box_has_children)
+                                + get_hilbert_state_args(srcntgt_hilbert_states,
+                                    new_srcntgt_hilbert_states))
+                        fin_debug("split and sort")
+
+                        evt = knl_info.split_and_sort_kernel(*split_and_sort_args,
+                                wait_for=wait_for)
+                        prof.event("split and sort", evt)
+                        wait_for = [evt]
+
+                        user_srcntgt_ids = new_user_srcntgt_ids
+                        del new_user_srcntgt_ids
+                        srcntgt_box_ids = new_srcntgt_box_ids
+                        del new_srcntgt_box_ids
+                        srcntgt_hilbert_states = new_srcntgt_hilbert_states
+                        del new_srcntgt_hilbert_states
+
+                    # {{{ synchronize with the host
+
+                    with prof.sync("read back level batch results"):
+                        nboxes_after_level = np.empty(max_level + 2, box_id_dtype)
+                        cl.enqueue_copy(queue, nboxes_after_level,
+                                nboxes_after_level_dev.data, wait_for=wait_for)
+                        have_oversize_split_box_host = np.empty((), np.int32)
+                        cl.enqueue_copy(queue, have_oversize_split_box_host,
+                                have_oversize_split_box.data, wait_for=wait_for)
+
+                    check_particles_inside_bbox()
+
+                    # }}}
+
+                    refinement_done = not have_oversize_split_box_host
+                    for level in range(batch_start_level, batch_end_level):
+                        nboxes_new = int(nboxes_after_level[level])
+
+                        if nboxes_new == level_start_box_nrs[-1]:
+                            # No boxes were created on this level, so no later
+                            # level in the batch created any either.
+                            refinement_done = True
+                            break
+
+                        logger.info("LEVEL %d -> %d boxes" % (level, nboxes_new))
+                        level_start_box_nrs.append(nboxes_new)
+
+                    level = len(level_start_box_nrs) - 2
+
+                    if (max_box_level is not None
+                            and batch_end_level > max_box_level):
+                        # Boxes on max_box_level are not split.
+                        refinement_done = True
+
+                    if refinement_done:
+                        break
+
+                    level = batch_end_level
+
+                del nboxes_after_level_dev
 
             # }}}
 
-            logger.info("LEVEL %d -> %d boxes" % (level, nboxes_new))
+            # (In batched mode, the level loop above has already done all the
+            # work.)
+            while level and levels_per_sync is None:
+                if debug:
+                    # More invariants:
+                    assert level == len(level_start_box_nrs) - 1
+
+                if level > np.iinfo(self.box_level_dtype).max:
+                    raise RuntimeError("level count exceeded maximum")
+
+                check_nboxes_bound(level_start_box_nrs[-1]
+                        + 2**dimensions
+                        * (level_start_box_nrs[-1] - level_start_box_nrs[-2]))
+
+                common_args = ((morton_bin_counts, morton_nrs,
+                        box_start_flags, srcntgt_box_ids, split_box_ids,
+                        box_morton_bin_counts)
+                        + refine_weights_args
+                        + (max_leaf_refine_weight,)
+                        + max_targets_in_box_args
+                        + (box_srcntgt_starts, box_srcntgt_counts_cumul,
+                        box_parent_ids, box_morton_nrs,
+                        nboxes_dev,
+                        level, bbox,
+                        user_srcntgt_ids)
+                        + srcntgt_coord_args
+                        )
+
+                fin_debug("morton count scan")
+
+                # writes: box_morton_bin_counts, morton_nrs
+                evt = knl_info.morton_count_scan(
+                        *common_args, queue=queue, size=nsrcntgts,
+                        wait_for=wait_for)
+                prof.event("morton count scan", evt)
+                wait_for = [evt]
 
-            assert level_start_box_nrs[-1] != nboxes_new or srcntgts_have_extent
+                fin_debug("split box id scan")
 
-            if level_start_box_nrs[-1] == nboxes_new:
-                # We haven't created new boxes in this level loop trip.  Unless
-                # srcntgts have extent, this should never happen.  (I.e., we
-                # should've never entered this loop trip.)
-                #
-                # If srcntgts have extent, this can happen if boxes were
-                # in-principle overfull, but couldn't subdivide because of
-                # extent restrictions.
+                # writes: nboxes_dev, split_box_ids
+                evt = knl_info.split_box_id_scan(
+                        srcntgt_box_ids,
+                        box_srcntgt_starts,
+                        box_srcntgt_counts_cumul,
+                        box_morton_bin_counts,
+                        max_leaf_refine_weight,
+                        box_levels,
+                        level,
+                        keep_refining,
 
-                assert srcntgts_have_extent
+                        # input/output:
+                        nboxes_dev,
 
-                level -= 1
+                        # output:
+                        box_has_children,
+                        split_box_ids,
 
-                logger.debug("no new boxes created this loop trip")
-                break
+                        *get_split_box_id_extra_args(user_srcntgt_ids),
+                        queue=queue, size=nsrcntgts, wait_for=wait_for)
+                prof.event("split box id scan", evt)
+                wait_for = [evt]
 
-            level_start_box_nrs.append(nboxes_new)
-            del nboxes_new
+                with prof.sync("read back number of boxes"):
+                    nboxes_new = int(nboxes_dev.get())
 
-            new_user_srcntgt_ids = cl.array.empty_like(user_srcntgt_ids)
-            new_srcntgt_box_ids = cl.array.empty_like(srcntgt_box_ids)
-            split_and_sort_args = (
-                    common_args
-                    + (new_user_srcntgt_ids, have_oversize_split_box,
-                        new_srcntgt_box_ids, box_levels,
-                        box_has_children))
-            fin_debug("split and sort")
+                check_particles_inside_bbox()
 
-            evt = knl_info.split_and_sort_kernel(*split_and_sort_args,
-                    wait_for=wait_for)
-            wait_for = [evt]
+                # Assumption: Everything between here and the top of the loop must
+                # be repeatable, so that in an out-of-memory situation, we can just
+                # rerun this bit of the code after reallocating and a minimal reset
+                # procedure.
 
-            if debug:
-                level_bl_chunk = box_levels.get()[
-                        level_start_box_nrs[-2]:level_start_box_nrs[-1]]
-                assert ((level_bl_chunk == level) | (level_bl_chunk == 0)).all()
-                del level_bl_chunk
+                # {{{ reallocate and retry if nboxes_guess was too small
 
-            if debug:
-                assert (box_srcntgt_starts.get() < nsrcntgts).all()
+                if nboxes_new > nboxes_guess:
+                    fin_debug("starting nboxes_guess increase")
 
-            user_srcntgt_ids = new_user_srcntgt_ids
-            del new_user_srcntgt_ids
-            srcntgt_box_ids = new_srcntgt_box_ids
-            del new_srcntgt_box_ids
+                    while nboxes_guess < nboxes_new:
+                        nboxes_guess *= 2
 
-            if not int(have_oversize_split_box.get()):
-                logger.debug("no overfull boxes left")
-                break
+                    ((box_morton_bin_counts, box_srcntgt_starts, box_parent_ids,
+                            box_morton_nrs, box_levels, box_srcntgt_counts_cumul,
+                            box_has_children),
+                        resize_events) = realloc_box_arrays(
+                                (box_morton_bin_counts, box_srcntgt_starts,
+                                    box_parent_ids, box_morton_nrs, box_levels,
+                                    box_srcntgt_counts_cumul, box_has_children),
+                                nboxes_guess, wait_for)
 
-            level += 1
+                    # reset nboxes_dev to previous value
+                    nboxes_dev.fill(level_start_box_nrs[-1])
+                    resize_events.append(evt)
 
-            have_oversize_split_box.fill(0)
+                    wait_for = resize_events
 
-        end_time = time()
-        elapsed = end_time-start_time
-        npasses = level+1
-        logger.info("elapsed time: %g s (%g s/particle/pass)" % (
-                elapsed, elapsed/(npasses*nsrcntgts)))
-        del npasses
+                    # retry
+                    logger.info("nboxes_guess exceeded: "
+                            "enlarged allocations, restarting level")
 
-        nboxes = int(nboxes_dev.get())
+                    continue
 
-        # }}}
+                # }}}
 
-        # {{{ extract number of non-child srcntgts from box morton counts
+                logger.info("LEVEL %d -> %d boxes" % (level, nboxes_new))
 
-        if srcntgts_have_extent:
-            box_srcntgt_counts_nonchild = empty(nboxes, particle_id_dtype)
-            fin_debug("extract non-child srcntgt count")
+                assert level_start_box_nrs[-1] != nboxes_new or srcntgts_have_extent
 
-            assert len(level_start_box_nrs) >= 2
-            highest_possibly_split_box_nr = level_start_box_nrs[-2]
+                if level_start_box_nrs[-1] == nboxes_new:
+                    # We haven't created new boxes in this level loop trip.  Unless
+                    # srcntgts have extent, this should never happen.  (I.e., we
+                    # should've never entered this loop trip.)
+                    #
+                    # If srcntgts have extent, this can happen if boxes were
+                    # in-principle overfull, but couldn't subdivide because of
+                    # extent restrictions.
 
-            evt = knl_info.extract_nonchild_srcntgt_count_kernel(
-                    # input
-                    box_morton_bin_counts,
-                    box_srcntgt_counts_cumul,
-                    highest_possibly_split_box_nr,
+                    assert srcntgts_have_extent
 
-                    # output
-                    box_srcntgt_counts_nonchild,
+                    level -= 1
 
-                    range=slice(nboxes), wait_for=wait_for)
-            wait_for = [evt]
+                    logger.debug("no new boxes created this loop trip")
+                    break
 
-            del highest_possibly_split_box_nr
+                level_start_box_nrs.append(nboxes_new)
+                del nboxes_new
 
-            if debug:
-                assert (box_srcntgt_counts_nonchild.get()
-                        <= box_srcntgt_counts_cumul.get()[:nboxes]).all()
+                new_user_srcntgt_ids, new_srcntgt_box_ids = \
+                        get_new_srcntgt_arrays(level)
+                new_srcntgt_hilbert_states = get_new_hilbert_states(level)
+                split_and_sort_args = (
+                        common_args
+                        + (new_user_srcntgt_ids, have_oversize_split_box,
+                            new_srcntgt_box_ids, box_levels,
+                            box_has_children)
+                        + get_hilbert_state_args(srcntgt_hilbert_states,
+                            new_srcntgt_hilbert_states))
+                fin_debug("split and sort")
 
-        # }}}
+                evt = knl_info.split_and_sort_kernel(*split_and_sort_args,
+                        wait_for=wait_for)
+                prof.event("split and sort", evt)
+                wait_for = [evt]
 
-        del morton_nrs
-        del box_morton_bin_counts
+                if debug:
+                    level_bl_chunk = box_levels.get()[
+                            level_start_box_nrs[-2]:level_start_box_nrs[-1]]
+                    assert ((level_bl_chunk == level) | (level_bl_chunk == 0)).all()
+                    del level_bl_chunk
 
-        # {{{ prune empty leaf boxes
+                if debug:
+                    assert (box_srcntgt_starts.get() < nsrcntgts).all()
+
+                user_srcntgt_ids = new_user_srcntgt_ids
+                del new_user_srcntgt_ids
+                srcntgt_box_ids = new_srcntgt_box_ids
+                del new_srcntgt_box_ids
+                srcntgt_hilbert_states = new_srcntgt_hilbert_states
+                del new_srcntgt_hilbert_states
+
+                with prof.sync("check for overfull boxes"):
+                    have_oversize_split_box_host = int(
+                            have_oversize_split_box.get())
+
+                if (not have_oversize_split_box_host
+                        and level >= max_min_leaf_level):
+                    logger.debug("no overfull boxes left")
+                    break
+
+                if max_box_level is not None and level >= max_box_level:
+                    # Boxes on max_box_level are not split.
+                    logger.debug("reached maximum leaf level")
+                    break
+
+                level += 1
+
+                have_oversize_split_box.fill(0)
+
+            end_time = time()
+            elapsed = end_time-start_time
+            npasses = level+1
+            logger.info("elapsed time: %g s (%g s/particle/pass)" % (
+                    elapsed, elapsed/(npasses*nsrcntgts)))
+            del npasses
+
+            if levels_per_sync is None:
+                with prof.sync("read back number of boxes"):
+                    nboxes = int(nboxes_dev.get())
+            else:
+                nboxes = level_start_box_nrs[-1]
 
-        is_pruned = not kwargs.get("skip_prune")
-        if is_pruned:
+            # if no level was refined
+            check_particles_inside_bbox()
 
-            # What is the original index of this box?
-            from_box_id = empty(nboxes, box_id_dtype)
+            del srcntgt_hilbert_states
 
-            # Where should I put this box?
-            to_box_id = empty(nboxes, box_id_dtype)
+            # }}}
 
-            fin_debug("find prune indices")
+            # {{{ extract number of non-child srcntgts from box morton counts
 
-            nboxes_post_prune_dev = empty((), dtype=box_id_dtype)
-            evt = knl_info.find_prune_indices_kernel(
-                    box_srcntgt_counts_cumul,
-                    to_box_id, from_box_id, nboxes_post_prune_dev,
-                    size=nboxes, wait_for=wait_for)
-            wait_for = [evt]
+            if srcntgts_have_extent:
+                box_srcntgt_counts_nonchild = box_scratch(
+                        "box_srcntgt_counts_nonchild", nboxes, particle_id_dtype)
+                fin_debug("extract non-child srcntgt count")
 
-            fin_debug("prune copy")
+                assert len(level_start_box_nrs) >= 2
+                highest_possibly_split_box_nr = level_start_box_nrs[-2]
 
-            nboxes_post_prune = int(nboxes_post_prune_dev.get())
+                evt = knl_info.extract_nonchild_srcntgt_count_kernel(
+                        # input
+                        box_morton_bin_counts,
+                        box_srcntgt_counts_cumul,
+                        highest_possibly_split_box_nr,
 
-            logger.info("%d empty leaves" % (nboxes-nboxes_post_prune))
+                        # output
+                        box_srcntgt_counts_nonchild,
 
-            prune_events = []
+                        range=slice(nboxes), wait_for=wait_for)
+                prof.event("extract non-child srcntgt count", evt)
+                wait_for = [evt]
 
-            prune_empty = partial(self.gappy_copy_and_map,
-                    queue, allocator, nboxes_post_prune, from_box_id)
+                del highest_possibly_split_box_nr
 
-            box_srcntgt_starts, evt = prune_empty(box_srcntgt_starts)
-            prune_events.append(evt)
+                if debug:
+                    assert (box_srcntgt_counts_nonchild.get()
+                            <= box_srcntgt_counts_cumul.get()[:nboxes]).all()
 
-            box_srcntgt_counts_cumul, evt = prune_empty(box_srcntgt_counts_cumul)
-            prune_events.append(evt)
+            # }}}
 
-            if debug:
-                assert (box_srcntgt_counts_cumul.get() > 0).all()
+            del morton_nrs
+            del box_morton_bin_counts
+
+            # {{{ prune empty leaf boxes
+
+            is_pruned = not skip_prune
+            if is_pruned:
+
+                # What is the original index of this box?
+                from_box_id = scratch("from_box_id", nboxes, box_id_dtype)
+
+                # Where should I put this box?
+                to_box_id = scratch("to_box_id", nboxes, box_id_dtype)
+
+                fin_debug("find prune indices")
+
+                nboxes_post_prune_dev = scratch(
+                        "nboxes_post_prune", (), dtype=box_id_dtype)
+                evt = knl_info.find_prune_indices_kernel(
+                        box_srcntgt_counts_cumul,
+                        to_box_id, from_box_id, nboxes_post_prune_dev,
+                        size=nboxes, wait_for=wait_for)
+                prof.event("find prune indices", evt)
+                wait_for = [evt]
+
+                fin_debug("prune copy")
+
+                if levels_per_sync is not None:
+                    # Remap level_start_box_nrs to new box IDs on the device, so
+                    # that it can be read back along with the box count.
+                    pre_prune_level_start_box_nrs = np.array(
+                            level_start_box_nrs[:-1], box_id_dtype)
+                    level_start_box_nrs_dev = cl.array.take(
+                            to_box_id,
+                            cl.array.to_device(queue, pre_prune_level_start_box_nrs,
+                                allocator=allocator, async_=True),
+                            queue=queue, wait_for=wait_for)
+
+                    nboxes_post_prune_and_level_starts = np.empty(
+                            len(level_start_box_nrs), box_id_dtype)
+                    cl.enqueue_copy(queue,
+                            nboxes_post_prune_and_level_starts[1:],
+                            level_start_box_nrs_dev.data,
+                            wait_for=level_start_box_nrs_dev.events,
+                            is_blocking=False)
+                    with prof.sync("read back pruned box counts"):
+                        cl.enqueue_copy(queue,
+                                nboxes_post_prune_and_level_starts[:1],
+                                nboxes_post_prune_dev.data,
+                                wait_for=wait_for)
+
+                    nboxes_post_prune = int(nboxes_post_prune_and_level_starts[0])
+                    pruned_level_start_box_nrs = (
+                            list(nboxes_post_prune_and_level_starts[1:])
+                            + [nboxes_post_prune])
+
+                    del level_start_box_nrs_dev
+                    del pre_prune_level_start_box_nrs
+                    del nboxes_post_prune_and_level_starts
+                else:
+                    with prof.sync("read back pruned box counts"):
+                        nboxes_post_prune = int(nboxes_post_prune_dev.get())
 
-            srcntgt_box_ids = cl.array.take(to_box_id, srcntgt_box_ids)
+                logger.info("%d empty leaves" % (nboxes-nboxes_post_prune))
 
-            box_parent_ids, evt = prune_empty(box_parent_ids, map_values=to_box_id)
-            prune_events.append(evt)
-            box_morton_nrs, evt = prune_empty(box_morton_nrs)
-            prune_events.append(evt)
-            box_levels, evt = prune_empty(box_levels)
-            prune_events.append(evt)
-            if srcntgts_have_extent:
-                box_srcntgt_counts_nonchild, evt = prune_empty(
-                        box_srcntgt_counts_nonchild)
+                prune_events = []
+
+                def prune_empty(ary, map_values=None):
+                    result, evt = self.gappy_copy_and_map(
+                            queue, allocator, nboxes_post_prune, from_box_id,
+                            ary, map_values=map_values)
+                    prof.event("prune copy", evt)
+                    prof.allocation("prune copy", result)
+                    return result, evt
+
+                box_srcntgt_starts, evt = prune_empty(box_srcntgt_starts)
                 prune_events.append(evt)
 
-            box_has_children, evt = prune_empty(box_has_children)
-            prune_events.append(evt)
+                box_srcntgt_counts_cumul, evt = prune_empty(box_srcntgt_counts_cumul)
+                prune_events.append(evt)
 
-            # Remap level_start_box_nrs to new box IDs.
-            # FIXME: It would be better to do this on the device.
-            level_start_box_nrs = list(
-                    to_box_id.get()
-                    [np.array(level_start_box_nrs[:-1], box_id_dtype)])
-            level_start_box_nrs = level_start_box_nrs + [nboxes_post_prune]
+                if debug:
+                    assert (box_srcntgt_counts_cumul.get() > 0).all()
 
-            wait_for = prune_events
-        else:
-            logger.info("skipping empty-leaf pruning")
-            nboxes_post_prune = nboxes
+                srcntgt_box_ids = cl.array.take(to_box_id, srcntgt_box_ids,
+                        out=scratch("pruned_srcntgt_box_ids",
+                            nsrcntgts, box_id_dtype))
 
-        level_start_box_nrs = np.array(level_start_box_nrs, box_id_dtype)
+                box_parent_ids, evt = prune_empty(box_parent_ids,
+                        map_values=to_box_id)
+                prune_events.append(evt)
+                box_morton_nrs, evt = prune_empty(box_morton_nrs)
+                prune_events.append(evt)
+                box_levels, evt = prune_empty(box_levels)
+                prune_events.append(evt)
+                if srcntgts_have_extent:
+                    box_srcntgt_counts_nonchild, evt = prune_empty(
+                            box_srcntgt_counts_nonchild)
+                    prune_events.append(evt)
 
-        # }}}
+                box_has_children, evt = prune_empty(box_has_children)
+                prune_events.append(evt)
 
-        del nboxes
+                # Remap level_start_box_nrs to new box IDs.
+                if levels_per_sync is not None:
+                    level_start_box_nrs = pruned_level_start_box_nrs
+                    del pruned_level_start_box_nrs
+                else:
+                    # FIXME: It would be better to do this on the device.
+                    with prof.sync("read back pruned level starts"):
+                        level_start_box_nrs = list(
+                                to_box_id.get()
+                                [np.array(level_start_box_nrs[:-1], box_id_dtype)])
+                    level_start_box_nrs = level_start_box_nrs + [nboxes_post_prune]
+
+                wait_for = prune_events
+            else:
+                logger.info("skipping empty-leaf pruning")
+                nboxes_post_prune = nboxes
+
+            level_start_box_nrs = np.array(level_start_box_nrs, box_id_dtype)
+
+            # }}}
+
+            if box_workspace is not None:
+                box_workspace.nboxes_guess = max(
+                        nboxes_guess, box_workspace.nboxes_guess or 0)
+
+            del nboxes
 
         # {{{ compute source/target particle indices and counts in each box
 
         if targets is None:
             from boxtree.tools import reverse_index_array
-            user_source_ids = user_srcntgt_ids
+            if workspace is not None and workspace.holds(user_srcntgt_ids):
+                # The tree must not refer to the workspace.
+                user_source_ids = empty(nsrcntgts, particle_id_dtype)
+                evt = cl.enqueue_copy(queue,
+                        user_source_ids.data, user_srcntgt_ids.data,
+                        byte_count=user_source_ids.nbytes, wait_for=wait_for)
+                wait_for = [evt]
+                user_srcntgt_ids = user_source_ids
+            else:
+                user_source_ids = user_srcntgt_ids
             sorted_target_ids = reverse_index_array(user_srcntgt_ids)
 
             box_source_starts = box_target_starts = box_srcntgt_starts
@@ -732,17 +2049,19 @@ class TreeBuilder(object):
                 box_source_counts_nonchild = box_target_counts_nonchild = \
                         box_srcntgt_counts_nonchild
         else:
-            source_numbers = empty(nsrcntgts, particle_id_dtype)
+            source_numbers = scratch("source_numbers", nsrcntgts, particle_id_dtype)
 
             fin_debug("source counter")
             evt = knl_info.source_counter(user_srcntgt_ids, nsources,
                     source_numbers, queue=queue, allocator=allocator,
                     wait_for=wait_for)
+            prof.event("source counter", evt)
             wait_for = [evt]
 
             user_source_ids = empty(nsources, particle_id_dtype)
             # srcntgt_target_ids is temporary until particle permutation is done
-            srcntgt_target_ids = empty(ntargets, particle_id_dtype)
+            srcntgt_target_ids = scratch(
+                    "srcntgt_target_ids", ntargets, particle_id_dtype)
             sorted_target_ids = empty(ntargets, particle_id_dtype)
 
             # need to use zeros because parent boxes won't be initialized
@@ -792,6 +2111,7 @@ class TreeBuilder(object):
                 ),
                 queue=queue, range=slice(nsrcntgts),
                 wait_for=wait_for)
+            prof.event("source and target index finder", evt)
             wait_for = [evt]
 
             if srcntgts_have_extent:
@@ -829,58 +2149,63 @@ class TreeBuilder(object):
 
         if targets is None:
             sources = targets = make_obj_array([
-                cl.array.empty_like(pt) for pt in srcntgts])
+                cl.array.empty_like(pt) for pt in particles])
 
             fin_debug("srcntgt permuter (particles)")
             evt = knl_info.srcntgt_permuter(
-                    user_srcntgt_ids,
-                    *(tuple(srcntgts) + tuple(sources)),
+                    user_srcntgt_ids, 0,
+                    *(tuple(particles) + tuple(sources)),
                     wait_for=wait_for)
+            prof.event("srcntgt permuter (particles)", evt)
             wait_for = [evt]
 
-            assert srcntgt_radii is None
-
         else:
+            user_targets = targets
+
             sources = make_obj_array([
                 empty(nsources, coord_dtype) for i in range(dimensions)])
             fin_debug("srcntgt permuter (sources)")
             evt = knl_info.srcntgt_permuter(
-                    user_source_ids,
-                    *(tuple(srcntgts) + tuple(sources)),
+                    user_source_ids, 0,
+                    *(tuple(particles) + tuple(sources)),
                     queue=queue, range=slice(nsources),
                     wait_for=wait_for)
+            prof.event("srcntgt permuter (sources)", evt)
             wait_for = [evt]
 
             targets = make_obj_array([
                 empty(ntargets, coord_dtype) for i in range(dimensions)])
             fin_debug("srcntgt permuter (targets)")
             evt = knl_info.srcntgt_permuter(
-                    srcntgt_target_ids,
-                    *(tuple(srcntgts) + tuple(targets)),
+                    srcntgt_target_ids, nsources,
+                    *(tuple(user_targets) + tuple(targets)),
                     queue=queue, range=slice(ntargets),
                     wait_for=wait_for)
+            prof.event("srcntgt permuter (targets)", evt)
             wait_for = [evt]
 
-            if srcntgt_radii is not None:
+            del user_targets
+
+            if srcntgts_have_extent:
                 fin_debug("srcntgt permuter (source radii)")
                 source_radii = cl.array.take(
-                        srcntgt_radii, user_source_ids, queue=queue,
+                        source_radii, user_source_ids, queue=queue,
                         wait_for=wait_for)
 
                 fin_debug("srcntgt permuter (target radii)")
                 target_radii = cl.array.take(
-                        srcntgt_radii, srcntgt_target_ids, queue=queue,
-                        wait_for=wait_for)
+                        target_radii, srcntgt_target_ids - nsources,
+                        queue=queue, wait_for=wait_for)
 
                 wait_for = source_radii.events + target_radii.events
+                for evt in wait_for:
+                    prof.event("srcntgt permuter (radii)", evt)
 
             del srcntgt_target_ids
 
-        del srcntgt_radii
-
         # }}}
 
-        del srcntgts
+        del particles
 
         nlevels = len(level_start_box_nrs) - 1
         assert level + 1 == nlevels, (level+1, nlevels)
@@ -957,6 +2282,7 @@ class TreeBuilder(object):
                 ),
                 range=slice(nboxes_post_prune),
                 wait_for=wait_for)
+        prof.event("compute box info", evt)
 
         # }}}
 
@@ -1015,6 +2341,10 @@ class TreeBuilder(object):
                 sorted_target_ids=sorted_target_ids,
 
                 _is_pruned=is_pruned,
+                is_balanced=non_adaptive,
+                is_periodic=periodic,
+                looseness=looseness,
+                ordering=ordering,
 
                 **extra_tree_attrs
                 ).with_queue(None), evt
@@ -1023,4 +2353,357 @@ class TreeBuilder(object):
 
     # }}}
 
+    # {{{ forests
+
+    def build_forest(self, queue, particles, tree_particle_starts,
+            max_particles_in_box=None, refine_weights=None,
+            max_leaf_refine_weight=None, allocator=None, debug=False,
+            wait_for=None, max_levels=None, particle_id_dtype=None,
+            box_id_dtype=None, profiler=None, workspace=None):
+        """Build many independent trees at once, with the cost of about one
+        call to :meth:`__call__` on all of their particles combined.
+
+        The trees are built as subtrees of one tree. Each tree's particles
+        are mapped from its own bounding box (found as in :meth:`__call__`)
+        into one box on a level of that tree, on which each tree has exactly
+        one box. The boxes below it are then found as in a build of this
+        tree alone, except that particles within rounding distance of a box
+        boundary may be sorted into the neighboring box.
+
+        :arg particles: an object array of (XYZ) point coordinate arrays,
+            containing the particles of all trees, one tree after another.
+            These act as both sources and targets.
+        :arg tree_particle_starts: a :class:`numpy.ndarray` of
+            ``ntrees + 1`` integers. The particles of tree number *i* are
+            those numbered ``tree_particle_starts[i]`` up to (but not
+            including) ``tree_particle_starts[i+1]``. Trees may not be
+            empty.
+        :arg max_levels: If not *None*, the maximum number of levels of
+            each tree.
+
+        The remaining arguments are as for :meth:`__call__`.
+
+        :returns: a tuple ``(forest, event)``, where *forest* is an instance
+            of :class:`boxtree.tree.Forest`, and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        # {{{ input processing
+
+        if wait_for is None:
+            wait_for = []
+        else:
+            wait_for = list(wait_for)
+
+        dimensions = len(particles)
+
+        from boxtree.tools import AXIS_NAMES
+        axis_names = AXIS_NAMES[:dimensions]
+
+        from pytools import single_valued
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+        nparticles = single_valued(len(coord) for coord in particles)
+
+        tree_particle_starts = np.asarray(tree_particle_starts, dtype=np.int64)
+        ntrees = len(tree_particle_starts) - 1
+
+        if ntrees < 1:
+            raise ValueError("must build at least one tree")
+        if (tree_particle_starts[0] != 0
+                or tree_particle_starts[-1] != nparticles):
+            raise ValueError("tree_particle_starts must start at 0 and end "
+                    "at the number of particles")
+        if not (np.diff(tree_particle_starts) > 0).all():
+            raise ValueError("trees may not be empty")
+
+        if particle_id_dtype is None:
+            if nparticles <= np.iinfo(np.int32).max:
+                particle_id_dtype = np.dtype(np.int32)
+            else:
+                particle_id_dtype = np.dtype(np.int64)
+        else:
+            particle_id_dtype = np.dtype(particle_id_dtype)
+
+        # The level on which each tree has its root box
+        root_level = 0
+        while 2**(dimensions*root_level) < ntrees:
+            root_level += 1
+
+        if root_level > np.iinfo(self.box_level_dtype).max:
+            raise ValueError("too many trees")
+
+        if max_levels is not None:
+            if max_levels < 1:
+                raise ValueError("max_levels must be positive")
+            max_levels = root_level + max_levels
+
+        # }}}
+
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "forest build")
+
+        def empty(shape, dtype):
+            result = cl.array.empty(queue, shape, dtype, allocator=allocator)
+            prof.allocation("empty", result)
+            return result
+
+        knl_info = self.get_forest_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype,
+                # box_id_dtype is not known until the tree is built, but
+                # the kernels used before then do not depend on it.
+                np.dtype(np.int32) if box_id_dtype is None else box_id_dtype)
+
+        # {{{ find bounding boxes of the trees
+
+        tree_particle_starts_dev = cl.array.to_device(queue,
+                tree_particle_starts.astype(particle_id_dtype),
+                allocator=allocator)
+
+        particle_tree_ids = empty(nparticles, particle_id_dtype)
+        evt = knl_info.particle_tree_id_finder(
+                tree_particle_starts_dev, ntrees, particle_tree_ids,
+                queue=queue, range=slice(nparticles),
+                wait_for=wait_for + tree_particle_starts_dev.events)
+        prof.event("find particle tree ids", evt)
+
+        tree_bboxes = empty(ntrees, knl_info.bbox_dtype)
+        evt = knl_info.bbox_scan(
+                particle_tree_ids, *(tuple(particles) + (tree_bboxes,)),
+                queue=queue, size=nparticles, wait_for=[evt])
+        prof.event("find tree bounding boxes", evt)
+
+        tree_bboxes.add_event(evt)
+        with prof.sync("read back tree bounding boxes"):
+            tree_bboxes_host = tree_bboxes.get()
+
+        # This mirrors __call__.
+        tree_bbox_min = np.array(
+                [tree_bboxes_host["min_"+ax] for ax in axis_names])
+        tree_root_extents = (np.max(
+                [tree_bboxes_host["max_"+ax] - tree_bboxes_host["min_"+ax]
+                    for ax in axis_names], axis=0)
+                * (1+1e-4)).astype(coord_dtype)
+        tree_bbox_max = (tree_bbox_min + tree_root_extents).astype(coord_dtype)
+
+        # The particles of a tree with zero extent all coincide, and map
+        # to the same point of any box.
+        for iaxis, ax in enumerate(axis_names):
+            tree_bboxes_host["max_"+ax] = np.where(tree_root_extents > 0,
+                    tree_bbox_max[iaxis], tree_bbox_min[iaxis] + 1)
+
+        tree_bboxes.set(tree_bboxes_host)
+
+        # }}}
+
+        # {{{ build the forest
+
+        from pytools.obj_array import make_obj_array
+        forest_particles = make_obj_array([
+            empty(nparticles, coord_dtype) for ax in axis_names])
+        evt = knl_info.coord_mapper(
+                particle_tree_ids, tree_bboxes, root_level,
+                *(tuple(particles) + tuple(forest_particles)),
+                queue=queue, range=slice(nparticles))
+        prof.event("map to forest coordinates", evt)
+        del particle_tree_ids
+
+        # Each tree must have its own box on root_level.
+        srcntgt_min_leaf_levels = (
+                empty(nparticles, self.box_level_dtype).fill(root_level))
+
+        tree, evt = self(queue, forest_particles,
+                max_particles_in_box=max_particles_in_box,
+                refine_weights=refine_weights,
+                max_leaf_refine_weight=max_leaf_refine_weight,
+                allocator=allocator, debug=debug,
+                wait_for=[evt] + srcntgt_min_leaf_levels.events,
+                max_levels=max_levels,
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                profiler=profiler, workspace=workspace,
+                bbox=(
+                    np.zeros(dimensions, coord_dtype),
+                    np.full(dimensions, 2**root_level, coord_dtype)),
+                srcntgt_min_leaf_levels=srcntgt_min_leaf_levels)
+        del forest_particles
+        del srcntgt_min_leaf_levels
+
+        sources = make_obj_array([
+            cl.array.take(ax, tree.user_source_ids, queue=queue)
+            for ax in particles])
+
+        # }}}
+
+        # {{{ find the boxes of each tree
+
+        box_id_dtype = tree.box_id_dtype
+        knl_info = self.get_forest_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype)
+
+        level_start_box_nrs = tree.level_start_box_nrs
+        ntree_levels = tree.nlevels - root_level
+
+        if debug:
+            assert (level_start_box_nrs[root_level+1]
+                    - level_start_box_nrs[root_level]) == ntrees
+
+        # Trees without boxes on a level get empty ranges, see below.
+        tree_level_box_starts = np.empty((ntree_levels, ntrees + 1), box_id_dtype)
+        for tree_level in range(ntree_levels):
+            tree_level_box_starts[tree_level] = \
+                    level_start_box_nrs[root_level + tree_level + 1]
+        tree_level_box_starts_dev = cl.array.to_device(
+                queue, tree_level_box_starts, allocator=allocator)
+
+        box_tree_ids = empty(tree.nboxes, particle_id_dtype)
+        evt = knl_info.box_tree_id_finder(
+                tree.box_levels, tree.box_source_starts,
+                tree.level_start_box_nrs_dev, root_level, ntrees,
+                box_tree_ids, tree_level_box_starts_dev,
+                queue=queue, range=slice(tree.nboxes),
+                wait_for=[evt] + tree_level_box_starts_dev.events)
+        prof.event("find box tree ids", evt)
+
+        tree_level_box_starts_dev.add_event(evt)
+        with prof.sync("read back tree box ranges"):
+            tree_level_box_starts = tree_level_box_starts_dev.get()
+
+        tree_level_box_starts = np.minimum.accumulate(
+                tree_level_box_starts[:, ::-1], axis=1)[:, ::-1]
+
+        # }}}
+
+        logger.info("forest build complete (%d trees)" % ntrees)
+
+        from boxtree.tree import Forest
+        return Forest(
+                tree=tree,
+                root_level=root_level,
+                sources=sources,
+
+                tree_particle_starts=tree_particle_starts.astype(
+                    particle_id_dtype),
+                tree_bbox_min=tree_bbox_min,
+                tree_bbox_max=tree_bbox_max,
+                tree_root_extents=tree_root_extents,
+
+                tree_root_box_ids=tree_level_box_starts[0, :-1],
+                tree_level_box_starts=tree_level_box_starts,
+                box_tree_ids=box_tree_ids,
+                ), evt
+
+    # }}}
+
+    # {{{ balancing
+
+    def _build_with_sticky_bbox(self, queue, particles, sticky_bbox,
+            build_kwargs):
+        if sticky_bbox.bounding_box is not None:
+            try:
+                return self(queue, particles, bbox=sticky_bbox.bounding_box,
+                        **build_kwargs)
+            except _ParticlesOutsideBoundingBox:
+                logger.info("particles left the sticky bounding box, "
+                        "finding a new one")
+
+        tree, evt = self(queue, particles, bbox_margin=sticky_bbox.margin,
+                **build_kwargs)
+
+        sticky_bbox.bounding_box = tree.bounding_box
+        sticky_bbox.nupdates += 1
+
+        return tree, evt
+
+    def _build_balanced(self, queue, particles, build_kwargs):
+        """Build a tree as :meth:`__call__` would, then rebuild it with every
+        leaf box adjacent to a non-leaf box on a finer level split, until no
+        such leaves are left.
+
+        Splitting is requested by giving each particle the level below which
+        its leaf box may not be. These minimum levels only increase from one
+        build to the next, and the boxes of one build are also present
+        in the next, so all particles in a box share the same requirement.
+        """
+
+        from boxtree.area_query import PeerListFinder
+        peer_list_finder = PeerListFinder(self.context)
+
+        profiler = build_kwargs["profiler"]
+        from boxtree.profiling import ProfileRecorder
+        prof = ProfileRecorder(profiler, "tree build")
+
+        from boxtree.tools import reverse_index_array
+
+        allocator = build_kwargs["allocator"]
+        srcntgt_min_leaf_levels = None
+        nrebuilds = 0
+
+        while True:
+            tree, evt = self(queue, particles,
+                    srcntgt_min_leaf_levels=srcntgt_min_leaf_levels,
+                    **build_kwargs)
+            build_kwargs["wait_for"] = None
+
+            tree = tree.with_queue(queue)
+
+            peer_lists, evt = peer_list_finder(queue, tree, wait_for=[evt],
+                    profiler=profiler)
+
+            knl_info = self.get_balance_kernel_info(
+                    tree.particle_id_dtype, tree.box_id_dtype,
+                    peer_lists.peer_list_starts.dtype, tree.sources_are_targets)
+
+            leaf_must_split = cl.array.zeros(queue, tree.nboxes, np.uint8,
+                    allocator=allocator)
+            have_unbalanced_leaves = cl.array.zeros(queue, (), np.int32,
+                    allocator=allocator)
+
+            evt = knl_info.unbalanced_leaf_finder(
+                    tree.box_flags, tree.box_levels,
+                    peer_lists.peer_list_starts, peer_lists.peer_lists,
+                    leaf_must_split, have_unbalanced_leaves,
+                    queue=queue, range=slice(tree.nboxes), wait_for=[evt])
+            prof.event("find unbalanced leaves", evt)
+
+            with prof.sync("check for unbalanced leaves"):
+                if not have_unbalanced_leaves.get():
+                    break
+
+            if srcntgt_min_leaf_levels is None:
+                nsrcntgts = tree.nsources
+                if not tree.sources_are_targets:
+                    nsrcntgts += tree.ntargets
+
+                srcntgt_min_leaf_levels = cl.array.zeros(
+                        queue, nsrcntgts, self.box_level_dtype,
+                        allocator=allocator)
+
+            if tree.sources_are_targets:
+                target_args = ()
+            else:
+                user_target_ids = reverse_index_array(
+                        tree.sorted_target_ids, queue=queue)
+                target_args = (
+                        tree.box_target_starts, tree.box_target_counts_nonchild,
+                        user_target_ids, tree.nsources)
+
+            evt = knl_info.min_leaf_level_marker(
+                    *((leaf_must_split, tree.box_levels,
+                        tree.box_source_starts, tree.box_source_counts_nonchild,
+                        tree.user_source_ids)
+                        + target_args
+                        + (srcntgt_min_leaf_levels,)),
+                    queue=queue, range=slice(tree.nboxes))
+            prof.event("mark minimum leaf levels", evt)
+
+            nrebuilds += 1
+            logger.info("balancing: rebuilding tree (%d)" % nrebuilds)
+
+        tree.is_balanced = True
+        return tree.with_queue(None), evt
+
+    # }}}
+
+# }}}
+
 # vim: foldmethod=marker:filetype=pyopencl
@@ -0,0 +1,561 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2017 Andreas Kloeckner and contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from six.moves import range
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pytools import single_valued
+from pytools.obj_array import make_obj_array
+from boxtree.tree import Tree, box_flags_enum
+from boxtree.tree_update import (
+        get_box_icoords, box_morton_nrs_from_child_ids, compute_box_centers)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# {{{ host-side box key helpers
+
+def _encode_box_keys(icoords, level):
+    """Pack integer box coordinates on *level* (an array of shape
+    ``(dimensions, n)``) into one integer per box.
+    """
+    dimensions = len(icoords)
+    keys = np.zeros(icoords.shape[1], np.int64)
+    for iaxis in range(dimensions):
+        keys |= icoords[iaxis] << (level*(dimensions-1-iaxis))
+
+    return keys
+
+
+def _decode_box_keys(keys, level, dimensions):
+    icoords = np.empty((dimensions, len(keys)), np.int64)
+    for iaxis in range(dimensions):
+        icoords[iaxis] = (keys >> (level*(dimensions-1-iaxis))) & ((1 << level)-1)
+
+    return icoords
+
+
+def _find_sorted(haystack, needles):
+    """Return the indices of *needles* in the sorted array *haystack*, and
+    a mask indicating which of them were found.
+    """
+    idx = np.searchsorted(haystack, needles)
+    idx = np.minimum(idx, len(haystack) - 1)
+    return idx, haystack[idx] == needles
+
+
+def _get_morton_keys(icoords, levels, nlevels):
+    """Return a key for each box (given by integer coordinates of shape
+    ``(dimensions, n)`` on *levels*) whose order agrees with the
+    order of the boxes' particles in the tree. Boxes must be disjoint.
+    """
+    dimensions = len(icoords)
+    fine_icoords = icoords << (nlevels - levels)
+
+    keys = np.zeros(icoords.shape[1], np.int64)
+    for ibit in range(nlevels):
+        for iaxis in range(dimensions):
+            keys |= (((fine_icoords[iaxis] >> ibit) & 1)
+                    << (ibit*dimensions + dimensions-1-iaxis))
+
+    return keys
+
+# }}}
+
+
+# {{{ chunked tree builder
+
+class ChunkedTreeBuilder(object):
+    """Builds a :class:`boxtree.Tree` for particle sets too large to be
+    processed by :class:`boxtree.TreeBuilder` in device memory at once.
+
+    Particles are read from host (possibly memory-mapped) arrays in
+    streaming passes and sorted into coarse top-level boxes, each holding at
+    most a given number of particles. The subtree below each of these
+    boxes is then built on the device by :class:`boxtree.TreeBuilder`, and the
+    subtrees are stitched together on the host. The result is identical to
+    the tree :class:`boxtree.TreeBuilder` would build from the whole
+    particle set.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        """
+        :arg context: A :class:`pyopencl.Context`.
+        """
+        self.context = context
+
+        from boxtree.tree_build import TreeBuilder
+        self.tree_builder = TreeBuilder(self.context)
+
+    def __call__(self, queue, particles, max_particles_in_box,
+            max_particles_in_chunk, allocator=None, debug=False):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue` instance
+        :arg particles: an object array (or list) of (XYZ) point coordinate
+            arrays of type :class:`numpy.ndarray`, or of an array type with
+            the same interface, such as :class:`numpy.memmap`. These act as
+            both sources and targets.
+        :arg max_particles_in_box: the maximum number of particles in a leaf
+            box.
+        :arg max_particles_in_chunk: the maximum number of particles handled
+            at once, both when reading *particles* and when building a subtree
+            on the device. Must be at least *max_particles_in_box*. Device
+            memory use is proportional to this number.
+        :arg allocator: the allocator used for device memory in the
+            subtree builds.
+
+        :returns: a tuple ``(tree, event)``, where *tree* is an instance of
+            :class:`boxtree.Tree` whose data resides on the host (as if
+            returned by :meth:`boxtree.Tree.get`), and *event* is a
+            :class:`pyopencl.Event` for dependency management.
+        """
+
+        # {{{ input processing
+
+        if max_particles_in_box <= 0:
+            raise ValueError("max_particles_in_box must be positive")
+
+        if max_particles_in_chunk < max_particles_in_box:
+            raise ValueError("max_particles_in_chunk may not be smaller than "
+                    "max_particles_in_box")
+
+        dimensions = len(particles)
+        nchildren = 2**dimensions
+
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+        nparticles = single_valued(len(coord) for coord in particles)
+
+        if nparticles == 0:
+            raise ValueError("cannot build a tree without particles")
+
+        def get_id_dtype(max_id):
+            if max_id <= np.iinfo(np.int32).max:
+                return np.dtype(np.int32)
+            else:
+                return np.dtype(np.int64)
+
+        particle_id_dtype = get_id_dtype(nparticles)
+        box_level_dtype = self.tree_builder.box_level_dtype
+
+        def get_slices():
+            for start in range(0, nparticles, max_particles_in_chunk):
+                yield slice(start, min(start + max_particles_in_chunk, nparticles))
+
+        # }}}
+
+        # {{{ find bounding box
+
+        # This mirrors TreeBuilder, so that the same bounding box results.
+
+        found_min = np.empty(dimensions, coord_dtype)
+        found_max = np.empty(dimensions, coord_dtype)
+        found_min.fill(np.inf)
+        found_max.fill(-np.inf)
+
+        for sl in get_slices():
+            for iaxis in range(dimensions):
+                slice_coords = np.asarray(particles[iaxis][sl])
+                found_min[iaxis] = min(found_min[iaxis], slice_coords.min())
+                found_max[iaxis] = max(found_max[iaxis], slice_coords.max())
+
+        root_extent = max(
+                found_max[iaxis] - found_min[iaxis]
+                for iaxis in range(dimensions)) * (1+1e-4)
+
+        bbox_min = found_min
+        bbox_max = bbox_min + root_extent
+
+        def get_scaled_coords(coords):
+            return [
+                    (np.asarray(coords[iaxis]) - bbox_min[iaxis])
+                    / (bbox_max[iaxis] - bbox_min[iaxis])
+                    for iaxis in range(dimensions)]
+
+        def get_level_icoords(scaled_coords, level):
+            level_factor = coord_dtype.type(1 << level)
+            return np.array([
+                (scaled_coords[iaxis] * level_factor).astype(np.int64)
+                for iaxis in range(dimensions)]).reshape(dimensions, -1)
+
+        # }}}
+
+        # {{{ find chunk boxes
+
+        # Boxes with more than max_particles_in_chunk particles are split
+        # (as they would be in the final tree, since max_particles_in_chunk >=
+        # max_particles_in_box), one level per pass over the particles.
+        # Their nonempty children become chunk boxes once they are small
+        # enough.
+
+        coarse_box_levels = [np.zeros(1, np.int64)]
+        coarse_box_keys = [np.zeros(1, np.int64)]
+        coarse_box_counts = [np.array([nparticles], np.int64)]
+
+        chunk_levels = []
+        chunk_keys = []
+        chunk_counts = []
+
+        if nparticles <= max_particles_in_chunk:
+            chunk_levels.append(np.zeros(1, np.int64))
+            chunk_keys.append(np.zeros(1, np.int64))
+            chunk_counts.append(np.array([nparticles], np.int64))
+
+            coarse_box_levels = []
+            coarse_box_keys = []
+            coarse_box_counts = []
+
+        level = 0
+        oversize_keys = coarse_box_keys[-1] if coarse_box_keys else []
+        while len(oversize_keys):
+            if (level + 1)*dimensions > 62 or level + 1 > np.iinfo(
+                    box_level_dtype).max:
+                raise RuntimeError("level count exceeded maximum")
+
+            child_keys = []
+            child_counts = []
+            for sl in get_slices():
+                icoords = get_level_icoords(
+                        get_scaled_coords([ax[sl] for ax in particles]),
+                        level + 1)
+                _, in_oversize = _find_sorted(
+                        oversize_keys, _encode_box_keys(icoords >> 1, level))
+                slice_keys, slice_counts = np.unique(
+                        _encode_box_keys(icoords[:, in_oversize], level + 1),
+                        return_counts=True)
+                child_keys.append(slice_keys)
+                child_counts.append(slice_counts)
+
+            child_keys, inverse = np.unique(
+                    np.concatenate(child_keys), return_inverse=True)
+            child_counts = np.bincount(
+                    inverse, weights=np.concatenate(child_counts)
+                    ).astype(np.int64)
+
+            level += 1
+
+            is_oversize = child_counts > max_particles_in_chunk
+            oversize_keys = child_keys[is_oversize]
+
+            coarse_box_levels.append(np.full(len(oversize_keys), level, np.int64))
+            coarse_box_keys.append(oversize_keys)
+            coarse_box_counts.append(child_counts[is_oversize])
+
+            chunk_levels.append(np.full(np.sum(~is_oversize), level, np.int64))
+            chunk_keys.append(child_keys[~is_oversize])
+            chunk_counts.append(child_counts[~is_oversize])
+
+        def finalize_boxes(levels, keys):
+            levels = np.concatenate(levels)
+            icoords = np.empty((dimensions, len(levels)), np.int64)
+            for key_level in np.unique(levels):
+                at_level = levels == key_level
+                icoords[:, at_level] = _decode_box_keys(
+                        np.concatenate(keys)[at_level], key_level, dimensions)
+
+            return levels, icoords
+
+        chunk_levels, chunk_icoords = finalize_boxes(chunk_levels, chunk_keys)
+        chunk_counts = np.concatenate(chunk_counts)
+        nchunks = len(chunk_levels)
+
+        if coarse_box_levels:
+            coarse_box_levels, coarse_box_icoords = finalize_boxes(
+                    coarse_box_levels, coarse_box_keys)
+            coarse_box_counts = np.concatenate(coarse_box_counts)
+        else:
+            coarse_box_levels = np.empty(0, np.int64)
+            coarse_box_icoords = np.empty((dimensions, 0), np.int64)
+            coarse_box_counts = np.empty(0, np.int64)
+
+        logger.info("chunked tree build: %d chunks, %d coarse boxes"
+                % (nchunks, len(coarse_box_levels)))
+
+        # Chunks take up consecutive ranges of the tree order, in
+        # Morton order.
+        chunk_morton_keys = _get_morton_keys(chunk_icoords, chunk_levels, level)
+        chunk_order = np.argsort(chunk_morton_keys)
+        chunk_morton_keys = chunk_morton_keys[chunk_order]
+        chunk_levels = chunk_levels[chunk_order]
+        chunk_icoords = chunk_icoords[:, chunk_order]
+        chunk_counts = chunk_counts[chunk_order]
+
+        chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+
+        coarse_box_starts = np.concatenate([chunk_starts, [nparticles]])[
+                np.searchsorted(
+                    chunk_morton_keys,
+                    _get_morton_keys(
+                        coarse_box_icoords, coarse_box_levels, level))]
+
+        # }}}
+
+        # {{{ sort particles into chunks
+
+        # This is a counting sort, so particles retain their relative order
+        # within each chunk.
+
+        chunk_particle_ids = np.empty(nparticles, np.int64)
+        chunk_fill_positions = chunk_starts.copy()
+
+        chunk_key_levels = np.unique(chunk_levels)
+        chunk_keys_by_level = []
+        for key_level in chunk_key_levels:
+            level_chunks, = np.nonzero(chunk_levels == key_level)
+            level_keys = _encode_box_keys(
+                    chunk_icoords[:, level_chunks], key_level)
+            order = np.argsort(level_keys)
+            chunk_keys_by_level.append((level_keys[order], level_chunks[order]))
+
+        for sl in get_slices():
+            scaled_coords = get_scaled_coords([ax[sl] for ax in particles])
+
+            slice_chunk_ids = np.empty(sl.stop - sl.start, np.int64)
+            slice_chunk_ids.fill(-1)
+            for key_level, (level_keys, level_chunks) in zip(
+                    chunk_key_levels, chunk_keys_by_level):
+                idx, found = _find_sorted(
+                        level_keys,
+                        _encode_box_keys(
+                            get_level_icoords(scaled_coords, key_level),
+                            key_level))
+                slice_chunk_ids[found] = level_chunks[idx[found]]
+
+            if debug:
+                assert (slice_chunk_ids >= 0).all()
+
+            order = np.argsort(slice_chunk_ids, kind="stable")
+            sorted_chunk_ids = slice_chunk_ids[order]
+            slice_counts = np.bincount(sorted_chunk_ids, minlength=nchunks)
+            group_starts = np.cumsum(slice_counts) - slice_counts
+
+            chunk_particle_ids[
+                    chunk_fill_positions[sorted_chunk_ids]
+                    + np.arange(len(order)) - group_starts[sorted_chunk_ids]
+                    ] = sl.start + order
+            chunk_fill_positions += slice_counts
+
+        if debug:
+            assert (chunk_fill_positions == chunk_starts + chunk_counts).all()
+
+        # }}}
+
+        # {{{ build subtrees
+
+        # Subtrees are built in the coordinates of the chunk box, scaled to
+        # [0, 1). Rescaling scaled global coordinates by a power of two and
+        # subtracting the box's integer coordinates is exact, so particles
+        # are sorted into the same boxes as in a global build.
+
+        unit_bbox = (np.zeros(dimensions, coord_dtype),
+                np.ones(dimensions, coord_dtype))
+
+        box_levels = [coarse_box_levels]
+        box_icoords = [coarse_box_icoords]
+        box_starts = [coarse_box_starts]
+        box_counts_cumul = [coarse_box_counts]
+        box_is_leaf = [np.zeros(len(coarse_box_levels), np.bool_)]
+
+        user_source_ids = np.empty(nparticles, particle_id_dtype)
+        sources = make_obj_array([
+            np.empty(nparticles, coord_dtype) for i in range(dimensions)])
+
+        stick_out_factor = None
+
+        for ichunk in range(nchunks):
+            chunk_start = chunk_starts[ichunk]
+            chunk_end = chunk_start + chunk_counts[ichunk]
+            chunk_level = chunk_levels[ichunk]
+
+            particle_ids = chunk_particle_ids[chunk_start:chunk_end]
+            chunk_coords = [np.asarray(ax[particle_ids]) for ax in particles]
+            scaled_coords = get_scaled_coords(chunk_coords)
+
+            level_factor = coord_dtype.type(1 << chunk_level)
+            local_coords = make_obj_array([
+                cl.array.to_device(queue,
+                    scaled_coords[iaxis]*level_factor
+                    - coord_dtype.type(chunk_icoords[iaxis, ichunk]),
+                    allocator=allocator)
+                for iaxis in range(dimensions)])
+
+            subtree, _ = self.tree_builder(queue, local_coords,
+                    max_particles_in_box=max_particles_in_box,
+                    allocator=allocator, debug=debug, bbox=unit_bbox,
+                    # The stitching below orders subtrees by Morton key.
+                    ordering="morton")
+            subtree = subtree.get(queue=queue)
+            stick_out_factor = subtree.stick_out_factor
+
+            local_levels = subtree.box_levels.astype(np.int64)
+            local_icoords = get_box_icoords(
+                    subtree.box_parent_ids,
+                    box_morton_nrs_from_child_ids(
+                        subtree.box_child_ids, subtree.nboxes),
+                    subtree.level_start_box_nrs, dimensions).T
+
+            box_levels.append(chunk_level + local_levels)
+            box_icoords.append(
+                    (chunk_icoords[:, ichunk, np.newaxis] << local_levels)
+                    + local_icoords)
+            box_starts.append(chunk_start + subtree.box_source_starts)
+            box_counts_cumul.append(subtree.box_source_counts_cumul)
+            box_is_leaf.append(
+                    (subtree.box_flags & box_flags_enum.HAS_CHILDREN) == 0)
+
+            tree_order_ids = subtree.user_source_ids
+            user_source_ids[chunk_start:chunk_end] = particle_ids[tree_order_ids]
+            for iaxis in range(dimensions):
+                sources[iaxis][chunk_start:chunk_end] = \
+                        chunk_coords[iaxis][tree_order_ids]
+
+        box_levels = np.concatenate(box_levels)
+        box_icoords = np.concatenate(box_icoords, axis=1)
+        box_starts = np.concatenate(box_starts)
+        box_counts_cumul = np.concatenate(box_counts_cumul)
+        box_is_leaf = np.concatenate(box_is_leaf)
+
+        # }}}
+
+        # {{{ number boxes
+
+        # Boxes are numbered by level, and within each level by their
+        # position in the particle order.
+
+        order = np.lexsort((box_starts, box_levels))
+        box_levels = box_levels[order]
+        box_icoords = box_icoords[:, order]
+        box_starts = box_starts[order]
+        box_counts_cumul = box_counts_cumul[order]
+        box_is_leaf = box_is_leaf[order]
+
+        nboxes = len(box_levels)
+        box_id_dtype = get_id_dtype(nboxes)
+        nlevels = int(box_levels.max()) + 1
+        level_start_box_nrs = np.searchsorted(
+                box_levels, np.arange(nlevels+1)).astype(box_id_dtype)
+
+        # A box's parent is the last box on the previous level starting at
+        # or before it, since boxes on a level are disjoint.
+        box_parent_ids = np.zeros(nboxes, np.int64)
+        for ilevel in range(1, nlevels):
+            parent_level_start = level_start_box_nrs[ilevel-1]
+            level_slice = slice(
+                    level_start_box_nrs[ilevel], level_start_box_nrs[ilevel+1])
+            box_parent_ids[level_slice] = parent_level_start + np.searchsorted(
+                    box_starts[parent_level_start:level_start_box_nrs[ilevel]],
+                    box_starts[level_slice], side="right") - 1
+
+        box_morton_nrs = np.zeros(nboxes, np.int64)
+        for iaxis in range(dimensions):
+            box_morton_nrs |= (box_icoords[iaxis] & 1) << (dimensions-1-iaxis)
+
+        if debug:
+            assert (box_icoords[:, box_parent_ids[1:]]
+                    == box_icoords[:, 1:] >> 1).all()
+            assert box_counts_cumul[0] == nparticles
+
+        from pytools import div_ceil
+        aligned_nboxes = div_ceil(nboxes, 32)*32
+
+        box_child_ids = np.zeros((nchildren, aligned_nboxes), box_id_dtype)
+        box_child_ids[box_morton_nrs[1:], box_parent_ids[1:]] = np.arange(
+                1, nboxes)
+
+        box_centers = np.zeros((dimensions, aligned_nboxes), coord_dtype)
+        box_centers[:, :nboxes] = compute_box_centers(
+                box_levels, box_icoords, bbox_min, bbox_max)
+
+        box_flags = np.where(box_is_leaf,
+                box_flags_enum.HAS_OWN_SRCNTGTS,
+                box_flags_enum.HAS_CHILDREN).astype(box_flags_enum.dtype)
+
+        # }}}
+
+        # {{{ build output
+
+        sorted_target_ids = np.empty(nparticles, particle_id_dtype)
+        sorted_target_ids[user_source_ids] = np.arange(
+                nparticles, dtype=particle_id_dtype)
+
+        box_source_starts = box_starts.astype(particle_id_dtype)
+        box_source_counts_cumul = box_counts_cumul.astype(particle_id_dtype)
+        box_source_counts_nonchild = np.where(
+                box_is_leaf, box_counts_cumul, 0).astype(particle_id_dtype)
+
+        logger.info("chunked tree build: complete (%d boxes)" % nboxes)
+
+        return Tree(
+                sources_are_targets=True,
+                sources_have_extent=False,
+                targets_have_extent=False,
+
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                coord_dtype=coord_dtype,
+                box_level_dtype=box_level_dtype,
+
+                root_extent=root_extent,
+                stick_out_factor=stick_out_factor,
+
+                bounding_box=(bbox_min, bbox_max),
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs,
+
+                sources=sources,
+                targets=sources,
+
+                box_source_starts=box_source_starts,
+                box_source_counts_nonchild=box_source_counts_nonchild,
+                box_source_counts_cumul=box_source_counts_cumul,
+                box_target_starts=box_source_starts,
+                box_target_counts_nonchild=box_source_counts_nonchild,
+                box_target_counts_cumul=box_source_counts_cumul,
+
+                box_parent_ids=box_parent_ids.astype(box_id_dtype),
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                box_levels=box_levels.astype(box_level_dtype),
+                box_flags=box_flags,
+
+                user_source_ids=user_source_ids,
+                sorted_target_ids=sorted_target_ids,
+
+                _is_pruned=True,
+                is_balanced=False,
+                is_periodic=False,
+                looseness=0,
+                ordering="morton",
+                ), cl.enqueue_marker(queue)
+
+        # }}}
+
+# }}}
+
+# vim: foldmethod=marker:filetype=pyopencl
@@ -30,6 +30,7 @@ import numpy as np
 import pyopencl as cl
 from pyopencl.elementwise import ElementwiseTemplate
 from pyopencl.scan import ScanTemplate
+from pyopencl.reduction import ReductionTemplate
 from mako.template import Template
 from pytools import Record, memoize
 from boxtree.tools import get_type_moniker
@@ -147,6 +148,23 @@ def make_morton_bin_count_type(device, dimensions, particle_id_dtype,
     dtype = get_or_register_dtype(name, dtype)
     return dtype, c_decl
 
+
+@memoize
+def make_refine_weight_stats_dtype(device):
+    dtype = np.dtype([
+        ("min_weight", refine_weight_dtype),
+        ("max_weight", refine_weight_dtype),
+        ("total_weight", np.int64),
+        ])
+
+    name = "boxtree_refine_weight_stats_t"
+
+    from pyopencl.tools import get_or_register_dtype, match_dtype_to_c_struct
+    dtype, c_decl = match_dtype_to_c_struct(device, name, dtype)
+
+    dtype = get_or_register_dtype(name, dtype)
+    return dtype, c_decl
+
 # }}}
 
 # {{{ preamble
@@ -268,18 +286,34 @@ SCAN_PREAMBLE_TPL = Template(r"""//CL//
         const int level,
         bbox_t const *bbox,
         global morton_nr_t *morton_nrs, // output/side effect
-        global particle_id_t *user_srcntgt_ids,
-        global refine_weight_t *refine_weights
+        global particle_id_t *user_srcntgt_ids
+        %if not unit_refine_weights:
+            , global refine_weight_t *refine_weights
+        %endif
         %for ax in axis_names:
             , global const coord_t *${ax}
         %endfor
+        %if not sources_are_targets:
+            , particle_id_t nsources
+            %for ax in axis_names:
+                , global const coord_t *target_${ax}
+            %endfor
+        %endif
         %if srcntgts_have_extent:
-            , global const coord_t *srcntgt_radii
+            , global const coord_t *source_radii
+            , global const coord_t *target_radii
         %endif
     )
     {
         particle_id_t user_srcntgt_id = user_srcntgt_ids[i];
 
+        %if not sources_are_targets:
+            // Sources and targets are read from their separate arrays.
+            // Targets are numbered after the sources.
+            bool is_source = user_srcntgt_id < nsources;
+            particle_id_t user_target_id = user_srcntgt_id - nsources;
+        %endif
+
         // Recall that 'level' is the level currently being built, e.g. 1 at
         // the root.  This should be 0.5 at level 1. (Level 0 is the root.)
         coord_t next_level_box_size_factor =
@@ -287,7 +321,9 @@ SCAN_PREAMBLE_TPL = Template(r"""//CL//
 
         %if srcntgts_have_extent:
             bool stop_srcntgt_descent = false;
-            coord_t srcntgt_radius = srcntgt_radii[user_srcntgt_id];
+            coord_t srcntgt_radius = is_source
+                ? source_radii[user_srcntgt_id]
+                : target_radii[user_target_id];
         %endif
 
         const coord_t one_half = ((coord_t) 1) / 2;
@@ -304,7 +340,13 @@ SCAN_PREAMBLE_TPL = Template(r"""//CL//
 
             coord_t global_min_${ax} = bbox->min_${ax};
             coord_t global_extent_${ax} = bbox->max_${ax} - global_min_${ax};
-            coord_t srcntgt_${ax} = ${ax}[user_srcntgt_id];
+            %if sources_are_targets:
+                coord_t srcntgt_${ax} = ${ax}[user_srcntgt_id];
+            %else:
+                coord_t srcntgt_${ax} = is_source
+                    ? ${ax}[user_srcntgt_id]
+                    : target_${ax}[user_target_id];
+            %endif
 
             // Note that the upper bound of the global bounding box is computed
             // to be slightly larger than the highest found coordinate, so that
@@ -369,8 +411,16 @@ SCAN_PREAMBLE_TPL = Template(r"""//CL//
         %endfor
         %for mnr in range(2**dimensions):
             <% field = "pwt"+padded_bin(mnr, dimensions) %>
-            result.${field} = (level_morton_number == ${mnr}) ?
-                    refine_weights[user_srcntgt_id] : 0;
+            %if separate_target_limit:
+                // Only sources count towards the refine weight, targets
+                // are limited separately.
+                result.${field} = (level_morton_number == ${mnr}) && is_source;
+            %elif unit_refine_weights:
+                result.${field} = (level_morton_number == ${mnr});
+            %else:
+                result.${field} = (level_morton_number == ${mnr}) ?
+                        refine_weights[user_srcntgt_id] : 0;
+            %endif
         %endfor
         morton_nrs[i] = level_morton_number;
 
@@ -425,10 +475,10 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
         particle_id_t *box_srcntgt_starts,
         particle_id_t *box_srcntgt_counts_cumul,
         morton_counts_t *box_morton_bin_counts,
-        refine_weight_t *refine_weights,
         refine_weight_t max_leaf_refine_weight,
         box_level_t *box_levels,
         box_level_t level,
+        int *keep_refining,
 
         /* input/output */
         box_id_t *nboxes,
@@ -436,6 +486,17 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
         /* output */
         int *box_has_children,
         box_id_t *split_box_ids,
+
+        %if separate_target_limit:
+            /* input */
+            refine_weight_t max_targets_in_box,
+        %endif
+
+        %if srcntgts_have_min_leaf_levels:
+            /* input */
+            particle_id_t *user_srcntgt_ids,
+            box_level_t *srcntgt_min_leaf_levels,
+        %endif
         """,
     preamble=r"""//CL:mako//
         scan_t count_new_boxes_needed(
@@ -448,7 +509,15 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
             __global morton_counts_t *box_morton_bin_counts,
             __global box_level_t *box_levels,
             __global int *box_has_children, // output/side effect
-            box_level_t level
+            box_level_t level,
+            __global int *keep_refining
+            %if separate_target_limit:
+                , refine_weight_t max_targets_in_box
+            %endif
+            %if srcntgts_have_min_leaf_levels:
+                , __global particle_id_t *user_srcntgt_ids
+                , __global box_level_t *srcntgt_min_leaf_levels
+            %endif
             )
         {
             scan_t result = 0;
@@ -474,11 +543,26 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
                     box_morton_bin_counts[box_id].pwt${padded_bin(mnr, dimensions)});
             %endfor
 
+            %if separate_target_limit:
+                // The refine weight counts the sources among the particles
+                // that would move into child boxes, the rest are targets.
+                particle_id_t box_target_count = -box_refine_weight;
+                %for mnr in range(2**dimensions):
+                    <% bin_nmr = padded_bin(mnr, dimensions) %>
+                    box_target_count +=
+                        box_morton_bin_counts[box_id].pcnt${bin_nmr};
+                %endfor
+            %endif
+
             // Add 2**d to make enough room for a split of the current box
             // This will be the split_box_id for *all* particles in this box,
             // including non-child srcntgts.
 
-            if (i == first_particle_in_my_box
+            // keep_refining is only ever cleared by the batched level loop
+            // in the tree builder, once refinement has finished.
+
+            if (*keep_refining
+                && i == first_particle_in_my_box
                 %if srcntgts_have_extent:
                     // Only last-level boxes get to produce new boxes.
                     // If srcntgts have extent, then prior-level boxes
@@ -489,9 +573,21 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
                 %endif
                 &&
                 %if adaptive:
+                    (
                     /* box overfull? */
                     box_refine_weight
                         > max_leaf_refine_weight
+                    %if separate_target_limit:
+                        || box_target_count > max_targets_in_box
+                    %endif
+                    %if srcntgts_have_min_leaf_levels:
+                        /* box required to be split to balance the tree?
+                           (All particles in a box carry the same
+                           requirement, so checking the first suffices.) */
+                        || srcntgt_min_leaf_levels[user_srcntgt_ids[i]]
+                            > box_levels[box_id]
+                    %endif
+                    )
                 %else:
                     /* box non-empty? */
                     /* Note: Refine weights are allowed to be 0,
@@ -508,10 +604,17 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
             return result;
         }
         """,
-    input_expr="""count_new_boxes_needed(
+    input_expr="""//CL:mako//
+        count_new_boxes_needed(
             i, srcntgt_box_ids[i], max_leaf_refine_weight, nboxes,
             box_srcntgt_starts, box_srcntgt_counts_cumul, box_morton_bin_counts,
-            box_levels, box_has_children, level
+            box_levels, box_has_children, level, keep_refining
+            %if separate_target_limit:
+                , max_targets_in_box
+            %endif
+            %if srcntgts_have_min_leaf_levels:
+                , user_srcntgt_ids, srcntgt_min_leaf_levels
+            %endif
             )""",
     scan_expr="a + b",
     neutral="0",
@@ -529,6 +632,98 @@ SPLIT_BOX_ID_SCAN_TPL = ScanTemplate(
 
 # {{{ split-and-sort kernel
 
+# By default, the children of a box are numbered (and its particles sorted)
+# in Morton order. Optionally, they follow a Hilbert curve instead, which
+# avoids the jumps between distant children of the Morton order. The
+# orientation of the curve within a box depends on the box's ancestors and
+# is tracked as a "Hilbert state" per particle. (All particles in a box
+# share it.) Children keep their Morton numbers in box_morton_nrs and
+# box_child_ids either way, only box ids and particle order change.
+
+@memoize
+def get_hilbert_tables(dimensions):
+    """Return a tuple *(child_ranks, child_states)* of tuples of tuples.
+    In a box with Hilbert state *s*, the child with Morton number *mnr* is
+    the ``child_ranks[s][mnr]``-th one along the curve and has Hilbert
+    state ``child_states[s][mnr]``. The root box has Hilbert state 0.
+
+    The states are the (entry point, direction) pairs from
+    C. H. Hamilton and A. Rau-Chaplin, Compact Hilbert indices:
+    Space-filling curves for domains with unequal side lengths,
+    Information Processing Letters 105 (2008).
+    """
+
+    n = dimensions
+    mask = 2**n - 1
+
+    def gray(i):
+        return i ^ (i >> 1)
+
+    def gray_inverse(g):
+        i = 0
+        while g:
+            i ^= g
+            g >>= 1
+        return i
+
+    def rotate_right(x, k):
+        k %= n
+        return ((x >> k) | (x << (n - k))) & mask
+
+    def rotate_left(x, k):
+        return rotate_right(x, n - k % n)
+
+    def trailing_set_bits(i):
+        result = 0
+        while i & 1:
+            result += 1
+            i >>= 1
+        return result
+
+    def entry(w):
+        return 0 if w == 0 else gray(2*((w - 1)//2))
+
+    def direction(w):
+        if w == 0:
+            return 0
+        elif w % 2 == 0:
+            return trailing_set_bits(w - 1) % n
+        else:
+            return trailing_set_bits(w) % n
+
+    states = [(0, 0)]
+    state_numbers = {(0, 0): 0}
+    child_ranks = []
+    child_states = []
+
+    istate = 0
+    while istate < len(states):
+        e, d = states[istate]
+
+        state_child_ranks = []
+        state_child_states = []
+        for mnr in range(2**n):
+            rank = gray_inverse(rotate_right(mnr ^ e, d + 1))
+            child_state = (
+                    e ^ rotate_left(entry(rank), d + 1),
+                    (d + direction(rank) + 1) % n)
+
+            if child_state not in state_numbers:
+                state_numbers[child_state] = len(states)
+                states.append(child_state)
+
+            state_child_ranks.append(rank)
+            state_child_states.append(state_numbers[child_state])
+
+        child_ranks.append(tuple(state_child_ranks))
+        child_states.append(tuple(state_child_states))
+        istate += 1
+
+    # (These end up in the var_values of kernel builds, which must be
+    # hashable.)
+    return tuple(child_ranks), tuple(child_states)
+
+
 SPLIT_AND_SORT_PREAMBLE_TPL = Template(r"""//CL//
     <%
       def get_count_for_branch(known_bits):
@@ -553,10 +748,34 @@ SPLIT_AND_SORT_PREAMBLE_TPL = Template(r"""//CL//
         return ${get_count_for_branch("")};
     }
 
+    %if hilbert:
+        <% child_ranks, child_states = hilbert_tables %>
+
+        // [nhilbert_states, 2**dimensions], see get_hilbert_tables
+        constant char hilbert_child_ranks[] = {
+            %for state_child_ranks in child_ranks:
+                ${", ".join(str(rank) for rank in state_child_ranks)},
+            %endfor
+            };
+        constant char hilbert_child_states[] = {
+            %for state_child_states in child_states:
+                ${", ".join(str(state) for state in state_child_states)},
+            %endfor
+            };
+    %endif
+
 """, strict_undefined=True)
 
 
 SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
+    <%
+        def child_rank(mnr):
+            if hilbert:
+                return "child_ranks[%d]" % mnr
+            else:
+                return str(mnr)
+    %>
+
     box_id_t ibox = srcntgt_box_ids[i];
     dbg_assert(ibox >= 0);
     dbg_assert(ibox < nboxes);
@@ -584,6 +803,16 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
         morton_nr_t my_morton_nr = morton_nrs[i];
         dbg_printf(("   my morton nr: %d\n", my_morton_nr));
 
+        // position of my child box among its siblings (-1 if none)
+        %if hilbert:
+            char my_hilbert_state = srcntgt_hilbert_states[i];
+            constant char *child_ranks =
+                hilbert_child_ranks + my_hilbert_state*${2**dimensions};
+            int my_rank = (my_morton_nr >= 0) ? child_ranks[my_morton_nr] : -1;
+        %else:
+            int my_rank = my_morton_nr;
+        %endif
+
         morton_counts_t my_box_morton_bin_counts = box_morton_bin_counts[ibox];
 
         morton_counts_t my_morton_bin_counts = morton_bin_counts[i];
@@ -602,7 +831,7 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
         %for mnr in range(2**dimensions):
             <% bin_nmr = padded_bin(mnr, dimensions) %>
             tgt_particle_idx +=
-                (my_morton_nr > ${mnr})
+                (my_rank > ${child_rank(mnr)})
                     ? my_box_morton_bin_counts.pcnt${bin_nmr}
                     : 0;
         %endfor
@@ -615,11 +844,19 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
 
         new_user_srcntgt_ids[tgt_particle_idx] = user_srcntgt_ids[i];
 
+        %if hilbert:
+            new_srcntgt_hilbert_states[tgt_particle_idx] =
+                (my_morton_nr >= 0)
+                    ? hilbert_child_states[
+                        my_hilbert_state*${2**dimensions} + my_morton_nr]
+                    : my_hilbert_state;
+        %endif
+
         // }}}
 
         // {{{ compute this srcntgt's new box id
 
-        box_id_t new_box_id = split_box_ids[i] - ${2**dimensions} + my_morton_nr;
+        box_id_t new_box_id = split_box_ids[i] - ${2**dimensions} + my_rank;
 
         %if srcntgts_have_extent:
             if (my_morton_nr == -1)
@@ -650,8 +887,14 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
                 %if srcntgts_have_extent:
                     + my_box_morton_bin_counts.nonchild_srcntgts
                 %endif
-                %for sub_mnr in range(mnr):
-                    + my_box_morton_bin_counts.pcnt${padded_bin(sub_mnr, dimensions)}
+                %for sub_mnr in range(2**dimensions if hilbert else mnr):
+                    <% sub_bin = padded_bin(sub_mnr, dimensions) %>
+                    %if hilbert:
+                        + ((${child_rank(sub_mnr)} < my_rank)
+                            ? my_box_morton_bin_counts.pcnt${sub_bin} : 0)
+                    %else:
+                        + my_box_morton_bin_counts.pcnt${sub_bin}
+                    %endif
                 %endfor
                     ;
 
@@ -671,7 +914,11 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
                     my_box_morton_bin_counts.pwt${padded_bin(mnr, dimensions)};
 
                 // This drives the level loop.
-                if (new_weight > max_leaf_refine_weight)
+                if (new_weight > max_leaf_refine_weight
+                    %if separate_target_limit:
+                        || new_count - new_weight > max_targets_in_box
+                    %endif
+                    )
                 {
                     *have_oversize_split_box = 1;
                 }
@@ -688,6 +935,9 @@ SPLIT_AND_SORT_KERNEL_TPL = Template(r"""//CL//
         // Not splitting? Copy over existing particle info.
         new_user_srcntgt_ids[i] = user_srcntgt_ids[i];
         new_srcntgt_box_ids[i] = ibox;
+        %if hilbert:
+            new_srcntgt_hilbert_states[i] = srcntgt_hilbert_states[i];
+        %endif
     }
 """, strict_undefined=True)
 
@@ -893,7 +1143,8 @@ SOURCE_AND_TARGET_INDEX_FINDER = ElementwiseTemplate(
 
 SRCNTGT_PERMUTER_TPL = ElementwiseTemplate(
     arguments="""//CL:mako//
-        particle_id_t *from_ids
+        particle_id_t *from_ids,
+        particle_id_t from_id_offset
         %for ax in axis_names:
             , coord_t *${ax}
         %endfor
@@ -902,7 +1153,7 @@ SRCNTGT_PERMUTER_TPL = ElementwiseTemplate(
         %endfor
         """,
     operation=r"""//CL:mako//
-        particle_id_t from_idx = from_ids[i];
+        particle_id_t from_idx = from_ids[i] - from_id_offset;
         %for ax in axis_names:
             sorted_${ax}[i] = ${ax}[from_idx];
         %endfor
@@ -1094,7 +1345,8 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
         particle_id_dtype, box_id_dtype,
         sources_are_targets, srcntgts_have_extent,
         stick_out_factor, morton_nr_dtype, box_level_dtype,
-        adaptive):
+        adaptive, srcntgts_have_min_leaf_levels=False,
+        unit_refine_weights=False, hilbert=False, separate_target_limit=False):
 
     logger.info("start building tree build kernels")
 
@@ -1146,6 +1398,11 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
 
             sources_are_targets=sources_are_targets,
             srcntgts_have_extent=srcntgts_have_extent,
+            unit_refine_weights=unit_refine_weights,
+            separate_target_limit=separate_target_limit,
+
+            hilbert=hilbert,
+            hilbert_tables=get_hilbert_tables(dimensions) if hilbert else None,
 
             stick_out_factor=stick_out_factor,
 
@@ -1198,11 +1455,21 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                 VectorArg(morton_bin_count_dtype, "box_morton_bin_counts"),
                 # [nsrcntgts]
 
-                VectorArg(refine_weight_dtype, "refine_weights"),
-                # [nsrcntgts]
+                ]
+
+            # refine weights, unless all are one
+            + ([VectorArg(refine_weight_dtype, "refine_weights")]  # [nsrcntgts]
+                if not unit_refine_weights else [])
 
+            + [
                 ScalarArg(refine_weight_dtype, "max_leaf_refine_weight"),
+                ]
+
+            # separate limit on the number of targets in a leaf, if any
+            + ([ScalarArg(refine_weight_dtype, "max_targets_in_box")]
+                if separate_target_limit else [])
 
+            + [
                 # particle# at which each box starts
                 VectorArg(particle_id_dtype, "box_srcntgt_starts"),  # [nboxes]
 
@@ -1228,7 +1495,13 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
             # particle coordinates
             + [VectorArg(coord_dtype, ax) for ax in axis_names]
 
-            + ([VectorArg(coord_dtype, "srcntgt_radii")]
+            # target coordinates, if separate
+            + ([ScalarArg(particle_id_dtype, "nsources")]
+                + [VectorArg(coord_dtype, "target_"+ax) for ax in axis_names]
+                if not sources_are_targets else [])
+
+            + ([VectorArg(coord_dtype, "source_radii"),
+                VectorArg(coord_dtype, "target_radii")]
                 if srcntgts_have_extent else [])
             )
 
@@ -1241,10 +1514,13 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                 % ", ".join([
                     "i", "level", "&bbox", "morton_nrs",
                     "user_srcntgt_ids",
-                    "refine_weights",
                     ]
+                    + (["refine_weights"] if not unit_refine_weights else [])
                     + ["%s" % ax for ax in axis_names]
-                    + (["srcntgt_radii"] if srcntgts_have_extent else []))),
+                    + (["nsources"] + ["target_"+ax for ax in axis_names]
+                        if not sources_are_targets else [])
+                    + (["source_radii", "target_radii"]
+                        if srcntgts_have_extent else []))),
             scan_expr="scan_t_add(a, b, across_seg_boundary)",
             neutral="scan_t_neutral()",
             is_segment_start_expr="box_start_flags[i]",
@@ -1271,6 +1547,8 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                 ("dimensions", dimensions),
                 ("srcntgts_have_extent", srcntgts_have_extent),
                 ("adaptive", adaptive),
+                ("srcntgts_have_min_leaf_levels", srcntgts_have_min_leaf_levels),
+                ("separate_target_limit", separate_target_limit),
                 ("padded_bin", padded_bin),
                 ),
             more_preamble=generic_preamble)
@@ -1283,7 +1561,9 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
     s_and_s_codegen_args = codegen_args.copy()
     s_and_s_codegen_args.update(
             dim=None,
-            boundary_morton_nr=None)
+            boundary_morton_nr=None,
+            child_ranks=None,
+            child_states=None)
 
     split_and_sort_preamble = \
             SPLIT_AND_SORT_PREAMBLE_TPL.render(**s_and_s_codegen_args)
@@ -1301,7 +1581,12 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                 VectorArg(box_id_dtype, "new_srcntgt_box_ids", with_offset=True),
                 VectorArg(box_level_dtype, "box_levels", with_offset=True),
                 VectorArg(np.int32, "box_has_children", with_offset=True),
-                ],
+                ]
+            + ([
+                VectorArg(np.int8, "srcntgt_hilbert_states", with_offset=True),
+                VectorArg(np.int8, "new_srcntgt_hilbert_states",
+                    with_offset=True),
+                ] if hilbert else []),
             str(split_and_sort_kernel_source), name="split_and_sort",
             preamble=(
                 preamble_with_dtype_decls
@@ -1455,6 +1740,539 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
 # }}}
 
 
+# {{{ Morton key sort tree build
+
+# The kernels in this section build the same (pruned) tree as the level loop
+# above, without iterating over levels:
+#
+# 1. A Morton key of the full available depth (KEY_LEVELS levels) is computed
+#    for each particle, and particles are radix-sorted by it. Since scaling by
+#    a power of two is exact, the leading bits of the key agree with the box
+#    coordinates the level loop computes on every level.
+#
+# 2. With the keys sorted, the particles of any box form a contiguous run, and
+#    a prefix sum of the refine weights gives the weight of a box with two
+#    binary searches. Box weights only decrease with increasing level, so the
+#    level of the leaf containing each particle is found by a binary search
+#    over the levels.
+#
+# 3. Particles are sorted again by their key truncated to their leaf level.
+#    (Ties are broken by user order.) This is exactly the order in which the
+#    level loop leaves them.
+#
+# 4. Every particle that is the first in a box (on any level) emits that box.
+#    Sorting the emitted boxes by level yields the box numbering of the pruned
+#    level loop tree: by level, then by the position of the first particle.
+#    Box parents and leaf boxes are then found by binary search among the
+#    boxes on a level.
+
+morton_key_dtype = np.dtype(np.uint64)
+
+
+def get_morton_key_levels(dimensions):
+    """Return the number of levels that fit into a
+    :data:`morton_key_dtype` Morton key in *dimensions* dimensions.
+    """
+    # Box coordinates are computed with 32-bit shifts in the level loop.
+    return min(31, (morton_key_dtype.itemsize*8 - 1) // dimensions)
+
+
+MORTON_PREAMBLE_TPL = Template(r"""//CL//
+    #define KEY_LEVELS ${key_levels}
+    #define DIMENSIONS ${dimensions}
+
+    inline int get_key_shift(int level)
+    {
+        return (KEY_LEVELS - level) * DIMENSIONS;
+    }
+
+    // Return the highest level on which the boxes containing *a* and *b*
+    // agree.
+    inline int get_nshared_levels(morton_key_t a, morton_key_t b)
+    {
+        morton_key_t diff = a ^ b;
+        if (diff == 0)
+            return KEY_LEVELS;
+
+        return ((int) clz(diff) - (64 - KEY_LEVELS*DIMENSIONS)) / DIMENSIONS;
+    }
+
+    // Find the beginning of the run of (sorted) keys that agree with
+    // keys[i] on *level*. Runs on deep levels are short, so search outward
+    // from *i* in growing steps before bisecting.
+    inline particle_id_t find_key_run_start(
+        __global const morton_key_t *keys, particle_id_t i, int level)
+    {
+        const int shift = get_key_shift(level);
+        const morton_key_t prefix = keys[i] >> shift;
+
+        // keys[hi] is in the run, keys[lo-1] is not (or lo == 0).
+        particle_id_t lo = 0;
+        particle_id_t hi = i;
+        for (particle_id_t step = 1; step <= i; step *= 2)
+        {
+            if ((keys[i - step] >> shift) != prefix)
+            {
+                lo = i - step + 1;
+                break;
+            }
+            hi = i - step;
+        }
+
+        while (lo < hi)
+        {
+            particle_id_t mid = lo + (hi-lo)/2;
+            if ((keys[mid] >> shift) < prefix)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        return lo;
+    }
+
+    // Find one past the end of the run of (sorted) keys that agree with
+    // keys[i] on *level*.
+    inline particle_id_t find_key_run_end(
+        __global const morton_key_t *keys, particle_id_t n, particle_id_t i,
+        int level)
+    {
+        const int shift = get_key_shift(level);
+        const morton_key_t prefix = keys[i] >> shift;
+
+        // keys[lo-1] is in the run, keys[hi] is not (or hi == n).
+        particle_id_t lo = i + 1;
+        particle_id_t hi = n;
+        for (particle_id_t step = 1; step < n - i; step *= 2)
+        {
+            if ((keys[i + step] >> shift) != prefix)
+            {
+                hi = i + step;
+                break;
+            }
+            lo = i + step + 1;
+        }
+
+        while (lo < hi)
+        {
+            particle_id_t mid = lo + (hi-lo)/2;
+            if ((keys[mid] >> shift) <= prefix)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        return lo;
+    }
+
+    // Find the box on *level* containing particle *i* (in tree order),
+    // i.e. the last one on that level starting at or before *i*.
+    inline box_id_t find_box_on_level(
+        __global const particle_id_t *box_srcntgt_starts,
+        __global const box_id_t *level_start_box_nrs,
+        int level, particle_id_t i)
+    {
+        box_id_t lo = level_start_box_nrs[level];
+        box_id_t hi = level_start_box_nrs[level + 1];
+        while (hi - lo > 1)
+        {
+            box_id_t mid = lo + (hi-lo)/2;
+            if (box_srcntgt_starts[mid] <= i)
+                lo = mid;
+            else
+                hi = mid;
+        }
+        return lo;
+    }
+
+    // Return the lowest level on which particle *i* (in tree order)
+    // is the first particle in its box.
+    inline int get_first_new_box_level(
+        __global const morton_key_t *leaf_keys,
+        __global const particle_id_t *user_srcntgt_ids,
+        __global const box_level_t *user_leaf_levels,
+        particle_id_t i)
+    {
+        if (i == 0)
+            return 0;
+
+        // Leaf keys are truncated below the leaf level, so they can only be
+        // compared up to the shallower of the two leaves.
+        int nshared_levels = min(
+            get_nshared_levels(leaf_keys[i-1], leaf_keys[i]),
+            min(
+                (int) user_leaf_levels[user_srcntgt_ids[i-1]],
+                (int) user_leaf_levels[user_srcntgt_ids[i]]));
+
+        return nshared_levels + 1;
+    }
+    """, strict_undefined=True)
+
+
+MORTON_KEY_KERNEL_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        bbox_t bbox,
+        morton_key_t *morton_keys
+        %for ax in axis_names:
+            , coord_t *${ax}
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        %for ax in axis_names:
+            // This must compute the same scaled coordinate as
+            // scan_t_from_particle.
+            coord_t global_min_${ax} = bbox.min_${ax};
+            coord_t global_extent_${ax} = bbox.max_${ax} - global_min_${ax};
+
+            morton_key_t ${ax}_bits = (morton_key_t) (
+                ((${ax}[i] - global_min_${ax}) / global_extent_${ax})
+                * ((coord_t) (((morton_key_t) 1) << KEY_LEVELS)));
+        %endfor
+
+        morton_key_t key = 0;
+        for (int ibit = KEY_LEVELS - 1; ibit >= 0; --ibit)
+        {
+            %for ax in axis_names:
+                key = (key << 1) | ((${ax}_bits >> ibit) & 1);
+            %endfor
+        }
+
+        morton_keys[i] = key;
+        """,
+    name="compute_morton_keys")
+
+
+LEAF_LEVEL_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        morton_key_t *sorted_keys,
+        particle_id_t nsrcntgts,
+        %if not unit_refine_weights:
+            long *refine_weight_sums,
+        %endif
+        refine_weight_t max_leaf_refine_weight,
+        int max_leaf_level,
+
+        /* output */
+        box_level_t *leaf_levels,
+        """,
+    operation=r"""//CL:mako//
+        // Find the lowest level on which the box containing this particle
+        // is not overfull. The box on level *lo* is known to be overfull,
+        // the one on *hi* is known not to be. (Level -1 and
+        // KEY_LEVELS+1 are sentinels.) If the result is KEY_LEVELS+1,
+        // the key does not have enough levels to resolve this box.
+        // Boxes on *max_leaf_level* are leaves, overfull or not.
+
+        int lo = -1;
+        int hi = min(KEY_LEVELS + 1, max_leaf_level);
+
+        while (hi - lo > 1)
+        {
+            int mid = (lo + hi) / 2;
+
+            %if unit_refine_weights:
+                long box_refine_weight =
+                    find_key_run_end(sorted_keys, nsrcntgts, i, mid)
+                    - find_key_run_start(sorted_keys, i, mid);
+            %else:
+                long box_refine_weight =
+                    refine_weight_sums[find_key_run_end(
+                        sorted_keys, nsrcntgts, i, mid)]
+                    - refine_weight_sums[find_key_run_start(sorted_keys, i, mid)];
+            %endif
+
+            if (box_refine_weight > max_leaf_refine_weight)
+                lo = mid;
+            else
+                hi = mid;
+        }
+
+        leaf_levels[i] = hi;
+        """,
+    name="find_leaf_levels")
+
+
+LEAF_KEY_SCATTER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        morton_key_t *sorted_keys,
+        particle_id_t *sorted_user_ids,
+        box_level_t *leaf_levels,
+        box_level_t max_leaf_level,
+
+        /* output */
+        morton_key_t *user_leaf_keys,
+        box_level_t *user_leaf_levels,
+        """,
+    operation=r"""//CL:mako//
+        %if adaptive:
+            box_level_t leaf_level = leaf_levels[i];
+        %else:
+            box_level_t leaf_level = max_leaf_level;
+        %endif
+
+        const int shift = get_key_shift(leaf_level);
+        particle_id_t user_id = sorted_user_ids[i];
+
+        user_leaf_keys[user_id] = (sorted_keys[i] >> shift) << shift;
+        user_leaf_levels[user_id] = leaf_level;
+        """,
+    name="scatter_leaf_keys")
+
+
+BOX_EMITTER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        morton_key_t *leaf_keys,
+        particle_id_t *user_srcntgt_ids,
+        box_level_t *user_leaf_levels,
+        long *box_emit_offsets,
+
+        /* output */
+        box_level_t *unsorted_box_levels,
+        particle_id_t *unsorted_box_srcntgt_starts,
+        """,
+    operation=r"""//CL:mako//
+        int leaf_level = user_leaf_levels[user_srcntgt_ids[i]];
+        long ibox = box_emit_offsets[i];
+
+        for (int level = get_first_new_box_level(
+                leaf_keys, user_srcntgt_ids, user_leaf_levels, i);
+            level <= leaf_level; ++level)
+        {
+            unsorted_box_levels[ibox] = level;
+            unsorted_box_srcntgt_starts[ibox] = i;
+            ++ibox;
+        }
+        """,
+    name="emit_boxes")
+
+
+LEVEL_START_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        box_level_t *box_levels,
+        box_id_t *level_start_box_nrs,
+        """,
+    operation=r"""//CL:mako//
+        if (i == 0 || box_levels[i] != box_levels[i-1])
+            level_start_box_nrs[box_levels[i]] = i;
+        """,
+    name="find_level_starts")
+
+
+MORTON_BOX_INFO_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        morton_key_t *leaf_keys,
+        particle_id_t *user_srcntgt_ids,
+        box_level_t *user_leaf_levels,
+        particle_id_t nsrcntgts,
+        box_level_t *box_levels,
+        particle_id_t *box_srcntgt_starts,
+        box_id_t *level_start_box_nrs,
+
+        /* output */
+        particle_id_t *box_srcntgt_counts_cumul,
+        box_id_t *box_parent_ids,
+        morton_nr_t *box_morton_nrs,
+        int *box_has_children,
+        """,
+    operation=r"""//CL:mako//
+        int level = box_levels[i];
+        particle_id_t start = box_srcntgt_starts[i];
+
+        box_srcntgt_counts_cumul[i] =
+            find_key_run_end(leaf_keys, nsrcntgts, start, level) - start;
+        box_has_children[i] =
+            user_leaf_levels[user_srcntgt_ids[start]] > level;
+
+        if (level == 0)
+        {
+            box_parent_ids[i] = 0;
+            box_morton_nrs[i] = 0;
+        }
+        else
+        {
+            box_parent_ids[i] = find_box_on_level(
+                box_srcntgt_starts, level_start_box_nrs, level - 1, start);
+            box_morton_nrs[i] =
+                (leaf_keys[start] >> get_key_shift(level))
+                & ${2**dimensions - 1};
+        }
+        """,
+    name="find_morton_box_info")
+
+
+SRCNTGT_BOX_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        particle_id_t *user_srcntgt_ids,
+        box_level_t *user_leaf_levels,
+        particle_id_t *box_srcntgt_starts,
+        box_id_t *level_start_box_nrs,
+
+        /* output */
+        box_id_t *srcntgt_box_ids,
+        """,
+    operation=r"""//CL:mako//
+        srcntgt_box_ids[i] = find_box_on_level(
+            box_srcntgt_starts, level_start_box_nrs,
+            user_leaf_levels[user_srcntgt_ids[i]], i);
+        """,
+    name="find_srcntgt_box_ids")
+
+
+def get_morton_tree_build_kernel_info(context, dimensions, coord_dtype,
+        particle_id_dtype, box_id_dtype, morton_nr_dtype, box_level_dtype,
+        adaptive, unit_refine_weights=False):
+    logger.info("start building Morton tree build kernels")
+
+    particle_id_dtype = np.dtype(particle_id_dtype)
+    box_id_dtype = np.dtype(box_id_dtype)
+
+    from boxtree.bounding_box import make_bounding_box_dtype
+    bbox_dtype, _ = make_bounding_box_dtype(
+            context.devices[0], dimensions, coord_dtype)
+
+    from boxtree.tools import AXIS_NAMES
+    axis_names = AXIS_NAMES[:dimensions]
+
+    key_levels = get_morton_key_levels(dimensions)
+
+    type_aliases = (
+            ("morton_key_t", morton_key_dtype),
+            ("bbox_t", bbox_dtype),
+            ("coord_t", coord_dtype),
+            ("particle_id_t", particle_id_dtype),
+            ("box_id_t", box_id_dtype),
+            ("refine_weight_t", refine_weight_dtype),
+            ("morton_nr_t", morton_nr_dtype),
+            ("box_level_t", box_level_dtype),
+            )
+    var_values = (
+            ("dimensions", dimensions),
+            ("axis_names", axis_names),
+            ("adaptive", adaptive),
+            ("unit_refine_weights", unit_refine_weights),
+            )
+
+    morton_preamble = str(MORTON_PREAMBLE_TPL.render(
+        key_levels=key_levels,
+        dimensions=dimensions))
+
+    def build_elementwise(tpl):
+        return tpl.build(context,
+                type_aliases=type_aliases,
+                var_values=var_values,
+                more_preamble=morton_preamble)
+
+    # Scan kernels get their types declared by hand.
+    from pyopencl.tools import dtype_to_ctype
+    scan_preamble = "".join(
+            "typedef %s %s;\n" % (dtype_to_ctype(dtype), name)
+            for name, dtype in type_aliases
+            if name != "bbox_t") + morton_preamble
+
+    from pyopencl.tools import VectorArg, ScalarArg
+    from pyopencl.algorithm import RadixSort
+    from pyopencl.scan import GenericScanKernel
+
+    # {{{ sorts
+
+    # used both for the full keys and for the keys truncated to leaf levels
+    morton_key_sort = RadixSort(
+            context,
+            [
+                VectorArg(morton_key_dtype, "keys"),
+                VectorArg(particle_id_dtype, "ids"),
+                ScalarArg(np.int32, "key_shift"),
+                ],
+            key_expr="keys[i] >> key_shift",
+            sort_arg_names=["keys", "ids"],
+            bits_at_a_time=3,
+            index_dtype=particle_id_dtype,
+            key_dtype=morton_key_dtype)
+
+    box_level_sort = RadixSort(
+            context,
+            [
+                VectorArg(box_level_dtype, "levels"),
+                VectorArg(particle_id_dtype, "starts"),
+                ],
+            key_expr="levels[i]",
+            sort_arg_names=["levels", "starts"],
+            index_dtype=box_id_dtype,
+            key_dtype=np.uint32)
+
+    # }}}
+
+    # {{{ scans
+
+    # (not needed if all refine weights are one)
+    refine_weight_sum_scan = None if unit_refine_weights else GenericScanKernel(
+            context, np.int64,
+            arguments=[
+                # input
+                VectorArg(particle_id_dtype, "sorted_user_ids"),
+                VectorArg(refine_weight_dtype, "refine_weights"),
+                # output
+                VectorArg(np.int64, "refine_weight_sums"),
+                ],
+            input_expr="refine_weights[sorted_user_ids[i]]",
+            scan_expr="a+b", neutral="0",
+            output_statement="""
+                if (i == 0) refine_weight_sums[0] = 0;
+                refine_weight_sums[i+1] = item;
+                """,
+            name_prefix="refine_weight_sum")
+
+    # Box counts are accumulated in 64 bits, so that they can be checked
+    # against the range of box_id_t before any box arrays are allocated.
+    box_count_scan = GenericScanKernel(
+            context, np.int64,
+            arguments=[
+                # input
+                VectorArg(morton_key_dtype, "leaf_keys"),
+                VectorArg(particle_id_dtype, "user_srcntgt_ids"),
+                VectorArg(box_level_dtype, "user_leaf_levels"),
+                # output
+                VectorArg(np.int64, "box_emit_offsets"),
+                VectorArg(np.int64, "nboxes"),
+                ],
+            input_expr="""max(0,
+                (int) user_leaf_levels[user_srcntgt_ids[i]] + 1
+                - get_first_new_box_level(
+                    leaf_keys, user_srcntgt_ids, user_leaf_levels, i))""",
+            scan_expr="a+b", neutral="0",
+            output_statement="""
+                box_emit_offsets[i] = prev_item;
+                if (i+1 == N) *nboxes = item;
+                """,
+            preamble=scan_preamble,
+            name_prefix="count_morton_boxes")
+
+    # }}}
+
+    logger.info("Morton tree build kernels built")
+
+    return _KernelInfo(
+            key_levels=key_levels,
+
+            morton_key_kernel=build_elementwise(MORTON_KEY_KERNEL_TPL),
+            morton_key_sort=morton_key_sort,
+            refine_weight_sum_scan=refine_weight_sum_scan,
+            leaf_level_finder=build_elementwise(LEAF_LEVEL_FINDER_TPL),
+            leaf_key_scatter=build_elementwise(LEAF_KEY_SCATTER_TPL),
+            box_count_scan=box_count_scan,
+            box_emitter=build_elementwise(BOX_EMITTER_TPL),
+            box_level_sort=box_level_sort,
+            level_start_finder=build_elementwise(LEVEL_START_FINDER_TPL),
+            box_info_kernel=build_elementwise(MORTON_BOX_INFO_TPL),
+            srcntgt_box_finder=build_elementwise(SRCNTGT_BOX_FINDER_TPL),
+            )
+
+# }}}
+
+
 # {{{ point source linking kernels
 
 # scan over (non-point) source ids in tree order
@@ -1612,4 +2430,392 @@ TREE_ORDER_TARGET_FILTER_INDEX_TPL = ElementwiseTemplate(
 
 # }}}
 
+# {{{ 2:1 balancing
+
+# A tree is balanced if no leaf box is adjacent to a non-leaf box on a finer
+# level. Then adjacent leaves differ by at most one level.
+
+UNBALANCED_LEAF_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL//
+        /* input */
+        box_flags_t *box_flags,
+        box_level_t *box_levels,
+        peer_list_idx_t *peer_list_starts,
+        box_id_t *peer_lists,
+
+        /* output */
+        unsigned char *leaf_must_split,
+        int *have_unbalanced_leaves,
+        """,
+    operation=r"""//CL//
+        if (box_flags[i] & BOX_HAS_CHILDREN)
+        {
+            // All coarser leaves adjacent to box i are among its peers.
+            for (peer_list_idx_t pb_i = peer_list_starts[i];
+                    pb_i < peer_list_starts[i+1]; ++pb_i)
+            {
+                box_id_t peer_box = peer_lists[pb_i];
+
+                if (!(box_flags[peer_box] & BOX_HAS_CHILDREN)
+                        && box_levels[peer_box] < box_levels[i])
+                {
+                    leaf_must_split[peer_box] = 1;
+                    *have_unbalanced_leaves = 1;
+                }
+            }
+        }
+        """,
+    name="find_unbalanced_leaves")
+
+
+MIN_LEAF_LEVEL_MARKER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        unsigned char *leaf_must_split,
+        box_level_t *box_levels,
+        particle_id_t *box_source_starts,
+        particle_id_t *box_source_counts_nonchild,
+        particle_id_t *user_source_ids,
+        %if not sources_are_targets:
+            particle_id_t *box_target_starts,
+            particle_id_t *box_target_counts_nonchild,
+            particle_id_t *user_target_ids,
+            particle_id_t nsources,
+        %endif
+
+        /* output */
+        box_level_t *srcntgt_min_leaf_levels,
+        """,
+    operation=r"""//CL:mako//
+        if (leaf_must_split[i])
+        {
+            box_level_t min_leaf_level = box_levels[i] + 1;
+
+            particle_id_t start = box_source_starts[i];
+            particle_id_t stop = start + box_source_counts_nonchild[i];
+            for (particle_id_t j = start; j < stop; ++j)
+                srcntgt_min_leaf_levels[user_source_ids[j]] = min_leaf_level;
+
+            %if not sources_are_targets:
+                start = box_target_starts[i];
+                stop = start + box_target_counts_nonchild[i];
+                for (particle_id_t j = start; j < stop; ++j)
+                    srcntgt_min_leaf_levels[nsources + user_target_ids[j]] = \
+                            min_leaf_level;
+            %endif
+        }
+        """,
+    name="mark_min_leaf_levels")
+
+# }}}
+
+
+# {{{ refine weight validation
+
+# Minimum, maximum and total of the refine weights, found in one pass over
+# the weights so that validating them takes a single transfer to the host.
+
+REFINE_WEIGHT_STATS_TPL = ReductionTemplate(
+    preamble=r"""//CL//
+        stats_t stats_neutral()
+        {
+            stats_t result;
+            result.min_weight = INT_MAX;
+            result.max_weight = INT_MIN;
+            result.total_weight = 0;
+            return result;
+        }
+
+        stats_t stats_from_weight(refine_weight_t weight)
+        {
+            stats_t result;
+            result.min_weight = weight;
+            result.max_weight = weight;
+            result.total_weight = weight;
+            return result;
+        }
+
+        stats_t agg_stats(stats_t a, stats_t b)
+        {
+            a.min_weight = min(a.min_weight, b.min_weight);
+            a.max_weight = max(a.max_weight, b.max_weight);
+            a.total_weight += b.total_weight;
+            return a;
+        }
+        """,
+    arguments="refine_weight_t *refine_weights",
+    neutral="stats_neutral()",
+    reduce_expr="agg_stats(a, b)",
+    map_expr="stats_from_weight(refine_weights[i])",
+    name_prefix="refine_weight_stats")
+
+# }}}
+
+
+# {{{ bounding box check
+
+# Particles outside the root box would be sorted into the wrong boxes (or
+# refined indefinitely), so a bounding box given by the user is checked.
+# Particles may touch the lower, but not the upper boundary, matching the
+# bounding boxes computed by the builder.
+
+PARTICLES_OUTSIDE_BBOX_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        bbox_t bbox,
+        int *have_particles_outside_bbox
+        %for ax in axis_names:
+            , coord_t *${ax}
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        %for ax in axis_names:
+            // also catches NaNs
+            if (!(bbox.min_${ax} <= ${ax}[i] && ${ax}[i] < bbox.max_${ax}))
+                *have_particles_outside_bbox = 1;
+        %endfor
+        """,
+    name="find_particles_outside_bbox")
+
+# }}}
+
+
+# {{{ loose tree particle escape finder
+
+LOOSE_PARTICLE_ESCAPE_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        particle_id_t *box_starts,
+        particle_id_t *box_counts_nonchild,
+        coord_t *box_centers,
+        box_level_t *box_levels,
+        box_id_t aligned_nboxes,
+        coord_t root_extent,
+        coord_t looseness,
+
+        /* output */
+        int *have_escaped_particles
+        %for ax in axis_names:
+            , coord_t *${ax}
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        // radius of box i, scaled by 1 + looseness about its center
+        const coord_t loose_radius = (1 + looseness) * root_extent
+            / (coord_t) (1 << (box_levels[i] + 1));
+
+        particle_id_t start = box_starts[i];
+        particle_id_t stop = start + box_counts_nonchild[i];
+
+        for (particle_id_t j = start; j < stop; ++j)
+        {
+            %for iax, ax in enumerate(axis_names):
+                // also catches NaNs
+                if (!(fabs(${ax}[j] - box_centers[${iax}*aligned_nboxes + i])
+                        <= loose_radius))
+                    *have_escaped_particles = 1;
+            %endfor
+        }
+        """,
+    name="find_escaped_loose_particles")
+
+# }}}
+
+
+# {{{ forest kernels
+
+# The trees of a forest are built as subtrees of one tree (see
+# TreeBuilder.build_forest). Each tree's particles are mapped from its own
+# bounding box into a unit cell on the forest's root level. Cells are
+# assigned to trees in Morton order, so that the particles, and the boxes
+# on each level, of each tree are contiguous in forest tree order and
+# ordered by tree number.
+
+FOREST_TREE_ID_SEARCH_PREAMBLE = r"""//CL//
+    // Return the number of the (nonempty) range of *starts* containing
+    // *pos*.
+    particle_id_t find_forest_tree_id(
+        global const particle_id_t *starts, particle_id_t ntrees,
+        particle_id_t pos)
+    {
+        particle_id_t lo = 0;
+        particle_id_t hi = ntrees;
+
+        while (hi - lo > 1)
+        {
+            particle_id_t mid = lo + (hi - lo) / 2;
+            if (starts[mid] <= pos)
+                lo = mid;
+            else
+                hi = mid;
+        }
+
+        return lo;
+    }
+    """
+
+FOREST_PARTICLE_TREE_ID_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL//
+        particle_id_t *tree_particle_starts,
+        particle_id_t ntrees,
+        particle_id_t *particle_tree_ids
+        """,
+    operation=r"""//CL//
+        particle_tree_ids[i] = find_forest_tree_id(
+            tree_particle_starts, ntrees, i);
+        """,
+    preamble=FOREST_TREE_ID_SEARCH_PREAMBLE,
+    name="find_forest_particle_tree_ids")
+
+FOREST_BBOX_SCAN_TPL = ScanTemplate(
+    preamble=r"""//CL:mako//
+        <%
+            if coord_dtype == np.float64:
+                coord_dtype_3ltr = "DBL"
+            elif coord_dtype == np.float32:
+                coord_dtype_3ltr = "FLT"
+            else:
+                raise TypeError("unknown coord_dtype")
+        %>
+
+        bbox_t bbox_neutral()
+        {
+            bbox_t result;
+            %for ax in axis_names:
+                result.min_${ax} = ${coord_dtype_3ltr}_MAX;
+                result.max_${ax} = -${coord_dtype_3ltr}_MAX;
+            %endfor
+            return result;
+        }
+
+        bbox_t bbox_from_particle(
+            %for iax, ax in enumerate(axis_names):
+                ${", " if iax else ""}coord_t ${ax}
+            %endfor
+            )
+        {
+            bbox_t result;
+            %for ax in axis_names:
+                result.min_${ax} = ${ax};
+                result.max_${ax} = ${ax};
+            %endfor
+            return result;
+        }
+
+        bbox_t agg_bbox(bbox_t a, bbox_t b)
+        {
+            %for ax in axis_names:
+                a.min_${ax} = min(a.min_${ax}, b.min_${ax});
+                a.max_${ax} = max(a.max_${ax}, b.max_${ax});
+            %endfor
+            return a;
+        }
+        """,
+    arguments=r"""//CL:mako//
+        particle_id_t *particle_tree_ids,
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        bbox_t *tree_bboxes
+        """,
+    input_expr=r"""//CL:mako//
+        bbox_from_particle(
+            %for iax, ax in enumerate(axis_names):
+                ${", " if iax else ""}${ax}[i]
+            %endfor
+            )
+        """,
+    scan_expr="across_seg_boundary ? b : agg_bbox(a, b)",
+    neutral="bbox_neutral()",
+    is_segment_start_expr=(
+        "i == 0 || particle_tree_ids[i] != particle_tree_ids[i-1]"),
+    output_statement=r"""//CL//
+        // Am I the last particle of my tree?
+        if (i+1 == N || particle_tree_ids[i+1] != particle_tree_ids[i])
+            tree_bboxes[particle_tree_ids[i]] = item;
+        """)
+
+FOREST_COORD_MAPPER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        particle_id_t *particle_tree_ids,
+        bbox_t *tree_bboxes,
+        int root_level
+        %for ax in axis_names:
+            , coord_t *${ax}
+        %endfor
+        %for ax in axis_names:
+            , coord_t *forest_${ax}
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        particle_id_t itree = particle_tree_ids[i];
+        bbox_t bbox = tree_bboxes[itree];
+
+        // The cell of tree number itree has the Morton number itree on the
+        // root level.
+        %for iax, ax in enumerate(axis_names):
+            ulong cell_${ax} = 0;
+        %endfor
+        for (int ibit = 0; ibit < root_level; ++ibit)
+        {
+            %for iax, ax in enumerate(axis_names):
+                cell_${ax} |= (
+                    (((ulong) itree) >> (ibit*${dimensions} + ${dimensions-1-iax}))
+                    & 1) << ibit;
+            %endfor
+        }
+
+        %for ax in axis_names:
+        {
+            // Scale as in the level loop of the tree build, so that
+            // particles end up in the same boxes as in a build of this tree
+            // alone (up to rounding in the addition below).
+            coord_t global_min = bbox.min_${ax};
+            coord_t global_extent = bbox.max_${ax} - global_min;
+
+            forest_${ax}[i] = (coord_t) cell_${ax}
+                + (${ax}[i] - global_min) / global_extent;
+        }
+        %endfor
+        """,
+    name="map_to_forest_coords")
+
+FOREST_BOX_TREE_ID_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL//
+        box_level_t *box_levels,
+        particle_id_t *box_source_starts,
+        box_id_t *level_start_box_nrs,
+        int root_level,
+        particle_id_t ntrees,
+        particle_id_t *box_tree_ids,
+        box_id_t *tree_level_box_starts
+        """,
+    operation=r"""//CL//
+        int level = box_levels[i];
+
+        if (level < root_level)
+        {
+            box_tree_ids[i] = -1;
+            PYOPENCL_ELWISE_CONTINUE;
+        }
+
+        // The root boxes of the trees are in tree order, and so are their
+        // particles.
+        global const particle_id_t *tree_starts =
+            box_source_starts + level_start_box_nrs[root_level];
+
+        particle_id_t itree = find_forest_tree_id(
+            tree_starts, ntrees, box_source_starts[i]);
+        box_tree_ids[i] = itree;
+
+        // Am I the first box of my tree on my level?
+        if (i == level_start_box_nrs[level]
+                || find_forest_tree_id(
+                    tree_starts, ntrees, box_source_starts[i-1]) != itree)
+            tree_level_box_starts[(level - root_level)*(ntrees + 1) + itree] = i;
+        """,
+    preamble=FOREST_TREE_ID_SEARCH_PREAMBLE,
+    name="find_forest_box_tree_ids")
+
+# }}}
+
 # vim: foldmethod=marker:filetype=pyopencl
@@ -0,0 +1,951 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2017 Andreas Kloeckner and contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from six.moves import range, zip
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pytools.obj_array import make_obj_array
+from boxtree.tree import Tree, box_flags_enum
+from boxtree.tools import DeviceDataRecord, memoize_method_in_context
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# {{{ host-side tree geometry helpers
+
+def get_level_morton_nrs(coords, bbox_min, bbox_max, levels):
+    """Return the Morton number of the box on *levels* containing
+    each point in *coords*, relative to its parent box, along with the
+    integer box coordinates on that level.
+
+    This mirrors the computation in the Morton count scan of the tree
+    build, so that points are sorted into the same boxes as they would be
+    by :class:`boxtree.TreeBuilder`.
+
+    :arg coords: an object array of (XYZ) host coordinate arrays.
+    :arg levels: an integer array (or scalar) of levels.
+    :returns: a tuple ``(morton_nrs, icoords)``, where *icoords* has shape
+        ``(dimensions, npoints)``.
+    """
+    dimensions = len(coords)
+    coord_dtype = bbox_min.dtype
+
+    level_factor = (
+            np.left_shift(1, np.asarray(levels, dtype=np.int64))
+            .astype(coord_dtype))
+
+    icoords = np.empty((dimensions, len(coords[0])), np.int64)
+    morton_nrs = np.zeros(len(coords[0]), np.int64)
+    for iaxis in range(dimensions):
+        extent = bbox_max[iaxis] - bbox_min[iaxis]
+        scaled = ((coords[iaxis] - bbox_min[iaxis]) / extent) * level_factor
+        icoords[iaxis] = scaled.astype(np.int64)
+        morton_nrs |= (icoords[iaxis] & 1) << (dimensions-1-iaxis)
+
+    return morton_nrs, icoords
+
+
+def compute_box_centers(box_levels, box_icoords, bbox_min, bbox_max):
+    """Compute box centers from integer box coordinates in the same way as
+    the box info kernel of the tree build does.
+
+    :returns: an array of shape ``(dimensions, nboxes)``.
+    """
+    dimensions = len(box_icoords)
+    coord_dtype = bbox_min.dtype
+    one_half = coord_dtype.type(0.5)
+
+    box_levels = np.asarray(box_levels, dtype=np.int64)
+
+    centers = np.zeros((dimensions, len(box_levels)), coord_dtype)
+    for ilevel_bit in range(int(np.max(box_levels, initial=0))):
+        walking = box_levels > ilevel_bit
+        for iaxis in range(dimensions):
+            has_bit = (
+                    (box_icoords[iaxis, walking] >> ilevel_bit) & 1
+                    ).astype(coord_dtype)
+            centers[iaxis, walking] = one_half*(
+                    centers[iaxis, walking] - one_half + has_bit)
+
+    extent = bbox_max[0] - bbox_min[0]
+    for iaxis in range(dimensions):
+        centers[iaxis] = bbox_min[iaxis] + extent*(one_half + centers[iaxis])
+
+    return centers
+
+
+def get_box_icoords(box_parent_ids, box_morton_nrs, level_start_box_nrs,
+        dimensions):
+    """Compute the integer coordinates of each box on its own level from
+    the parent relation (host version).
+
+    :returns: an array of shape ``(nboxes, dimensions)``.
+    """
+    box_icoords = np.zeros((len(box_parent_ids), dimensions), np.int64)
+    for level in range(1, len(level_start_box_nrs) - 1):
+        level_boxes = np.arange(
+                level_start_box_nrs[level], level_start_box_nrs[level+1])
+        parents = box_parent_ids[level_boxes]
+        for iaxis in range(dimensions):
+            box_icoords[level_boxes, iaxis] = (
+                    2*box_icoords[parents, iaxis]
+                    + ((box_morton_nrs[level_boxes]
+                        >> (dimensions-1-iaxis)) & 1))
+
+    return box_icoords
+
+
+def box_morton_nrs_from_child_ids(box_child_ids, nboxes):
+    """Recover each box's Morton number within its parent from
+    :attr:`boxtree.Tree.box_child_ids` (host version).
+    """
+    result = np.zeros(nboxes, np.int64)
+    for mnr, child_ids in enumerate(box_child_ids):
+        child_ids = child_ids[:nboxes]
+        result[child_ids[child_ids != 0]] = mnr
+
+    return result
+
+# }}}
+
+
+# {{{ output
+
+class TreeUpdateInfo(DeviceDataRecord):
+    """Describes how the boxes and particles of a :class:`boxtree.Tree`
+    relate to those of the tree obtained from it by :class:`TreeUpdater`.
+    Useful for patching downstream data structures (such as per-box
+    expansions) instead of recomputing them.
+
+    .. attribute:: new_box_ids_from_old
+
+        ``box_id_t [old_nboxes]``
+
+        The id in the updated tree of each box of the original tree, or -1
+        if the box no longer exists (because it became empty or was
+        merged into an ancestor).
+
+    .. attribute:: changed_box_ids
+
+        ``box_id_t [nchanged_boxes]``
+
+        A sorted list of box ids in the updated tree whose particle content or
+        children differ from the corresponding box in the original tree. This
+        includes all new boxes and the ancestors of every box that gained or
+        lost particles. Boxes not in this list contain the same particles as
+        before, in the same order, though possibly at a different particle
+        index.
+
+    .. attribute:: new_user_ids_from_old
+
+        ``particle_id_t [old_nsources]``
+
+        The :ref:`user order <particle-orderings>` index in the updated tree
+        of each particle of the original tree, or -1 if the particle was
+        removed. Surviving particles retain their relative order, and
+        added particles follow them in the order in which they were given.
+
+    .. automethod:: get
+    """
+
+# }}}
+
+
+# {{{ tree updater
+
+class TreeUpdater(object):
+    """Updates an existing :class:`boxtree.Tree` by adding and removing
+    particles, without rebuilding it from scratch.
+
+    Only the parts of the tree affected by the change are restructured: leaves
+    that become overfull are split, and boxes that become underfull
+    are merged into leaves. Neither the bounding box nor any box that
+    is unaffected by the change is modified. The resulting tree is identical
+    to one built by :class:`boxtree.TreeBuilder` from the updated particle set
+    with the same bounding box.
+
+    The update is done on the host: the whole tree is transferred to the
+    host, the affected boxes are restructured, all boxes and particles are
+    renumbered, and the whole tree is transferred back to the device.
+    The cost is therefore linear in the size of the tree, whatever the size
+    of the change. It saves the sorting and level-by-level subdivision of
+    a rebuild, but for small changes to large trees it is only a few times
+    cheaper than a rebuild with :class:`boxtree.TreeBuilder`.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        """
+        :arg context: A :class:`pyopencl.Context`.
+        """
+        self.context = context
+
+    def __call__(self, queue, tree, max_particles_in_box,
+            added_particles=None, removed_user_ids=None,
+            allocator=None, debug=False, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue` instance
+        :arg tree: a :class:`boxtree.Tree` built with sources equal to
+            targets, without particle extent or looseness, and with the default
+            empty leaf pruning, adaptive refinement and Morton ordering.
+        :arg max_particles_in_box: The maximum number of particles in a leaf
+            box. This should be the same value that was used to build *tree*.
+        :arg added_particles: an object array of (XYZ) point coordinate arrays
+            (either :class:`pyopencl.array.Array` or :class:`numpy.ndarray`)
+            of particles to add, or *None*. All added particles must lie inside
+            :attr:`boxtree.Tree.bounding_box`.
+        :arg removed_user_ids: an integer array of particle numbers in
+            :ref:`user order <particle-orderings>` of particles to remove, or
+            *None*.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+
+        :returns: a tuple ``(tree, update_info, event)``, where *tree* is the
+            updated :class:`boxtree.Tree`, *update_info* is a
+            :class:`TreeUpdateInfo`, and *event* is a :class:`pyopencl.Event`
+            for dependency management.
+        """
+
+        # {{{ input processing
+
+        if (not tree.sources_are_targets
+                or tree.sources_have_extent or tree.targets_have_extent):
+            raise ValueError("only allowed on trees whose sources are targets "
+                    "and whose particles have no extent")
+
+        if not tree._is_pruned:
+            raise ValueError("only allowed on pruned trees")
+
+        # The particle ranges of new and split boxes are laid out in Morton
+        # order.
+        if tree.ordering != "morton":
+            raise ValueError("only allowed on Morton-ordered trees")
+
+        # (Trees stored before looseness existed don't have it.)
+        if getattr(tree, "looseness", 0):
+            raise ValueError("not allowed on loose trees, "
+                    "see LooseTreeUpdater")
+
+        if max_particles_in_box <= 0:
+            raise ValueError("max_particles_in_box must be positive")
+
+        if wait_for:
+            cl.wait_for_events(wait_for)
+
+        dimensions = tree.dimensions
+        nchildren = 2**dimensions
+
+        def to_host(ary):
+            if isinstance(ary, cl.array.Array):
+                return ary.get(queue=queue)
+            return np.asarray(ary)
+
+        if added_particles is not None:
+            added = make_obj_array([
+                to_host(coord).astype(tree.coord_dtype)
+                for coord in added_particles])
+            if len(added) != dimensions:
+                raise ValueError("added_particles has the wrong number of "
+                        "dimensions")
+            nadded = len(added[0])
+        else:
+            added = make_obj_array([
+                np.empty(0, tree.coord_dtype) for i in range(dimensions)])
+            nadded = 0
+
+        if removed_user_ids is not None:
+            removed_user_ids = np.unique(to_host(removed_user_ids))
+        else:
+            removed_user_ids = np.empty(0, np.int64)
+
+        logger.info("tree update: start (%d added, %d removed)"
+                % (nadded, len(removed_user_ids)))
+
+        htree = tree.get(queue=queue)
+        bbox_min, bbox_max = htree.bounding_box
+
+        old_nboxes = htree.nboxes
+        old_nparticles = htree.nsources
+
+        if len(removed_user_ids) and (
+                removed_user_ids[0] < 0
+                or removed_user_ids[-1] >= old_nparticles):
+            raise ValueError("removed_user_ids out of range")
+
+        if old_nparticles - len(removed_user_ids) + nadded == 0:
+            raise ValueError("cannot remove all particles from a tree")
+
+        if nadded:
+            for iaxis in range(dimensions):
+                if ((added[iaxis] < bbox_min[iaxis]).any()
+                        or (added[iaxis] >= bbox_max[iaxis]).any()):
+                    raise ValueError("added particles must lie within the "
+                            "bounding box of the tree")
+
+        # }}}
+
+        # {{{ gather old box structure
+
+        # Box state is kept in growable arrays, indexed by the old box id for
+        # old boxes, and by ids past the end of the old tree for new ones.
+
+        capacity = [old_nboxes + nchildren]
+
+        box_parent_ids = np.empty(capacity[0], np.int64)
+        box_parent_ids[:old_nboxes] = htree.box_parent_ids
+
+        box_levels = np.empty(capacity[0], np.int64)
+        box_levels[:old_nboxes] = htree.box_levels
+
+        box_morton_nrs = np.empty(capacity[0], np.int64)
+        box_morton_nrs[:old_nboxes] = box_morton_nrs_from_child_ids(
+                htree.box_child_ids, old_nboxes)
+
+        box_is_leaf = np.empty(capacity[0], np.bool_)
+        box_is_leaf[:old_nboxes] = (
+                htree.box_flags & box_flags_enum.HAS_CHILDREN) == 0
+
+        box_counts_cumul = np.empty(capacity[0], np.int64)
+        box_counts_cumul[:old_nboxes] = htree.box_source_counts_cumul
+
+        # (stored with the box index as the slowest-moving index, so that
+        # in-place resizing preserves contents)
+        box_icoords = np.empty((capacity[0], dimensions), np.int64)
+        box_icoords[:old_nboxes] = get_box_icoords(
+                box_parent_ids[:old_nboxes], box_morton_nrs[:old_nboxes],
+                htree.level_start_box_nrs, dimensions)
+
+        nboxes = [old_nboxes]
+
+        def add_boxes(parent_ids, morton_nrs):
+            nnew = len(parent_ids)
+            start = nboxes[0]
+            if start + nnew > capacity[0]:
+                new_capacity = max(2*capacity[0], start + nnew)
+                for ary in [box_parent_ids, box_levels, box_morton_nrs,
+                        box_is_leaf, box_counts_cumul]:
+                    ary.resize(new_capacity, refcheck=False)
+                box_icoords.resize(
+                        (new_capacity, dimensions), refcheck=False)
+                capacity[0] = new_capacity
+
+            new_ids = np.arange(start, start+nnew)
+            box_parent_ids[new_ids] = parent_ids
+            box_levels[new_ids] = box_levels[parent_ids] + 1
+            box_morton_nrs[new_ids] = morton_nrs
+            box_is_leaf[new_ids] = True
+            box_counts_cumul[new_ids] = 0
+            for iaxis in range(dimensions):
+                box_icoords[new_ids, iaxis] = (
+                        2*box_icoords[parent_ids, iaxis]
+                        + ((morton_nrs >> (dimensions-1-iaxis)) & 1))
+
+            box_is_leaf[parent_ids] = False
+            nboxes[0] += nnew
+
+            if box_levels[start:start+nnew].max(initial=0) > np.iinfo(
+                    tree.box_level_dtype).max:
+                raise RuntimeError("level count exceeded maximum")
+
+            return new_ids
+
+        # }}}
+
+        # {{{ locate removed particles
+
+        # Particles are numbered by their old tree order index, with added
+        # particles following the old ones.
+
+        particle_leaf_ids = np.empty(old_nparticles + nadded, np.int64)
+
+        removed_tree_ids = htree.sorted_target_ids[removed_user_ids]
+
+        old_leaf_starts = htree.box_source_starts
+        old_leaf_counts = htree.box_source_counts_nonchild
+
+        def old_leaf_for_tree_ids(tree_ids):
+            # Leaves partition the particles in tree order.
+            leaves, = np.nonzero(old_leaf_counts)
+            leaves = leaves[np.argsort(old_leaf_starts[leaves])]
+            idx = np.searchsorted(
+                    old_leaf_starts[leaves], tree_ids, side="right") - 1
+            return leaves[idx]
+
+        removed_leaf_ids = old_leaf_for_tree_ids(removed_tree_ids)
+        particle_leaf_ids[removed_tree_ids] = -1
+
+        # }}}
+
+        # {{{ locate added particles, creating boxes for them if needed
+
+        added_leaf_ids = np.zeros(nadded, np.int64)
+        active = np.arange(nadded)
+
+        old_box_child_ids = htree.box_child_ids
+        while len(active):
+            current = added_leaf_ids[active]
+            descend = ~box_is_leaf[current]
+            active = active[descend]
+            current = current[descend]
+
+            morton_nrs, _ = get_level_morton_nrs(
+                    make_obj_array([ax[active] for ax in added]),
+                    bbox_min, bbox_max, box_levels[current] + 1)
+
+            child_ids = old_box_child_ids[morton_nrs, current]
+            found = child_ids != 0
+
+            # This particle lands in a (pruned) empty child box, which will
+            # need to be created.
+            if not found.all():
+                new_child_keys, inverse = np.unique(
+                        current[~found]*nchildren + morton_nrs[~found],
+                        return_inverse=True)
+                new_ids = add_boxes(
+                        new_child_keys // nchildren, new_child_keys % nchildren)
+                added_leaf_ids[active[~found]] = new_ids[inverse]
+
+            added_leaf_ids[active[found]] = child_ids[found]
+            active = active[found]
+
+        # }}}
+
+        # {{{ update cumulative counts of affected boxes and their ancestors
+
+        box_count_deltas = np.zeros(nboxes[0], np.int64)
+        np.add.at(box_count_deltas, removed_leaf_ids, -1)
+        np.add.at(box_count_deltas, added_leaf_ids, 1)
+
+        touched_leaf_ids = np.union1d(removed_leaf_ids, added_leaf_ids)
+
+        changed_box_ids = [touched_leaf_ids]
+        frontier = touched_leaf_ids
+        while len(frontier):
+            frontier = np.unique(box_parent_ids[frontier[frontier != 0]])
+            changed_box_ids.append(frontier)
+        changed_box_ids = np.unique(np.concatenate(changed_box_ids))
+
+        changed_box_levels = box_levels[changed_box_ids]
+        for level in range(int(changed_box_levels.max(initial=0)), 0, -1):
+            level_boxes = changed_box_ids[changed_box_levels == level]
+            np.add.at(box_count_deltas, box_parent_ids[level_boxes],
+                    box_count_deltas[level_boxes])
+
+        box_counts_cumul[changed_box_ids] += box_count_deltas[changed_box_ids]
+
+        # }}}
+
+        # {{{ merge boxes that became underfull
+
+        # Old non-leaf boxes had more than max_particles_in_box particles, so
+        # only boxes that lost particles can become underfull. Merge the
+        # topmost ones into leaves.
+
+        underfull = np.zeros(nboxes[0], np.bool_)
+        underfull[changed_box_ids] = (
+                ~box_is_leaf[changed_box_ids]
+                & (box_counts_cumul[changed_box_ids] <= max_particles_in_box))
+        merged_box_ids, = np.nonzero(underfull)
+        merged_box_ids = merged_box_ids[
+                (merged_box_ids == 0)
+                | ~underfull[box_parent_ids[merged_box_ids]]]
+
+        logger.debug("tree update: merging %d boxes" % len(merged_box_ids))
+
+        box_is_leaf[merged_box_ids] = True
+
+        # Find, for every box below a merged box, the merged ancestor now
+        # holding its particles.
+        box_owner_ids = np.arange(nboxes[0])
+        box_alive = np.ones(nboxes[0], np.bool_)
+        if len(merged_box_ids):
+            merged = np.zeros(nboxes[0], np.bool_)
+            merged[merged_box_ids] = True
+
+            below_merged = np.zeros(nboxes[0], np.bool_)
+            boxes_by_level = np.argsort(box_levels[:nboxes[0]], kind="stable")
+            level_starts = np.searchsorted(
+                    box_levels[boxes_by_level],
+                    np.arange(box_levels[:nboxes[0]].max() + 2))
+            for level in range(1, len(level_starts) - 1):
+                level_boxes = boxes_by_level[
+                        level_starts[level]:level_starts[level+1]]
+                parents = box_parent_ids[level_boxes]
+                below = merged[parents] | below_merged[parents]
+                below_merged[level_boxes] = below
+                box_owner_ids[level_boxes[below]] = box_owner_ids[
+                        parents[below]]
+
+            box_alive &= ~below_merged
+
+        # }}}
+
+        # {{{ assign particles to leaves
+
+        particle_leaf_ids[old_nparticles:] = added_leaf_ids
+
+        kept = np.ones(old_nparticles, np.bool_)
+        kept[removed_tree_ids] = False
+        kept_tree_ids, = np.nonzero(kept)
+        particle_leaf_ids[kept_tree_ids] = old_leaf_for_tree_ids(kept_tree_ids)
+
+        particle_leaf_ids[kept_tree_ids] = box_owner_ids[
+                particle_leaf_ids[kept_tree_ids]]
+        particle_leaf_ids[old_nparticles:] = box_owner_ids[added_leaf_ids]
+
+        # Remove leaves that became empty.
+        empty_leaves = (
+                box_is_leaf[:nboxes[0]]
+                & (box_counts_cumul[:nboxes[0]] == 0))
+        empty_leaves[0] = False
+        box_alive &= ~empty_leaves
+
+        # }}}
+
+        # {{{ split leaves that became overfull
+
+        # Only leaves that gained particles can become overfull.
+        overfull_leaf_ids = np.unique(added_leaf_ids)
+        overfull_leaf_ids = overfull_leaf_ids[
+                box_alive[overfull_leaf_ids]
+                & box_is_leaf[overfull_leaf_ids]
+                & (box_counts_cumul[overfull_leaf_ids] > max_particles_in_box)]
+
+        logger.debug("tree update: splitting %d boxes"
+                % len(overfull_leaf_ids))
+
+        is_overfull = np.zeros(nboxes[0], np.bool_)
+        is_overfull[overfull_leaf_ids] = True
+        split_particles = [
+                old_nparticles + np.nonzero(is_overfull[added_leaf_ids])[0]]
+        for ibox in overfull_leaf_ids:
+            if ibox < old_nboxes:
+                start = old_leaf_starts[ibox]
+                split_particles.append(
+                        kept_tree_ids[np.searchsorted(kept_tree_ids, start):
+                            np.searchsorted(
+                                kept_tree_ids, start+old_leaf_counts[ibox])])
+
+        split_particles = np.concatenate(split_particles)
+        all_coords = make_obj_array([
+            np.concatenate([old_ax, added_ax])
+            for old_ax, added_ax in zip(htree.sources, added)])
+
+        while len(split_particles):
+            leaf_ids = particle_leaf_ids[split_particles]
+            morton_nrs, _ = get_level_morton_nrs(
+                    make_obj_array([ax[split_particles] for ax in all_coords]),
+                    bbox_min, bbox_max, box_levels[leaf_ids] + 1)
+
+            new_child_keys, inverse = np.unique(
+                    leaf_ids*nchildren + morton_nrs, return_inverse=True)
+            new_ids = add_boxes(
+                    new_child_keys // nchildren, new_child_keys % nchildren)
+            particle_leaf_ids[split_particles] = new_ids[inverse]
+
+            new_counts = np.bincount(inverse)
+            box_counts_cumul[new_ids] = new_counts
+
+            split_particles = split_particles[
+                    new_counts[inverse] > max_particles_in_box]
+
+        nboxes = nboxes[0]
+        box_alive = np.concatenate([
+            box_alive, np.ones(nboxes - len(box_alive), np.bool_)])
+
+        box_changed = np.zeros(nboxes, np.bool_)
+        box_changed[changed_box_ids] = True
+        box_changed[old_nboxes:] = True
+        box_changed[merged_box_ids] = True
+
+        # }}}
+
+        # {{{ compute box particle starts
+
+        # Children of a box occupy its particle range in Morton order.
+
+        alive_box_ids, = np.nonzero(box_alive)
+        alive_box_levels = box_levels[alive_box_ids]
+
+        box_starts = np.zeros(nboxes, np.int64)
+        nlevels = int(alive_box_levels.max()) + 1
+        for level in range(1, nlevels):
+            level_boxes = alive_box_ids[alive_box_levels == level]
+            parents = box_parent_ids[level_boxes]
+            order = np.lexsort((box_morton_nrs[level_boxes], parents))
+            level_boxes = level_boxes[order]
+            parents = parents[order]
+
+            counts = box_counts_cumul[level_boxes]
+            excl_counts = np.cumsum(counts) - counts
+            is_first = np.ones(len(level_boxes), np.bool_)
+            is_first[1:] = parents[1:] != parents[:-1]
+            group_starts = np.maximum.accumulate(
+                    np.where(is_first, np.arange(len(level_boxes)), 0))
+
+            box_starts[level_boxes] = (
+                    box_starts[parents]
+                    + excl_counts - excl_counts[group_starts])
+
+        # }}}
+
+        # {{{ compute new particle order and user ids
+
+        kept_user = np.ones(old_nparticles, np.bool_)
+        kept_user[removed_user_ids] = False
+        new_user_ids_from_old = np.cumsum(kept_user) - 1
+        new_user_ids_from_old[~kept_user] = -1
+        nparticles = len(kept_tree_ids) + nadded
+
+        # indexed like particle_leaf_ids
+        particle_user_ids = np.empty(old_nparticles + nadded, np.int64)
+        particle_user_ids[:old_nparticles] = new_user_ids_from_old[
+                htree.user_source_ids]
+        particle_user_ids[old_nparticles:] = (
+                len(kept_tree_ids) + np.arange(nadded))
+
+        live_particles = np.concatenate([
+            kept_tree_ids, old_nparticles + np.arange(nadded)])
+        live_leaf_ids = particle_leaf_ids[live_particles]
+
+        # Within unchanged leaves, particles keep their relative order.
+        # Everywhere else, they are sorted by user id, as the tree builder
+        # would do.
+        touched = box_changed[live_leaf_ids]
+        untouched_particles = live_particles[~touched]
+        untouched_leaf_ids = live_leaf_ids[~touched]
+
+        new_positions = np.empty(old_nparticles + nadded, np.int64)
+        new_positions[untouched_particles] = (
+                box_starts[untouched_leaf_ids]
+                + untouched_particles - old_leaf_starts[untouched_leaf_ids])
+
+        touched_particles = live_particles[touched]
+        touched_leaf_ids = live_leaf_ids[touched]
+        order = np.lexsort((
+            particle_user_ids[touched_particles],
+            touched_leaf_ids))
+        touched_particles = touched_particles[order]
+        touched_leaf_ids = touched_leaf_ids[order]
+        is_first = np.ones(len(touched_particles), np.bool_)
+        is_first[1:] = touched_leaf_ids[1:] != touched_leaf_ids[:-1]
+        group_starts = np.maximum.accumulate(
+                np.where(is_first, np.arange(len(touched_particles)), 0))
+        new_positions[touched_particles] = (
+                box_starts[touched_leaf_ids]
+                + np.arange(len(touched_particles)) - group_starts)
+
+        tree_order_particles = np.empty(nparticles, np.int64)
+        tree_order_particles[new_positions[live_particles]] = live_particles
+
+        # }}}
+
+        # {{{ renumber boxes
+
+        # Boxes are numbered by level, and within each level by their
+        # position in the particle order.
+
+        order = np.lexsort((box_starts[alive_box_ids], alive_box_levels))
+        alive_box_ids = alive_box_ids[order]
+        alive_box_levels = alive_box_levels[order]
+        new_nboxes = len(alive_box_ids)
+
+        new_box_ids = np.empty(nboxes, np.int64)
+        new_box_ids.fill(-1)
+        new_box_ids[alive_box_ids] = np.arange(new_nboxes)
+
+        from pytools import div_ceil
+        aligned_nboxes = div_ceil(new_nboxes, 32)*32
+
+        box_id_dtype = tree.box_id_dtype
+        particle_id_dtype = tree.particle_id_dtype
+
+        new_box_child_ids = np.zeros((nchildren, aligned_nboxes), box_id_dtype)
+        nonroot = alive_box_ids[1:]
+        new_box_child_ids[
+                box_morton_nrs[nonroot],
+                new_box_ids[box_parent_ids[nonroot]]] = new_box_ids[nonroot]
+
+        new_box_centers = np.zeros((dimensions, aligned_nboxes), tree.coord_dtype)
+        is_old = alive_box_ids < old_nboxes
+        new_box_centers[:, :new_nboxes][:, is_old] = \
+                htree.box_centers[:, alive_box_ids[is_old]]
+        new_box_centers[:, :new_nboxes][:, ~is_old] = compute_box_centers(
+                alive_box_levels[~is_old],
+                box_icoords[alive_box_ids[~is_old]].T,
+                bbox_min, bbox_max)
+
+        new_box_is_leaf = box_is_leaf[alive_box_ids]
+        new_box_counts_cumul = box_counts_cumul[alive_box_ids]
+
+        new_box_flags = np.where(new_box_is_leaf,
+                box_flags_enum.HAS_OWN_SRCNTGTS,
+                box_flags_enum.HAS_CHILDREN).astype(box_flags_enum.dtype)
+
+        new_level_start_box_nrs = np.searchsorted(
+                alive_box_levels, np.arange(nlevels+1)).astype(box_id_dtype)
+
+        # }}}
+
+        if debug:
+            assert (new_box_counts_cumul > 0).all() or new_nboxes == 1
+            assert (new_box_counts_cumul[new_box_is_leaf]
+                    <= max_particles_in_box).all() or new_nboxes == 1
+            assert new_box_counts_cumul[0] == nparticles
+            assert (new_box_ids[merged_box_ids] >= 0).all()
+
+        # {{{ build output
+
+        def to_device(ary, dtype=None):
+            if dtype is not None:
+                ary = ary.astype(dtype)
+            return cl.array.to_device(queue, ary, allocator=allocator)
+
+        user_source_ids = particle_user_ids[tree_order_particles]
+        sorted_target_ids = np.empty(nparticles, np.int64)
+        sorted_target_ids[user_source_ids] = np.arange(nparticles)
+
+        sources = make_obj_array([
+            to_device(ax[tree_order_particles]) for ax in all_coords])
+
+        box_source_starts = to_device(
+                box_starts[alive_box_ids], particle_id_dtype)
+        box_source_counts_cumul = to_device(
+                new_box_counts_cumul, particle_id_dtype)
+        box_source_counts_nonchild = to_device(
+                np.where(new_box_is_leaf, new_box_counts_cumul, 0),
+                particle_id_dtype)
+
+        new_tree = Tree(
+                sources_are_targets=True,
+                sources_have_extent=False,
+                targets_have_extent=False,
+
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                coord_dtype=tree.coord_dtype,
+                box_level_dtype=tree.box_level_dtype,
+
+                root_extent=tree.root_extent,
+                stick_out_factor=tree.stick_out_factor,
+
+                bounding_box=tree.bounding_box,
+                level_start_box_nrs=new_level_start_box_nrs,
+                level_start_box_nrs_dev=to_device(new_level_start_box_nrs),
+
+                sources=sources,
+                targets=sources,
+
+                box_source_starts=box_source_starts,
+                box_source_counts_nonchild=box_source_counts_nonchild,
+                box_source_counts_cumul=box_source_counts_cumul,
+                box_target_starts=box_source_starts,
+                box_target_counts_nonchild=box_source_counts_nonchild,
+                box_target_counts_cumul=box_source_counts_cumul,
+
+                box_parent_ids=to_device(
+                    new_box_ids[box_parent_ids[alive_box_ids]], box_id_dtype),
+                box_child_ids=to_device(new_box_child_ids),
+                box_centers=to_device(new_box_centers),
+                box_levels=to_device(alive_box_levels, tree.box_level_dtype),
+                box_flags=to_device(new_box_flags),
+
+                user_source_ids=to_device(user_source_ids, particle_id_dtype),
+                sorted_target_ids=to_device(
+                    sorted_target_ids, particle_id_dtype),
+
+                _is_pruned=True,
+                is_balanced=False,
+                # The root box is kept, and with it the unit cell.
+                is_periodic=getattr(tree, "is_periodic", False),
+                looseness=0,
+                ordering="morton",
+                ).with_queue(None)
+
+        update_info = TreeUpdateInfo(
+                new_box_ids_from_old=to_device(
+                    new_box_ids[:old_nboxes], box_id_dtype),
+                changed_box_ids=to_device(
+                    np.sort(new_box_ids[box_changed & (new_box_ids >= 0)]),
+                    box_id_dtype),
+                new_user_ids_from_old=to_device(
+                    new_user_ids_from_old, particle_id_dtype),
+                ).with_queue(None)
+
+        logger.info("tree update: complete (%d -> %d boxes)"
+                % (old_nboxes, new_nboxes))
+
+        return new_tree, update_info, cl.enqueue_marker(queue)
+
+        # }}}
+
+# }}}
+
+
+# {{{ loose tree updater
+
+class LooseTreeUpdater(object):
+    """Moves the particles of a :class:`boxtree.Tree` with nonzero
+    :attr:`boxtree.Tree.looseness`, without changing its boxes.
+
+    Each particle stays in the box it was sorted into for as long as it lies
+    within that box scaled by ``1 + looseness`` about its center. Only the
+    particle coordinates of the tree are replaced, so that traversals (see
+    :class:`boxtree.traversal.FMMTraversalBuilder`) and other box-based
+    data of the original tree remain valid for the updated one. Once a
+    particle has moved further, the tree needs to be rebuilt by
+    :class:`boxtree.TreeBuilder`.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        """
+        :arg context: A :class:`pyopencl.Context`.
+        """
+        self.context = context
+
+    @memoize_method_in_context
+    def get_escaped_particle_finder(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype, box_level_dtype):
+        from boxtree.tools import AXIS_NAMES
+        from boxtree.tree_build_kernels import LOOSE_PARTICLE_ESCAPE_FINDER_TPL
+
+        return LOOSE_PARTICLE_ESCAPE_FINDER_TPL.build(self.context,
+                type_aliases=(
+                    ("particle_id_t", particle_id_dtype),
+                    ("box_id_t", box_id_dtype),
+                    ("box_level_t", box_level_dtype),
+                    ("coord_t", coord_dtype),
+                    ),
+                var_values=(
+                    ("axis_names", AXIS_NAMES[:dimensions]),
+                    ))
+
+    def __call__(self, queue, tree, particles, targets=None,
+            allocator=None, wait_for=None):
+        """
+        :arg queue: a :class:`pyopencl.CommandQueue` instance
+        :arg tree: a :class:`boxtree.Tree` with nonzero
+            :attr:`boxtree.Tree.looseness`, such as one returned by an
+            earlier call.
+        :arg particles: an object array of (XYZ) point coordinate arrays
+            with the new positions of the sources (or particles, if
+            :attr:`boxtree.Tree.sources_are_targets`) of *tree*, in
+            :ref:`user order <particle-orderings>`.
+        :arg targets: Like *particles*, but for the targets. Must be given
+            if and only if *tree* has separate targets.
+        :arg wait_for: may either be *None* or a list of :class:`pyopencl.Event`
+            instances for whose completion this command waits before starting
+            execution.
+
+        :returns: a tuple ``(tree, event)``, where *tree* is the updated
+            :class:`boxtree.Tree`, or *None* if some particle has left the
+            enlarged extent of its box, so that the tree must be rebuilt.
+            *event* is a :class:`pyopencl.Event` for dependency management.
+        """
+
+        # (Trees stored before looseness existed don't have it.)
+        looseness = getattr(tree, "looseness", 0)
+        if not looseness:
+            raise ValueError("only allowed on trees with nonzero looseness")
+
+        if (targets is None) != tree.sources_are_targets:
+            raise ValueError("targets must be given if and only if the tree "
+                    "has separate targets")
+
+        dimensions = tree.dimensions
+
+        parts = [(particles, tree.nsources, tree.user_source_ids,
+            tree.box_source_starts, tree.box_source_counts_nonchild)]
+        if targets is not None:
+            parts.append((targets, tree.ntargets, tree.sorted_target_ids,
+                tree.box_target_starts, tree.box_target_counts_nonchild))
+
+        for coords, nparticles, _, _, _ in parts:
+            if len(coords) != dimensions:
+                raise ValueError("particle coordinates have the wrong number "
+                        "of dimensions")
+            for coord in coords:
+                if coord.shape != (nparticles,):
+                    raise ValueError("particle coordinate arrays must keep "
+                            "the number of particles of the tree")
+                if coord.dtype != tree.coord_dtype:
+                    raise TypeError("dtypes of coordinate arrays and the tree "
+                            "must agree")
+
+        if wait_for:
+            cl.wait_for_events(wait_for)
+
+        finder = self.get_escaped_particle_finder(dimensions, tree.coord_dtype,
+                tree.particle_id_dtype, tree.box_id_dtype, tree.box_level_dtype)
+
+        have_escaped_particles = cl.array.zeros(queue, (), np.int32,
+                allocator=allocator)
+        events = []
+
+        # {{{ gather coordinates into tree order and check boxes
+
+        tree_order_coords = []
+        for coords, _, tree_order_user_ids, box_starts, box_counts_nonchild \
+                in parts:
+            sorted_coords = make_obj_array([
+                cl.array.take(coord, tree_order_user_ids, queue=queue)
+                for coord in coords])
+            tree_order_coords.append(sorted_coords)
+
+            evt = finder(
+                    box_starts, box_counts_nonchild,
+                    tree.box_centers, tree.box_levels, tree.aligned_nboxes,
+                    tree.root_extent, looseness,
+                    have_escaped_particles, *sorted_coords,
+                    queue=queue, range=slice(tree.nboxes))
+            events.append(evt)
+
+        # }}}
+
+        cl.wait_for_events(events)
+        if have_escaped_particles.get():
+            logger.info("loose tree update: particles escaped, "
+                    "rebuild needed")
+            return None, cl.enqueue_marker(queue)
+
+        sources = tree_order_coords[0]
+        if targets is None:
+            new_targets = sources
+        else:
+            new_targets = tree_order_coords[1]
+
+        return (tree.copy(sources=sources, targets=new_targets)
+                .with_queue(None), cl.enqueue_marker(queue))
+
+# }}}
+
+# vim: foldmethod=marker:filetype=pyopencl
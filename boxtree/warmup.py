@@ -0,0 +1,176 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2017 Andreas Kloeckner and contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+from six.moves import range
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pytools.obj_array import make_obj_array
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Compiling kernels ahead of time
+-------------------------------
+
+:mod:`boxtree` generates its OpenCL kernels for the specific dimension,
+data types, and tree kind at hand, and it compiles them on first use.
+Generated kernels are shared among all builders (:class:`boxtree.TreeBuilder`,
+:class:`boxtree.traversal.FMMTraversalBuilder`, ...) using the same
+:class:`pyopencl.Context`, so that creating a new builder does not cause
+kernels to be compiled again.
+
+Across processes, compiled programs are reused through the persistent
+program caches of PyOpenCL and of the OpenCL implementation, which are
+keyed on the generated source code and the device. To keep short-running
+jobs from paying for code generation and compilation at a point where it
+hurts (or to populate these caches ahead of time, e.g. when setting up a
+batch of jobs), :func:`warmup` may be used to build all needed kernel
+variants in one go.
+
+.. autofunction:: warmup
+"""
+
+
+WARMUP_MODES = ("particles", "non_adaptive", "sources_and_targets", "extent")
+
+
+def _make_warmup_particles(queue, dimensions, coord_dtype, nlevels):
+    """Return particles that, with *max_particles_in_box* set to 1, result in
+    a tree with roughly *nlevels* levels.
+    """
+    # One particle at -1, the others at 2**-i (i.e. ever closer together)
+    # on the diagonal.
+    coords = np.empty(nlevels, dtype=coord_dtype)
+    coords[0] = -1
+    coords[1:] = 2.0**-np.arange(nlevels-1)
+
+    return make_obj_array([
+        cl.array.to_device(queue, coords)
+        for i in range(dimensions)])
+
+
+def warmup(context, dimensions=(2, 3), dtypes=(np.float64,),
+        modes=("particles",), id_dtypes=(np.int32,), stick_out_factor=0.25,
+        max_nlevels=20, queue=None):
+    """Generate and compile the kernels of :class:`boxtree.TreeBuilder`,
+    :class:`boxtree.traversal.FMMTraversalBuilder`,
+    :class:`boxtree.area_query.AreaQueryBuilder`,
+    :class:`boxtree.area_query.PeerListFinder`, and
+    :class:`boxtree.geo_lookup.LeavesToBallsLookupBuilder` for all
+    combinations of the given parameters by running them on small
+    inputs.
+
+    :arg context: A :class:`pyopencl.Context`.
+    :arg dimensions: A sequence of dimension counts.
+    :arg dtypes: A sequence of coordinate dtypes.
+    :arg modes: A sequence of tree kinds, each one of
+
+        * ``"particles"``: no distinction between sources and targets,
+        * ``"non_adaptive"``: as above, with ``kind="non-adaptive"``,
+        * ``"sources_and_targets"``: separate sources and targets,
+        * ``"extent"``: separate sources and targets that have
+          radii, with *stick_out_factor*.
+
+    :arg id_dtypes: A sequence of dtypes used as both *particle_id_dtype* and
+        *box_id_dtype*.
+    :arg max_nlevels: Some kernels are generated for a maximum number of
+        tree levels (rounded up). Kernels are generated for trees of up to
+        this many levels. Non-adaptive trees are only built with few levels,
+        their traversals use the same kernels as those of adaptive trees.
+    :arg queue: A :class:`pyopencl.CommandQueue` on *context*, or *None* to
+        use a new one.
+    """
+
+    for mode in modes:
+        if mode not in WARMUP_MODES:
+            raise ValueError("unknown warmup mode '%s'" % mode)
+
+    if queue is None:
+        queue = cl.CommandQueue(context)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.area_query import AreaQueryBuilder
+    from boxtree.geo_lookup import LeavesToBallsLookupBuilder
+
+    tb = TreeBuilder(context)
+    tg = FMMTraversalBuilder(context)
+    aqb = AreaQueryBuilder(context)
+    lblb = LeavesToBallsLookupBuilder(context)
+
+    from time import time
+    start_time = time()
+
+    for dims in dimensions:
+        for coord_dtype in dtypes:
+            coord_dtype = np.dtype(coord_dtype)
+
+            for id_dtype in id_dtypes:
+                for mode in modes:
+                    # Kernels depend on the number of levels in steps of 5.
+                    for nlevels in range(5, max_nlevels+1, 5):
+                        if mode == "non_adaptive" and nlevels > 5:
+                            break
+
+                        particles = _make_warmup_particles(
+                                queue, dims, coord_dtype, nlevels)
+                        nparticles = len(particles[0])
+
+                        max_particles_in_box = 1
+
+                        kwargs = {}
+                        if mode == "non_adaptive":
+                            kwargs["kind"] = "non-adaptive"
+                        if mode in ["sources_and_targets", "extent"]:
+                            kwargs["targets"] = make_obj_array([
+                                x.copy() for x in particles])
+                            # each location holds a source and a target
+                            max_particles_in_box = 2
+                        if mode == "extent":
+                            radii = cl.array.zeros(
+                                    queue, nparticles, coord_dtype)
+                            kwargs["source_radii"] = radii
+                            kwargs["target_radii"] = radii
+                            kwargs["stick_out_factor"] = stick_out_factor
+
+                        tree, _ = tb(queue, particles,
+                                max_particles_in_box=max_particles_in_box,
+                                particle_id_dtype=id_dtype, box_id_dtype=id_dtype,
+                                **kwargs)
+                        tg(queue, tree)
+
+                        ball_radii = cl.array.empty(
+                                queue, nparticles, coord_dtype).fill(0.1)
+                        aqb(queue, tree, particles, ball_radii)
+                        lblb(queue, tree, particles, ball_radii)
+
+    queue.finish()
+    logger.info("warmup complete after %g s" % (time() - start_time))
+
+# vim: foldmethod=marker
@@ -0,0 +1,133 @@
+from __future__ import absolute_import, division, print_function
+
+# Compare the k nearest neighbor search of boxtree.area_query.KNNBuilder
+# with a brute-force kernel that checks every source for every query point.
+# (The timings of KNNBuilder include the peer list build, but not the tree
+# build.)
+#
+# Usage: python knn_benchmark.py [dims [k]]
+
+import sys
+from time import time
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+
+from boxtree import TreeBuilder
+from boxtree.area_query import KNNBuilder
+from boxtree.tools import make_normal_particle_array
+
+ctx = cl.create_some_context()
+queue = cl.CommandQueue(ctx)
+
+dims = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+nqueries = 10**4
+nrounds = 3
+
+BRUTE_FORCE_KERNEL_TPL = """
+    #define K %(k)d
+
+    kernel void knn_brute_force(
+        int nsources,
+        %(coord_args)s,
+        global int *knn_ids,
+        global double *knn_dists)
+    {
+        int iquery = get_global_id(0);
+
+        double dists[K];
+        int ids[K];
+        for (int j = 0; j < K; ++j)
+        {
+            dists[j] = INFINITY;
+            ids[j] = -1;
+        }
+
+        for (int isrc = 0; isrc < nsources; ++isrc)
+        {
+            double dist = %(dist_sq)s;
+            if (dist >= dists[K-1])
+                continue;
+
+            // insertion into the sorted list
+            int j = K-1;
+            for (; j > 0 && dists[j-1] > dist; --j)
+            {
+                dists[j] = dists[j-1];
+                ids[j] = ids[j-1];
+            }
+            dists[j] = dist;
+            ids[j] = isrc;
+        }
+
+        for (int j = 0; j < K; ++j)
+        {
+            knn_ids[K*iquery + j] = ids[j];
+            knn_dists[K*iquery + j] = sqrt(dists[j]);
+        }
+    }
+    """
+
+axis_names = ["x", "y", "z"][:dims]
+brute_force_knl = cl.Program(ctx, BRUTE_FORCE_KERNEL_TPL % dict(
+    k=k,
+    coord_args=", ".join(
+        "global const double *src_%s, global const double *query_%s"
+        % (ax, ax) for ax in axis_names),
+    dist_sq=" + ".join(
+        "(src_%s[isrc] - query_%s[iquery]) * (src_%s[isrc] - query_%s[iquery])"
+        % (ax, ax, ax, ax) for ax in axis_names),
+    )).build().knn_brute_force
+
+tb = TreeBuilder(ctx)
+knnb = KNNBuilder(ctx)
+
+queries = make_normal_particle_array(queue, nqueries, dims, np.float64, seed=12)
+
+
+def time_min(f):
+    # warm up, including kernel compilation
+    result = f()
+
+    elapsed = []
+    for i in range(nrounds):
+        queue.finish()
+        start = time()
+        result = f()
+        queue.finish()
+        elapsed.append(time() - start)
+
+    return min(elapsed), result
+
+
+print("%10s %8s %8s %12s %12s %8s" % (
+    "nsources", "nlevels", "nboxes", "brute [s]", "tree [s]", "match"))
+
+for nsources in [10**4, 10**5, 3*10**5]:
+    sources = make_normal_particle_array(queue, nsources, dims, np.float64)
+    tree, _ = tb(queue, sources, max_particles_in_box=30)
+
+    def brute_force():
+        knn_ids = cl.array.empty(queue, (nqueries, k), np.int32)
+        knn_dists = cl.array.empty(queue, (nqueries, k), np.float64)
+
+        args = []
+        for iaxis in range(dims):
+            args.extend([sources[iaxis].data, queries[iaxis].data])
+
+        brute_force_knl(queue, (nqueries,), None,
+                np.int32(nsources), *(args + [knn_ids.data, knn_dists.data]))
+        return knn_dists
+
+    def tree_knn():
+        knn, _ = knnb(queue, tree, queries, k, particle_order="user")
+        return knn.nearest_particle_distances
+
+    brute_force_time, brute_force_dists = time_min(brute_force)
+    tree_time, tree_dists = time_min(tree_knn)
+
+    print("%10d %8d %8d %12.4f %12.4f %8s" % (
+        nsources, tree.nlevels, tree.nboxes, brute_force_time, tree_time,
+        np.allclose(brute_force_dists.get(), tree_dists.get(queue=queue))))
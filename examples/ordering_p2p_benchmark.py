@@ -0,0 +1,141 @@
+from __future__ import absolute_import, division, print_function
+
+# Compare Morton and Hilbert box orderings (see the *ordering* argument of
+# TreeBuilder) on the direct (particle-to-particle) interactions of an FMM.
+#
+# For each ordering, this reports the mean distance in memory (in particles)
+# between the sources of consecutively visited source boxes, when target
+# boxes are processed in order, and the time taken by a simple P2P kernel
+# with one work item per target box.
+#
+# Usage: python ordering_p2p_benchmark.py [dims [max_particles_in_box]]
+
+import sys
+from time import time
+
+import numpy as np
+import pyopencl as cl
+
+from boxtree import TreeBuilder
+from boxtree.traversal import FMMTraversalBuilder
+from boxtree.tools import make_normal_particle_array
+
+ctx = cl.create_some_context()
+queue = cl.CommandQueue(ctx)
+
+dims = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+max_particles_in_box = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+nrounds = 3
+
+P2P_KERNEL_TPL = """
+    kernel void p2p(
+        global const int *target_boxes,
+        global const int *neighbor_source_boxes_starts,
+        global const int *neighbor_source_boxes_lists,
+        global const int *box_source_starts,
+        global const int *box_source_counts_nonchild,
+        %(coord_args)s,
+        global double *potential)
+    {
+        int itgt_box = get_global_id(0);
+        int tgt_ibox = target_boxes[itgt_box];
+
+        int tgt_start = box_source_starts[tgt_ibox];
+        int tgt_stop = tgt_start + box_source_counts_nonchild[tgt_ibox];
+
+        for (int itgt = tgt_start; itgt < tgt_stop; ++itgt)
+        {
+            double result = 0;
+
+            for (int i = neighbor_source_boxes_starts[itgt_box];
+                    i < neighbor_source_boxes_starts[itgt_box + 1]; ++i)
+            {
+                int src_ibox = neighbor_source_boxes_lists[i];
+                int src_start = box_source_starts[src_ibox];
+                int src_stop = src_start + box_source_counts_nonchild[src_ibox];
+
+                for (int isrc = src_start; isrc < src_stop; ++isrc)
+                {
+                    double dist_sq = %(dist_sq)s;
+                    if (dist_sq)
+                        result += rsqrt(dist_sq);
+                }
+            }
+
+            potential[itgt] = result;
+        }
+    }
+    """
+
+axis_names = "xyz"[:dims]
+p2p_knl = cl.Program(ctx, P2P_KERNEL_TPL % dict(
+    coord_args=", ".join(
+        "global const double *%s" % ax for ax in axis_names),
+    dist_sq=" + ".join(
+        "(%s[itgt] - %s[isrc]) * (%s[itgt] - %s[isrc])" % (4*(ax,))
+        for ax in axis_names),
+    )).build().p2p
+
+tb = TreeBuilder(ctx)
+tg = FMMTraversalBuilder(ctx)
+
+
+def get_mean_source_jump(tree, trav):
+    tree = tree.get(queue=queue)
+    trav = trav.get(queue=queue)
+
+    visited_boxes = []
+    for itgt_box in range(len(trav.target_boxes)):
+        start, stop = trav.neighbor_source_boxes_starts[itgt_box:itgt_box+2]
+        visited_boxes.extend(trav.neighbor_source_boxes_lists[start:stop])
+
+    visited_starts = tree.box_source_starts[np.array(visited_boxes)]
+    return np.mean(np.abs(np.diff(visited_starts.astype(np.int64))))
+
+
+print("%10s %8s | %14s %14s | %12s %12s" % (
+    "nparticles", "nboxes", "morton jump", "hilbert jump",
+    "morton [s]", "hilbert [s]"))
+
+for nparticles in [10**4, 10**5, 10**6]:
+    particles = make_normal_particle_array(queue, nparticles, dims, np.float64)
+
+    jumps = {}
+    timings = {}
+    for ordering in ["morton", "hilbert"]:
+        tree, _ = tb(queue, particles, max_particles_in_box=max_particles_in_box,
+                ordering=ordering)
+        trav, _ = tg(queue, tree)
+
+        jumps[ordering] = get_mean_source_jump(tree, trav)
+
+        if tree.box_id_dtype != np.int32 or tree.particle_id_dtype != np.int32:
+            raise RuntimeError("the P2P kernel needs 32-bit ids")
+
+        potential = cl.array.empty(queue, nparticles, np.float64)
+        p2p_args = (
+                [trav.target_boxes, trav.neighbor_source_boxes_starts,
+                    trav.neighbor_source_boxes_lists, tree.box_source_starts,
+                    tree.box_source_counts_nonchild]
+                + list(tree.sources)
+                + [potential])
+        p2p_args = [ary.data for ary in p2p_args]
+        global_size = (len(trav.target_boxes),)
+
+        # warm up
+        p2p_knl(queue, global_size, None, *p2p_args)
+
+        elapsed = []
+        for i in range(nrounds):
+            queue.finish()
+            start = time()
+            p2p_knl(queue, global_size, None, *p2p_args)
+            queue.finish()
+            elapsed.append(time() - start)
+
+        timings[ordering] = min(elapsed)
+
+    print("%10d %8d | %14.1f %14.1f | %12.4f %12.4f" % (
+        nparticles, tree.nboxes,
+        jumps["morton"], jumps["hilbert"],
+        timings["morton"], timings["hilbert"]))
@@ -0,0 +1,50 @@
+from __future__ import absolute_import, division, print_function
+
+# Compare the tree build engines of TreeBuilder.
+#
+# Usage: python tree_build_benchmark.py [dims [max_particles_in_box]]
+
+import sys
+from time import time
+
+import numpy as np
+import pyopencl as cl
+
+from boxtree import TreeBuilder
+from boxtree.tools import make_normal_particle_array
+
+ctx = cl.create_some_context()
+queue = cl.CommandQueue(ctx)
+
+dims = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+max_particles_in_box = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+nrounds = 3
+
+tb = TreeBuilder(ctx)
+
+print("%10s %8s %8s %12s %12s" % (
+    "nparticles", "nlevels", "nboxes", "level [s]", "morton [s]"))
+
+for nparticles in [10**4, 10**5, 10**6, 4*10**6]:
+    particles = make_normal_particle_array(queue, nparticles, dims, np.float64)
+
+    timings = {}
+    for engine in ["level", "morton"]:
+        # warm up, including kernel compilation
+        tree, _ = tb(queue, particles, max_particles_in_box=max_particles_in_box,
+                engine=engine)
+
+        elapsed = []
+        for i in range(nrounds):
+            queue.finish()
+            start = time()
+            tree, _ = tb(queue, particles,
+                    max_particles_in_box=max_particles_in_box, engine=engine)
+            queue.finish()
+            elapsed.append(time() - start)
+
+        timings[engine] = min(elapsed)
+
+    print("%10d %8d %8d %12.4f %12.4f" % (
+        nparticles, tree.nlevels, tree.nboxes,
+        timings["level"], timings["morton"]))
@@ -245,6 +245,543 @@ def test_tree_connectivity(ctx_getter, dims, sources_are_targets):
 # }}}
 
 
+# {{{ 64-bit id test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_traversal_with_64bit_ids(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 10**4, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+
+    trees = []
+    travs = []
+    for id_dtype in [np.int32, np.int64]:
+        tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+                particle_id_dtype=id_dtype, box_id_dtype=id_dtype, debug=True)
+        trav, _ = tg(queue, tree, debug=True)
+        trees.append(tree)
+        travs.append(trav.get(queue=queue))
+
+    ref_trav, trav = travs
+
+    for name in [
+            "source_boxes", "target_boxes",
+            "target_or_target_parent_boxes",
+            "colleagues_starts", "colleagues_lists",
+            "neighbor_source_boxes_starts", "neighbor_source_boxes_lists",
+            "sep_siblings_starts", "sep_siblings_lists",
+            "sep_smaller_starts", "sep_smaller_lists",
+            "sep_bigger_starts", "sep_bigger_lists",
+            ]:
+        ref_ary = getattr(ref_trav, name)
+        ary = getattr(trav, name)
+        assert ary.dtype == np.int64, name
+        assert (ref_ary == ary).all(), name
+
+    from boxtree.area_query import AreaQueryBuilder
+    from boxtree.geo_lookup import LeavesToBallsLookupBuilder
+
+    ball_centers = [ax[:100] for ax in targets]
+    ball_radii = cl.array.empty(queue, 100, dtype).fill(0.1)
+
+    for builder_cls, name in [
+            (AreaQueryBuilder, "leaves_near_ball_starts"),
+            (LeavesToBallsLookupBuilder, "balls_near_box_starts"),
+            ]:
+        builder = builder_cls(ctx)
+        results = [
+                builder(queue, tree, ball_centers, ball_radii)[0]
+                .get(queue=queue)
+                for tree in trees]
+        assert getattr(results[1], name).dtype == np.int64
+        assert (getattr(results[0], name) == getattr(results[1], name)).all()
+
+# }}}
+
+
+# {{{ balanced tree test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_balanced_tree_traversal(ctx_getter, dims, sources_are_targets):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, 5000, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, 3000, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=10,
+            balanced=True, debug=True)
+    assert tree.is_balanced
+
+    trav, _ = tg(queue, tree, debug=True)
+    trav = trav.get(queue=queue)
+
+    # Build the lists the general way for comparison.
+    ref_trav, _ = tg(queue, tree.copy(is_balanced=False), debug=True)
+    ref_trav = ref_trav.get(queue=queue)
+
+    for what, boxes_name in [
+            ("neighbor_source_boxes", "target_boxes"),
+            ("sep_siblings", "target_or_target_parent_boxes"),
+            ("sep_smaller", "target_boxes"),
+            ("sep_bigger", "target_or_target_parent_boxes"),
+            ]:
+        starts = getattr(trav, what + "_starts")
+        lists = getattr(trav, what + "_lists")
+        ref_starts = getattr(ref_trav, what + "_starts")
+        ref_lists = getattr(ref_trav, what + "_lists")
+
+        for ibox in range(len(getattr(trav, boxes_name))):
+            assert (
+                    sorted(lists[starts[ibox]:starts[ibox+1]])
+                    == sorted(ref_lists[ref_starts[ibox]:ref_starts[ibox+1]])
+                    ), (what, ibox)
+
+# }}}
+
+
+# {{{ periodic tree test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("balanced", [False, True])
+def test_periodic_traversal(ctx_getter, dims, balanced):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(15)
+    nsources = 3000
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nsources))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+
+    bbox = (np.zeros(dims), np.ones(dims))
+    tree, _ = tb(queue, sources, max_particles_in_box=10, bbox=bbox,
+            periodic=True, balanced=balanced, debug=True)
+    assert tree.is_periodic
+    assert tree.is_balanced == balanced
+
+    trav, _ = tg(queue, tree, debug=True)
+    tree = tree.get(queue=queue)
+    trav = trav.get(queue=queue)
+
+    assert tree.nimages == 3**dims
+    image_shifts = tree.image_offsets * tree.root_extent
+    assert (image_shifts[tree.nimages // 2] == 0).all()
+
+    from boxtree import box_flags_enum
+    has_own_sources = (
+            tree.box_flags & box_flags_enum.HAS_OWN_SOURCES).astype(bool)
+    levels = tree.box_levels.astype(np.int64)
+    rads = 0.5 * tree.root_extent * 2.**(-levels)
+    centers = tree.box_centers[:, :tree.nboxes].T
+
+    def get_list(what, ibox):
+        start, end = getattr(trav, what + "_starts")[ibox:ibox+2]
+        return set(zip(
+            getattr(trav, what + "_lists")[start:end],
+            getattr(trav, what + "_images")[start:end]))
+
+    # {{{ list 1 matches brute force over all images
+
+    for itgt_box, ibox in enumerate(trav.target_boxes):
+        dists = np.max(np.abs(
+            centers[np.newaxis, :, :] + image_shifts[:, np.newaxis, :]
+            - centers[ibox]), axis=-1)
+        slack = rads[ibox] + rads + np.minimum(rads[ibox], rads)
+        images, boxes = np.where((dists <= slack + 1e-12) & has_own_sources)
+
+        assert get_list("neighbor_source_boxes", itgt_box) \
+                == set(zip(boxes, images))
+
+    # }}}
+
+    # {{{ lists 1-4 of each target box and its parents cover all images once
+
+    target_or_target_parent_box_nrs = np.empty(tree.nboxes, np.int64)
+    target_or_target_parent_box_nrs[trav.target_or_target_parent_boxes] = \
+            np.arange(trav.ntarget_or_target_parent_boxes)
+
+    for itgt_box, ibox in enumerate(trav.target_boxes):
+        nsources_seen = 0
+        for box, _ in get_list("neighbor_source_boxes", itgt_box):
+            nsources_seen += tree.box_source_counts_nonchild[box]
+        for box, _ in get_list("sep_smaller", itgt_box):
+            nsources_seen += tree.box_source_counts_cumul[box]
+
+        jbox = ibox
+        while True:
+            itgt_or_parent = target_or_target_parent_box_nrs[jbox]
+            for box, _ in get_list("sep_siblings", itgt_or_parent):
+                nsources_seen += tree.box_source_counts_cumul[box]
+            for box, _ in get_list("sep_bigger", itgt_or_parent):
+                nsources_seen += tree.box_source_counts_nonchild[box]
+
+            if jbox == 0:
+                break
+            jbox = tree.box_parent_ids[jbox]
+
+        assert nsources_seen == tree.nimages * nsources, ibox
+
+    # }}}
+
+    with pytest.raises(ValueError):
+        tb(queue, sources, max_particles_in_box=10, periodic=True)
+    with pytest.raises(ValueError):
+        tb(queue, sources, max_particles_in_box=10, periodic=True,
+                bbox=(np.zeros(dims), np.arange(1, dims+1)))
+
+# }}}
+
+
+# {{{ loose tree traversal test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_loose_tree_traversal(ctx_getter, dims, sources_are_targets):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    looseness = 0.25
+
+    sources = make_normal_particle_array(queue, 3000, dims, dtype, seed=15)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(queue, 3000, dims, dtype, seed=16)
+
+    from boxtree import TreeBuilder, LooseTreeUpdater
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=10,
+            looseness=looseness, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+    trav = trav.get(queue=queue)
+
+    assert trav.sep_close_smaller_starts is not None
+    assert trav.sep_close_bigger_starts is not None
+
+    # {{{ move each particle close to the corners of the enlarged box extent
+
+    htree = tree.get(queue=queue)
+    levels = htree.box_levels.astype(np.int64)
+    rads = 0.5 * htree.root_extent * 2.**(-levels)
+    centers = htree.box_centers[:, :htree.nboxes].T
+
+    rng = np.random.RandomState(17)
+
+    def move(coords, user_ids, box_starts, box_counts_nonchild):
+        tree_order_coords = np.empty((dims, len(user_ids)))
+        for ibox in range(htree.nboxes):
+            start = box_starts[ibox]
+            stop = start + box_counts_nonchild[ibox]
+            tree_order_coords[:, start:stop] = (
+                    centers[ibox][:, np.newaxis]
+                    + (1 + looseness) * rads[ibox]
+                    * rng.choice([-1, 1], (dims, stop-start))
+                    * rng.uniform(0.9, 1, (dims, stop-start)))
+
+        user_order_coords = np.empty_like(tree_order_coords)
+        user_order_coords[:, user_ids] = tree_order_coords
+        return [cl.array.to_device(queue, ax) for ax in user_order_coords]
+
+    moved_sources = move(sources, htree.user_source_ids,
+            htree.box_source_starts, htree.box_source_counts_nonchild)
+    if sources_are_targets:
+        moved_targets = None
+    else:
+        moved_targets = move(targets, htree.sorted_target_ids,
+                htree.box_target_starts, htree.box_target_counts_nonchild)
+
+    tree, _ = LooseTreeUpdater(ctx)(queue, tree, moved_sources, moved_targets)
+    tree = tree.get(queue=queue)
+
+    # }}}
+
+    # {{{ particles in far lists (3 and 4) are separated by the smaller box
+
+    srcs = np.array(list(tree.sources)).T
+    tgts = np.array(list(tree.targets)).T
+
+    def check_separated(tgt_box, src_box):
+        start = tree.box_target_starts[tgt_box]
+        tgt = tgts[start:start + tree.box_target_counts_cumul[tgt_box]]
+        start = tree.box_source_starts[src_box]
+        src = srcs[start:start + tree.box_source_counts_cumul[src_box]]
+
+        dists = np.max(np.abs(
+            tgt[:, np.newaxis, :] - src[np.newaxis, :, :]), axis=-1)
+        gap = min(rads[tgt_box], rads[src_box])
+        assert (dists >= (1 - 1e-12) * gap).all(), (tgt_box, src_box)
+
+    for itgt_box, ibox in enumerate(trav.target_boxes):
+        start, end = trav.sep_smaller_starts[itgt_box:itgt_box+2]
+        for jbox in trav.sep_smaller_lists[start:end]:
+            check_separated(ibox, jbox)
+
+    for itgt_box, ibox in enumerate(trav.target_or_target_parent_boxes):
+        start, end = trav.sep_bigger_starts[itgt_box:itgt_box+2]
+        for jbox in trav.sep_bigger_lists[start:end]:
+            check_separated(ibox, jbox)
+
+    # }}}
+
+# }}}
+
+
+# {{{ save/load test
+
+def assert_records_equal(rec_a, rec_b):
+    assert type(rec_a) is type(rec_b)
+
+    for name in rec_a.__class__.fields:
+        try:
+            a = getattr(rec_a, name)
+        except AttributeError:
+            assert not hasattr(rec_b, name), name
+            continue
+        b = getattr(rec_b, name)
+
+        if name == "tree":
+            assert_records_equal(a, b)
+        elif isinstance(a, (tuple, np.ndarray)) and (
+                isinstance(a, tuple) or a.dtype == object):
+            assert len(a) == len(b), name
+            for a_i, b_i in zip(a, b):
+                assert a_i.dtype == b_i.dtype, name
+                assert (a_i == b_i).all(), name
+        elif isinstance(a, np.ndarray):
+            assert a.dtype == b.dtype, name
+            assert a.shape == b.shape, name
+            # compare bitwise, uninitialized padding may contain NaNs
+            assert a.tobytes() == b.tobytes(), name
+        else:
+            assert type(a) is type(b), name
+            assert a == b, name
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_save_load(ctx_getter, dims, tmpdir):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 3000
+    ntargets = 2000
+    dtype = np.float64
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from pyopencl.clrandom import PhiloxGenerator
+    rng = PhiloxGenerator(ctx, seed=13)
+    source_radii = 2**rng.uniform(queue, nsources, dtype=dtype, a=-10, b=0)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, targets=targets, source_radii=source_radii,
+            stick_out_factor=0.1, max_particles_in_box=30, debug=True)
+
+    from boxtree.tree import link_point_sources
+    point_source_starts = cl.array.arange(queue, 0, 2*nsources+1, 2,
+            dtype=tree.particle_id_dtype)
+    point_sources = make_normal_particle_array(queue, 2*nsources, dims, dtype,
+            seed=15)
+    tree = link_point_sources(queue, tree, point_source_starts, point_sources,
+            debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    from boxtree.storage import save, load
+    save(trav, str(tmpdir.join("trav")), queue=queue)
+    save(tree, str(tmpdir.join("tree")), queue=queue)
+
+    host_trav = trav.get(queue=queue)
+
+    # {{{ load to host
+
+    loaded_trav = load(str(tmpdir.join("trav")))
+    assert isinstance(loaded_trav.tree.box_source_starts, np.memmap)
+    assert_records_equal(host_trav, loaded_trav)
+
+    loaded_tree = load(str(tmpdir.join("tree")), mmap=False)
+    assert not isinstance(loaded_tree.box_source_starts, np.memmap)
+    assert_records_equal(host_trav.tree, loaded_tree)
+
+    # }}}
+
+    # {{{ load to device
+
+    loaded_trav = load(str(tmpdir.join("trav")), queue=queue)
+    assert isinstance(loaded_trav.colleagues_lists, cl.array.Array)
+    assert isinstance(loaded_trav.tree.sources[0], cl.array.Array)
+    assert isinstance(loaded_trav.tree.level_start_box_nrs, np.ndarray)
+    assert_records_equal(host_trav, loaded_trav.get(queue=queue))
+
+    # A loaded tree must be usable for building traversals.
+    trav2, _ = tg(queue, loaded_trav.tree, debug=True)
+    assert_records_equal(host_trav, trav2.get(queue=queue))
+
+    # }}}
+
+# }}}
+
+
+# {{{ concurrent list build test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_concurrent_traversal(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    nparticles = 5000
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=15)
+    targets = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=16)
+    radii = cl.array.empty(queue, nparticles, dtype).fill(1e-3)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, particles, targets=targets, source_radii=radii,
+            stick_out_factor=0.1, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, debug=True)
+
+    from boxtree.profiling import Profiler
+    profiler = Profiler(queue)
+    concurrent_trav, evt = tg(queue, tree, profiler=profiler, concurrent=True)
+    evt.wait()
+
+    assert_records_equal(trav.get(queue=queue), concurrent_trav.get(queue=queue))
+
+    # The list builds on other queues are recorded, too.
+    summary = profiler.get_summary()
+    assert ("host", "traversal build", "separated bigger (list 4)") in summary
+
+# }}}
+
+
+# {{{ profiling test
+
+@pytest.mark.opencl
+def test_profiling(ctx_getter, tmpdir):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    dims = 2
+    nparticles = 5000
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=15)
+    targets = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=16)
+    radii = cl.array.empty(queue, nparticles, dtype).fill(1e-3)
+
+    from boxtree.profiling import Profiler
+    with pytest.raises(ValueError):
+        Profiler(cl.CommandQueue(ctx))
+
+    profiler = Profiler(queue)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    # Use sources with extent, so that there are close lists to merge.
+    tree, _ = tb(queue, particles, targets=targets, source_radii=radii,
+            stick_out_factor=0.1, max_particles_in_box=30,
+            profiler=profiler)
+    tb(queue, particles, max_particles_in_box=30, engine="morton",
+            profiler=profiler)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    trav, _ = tg(queue, tree, profiler=profiler)
+    trav.merge_close_lists(queue, profiler=profiler)
+
+    from boxtree.area_query import AreaQueryBuilder
+    ball_radii = cl.array.empty(queue, nparticles, dtype).fill(0.01)
+    AreaQueryBuilder(ctx)(queue, tree, particles, ball_radii, profiler=profiler)
+
+    summary = profiler.get_summary()
+    categories = set(category for _, category, _ in summary)
+    assert categories == set(["tree build", "traversal build",
+        "merge close lists", "peer list finder", "area query"])
+
+    kinds = set(kind for kind, _, _ in summary)
+    assert kinds == set(["kernel", "sync", "host", "allocation"])
+
+    assert ("kernel", "tree build", "compute box info") in summary
+    assert ("kernel", "tree build", "sort by morton key") in summary
+    assert ("host", "traversal build", "colleagues") in summary
+    assert ("kernel", "merge close lists", "write merged lists") in summary
+
+    for (kind, _, _), (count, total) in summary.items():
+        assert count > 0
+        assert total >= 0
+
+    records = profiler.get_records()
+    assert all(
+            rec1.start <= rec2.start for rec1, rec2 in zip(records, records[1:]))
+
+    trace_file = str(tmpdir.join("trace.json"))
+    profiler.dump_chrome_trace(trace_file)
+
+    import json
+    with open(trace_file) as inf:
+        trace = json.load(inf)
+
+    phases = set(evt["ph"] for evt in trace["traceEvents"])
+    assert phases == set(["M", "X", "i", "C"])
+
+# }}}
+
+
 # {{{ visualization helper (not a test)
 
 def plot_traversal(ctx_getter, do_plot=False):
@@ -320,6 +320,105 @@ def test_explicit_refine_weights_particle_tree(ctx_getter, dtype, dims,
             do_plot=do_plot)
 
 
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("engine", ["level", "morton"])
+def test_unit_refine_weights(ctx_getter, dims, engine):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 10**4
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=12)
+    refine_weights = cl.array.zeros(queue, nparticles, np.int32) + 1
+
+    ref_tree, _ = tb(queue, particles, refine_weights=refine_weights,
+            max_leaf_refine_weight=30, engine=engine, debug=True)
+    tree, _ = tb(queue, particles, max_particles_in_box=30, engine=engine,
+            debug=True)
+
+    assert_trees_equal(ref_tree.get(queue=queue), tree.get(queue=queue))
+
+    with pytest.raises(ValueError):
+        tb(queue, particles, refine_weights=refine_weights,
+                max_leaf_refine_weight=0)
+
+    refine_weights[0] = 31
+    with pytest.raises(ValueError):
+        tb(queue, particles, refine_weights=refine_weights,
+                max_leaf_refine_weight=30)
+
+    refine_weights[0] = -1
+    with pytest.raises(ValueError):
+        tb(queue, particles, refine_weights=refine_weights,
+                max_leaf_refine_weight=30)
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("levels_per_sync", [None, 2])
+def test_separate_source_and_target_limits(ctx_getter, dims, levels_per_sync):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 500
+    ntargets = 2*10**4
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    # dense targets over sparse sources
+    sources = make_normal_particle_array(queue, nsources, dims, dtype, seed=12)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_sources_in_box=10, max_targets_in_box=200,
+            levels_per_sync=levels_per_sync, debug=True)
+    tree = tree.get(queue=queue)
+
+    from boxtree.tree import box_flags_enum
+    is_leaf = (tree.box_flags & box_flags_enum.HAS_CHILDREN) == 0
+
+    assert (tree.box_source_counts_cumul[is_leaf] <= 10).all()
+    assert (tree.box_target_counts_cumul[is_leaf] <= 200).all()
+    assert ((tree.box_source_counts_cumul[~is_leaf] > 10)
+            | (tree.box_target_counts_cumul[~is_leaf] > 200)).all()
+
+    # Without a binding target limit, this is the same as weighting only
+    # the sources.
+    refine_weights = cl.array.zeros(queue, nsources + ntargets, np.int32)
+    refine_weights[:nsources] = 1
+
+    ref_tree, _ = tb(queue, sources, targets=targets,
+            refine_weights=refine_weights, max_leaf_refine_weight=10,
+            debug=True)
+    tree, _ = tb(queue, sources, targets=targets,
+            max_sources_in_box=10, max_targets_in_box=ntargets,
+            levels_per_sync=levels_per_sync, debug=True)
+
+    assert_trees_equal(ref_tree.get(queue=queue), tree.get(queue=queue))
+
+    with pytest.raises(ValueError):
+        tb(queue, sources, targets=targets, max_sources_in_box=10)
+
+    with pytest.raises(ValueError):
+        tb(queue, sources, max_sources_in_box=10, max_targets_in_box=200)
+
+    with pytest.raises(ValueError):
+        tb(queue, sources, targets=targets, max_particles_in_box=10,
+                max_sources_in_box=10, max_targets_in_box=200)
+
+    with pytest.raises(NotImplementedError):
+        tb(queue, sources, targets=targets, engine="morton",
+                max_sources_in_box=10, max_targets_in_box=200)
+
+
 @particle_tree_test_decorator
 def test_non_adaptive_particle_tree(ctx_getter, dtype, dims, do_plot=False):
     ctx = ctx_getter()
@@ -331,6 +430,527 @@ def test_non_adaptive_particle_tree(ctx_getter, dtype, dims, do_plot=False):
     run_build_test(builder, queue, dims, dtype, 10**4,
             max_particles_in_box=30, do_plot=do_plot, non_adaptive=True)
 
+
+@particle_tree_test_decorator
+def test_balanced_particle_tree(ctx_getter, dtype, dims, do_plot=False):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    builder = TreeBuilder(ctx)
+
+    run_build_test(builder, queue, dims, dtype, 10**4,
+            max_particles_in_box=30, do_plot=do_plot, balanced=True)
+
+# }}}
+
+
+# {{{ balanced tree test
+
+def get_max_adjacent_leaf_level_difference(tree):
+    from boxtree import box_flags_enum as bfe
+    leaves, = np.where(~tree.box_flags & bfe.HAS_CHILDREN)
+
+    centers = tree.box_centers[:, leaves]
+    levels = tree.box_levels[leaves].astype(np.int32)
+    radii = tree.root_extent / 2**(levels + 1)
+
+    max_dist = np.max(
+            np.abs(centers[:, :, np.newaxis] - centers[:, np.newaxis, :]),
+            axis=0)
+    adjacent = max_dist <= 1.0001 * (radii[:, np.newaxis] + radii[np.newaxis, :])
+
+    level_diff = np.abs(levels[:, np.newaxis] - levels[np.newaxis, :])
+    return np.max(level_diff[adjacent])
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("tree_kind", ["particles", "sources_and_targets"])
+def test_balanced_tree(ctx_getter, dims, tree_kind):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 5000
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=12)
+    kwargs = {"max_particles_in_box": 10}
+    if tree_kind == "sources_and_targets":
+        kwargs["targets"] = make_normal_particle_array(
+                queue, nparticles, dims, dtype, seed=19)
+
+    tree, _ = tb(queue, particles, debug=True, **kwargs)
+    tree = tree.get(queue=queue)
+    assert not tree.is_balanced
+    assert get_max_adjacent_leaf_level_difference(tree) > 1
+
+    balanced_tree, _ = tb(queue, particles, debug=True, balanced=True, **kwargs)
+    balanced_tree = balanced_tree.get(queue=queue)
+    assert balanced_tree.is_balanced
+    assert get_max_adjacent_leaf_level_difference(balanced_tree) == 1
+
+    # Balancing only ever splits boxes.
+    assert balanced_tree.nboxes > tree.nboxes
+    assert balanced_tree.nlevels == tree.nlevels
+
+    sorted_particles = np.array(list(balanced_tree.sources))
+    assert (sorted_particles == np.array([
+        pi.get() for pi in particles])[:, balanced_tree.user_source_ids]).all()
+
+    if tree_kind == "sources_and_targets":
+        with pytest.raises(NotImplementedError):
+            tb(queue, particles, balanced=True,
+                    source_radii=cl.array.zeros(queue, nparticles, dtype),
+                    **kwargs)
+
+    with pytest.raises(NotImplementedError):
+        tb(queue, particles, balanced=True, engine="morton", **kwargs)
+
+# }}}
+
+
+# {{{ batched level loop test
+
+def assert_trees_equal(tree_a, tree_b, exact_box_centers=True):
+    """Compare two trees (after :meth:`boxtree.Tree.get`) field by field."""
+    assert set(tree_a.__class__.fields) == set(tree_b.__class__.fields)
+
+    for name in tree_a.__class__.fields:
+        try:
+            a = getattr(tree_a, name)
+        except AttributeError:
+            continue
+        b = getattr(tree_b, name)
+
+        if name == "bounding_box":
+            for a_i, b_i in zip(a, b):
+                assert (a_i == b_i).all(), name
+        elif isinstance(a, np.ndarray) and a.dtype == object:
+            for a_i, b_i in zip(a, b):
+                assert (a_i == b_i).all(), name
+        elif name == "box_centers":
+            # padding beyond nboxes is uninitialized
+            assert a.shape == b.shape, name
+            if exact_box_centers:
+                assert (a[:, :tree_a.nboxes] == b[:, :tree_b.nboxes]).all(), name
+            else:
+                assert np.allclose(
+                        a[:, :tree_a.nboxes], b[:, :tree_b.nboxes]), name
+        elif isinstance(a, np.ndarray):
+            assert a.shape == b.shape, name
+            assert (a == b).all(), name
+        else:
+            assert a == b, name
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize(("levels_per_sync", "tree_kind"), [
+    ("auto", "particles"),
+    (1, "particles"),
+    (3, "non_adaptive"),
+    (2, "extent"),
+    ])
+def test_batched_level_loop(ctx_getter, dims, levels_per_sync, tree_kind):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    particles = make_normal_particle_array(queue, 10**4, dims, dtype, seed=12)
+    kwargs = {}
+    if tree_kind == "non_adaptive":
+        kwargs["non_adaptive"] = True
+    elif tree_kind == "extent":
+        kwargs["targets"] = make_normal_particle_array(
+                queue, 2*10**4, dims, dtype, seed=19)
+
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        kwargs["source_radii"] = 2**rng.uniform(
+                queue, 10**4, dtype=dtype, a=-10, b=0)
+        kwargs["target_radii"] = 2**rng.uniform(
+                queue, 2*10**4, dtype=dtype, a=-10, b=0)
+
+    ref_tree, _ = tb(queue, particles, max_particles_in_box=30,
+            debug=True, **kwargs)
+    # Use a small initial guess to exercise growing the box storage.
+    tree, _ = tb(queue, particles, max_particles_in_box=30,
+            levels_per_sync=levels_per_sync, nboxes_guess=5, **kwargs)
+
+    assert_trees_equal(ref_tree.get(queue=queue), tree.get(queue=queue))
+
+# }}}
+
+
+# {{{ morton engine test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("tree_kind", [
+    "particles", "non_adaptive", "refine_weights", "sources_and_targets",
+    "single_box"])
+def test_morton_engine(ctx_getter, dims, tree_kind):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 10**4
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=12)
+    kwargs = {"max_particles_in_box": 30}
+    if tree_kind == "non_adaptive":
+        kwargs["non_adaptive"] = True
+    elif tree_kind == "refine_weights":
+        from pyopencl.clrandom import PhiloxGenerator
+        rng = PhiloxGenerator(queue.context, seed=13)
+        del kwargs["max_particles_in_box"]
+        kwargs["refine_weights"] = rng.uniform(
+                queue, nparticles, dtype=np.int32, a=0, b=10)
+        kwargs["max_leaf_refine_weight"] = 100
+    elif tree_kind == "sources_and_targets":
+        kwargs["targets"] = make_normal_particle_array(
+                queue, 2*10**4, dims, dtype, seed=19)
+    elif tree_kind == "single_box":
+        kwargs["max_particles_in_box"] = nparticles
+
+    ref_tree, _ = tb(queue, particles, debug=True, **kwargs)
+    tree, _ = tb(queue, particles, debug=True, engine="morton", **kwargs)
+
+    assert_trees_equal(ref_tree.get(queue=queue), tree.get(queue=queue))
+
+    if tree_kind == "sources_and_targets":
+        with pytest.raises(NotImplementedError):
+            tb(queue, particles, engine="morton",
+                    source_radii=cl.array.zeros(queue, nparticles, dtype),
+                    **kwargs)
+
+# }}}
+
+
+# {{{ hilbert ordering test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_hilbert_ordering(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    for kwargs in [{}, {"levels_per_sync": 2}]:
+        run_build_test(tb, queue, dims, np.float64, 10**4,
+                max_particles_in_box=30, do_plot=False, ordering="hilbert",
+                **kwargs)
+
+    # one particle at the center of each box of a full tree with 4 levels
+    nlevels = 4
+    grid = (np.arange(2**(nlevels-1)) + 0.5) / 2**(nlevels-1)
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue, ax.ravel().copy())
+        for ax in np.meshgrid(*(dims*[grid]))])
+
+    tree, _ = tb(queue, particles, max_particles_in_box=1, ordering="hilbert",
+            bbox=(np.zeros(dims), np.ones(dims)), debug=True)
+    tree = tree.get(queue=queue)
+    assert tree.nlevels == nlevels
+
+    centers = tree.box_centers[:, :tree.nboxes]
+
+    # Consecutive boxes on each level are neighbors.
+    for level in range(1, nlevels):
+        start, stop = tree.level_start_box_nrs[level:level+2]
+        assert stop - start == 2**(dims*level)
+        steps = np.abs(np.diff(centers[:, start:stop], axis=1))
+        assert (np.sum(steps > 1e-12, axis=0) == 1).all()
+        assert np.allclose(np.max(steps, axis=0), 2.**(-level))
+
+    # Children are still indexed by Morton number.
+    from boxtree.tools import padded_bin
+    for ibox in range(tree.level_start_box_nrs[-2]):
+        for mnr in range(2**dims):
+            child = tree.box_child_ids[mnr, ibox]
+            offset = np.array(
+                    [int(bit) for bit in padded_bin(mnr, dims)]) - 0.5
+            child_extent = tree.root_extent * 2.**(-int(tree.box_levels[child]))
+            assert np.allclose(centers[:, child],
+                    centers[:, ibox] + offset*child_extent)
+
+    with pytest.raises(NotImplementedError):
+        tb(queue, particles, max_particles_in_box=1, ordering="hilbert",
+                engine="morton")
+
+# }}}
+
+
+# {{{ workspace test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("tree_kind", ["particles", "extent", "batched", "morton"])
+def test_tree_build_workspace(ctx_getter, dims, tree_kind):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    dtype = np.float64
+    nparticles = 10**4
+
+    from boxtree import TreeBuilder, TreeBuildWorkspace
+    from boxtree.profiling import Profiler
+    tb = TreeBuilder(ctx)
+    workspace = TreeBuildWorkspace()
+
+    def build(seed, **extra_kwargs):
+        particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+                seed=seed)
+
+        kwargs = {"max_particles_in_box": 30}
+        if tree_kind == "extent":
+            kwargs["targets"] = make_normal_particle_array(
+                    queue, nparticles, dims, dtype, seed=seed+100)
+            kwargs["source_radii"] = cl.array.empty(
+                    queue, nparticles, dtype).fill(1e-3)
+            kwargs["stick_out_factor"] = 0.1
+        elif tree_kind == "batched":
+            kwargs["levels_per_sync"] = 2
+        elif tree_kind == "morton":
+            kwargs["engine"] = "morton"
+        kwargs.update(extra_kwargs)
+
+        tree, _ = tb(queue, particles, **kwargs)
+        return tree
+
+    trees = []
+    for seed in [12, 13, 12]:
+        profiler = Profiler(queue)
+        ref_tree = build(seed).get(queue=queue)
+        tree = build(seed, workspace=workspace, profiler=profiler)
+        assert_trees_equal(ref_tree, tree.get(queue=queue))
+        trees.append((ref_tree, tree))
+
+    if tree_kind != "morton":
+        assert workspace.nboxes_guess >= max(tree.nboxes for _, tree in trees)
+
+    # The last build did not need any new temporary storage.
+    assert workspace.nbytes > 0
+    assert not [rec for rec in profiler.get_records()
+            if rec.kind == "allocation" and rec.name == "workspace"]
+
+    # Trees must not share storage with the workspace.
+    for ref_tree, tree in trees:
+        assert_trees_equal(ref_tree, tree.get(queue=queue))
+
+    workspace.clear()
+    assert workspace.nbytes == 0
+
+# }}}
+
+
+# {{{ level cap test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("cap", ["max_levels", "min_box_extent"])
+def test_level_cap(ctx_getter, dims, cap):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 10**4
+    ncoincident = 100
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    # Without a cap, the coincident particles would be refined until the
+    # level count is exceeded.
+    from pytools.obj_array import make_obj_array
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=12)
+    particles = make_obj_array([
+        cl.array.to_device(queue, np.concatenate([
+            ax.get(), np.full(ncoincident, 0.1, dtype)]))
+        for ax in particles])
+
+    max_particles_in_box = 30
+    kwargs = {"max_particles_in_box": max_particles_in_box}
+    if cap == "max_levels":
+        kwargs["max_levels"] = 9
+    else:
+        # about the size of a box on level 8
+        kwargs["min_box_extent"] = 8 / 2**8
+
+    tree, _ = tb(queue, particles, debug=True, **kwargs)
+    host_tree = tree.get(queue=queue)
+
+    if cap == "max_levels":
+        assert host_tree.nlevels == 9
+    else:
+        min_box_extent = host_tree.root_extent / 2**(host_tree.nlevels - 1)
+        assert min_box_extent >= kwargs["min_box_extent"]
+        assert min_box_extent / 2 < kwargs["min_box_extent"]
+
+    from boxtree import box_flags_enum as bfe
+    leaf_counts = host_tree.box_source_counts_nonchild[
+            (host_tree.box_flags & bfe.HAS_CHILDREN) == 0]
+    assert leaf_counts.max() > max_particles_in_box
+    assert leaf_counts.sum() == nparticles + ncoincident
+
+    for other_kwargs in [{"levels_per_sync": 2}, {"engine": "morton"}]:
+        other_kwargs.update(kwargs)
+        other_tree, _ = tb(queue, particles, debug=True, **other_kwargs)
+        assert_trees_equal(host_tree, other_tree.get(queue=queue))
+
+    # Structures depending on the tree must cope with overfull leaves.
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(ctx)
+    tg(queue, tree, debug=True)
+
+    from boxtree.area_query import AreaQueryBuilder
+    aqb = AreaQueryBuilder(ctx)
+    ball_radii = cl.array.empty(queue, nparticles + ncoincident, dtype).fill(0.01)
+    area_query, _ = aqb(queue, tree, particles, ball_radii)
+    area_query = area_query.get(queue=queue)
+
+    # The leaf holding the coincident particles is near each of them.
+    coincident_leaf = host_tree.find_box_nr_for_source(
+            np.where(host_tree.user_source_ids == nparticles)[0][0])
+    starts = area_query.leaves_near_ball_starts
+    assert coincident_leaf in area_query.leaves_near_ball_lists[
+            starts[nparticles]:starts[nparticles+1]]
+
+    with pytest.raises(ValueError):
+        tb(queue, particles, max_particles_in_box=max_particles_in_box,
+                max_levels=0)
+
+# }}}
+
+
+# {{{ given bounding box test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("engine_kwargs", [
+    {}, {"levels_per_sync": 2}, {"engine": "morton"}])
+def test_given_bbox(ctx_getter, dims, engine_kwargs):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nparticles = 10**4
+
+    from boxtree import TreeBuilder, StickyBoundingBox
+    tb = TreeBuilder(ctx)
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype,
+            seed=12)
+
+    def build(particles, **kwargs):
+        tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True,
+                **dict(engine_kwargs, **kwargs))
+        return tree.get(queue=queue)
+
+    # reusing a bounding box yields the same tree
+    ref_tree = build(particles)
+    assert_trees_equal(ref_tree, build(particles, bbox=ref_tree.bounding_box))
+
+    # boxes are extended to cubes
+    bbox_min = np.full(dims, -10.)
+    bbox_max = np.full(dims, 10.)
+    bbox_max[0] = 15
+    tree = build(particles, bbox=(bbox_min, bbox_max))
+    assert tree.root_extent == 25
+    assert (tree.bounding_box[0] == bbox_min).all()
+    assert (tree.bounding_box[1] == bbox_min + 25).all()
+
+    with pytest.raises(ValueError):
+        build(particles, bbox=(ref_tree.bounding_box[0] + 1,
+            ref_tree.bounding_box[1]))
+
+    # sticky bounding boxes are kept while particles stay inside
+    sticky_bbox = StickyBoundingBox(margin=0.1)
+    tree = build(particles, bbox=sticky_bbox)
+    assert sticky_bbox.nupdates == 1
+    assert np.allclose(tree.root_extent, ref_tree.root_extent * 1.2)
+
+    bbox_before = sticky_bbox.bounding_box
+    from pytools.obj_array import make_obj_array
+    tree = build(make_obj_array([0.5*ax for ax in particles]), bbox=sticky_bbox)
+    assert sticky_bbox.nupdates == 1
+    assert sticky_bbox.bounding_box is bbox_before
+    for bbox_a, bbox_b in zip(tree.bounding_box, bbox_before):
+        assert (bbox_a == bbox_b).all()
+
+    tree = build(make_obj_array([2*ax for ax in particles]), bbox=sticky_bbox)
+    assert sticky_bbox.nupdates == 2
+    assert np.allclose(tree.root_extent, 2 * ref_tree.root_extent * 1.2)
+
+# }}}
+
+
+# {{{ id dtype test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize(("particle_id_dtype", "box_id_dtype"), [
+    (np.int64, np.int64),
+    (np.int32, np.int64),
+    ])
+def test_id_dtypes(ctx_getter, dims, particle_id_dtype, box_id_dtype):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    nsources = 10**4
+    ntargets = 2 * 10**4
+
+    sources = make_normal_particle_array(queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    ref_tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+    assert ref_tree.particle_id_dtype == np.int32
+    assert ref_tree.box_id_dtype == np.int32
+
+    tree, _ = tb(queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True,
+            particle_id_dtype=particle_id_dtype, box_id_dtype=box_id_dtype)
+    assert tree.particle_id_dtype == particle_id_dtype
+    assert tree.box_id_dtype == box_id_dtype
+
+    ref_tree = ref_tree.get(queue=queue)
+    tree = tree.get(queue=queue)
+
+    for name in [
+            "level_start_box_nrs",
+            "user_source_ids", "sorted_target_ids",
+            "box_source_starts", "box_source_counts_cumul",
+            "box_target_starts", "box_target_counts_nonchild",
+            "box_parent_ids", "box_child_ids", "box_levels", "box_flags"]:
+        assert (getattr(ref_tree, name) == getattr(tree, name)).all(), name
+
+    assert tree.box_source_starts.dtype == particle_id_dtype
+    assert tree.box_parent_ids.dtype == box_id_dtype
+    assert tree.box_child_ids.dtype == box_id_dtype
+
 # }}}
 
 
@@ -729,6 +1349,795 @@ def test_area_query(ctx_getter, dims, do_plot=False):
         actual = near_leaves
         assert sorted(found) == sorted(actual)
 
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("ball_norm", ["linf", "l2"])
+@pytest.mark.parametrize(("particles", "particle_order", "periodic"), [
+    ("sources", "tree", False),
+    ("targets", "user", False),
+    ("sources", "user", True),
+    ])
+def test_area_query_particles(ctx_getter, dims, ball_norm, particles,
+        particle_order, periodic):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(17)
+    nsources = 10**4
+    ntargets = 3 * 10**3
+    nballs = 300
+
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nsources) ** (i + 1))
+        for i in range(dims)])
+    targets = make_obj_array([
+        cl.array.to_device(queue, rng.rand(ntargets))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            bbox=(np.zeros(dims), np.ones(dims)), periodic=periodic,
+            debug=True)
+
+    ball_centers_host = rng.rand(nballs, dims)
+    ball_radii_host = 0.15 * rng.rand(nballs)
+    ball_centers = make_obj_array([
+        cl.array.to_device(queue, ball_centers_host[:, i].copy())
+        for i in range(dims)])
+    ball_radii = cl.array.to_device(queue, ball_radii_host)
+
+    from boxtree.area_query import AreaQueryBuilder
+    area_query, _ = AreaQueryBuilder(ctx)(
+            queue, tree, ball_centers, ball_radii, particles=particles,
+            ball_norm=ball_norm, particle_order=particle_order)
+    area_query = area_query.get(queue=queue)
+
+    host_tree = tree.get(queue=queue)
+
+    if particle_order == "tree":
+        particles_host = np.vstack(getattr(host_tree, particles))
+    elif particles == "sources":
+        particles_host = np.array([x.get() for x in sources])
+    else:
+        particles_host = np.array([x.get() for x in targets])
+
+    # [image, axis, particle]
+    image_particles = (
+            particles_host[np.newaxis]
+            + host_tree.root_extent
+            * host_tree.image_offsets[:, :, np.newaxis])
+
+    for ball_nr in range(nballs):
+        diffs = np.abs(
+                image_particles - ball_centers_host[ball_nr, :, np.newaxis])
+        if ball_norm == "linf":
+            dists = np.max(diffs, axis=1)
+        else:
+            dists = np.sqrt(np.sum(diffs**2, axis=1))
+        images, particle_nrs = np.where(dists <= ball_radii_host[ball_nr])
+
+        start, end = area_query.particles_in_ball_starts[ball_nr:ball_nr+2]
+        found_particles = area_query.particles_in_ball_lists[start:end]
+        if periodic:
+            found = set(zip(found_particles,
+                area_query.particles_in_ball_images[start:end]))
+            assert found == set(zip(particle_nrs, images))
+        else:
+            assert area_query.particles_in_ball_images is None
+            assert sorted(found_particles) == sorted(particle_nrs)
+
+# }}}
+
+
+# {{{ peer list test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+def test_peer_lists(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    # Particles on a thin shell give a deep, non-uniform tree.
+    rng = np.random.RandomState(15)
+    nparticles = 3000
+    particles = rng.randn(dims, nparticles)
+    particles /= np.sqrt(np.sum(particles**2, axis=0))
+    particles *= 1 + 1e-4 * rng.rand(nparticles)
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue, particles[i].copy())
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, particles, max_particles_in_box=4, debug=True)
+
+    from boxtree.area_query import PeerListFinder
+    peer_lists, _ = PeerListFinder(ctx)(queue, tree)
+
+    tree = tree.get(queue=queue)
+    peer_lists = peer_lists.get(queue=queue)
+
+    from boxtree import box_flags_enum
+    has_children = (tree.box_flags & box_flags_enum.HAS_CHILDREN) != 0
+    box_rads = tree.root_extent / 2**(tree.box_levels.astype(np.float64) + 1)
+
+    def is_adjacent(ibox, other_boxes):
+        # like is_adjacent_or_overlapping() for boxes at most as big as
+        # other_boxes
+        dists = np.max(np.abs(
+            tree.box_centers[:, other_boxes].T - tree.box_centers[:, ibox]),
+            axis=-1)
+        return dists <= box_rads[other_boxes] + 2 * box_rads[ibox]
+
+    for ibox in range(tree.nboxes):
+        level = tree.box_levels[ibox]
+
+        candidates, = np.where(tree.box_levels <= level)
+        candidates = candidates[is_adjacent(ibox, candidates)]
+        if level > 0:
+            candidates = candidates[candidates != 0]
+
+        expected = []
+        for cand in candidates:
+            children = tree.box_child_ids[:, cand]
+            children = children[children != 0]
+            if (tree.box_levels[cand] == level or not has_children[cand]
+                    or not is_adjacent(ibox, children).any()):
+                expected.append(cand)
+
+        start, end = peer_lists.peer_list_starts[ibox:ibox+2]
+        found = peer_lists.peer_lists[start:end]
+        assert len(found) == len(set(found))
+        assert sorted(found) == sorted(expected), ibox
+
+# }}}
+
+
+# {{{ periodic area query test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.geo_lookup
+@pytest.mark.parametrize("dims", [2, 3])
+def test_periodic_area_query(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(12)
+    nparticles = 10**4
+    nballs = 10**3
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nparticles))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30,
+            bbox=(np.zeros(dims), np.ones(dims)), periodic=True, debug=True)
+
+    ball_centers_host = rng.rand(nballs, dims)
+    ball_radii_host = 0.2 * rng.rand(nballs)
+    ball_centers = make_obj_array([
+        cl.array.to_device(queue, ball_centers_host[:, i].copy())
+        for i in range(dims)])
+    ball_radii = cl.array.to_device(queue, ball_radii_host)
+
+    from boxtree.area_query import AreaQueryBuilder
+    area_query, _ = AreaQueryBuilder(ctx)(
+            queue, tree, ball_centers, ball_radii)
+    area_query = area_query.get(queue=queue)
+
+    from boxtree.geo_lookup import LeavesToBallsLookupBuilder
+    lbl, _ = LeavesToBallsLookupBuilder(ctx)(
+            queue, tree, ball_centers, ball_radii)
+    lbl = lbl.get(queue=queue)
+
+    tree = tree.get(queue=queue)
+
+    from boxtree import box_flags_enum
+    leaf_boxes, = np.where(
+            (tree.box_flags & box_flags_enum.HAS_CHILDREN) == 0)
+    leaf_rads = 0.5 * tree.root_extent * 2.**(
+            -tree.box_levels[leaf_boxes].astype(np.int64))
+    # [image, leaf, axis]
+    leaf_centers = (
+            tree.box_centers[:, leaf_boxes].T[np.newaxis, :, :]
+            + tree.root_extent * tree.image_offsets[:, np.newaxis, :])
+
+    expected_balls_near_box = dict((ibox, set()) for ibox in leaf_boxes)
+
+    for ball_nr in range(nballs):
+        dists = np.max(
+                np.abs(leaf_centers - ball_centers_host[ball_nr]), axis=-1)
+        images, ileaves = np.where(dists < ball_radii_host[ball_nr] + leaf_rads)
+        expected = set(zip(leaf_boxes[ileaves], images))
+
+        start, end = area_query.leaves_near_ball_starts[ball_nr:ball_nr+2]
+        assert set(zip(
+            area_query.leaves_near_ball_lists[start:end],
+            area_query.leaves_near_ball_images[start:end])) == expected
+
+        for ibox, image in expected:
+            expected_balls_near_box[ibox].add((ball_nr, image))
+
+    for ibox in leaf_boxes:
+        start, end = lbl.balls_near_box_starts[ibox:ibox+2]
+        assert set(zip(
+            lbl.balls_near_box_lists[start:end],
+            lbl.balls_near_box_images[start:end])) \
+                    == expected_balls_near_box[ibox]
+
+
+@pytest.mark.opencl
+@pytest.mark.geo_lookup
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("periodic", [False, True])
+def test_box_hash_table(ctx_getter, dims, periodic):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(15)
+    nparticles = 10**4
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nparticles) ** (i + 1))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30,
+            bbox=(np.zeros(dims), np.ones(dims)), periodic=periodic,
+            debug=True)
+
+    from boxtree.geo_lookup import BoxHashTableBuilder
+    htb = BoxHashTableBuilder(ctx)
+    table, _ = htb(queue, tree)
+
+    host_tree = tree.get(queue=queue)
+    bbox_min, _ = host_tree.bounding_box
+    levels = host_tree.box_levels.astype(np.int32)
+    # [axis, box]
+    coords = np.floor(
+            (host_tree.box_centers[:, :host_tree.nboxes]
+                - bbox_min[:, np.newaxis])
+            / host_tree.root_extent * 2.**levels).astype(np.int32)
+
+    def find_boxes(levels, coords):
+        box_ids, _ = htb.find_boxes(queue, table,
+                cl.array.to_device(queue, levels),
+                [cl.array.to_device(queue, c.copy()) for c in coords])
+        return box_ids.get()
+
+    # Every box is found by its level and coordinates.
+    assert (find_boxes(levels, coords)
+            == np.arange(host_tree.nboxes)).all()
+
+    # Nothing is found below the leaves or outside the tree.
+    from boxtree import box_flags_enum
+    leaves, = np.where(
+            (host_tree.box_flags & box_flags_enum.HAS_CHILDREN) == 0)
+    assert (find_boxes(levels[leaves] + 1, 2 * coords[:, leaves]) == -1).all()
+    assert (find_boxes(levels, coords - (1 << levels)) == -1).all()
+    assert (find_boxes(levels, coords + (1 << levels)) == -1).all()
+
+    # Each particle is found in a leaf containing it.
+    point_box_ids, _ = htb.find_boxes_containing_points(queue, table, particles)
+    point_box_ids = point_box_ids.get()
+    host_particles = np.array([p.get() for p in particles])
+
+    assert (host_tree.box_flags[point_box_ids]
+            & box_flags_enum.HAS_CHILDREN == 0).all()
+    point_box_rads = 0.5 * host_tree.root_extent * 2.**(
+            -host_tree.box_levels[point_box_ids].astype(np.int64))
+    assert (np.abs(host_particles - host_tree.box_centers[:, point_box_ids])
+            <= point_box_rads).all()
+
+    outside_box_ids, _ = htb.find_boxes_containing_points(queue, table,
+            [p + 2 for p in particles])
+    assert (outside_box_ids.get() == -1).all()
+
+    # Neighbors are found at their coordinates.
+    offset = (1,) + (0,) * (dims - 1)
+    neighbor_ids, _ = htb.find_neighbors(queue, table,
+            cl.array.arange(queue, host_tree.nboxes,
+                dtype=host_tree.box_id_dtype),
+            offset)
+    neighbor_ids = neighbor_ids.get()
+
+    box_by_key = dict(
+            ((lev,) + tuple(c), ibox)
+            for ibox, (lev, c) in enumerate(zip(levels, coords.T)))
+    for ibox in range(host_tree.nboxes):
+        neighbor_coords = coords[:, ibox] + np.array(offset)
+        if periodic:
+            neighbor_coords %= 1 << levels[ibox]
+        expected = box_by_key.get(
+                (levels[ibox],) + tuple(neighbor_coords), -1)
+        assert neighbor_ids[ibox] == expected
+
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+def test_point_locator(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(16)
+    nparticles = 10**4
+    npoints = 10**3
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nparticles) ** (i + 1))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30, debug=True)
+    host_tree = tree.get(queue=queue)
+
+    # Some of these are outside the tree.
+    points_host = 1.2 * rng.rand(dims, npoints) - 0.1
+    points = make_obj_array([
+        cl.array.to_device(queue, points_host[i].copy())
+        for i in range(dims)])
+
+    from boxtree.area_query import PointLocator
+    box_ids, _ = PointLocator(ctx)(queue, tree, points)
+    box_ids = box_ids.get()
+
+    assert (box_ids == host_tree.find_box_nrs_for_points(points_host)).all()
+
+    # Compare with the deepest box containing each point.
+    box_levels = host_tree.box_levels.astype(np.int64)
+    box_rads = 0.5 * host_tree.root_extent * 2.**(-box_levels)
+    bbox_min, _ = host_tree.bounding_box
+    for ipoint in range(npoints):
+        lower = host_tree.box_centers[:, :host_tree.nboxes] - box_rads
+        containing, = np.where((
+            (lower <= points_host[:, ipoint, np.newaxis])
+            & (points_host[:, ipoint, np.newaxis] < lower + 2*box_rads)
+            ).all(axis=0))
+
+        if len(containing):
+            assert box_ids[ipoint] == containing[
+                    np.argmax(box_levels[containing])]
+        else:
+            assert box_ids[ipoint] == -1
+
+    # Particles are in the leaves owning them.
+    from boxtree import box_flags_enum
+    particle_box_ids, _ = PointLocator(ctx)(queue, tree, tree.sources)
+    particle_box_ids = particle_box_ids.get()
+    assert (host_tree.box_flags[particle_box_ids]
+            & box_flags_enum.HAS_CHILDREN == 0).all()
+    assert (particle_box_ids == host_tree.find_box_nr_for_source(
+        np.arange(nparticles))).all()
+    assert host_tree.find_box_nr_for_source(17) == particle_box_ids[17]
+
+# }}}
+
+
+# {{{ k nearest neighbors test
+
+@pytest.mark.opencl
+@pytest.mark.area_query
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize(("particles", "particle_order"), [
+    ("sources", "tree"),
+    ("targets", "user"),
+    ])
+def test_knn(ctx_getter, dims, particles, particle_order):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    rng = np.random.RandomState(18)
+    nsources = 10**4
+    ntargets = 3 * 10**3
+    nqueries = 500
+
+    from pytools.obj_array import make_obj_array
+    sources = make_obj_array([
+        cl.array.to_device(queue, rng.rand(nsources) ** (i + 1))
+        for i in range(dims)])
+    targets = make_obj_array([
+        cl.array.to_device(queue, rng.rand(ntargets))
+        for i in range(dims)])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, sources, targets=targets, max_particles_in_box=30,
+            debug=True)
+    host_tree = tree.get(queue=queue)
+
+    # Some of these are outside the tree.
+    queries_host = 1.4 * rng.rand(dims, nqueries) - 0.2
+    queries = make_obj_array([
+        cl.array.to_device(queue, queries_host[i].copy())
+        for i in range(dims)])
+
+    if particle_order == "tree":
+        particles_host = np.vstack(getattr(host_tree, particles))
+    elif particles == "sources":
+        particles_host = np.array([x.get() for x in sources])
+    else:
+        particles_host = np.array([x.get() for x in targets])
+
+    dists = np.sqrt(np.sum(
+        (queries_host[:, :, np.newaxis] - particles_host[:, np.newaxis, :])**2,
+        axis=0))
+    sorted_dists = np.sort(dists, axis=1)
+
+    from boxtree.area_query import KNNBuilder
+    knnb = KNNBuilder(ctx)
+
+    for k in [1, 5, 40]:
+        knn, _ = knnb(queue, tree, queries, k, particles=particles,
+                particle_order=particle_order)
+        knn = knn.get(queue=queue)
+
+        assert knn.nearest_particle_ids.shape == (nqueries, k)
+        assert np.allclose(knn.nearest_particle_distances,
+                sorted_dists[:, :k])
+        assert np.allclose(
+                dists[np.arange(nqueries)[:, np.newaxis],
+                    knn.nearest_particle_ids],
+                sorted_dists[:, :k])
+        for ids in knn.nearest_particle_ids:
+            assert len(set(ids)) == k
+
+    # Fewer particles than neighbors requested
+    few_particles = make_obj_array([
+        cl.array.to_device(queue, rng.rand(5)) for i in range(dims)])
+    few_tree, _ = tb(queue, few_particles, max_particles_in_box=2)
+    knn, _ = knnb(queue, few_tree, queries, 8)
+    knn = knn.get(queue=queue)
+    assert (np.sort(knn.nearest_particle_ids[:, :5], axis=1)
+            == np.arange(5)).all()
+    assert (knn.nearest_particle_ids[:, 5:] == -1).all()
+    assert np.isinf(knn.nearest_particle_distances[:, 5:]).all()
+
+# }}}
+
+
+# {{{ tree update test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_tree_update(ctx_getter, dims, do_plot=False):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    max_particles_in_box = 30
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+    host_particles = np.array([x.get() for x in particles])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=max_particles_in_box,
+            debug=True)
+
+    rng = np.random.RandomState(12)
+
+    # Keep the particles that determine the bounding box, so that building
+    # from scratch yields the same bounding box.
+    pmin = host_particles.min(axis=1)
+    pmax = host_particles.max(axis=1)
+    extreme = np.union1d(
+            np.argmin(host_particles, axis=1),
+            np.argmax(host_particles, axis=1))
+
+    # Remove a clump (to force merging) and some scattered particles.
+    dist = np.max(np.abs(host_particles - host_particles[:, :1]), axis=0)
+    removed = np.union1d(
+            np.nonzero(dist < 0.3)[0],
+            rng.choice(nparticles, nparticles // 20, replace=False))
+    removed = np.setdiff1d(removed, extreme)
+
+    # Add a clump (to force splitting) and some scattered particles.
+    clump_center = 0.5*(pmin + pmax) + 0.1*(pmax - pmin)
+    added = np.concatenate([
+        clump_center[:, np.newaxis] + 1e-3*rng.rand(dims, 200),
+        pmin[:, np.newaxis]
+        + (pmax - pmin)[:, np.newaxis]*rng.rand(dims, nparticles // 20),
+        ], axis=1)
+    added = np.clip(added, pmin[:, np.newaxis], pmax[:, np.newaxis])
+
+    from boxtree import TreeUpdater
+    updater = TreeUpdater(ctx)
+    from pytools.obj_array import make_obj_array
+    updated_tree, update_info, _ = updater(queue, tree, max_particles_in_box,
+            added_particles=make_obj_array(list(added)),
+            removed_user_ids=removed, debug=True)
+
+    # {{{ compare with a tree built from scratch
+
+    new_particles = np.concatenate(
+            [np.delete(host_particles, removed, axis=1), added], axis=1)
+    ref_tree, _ = tb(queue,
+            make_obj_array([
+                cl.array.to_device(queue, x.copy()) for x in new_particles]),
+            max_particles_in_box=max_particles_in_box, debug=True)
+
+    ref_tree = ref_tree.get(queue=queue)
+    updated_tree = updated_tree.get(queue=queue)
+    tree = tree.get(queue=queue)
+    update_info = update_info.get(queue=queue)
+
+    assert (ref_tree.bounding_box[0] == updated_tree.bounding_box[0]).all()
+    assert ref_tree.nboxes == updated_tree.nboxes
+
+    for name in [
+            "level_start_box_nrs",
+            "user_source_ids", "sorted_target_ids",
+            "box_source_starts", "box_source_counts_cumul",
+            "box_source_counts_nonchild",
+            "box_parent_ids", "box_child_ids", "box_levels", "box_flags"]:
+        assert (getattr(ref_tree, name) == getattr(updated_tree, name)).all(), \
+                name
+
+    assert np.allclose(
+            ref_tree.box_centers[:, :ref_tree.nboxes],
+            updated_tree.box_centers[:, :updated_tree.nboxes])
+
+    for ref_ax, upd_ax in zip(ref_tree.sources, updated_tree.sources):
+        assert (ref_ax == upd_ax).all()
+
+    # }}}
+
+    # {{{ check update info
+
+    unchanged = np.ones(updated_tree.nboxes, np.bool_)
+    unchanged[update_info.changed_box_ids] = False
+
+    for old_ibox, new_ibox in enumerate(update_info.new_box_ids_from_old):
+        if new_ibox < 0 or not unchanged[new_ibox]:
+            continue
+
+        old_start = tree.box_source_starts[old_ibox]
+        new_start = updated_tree.box_source_starts[new_ibox]
+        count = tree.box_source_counts_cumul[old_ibox]
+        assert count == updated_tree.box_source_counts_cumul[new_ibox]
+
+        assert (update_info.new_user_ids_from_old[
+                    tree.user_source_ids[old_start:old_start+count]]
+                == updated_tree.user_source_ids[new_start:new_start+count]
+                ).all()
+
+    assert (update_info.new_user_ids_from_old[removed] == -1).all()
+
+    # }}}
+
+    # Hilbert-ordered trees are rejected rather than losing their order.
+    hilbert_tree, _ = tb(queue, particles,
+            max_particles_in_box=max_particles_in_box, ordering="hilbert")
+    assert hilbert_tree.ordering == "hilbert"
+    assert updated_tree.ordering == "morton"
+    with pytest.raises(ValueError):
+        updater(queue, hilbert_tree, max_particles_in_box,
+                removed_user_ids=removed)
+
+# }}}
+
+
+# {{{ loose tree update test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_loose_tree_update(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dtype = np.float64
+    looseness = 0.25
+
+    particles = make_normal_particle_array(queue, 10**4, dims, dtype)
+    host_particles = np.array([x.get() for x in particles])
+
+    from boxtree import TreeBuilder, TreeUpdater, LooseTreeUpdater
+    tb = TreeBuilder(ctx)
+    ltu = LooseTreeUpdater(ctx)
+
+    tree, _ = tb(queue, particles, max_particles_in_box=30,
+            looseness=looseness, debug=True)
+    assert tree.looseness == looseness
+    htree = tree.get(queue=queue)
+
+    # Particles may move by the looseness of the smallest box.
+    min_rad = 0.5 * htree.root_extent * 2.**(-int(htree.box_levels.max()))
+    rng = np.random.RandomState(12)
+    moved = host_particles + 0.99 * looseness * min_rad * rng.uniform(
+            -1, 1, host_particles.shape)
+
+    updated_tree, _ = ltu(queue, tree,
+            [cl.array.to_device(queue, ax) for ax in moved])
+    assert updated_tree is not None
+    updated_tree = updated_tree.get(queue=queue)
+
+    assert updated_tree.looseness == looseness
+    assert updated_tree.nboxes == htree.nboxes
+    assert (updated_tree.box_source_starts == htree.box_source_starts).all()
+    assert (updated_tree.user_source_ids == htree.user_source_ids).all()
+    for iaxis in range(dims):
+        assert (updated_tree.sources[iaxis]
+                == moved[iaxis][htree.user_source_ids]).all()
+        assert (updated_tree.targets[iaxis]
+                == updated_tree.sources[iaxis]).all()
+
+    # Moving one particle across the tree requires a rebuild.
+    moved[:, 0] = htree.bounding_box[1]
+    updated_tree, _ = ltu(queue, tree,
+            [cl.array.to_device(queue, ax) for ax in moved])
+    assert updated_tree is None
+
+    with pytest.raises(ValueError):
+        ltu(queue, tb(queue, particles, max_particles_in_box=30)[0], particles)
+    with pytest.raises(ValueError):
+        TreeUpdater(ctx)(queue, tree, 30, removed_user_ids=np.arange(10))
+    with pytest.raises(ValueError):
+        tb(queue, particles, max_particles_in_box=30, looseness=-1)
+
+# }}}
+
+
+# {{{ chunked tree build test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("max_particles_in_chunk", [500, 10**5])
+def test_chunked_tree_build(ctx_getter, dims, max_particles_in_chunk, tmpdir):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nparticles = 10**4
+    max_particles_in_box = 30
+    dtype = np.float64
+
+    particles = make_normal_particle_array(queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    ref_tree, _ = tb(queue, particles, max_particles_in_box=max_particles_in_box,
+            debug=True)
+
+    # Read the particles from disk.
+    mmap_particles = []
+    for iaxis, x in enumerate(particles):
+        mmap_x = np.lib.format.open_memmap(
+                str(tmpdir.join("particles_%d.npy" % iaxis)), mode="w+",
+                dtype=dtype, shape=(nparticles,))
+        mmap_x[:] = x.get()
+        mmap_particles.append(mmap_x)
+
+    from boxtree import ChunkedTreeBuilder
+    ctb = ChunkedTreeBuilder(ctx)
+    tree, _ = ctb(queue, mmap_particles,
+            max_particles_in_box=max_particles_in_box,
+            max_particles_in_chunk=max_particles_in_chunk,
+            debug=True)
+
+    # (box centers are computed on the host here)
+    assert_trees_equal(ref_tree.get(queue=queue), tree, exact_box_centers=False)
+
+# }}}
+
+
+# {{{ forest build test
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_forest_build(ctx_getter, dims):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    max_particles_in_box = 30
+    dtype = np.float64
+
+    tree_nparticles = [500, 1, 2000, 30, 31, 10**4]
+    tree_particles = [
+            [ax.get() for ax in make_normal_particle_array(
+                queue, n, dims, dtype, seed=itree)]
+            for itree, n in enumerate(tree_nparticles)]
+
+    from pytools.obj_array import make_obj_array
+    particles = make_obj_array([
+        cl.array.to_device(queue,
+            np.concatenate([tp[iaxis] for tp in tree_particles]))
+        for iaxis in range(dims)])
+    tree_particle_starts = np.cumsum([0] + tree_nparticles)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    forest, _ = tb.build_forest(queue, particles, tree_particle_starts,
+            max_particles_in_box=max_particles_in_box, debug=True)
+
+    assert forest.ntrees == len(tree_nparticles)
+
+    forest_host = forest.get(queue=queue)
+    box_tree_ids = forest_host.box_tree_ids
+    for ilevel, level_starts in enumerate(forest_host.tree_level_box_starts):
+        level = forest.root_level + ilevel
+        level_slice = slice(*forest.tree.level_start_box_nrs[level:level+2])
+        assert (np.searchsorted(level_starts, np.arange(
+            level_slice.start, level_slice.stop), side="right") - 1
+            == box_tree_ids[level_slice]).all()
+
+    for itree, tree in enumerate(forest.get_trees(queue)):
+        ref_tree, _ = tb(queue,
+                make_obj_array([
+                    cl.array.to_device(queue, ax)
+                    for ax in tree_particles[itree]]),
+                max_particles_in_box=max_particles_in_box, debug=True)
+
+        # (box centers are computed on the host here)
+        assert_trees_equal(ref_tree.get(queue=queue), tree,
+                exact_box_centers=False)
+
+# }}}
+
+
+# {{{ warmup test
+
+@pytest.mark.opencl
+def test_warmup(ctx_getter, monkeypatch):
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    dims = 2
+    dtype = np.float64
+
+    from boxtree.warmup import warmup
+    warmup(ctx, dimensions=(dims,), dtypes=(dtype,),
+            modes=("particles", "sources_and_targets"), max_nlevels=10,
+            queue=queue)
+
+    sources = make_normal_particle_array(queue, 10**4, dims, dtype)
+    targets = make_normal_particle_array(queue, 10**4, dims, dtype, seed=19)
+    ball_radii = cl.array.empty(queue, 10**4, dtype).fill(0.1)
+
+    # From here on, no kernels should get built, even with new builders.
+    program_builds = []
+    orig_build = cl.Program.build
+
+    def counting_build(self, *args, **kwargs):
+        program_builds.append(self)
+        return orig_build(self, *args, **kwargs)
+
+    monkeypatch.setattr(cl.Program, "build", counting_build)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.area_query import AreaQueryBuilder
+
+    for tree_targets in [None, targets]:
+        tree, _ = TreeBuilder(ctx)(queue, sources, targets=tree_targets,
+                max_particles_in_box=30)
+        assert tree.nlevels <= 10
+        FMMTraversalBuilder(ctx)(queue, tree)
+        AreaQueryBuilder(ctx)(queue, tree, targets, ball_radii)
+
+    assert not program_builds
+
 # }}}
 
 